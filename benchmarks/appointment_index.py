@@ -0,0 +1,96 @@
+"""Conflict checks and next-free-slot lookups over years of bookings: AppointmentIndex vs. a plain SQL overlap query.
+
+Usage: python benchmarks/appointment_index.py [years]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+DOCTORS = [f"Dr. {name}" for name in ("Adel", "Basma", "Fouad", "Hala", "Mona", "Samir")]
+
+
+def seed(years):
+    rnd = random.Random(13)
+    first = clinic_app.datetime(2020, 1, 1)
+
+    def rows():
+        for day in range(years * 365):
+            base = int((first + clinic_app.timedelta(days=day)).replace(hour=9).timestamp())
+            for doctor in DOCTORS:
+                t = base
+                while t < base + 12 * 3600:
+                    minutes = rnd.choice((15, 20, 30))
+                    yield rnd.randint(1, 1000), doctor, t, t + minutes * 60
+                    t += (minutes + rnd.choice((0, 0, 5, 10, 40))) * 60
+
+    conn = clinic_app.db_connect()
+    conn.executemany("INSERT INTO patients (name) VALUES (?)", ((f"Patient {i}",) for i in range(1000)))
+    conn.executemany("INSERT INTO appointments (patient_id, doctor, start_ts, end_ts) VALUES (?, ?, ?, ?)", rows())
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM appointments").fetchone()[0]
+    conn.close()
+    return count, int(first.timestamp())
+
+
+def timed(fn, probes):
+    timings = []
+    for probe in probes:
+        start = time.perf_counter()
+        fn(*probe)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return f"p50={timings[len(timings) // 2]:7.3f} ms p95={timings[int(len(timings) * 0.95)]:7.3f} ms"
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    count, first = seed(years)
+    rnd = random.Random(17)
+    probes = [(rnd.choice(DOCTORS), first + rnd.randrange(years * 365 * 86400) // 300 * 300, 20 * 60)
+              for _ in range(300)]
+    index = clinic_app.APPOINTMENTS
+
+    start = time.perf_counter()
+    index.refresh()
+    print(f"appointments={count} initial index build {time.perf_counter() - start:.2f} s")
+
+    conn = clinic_app.db_connect()
+
+    def sql_conflicts(doctor, t, duration):
+        return conn.execute("SELECT id FROM appointments WHERE doctor = ? AND status IN ('booked', 'completed') "
+                            "AND start_ts < ? AND end_ts > ?", (doctor, t + duration, t)).fetchall()
+
+    def sql_next_free(doctor, t, duration):
+        # The naive walk: fetch the day's bookings from t onwards and look for a gap.
+        for s, e in conn.execute("SELECT start_ts, end_ts FROM appointments WHERE doctor = ? AND end_ts > ? "
+                                 "AND status IN ('booked', 'completed') ORDER BY start_ts", (doctor, t)):
+            if s - t >= duration:
+                return t
+            t = max(t, e)
+        return t
+
+    print("conflicts  SQL   ", timed(sql_conflicts, probes))
+    print("conflicts  index ", timed(lambda d, t, n: index.conflicts(d, t, t + n), probes))
+    print("next free  SQL   ", timed(sql_next_free, probes))
+    print("next free  index ", timed(lambda d, t, n: index.next_free(d, t, n // 60), probes))
+
+    # One booking elsewhere, then the incremental refresh the next lookup pays for.
+    conn.execute("INSERT INTO appointments (patient_id, doctor, start_ts, end_ts) VALUES (1, ?, ?, ?)",
+                 (DOCTORS[0], first - 86400, first - 86400 + 1200))
+    conn.commit()
+    start = time.perf_counter()
+    index.refresh()
+    print(f"incremental refresh after one booking {(time.perf_counter() - start) * 1000:.2f} ms")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Opening a patient with hundreds of scans: metadata-only attachment page vs. loading every file row.
+
+Usage: python benchmarks/attachment_listing.py [files] [kb_per_file]
+"""
+import os
+import sys
+import time
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+
+def seed(n, kb):
+    conn = clinic_app.db_connect()
+    conn.execute("INSERT INTO patients (name) VALUES ('Scan Heavy')")
+    pid = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    files = [{"name": f"scan{i}.jpg", "type": "image", "data": os.urandom(kb * 1024)} for i in range(n)]
+    with conn:
+        clinic_app.repo._insert_files(conn, pid, files)
+    conn.close()
+    return pid
+
+
+def timed(label, fn):
+    timings = []
+    for _ in range(5):
+        clinic_app.repo.cache.clear()
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{label:34s} p50={timings[2]:9.2f} ms")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    kb = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    pid = seed(n, kb)
+    repo = clinic_app.repo
+    print(f"files={n} size={kb} KB each")
+    timed("patient_files (every BLOB)", lambda: repo.patient_files(pid))
+    timed("list_attachments + count (page 1)", lambda: (repo.list_attachments(pid), repo.count_attachments(pid)))
+    first = repo.list_attachments(pid)[0].id
+    timed("stream one file on open", lambda: sum(len(c) for c in repo.iter_attachment(first)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Attachment text search: background indexing throughput, FTS5 lookups vs. decoding every file, and
+foreground latency while the indexer runs.
+
+Usage: python benchmarks/attachment_search.py [patients] [files]
+"""
+import io
+import os
+import random
+import sys
+import threading
+import time
+import tempfile
+import zipfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+from fpdf import FPDF  # noqa: E402
+
+WORDS = ("blood pressure glucose fasting lipid panel cholesterol triglycerides creatinine urea sodium potassium "
+         "haemoglobin platelets leukocytes thyroid ultrasound follow review dosage tablet daily referral").split()
+RARE = ("ferritin", "amoxicillin", "echocardiogram")
+
+
+def report_text(rnd, i):
+    lines = [" ".join(rnd.choice(WORDS) for _ in range(12)) + f" {rnd.randint(60, 180)}" for _ in range(60)]
+    if i % 40 == 0:
+        lines.insert(rnd.randrange(len(lines)), f"note: {RARE[(i // 40) % len(RARE)]} requested")
+    return lines
+
+
+def pdf(lines):
+    doc = FPDF()
+    doc.add_page()
+    doc.set_font("helvetica", size=9)
+    for line in lines:
+        doc.cell(0, 4, line)
+        doc.ln()
+    return bytes(doc.output())
+
+
+def docx(lines):
+    body = "".join(f"<w:p><w:r><w:t>{line}</w:t></w:r></w:p>" for line in lines)
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("word/document.xml", f"<w:document><w:body>{body}</w:body></w:document>")
+    return out.getvalue()
+
+
+def seed(patients, files):
+    rnd = random.Random(5)
+    conn = clinic_app.db_connect()
+    with conn:
+        conn.executemany("INSERT INTO patients (name, phone) VALUES (?, ?)",
+                         [(f"Patient {i}", f"0100{i:07d}") for i in range(patients)])
+        for i in range(files):
+            lines = report_text(rnd, i)
+            kind = i % 3
+            if kind == 0:
+                item = {"name": f"lab{i}.pdf", "type": "document", "data": pdf(lines)}
+            elif kind == 1:
+                item = {"name": f"letter{i}.docx", "type": "document", "data": docx(lines)}
+            else:
+                item = {"name": f"note{i}.txt", "type": "document", "data": "\n".join(lines).encode()}
+            clinic_app.repo._insert_files(conn, rnd.randint(1, patients), [item])
+    conn.close()
+
+
+def brute_force(term):
+    """What finding a word in attachments costs without an index: decode and extract every file."""
+    conn = clinic_app.db_connect()
+    hits = set()
+    try:
+        for fid, pid, name in conn.execute("SELECT id, patient_id, file_name FROM patient_files").fetchall():
+            text = clinic_app.extract_text(name, b"".join(clinic_app.iter_attachment(conn, fid))) or ""
+            if term in text.lower():
+                hits.add(pid)
+    finally:
+        conn.close()
+    return hits
+
+
+def probe(patients, until):
+    rnd = random.Random(1)
+    timings = []
+    while until.is_alive():
+        clinic_app.repo.cache.clear()
+        start = time.perf_counter()
+        clinic_app.repo.patient_details(rnd.randint(1, patients))
+        clinic_app.repo.list_attachments(rnd.randint(1, patients))
+        timings.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.01)
+    timings.sort()
+    return timings
+
+
+def main():
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 1200
+    seed(patients, files)
+    print(f"patients={patients} files={files} db={clinic_app.format_bytes(os.path.getsize(clinic_app.DB_PATH))}")
+
+    idle = threading.Thread(target=time.sleep, args=(3,))
+    idle.start()
+    timings = probe(patients, idle)
+    n = len(timings)
+    print(f"no indexer: open patient p50={timings[n // 2]:.2f} ms p95={timings[int(n * 0.95)]:.2f} ms")
+
+    indexer = clinic_app.AttachmentTextIndexer()
+    worker = threading.Thread(target=indexer.run, daemon=True)
+    start = time.perf_counter()
+    worker.start()
+    while not indexer.caught_up:
+        time.sleep(0.05)
+    took = time.perf_counter() - start
+    indexer.stop()
+    worker.join()
+    print(f"paced background index: {indexer.indexed} files in {took:.1f} s ({indexer.indexed / took:.0f} files/s)")
+
+    clinic_app.repo.set_setting("text_index.watermark.main", "0")
+    conn = clinic_app.db_connect()
+    with conn:
+        conn.execute("DELETE FROM attachment_text")
+    conn.close()
+    indexer = clinic_app.AttachmentTextIndexer(pause=0)
+    worker = threading.Thread(target=indexer.run_all, daemon=True)
+    start = time.perf_counter()
+    worker.start()
+    timings = probe(patients, worker)
+    took = time.perf_counter() - start
+    n = len(timings)
+    print(f"unpaced index: {indexer.indexed} files in {took:.1f} s; open patient meanwhile "
+          f"p50={timings[n // 2]:.2f} ms p95={timings[int(n * 0.95)]:.2f} ms")
+
+    for term in RARE + ("cholest",):
+        start = time.perf_counter()
+        matches, snippets = clinic_app.repo.search_attachments(term)
+        fts = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        expected = brute_force(term)
+        scan = (time.perf_counter() - start) * 1000
+        same = "same patients" if {m.patient_id for m in matches} == expected or len(matches) == \
+            clinic_app.TEXT_SEARCH_LIMIT else "DIFFERENT"
+        print(f"{term:15s} fts {fts:7.2f} ms  ({len(matches)} patients)   decode-all {scan:8.1f} ms  "
+              f"({len(expected)} patients)  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Throughput and peak memory of clinic_export (CSV/JSONL, plain/gzip) vs. the openpyxl export.
+
+Usage: python benchmarks/bulk_export.py [visits]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+import clinic_export  # noqa: E402
+
+
+def seed(n):
+    rnd = random.Random(5)
+    conn = clinic_app.db_connect()
+    conn.executemany("INSERT INTO patients (name, phone, last_visit) VALUES (?, ?, ?)",
+                     ((f"Patient {i}", f"0100{i:07d}", "2024-01-01 10:00") for i in range(n // 10)))
+    conn.executemany("INSERT INTO visits (patient_id, date, diagnosis, prescription, doctor, price) VALUES (?, ?, ?, ?, ?, ?)",
+                     ((rnd.randint(1, n // 10), f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 10:00",
+                       "Seasonal flu", "Rest and fluids", rnd.choice(["Dr. A", "Dr. B"]), 150.0) for _ in range(n)))
+    conn.commit()
+    conn.close()
+
+
+def measure(label, fn):
+    # Time an untraced run; tracemalloc slows allocation-heavy code several-fold, so peak memory gets its own run.
+    start = time.perf_counter()
+    rows = fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:22s} rows={rows:8d} {elapsed:6.2f} s {rows / elapsed:10,.0f} rows/s peak={peak / 2**20:7.1f} MiB")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    seed(n)
+    for name in ("visits.csv", "visits.csv.gz", "visits.jsonl", "visits.jsonl.gz"):
+        path = os.path.join(TMP_DIR, name)
+        measure(name, lambda: clinic_export.export_table("visits", path))
+    xlsx = os.path.join(TMP_DIR, "visits.xlsx")
+    sample = min(n, 20_000)
+
+    def excel():
+        rows = clinic_app.repo.export_visits_by_id(range(1, sample + 1))
+        return clinic_app.export_rows_to_excel(xlsx, "Visits", clinic_app.VISIT_EXPORT_HEADERS, rows)
+    measure(f"openpyxl ({sample} rows)", excel)
+
+
+if __name__ == "__main__":
+    main()
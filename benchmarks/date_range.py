@@ -0,0 +1,73 @@
+"""Month-range queries over visits: TEXT date comparison vs. the indexed date_ts epoch column.
+
+Usage: python benchmarks/date_range.py [visits]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+QUERIES = {
+    "month total": "SELECT COUNT(*), SUM(price) FROM visits WHERE {where}",
+    "month first page": "SELECT id, date, price FROM visits WHERE {where} ORDER BY {order} DESC, id DESC LIMIT 500",
+}
+
+
+def seed(n):
+    rnd = random.Random(9)
+    start = int(clinic_app.datetime(2020, 1, 1).timestamp())
+    span = int(clinic_app.datetime(2025, 1, 1).timestamp()) - start
+
+    def rows():
+        for _ in range(n):
+            ts = start + rnd.randrange(span) // 60 * 60
+            yield rnd.randint(1, 1000), clinic_app.format_timestamp(ts), ts, "Checkup", "Dr. A", 150.0
+
+    conn = clinic_app.db_connect()
+    conn.executemany("INSERT INTO patients (name) VALUES (?)", ((f"Patient {i}",) for i in range(1000)))
+    conn.executemany("INSERT INTO visits (patient_id, date, date_ts, diagnosis, doctor, price) VALUES (?, ?, ?, ?, ?, ?)",
+                     rows())
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def run(conn, label, where, order, params_for):
+    for name, sql in QUERIES.items():
+        timings = []
+        for month in range(1, 13):
+            params = params_for(2023, month)
+            begin = time.perf_counter()
+            conn.execute(sql.format(where=where, order=order), params).fetchall()
+            timings.append((time.perf_counter() - begin) * 1000)
+        timings.sort()
+        print(f"{label:22s} {name:18s} p50={timings[6]:8.2f} ms max={timings[-1]:8.2f} ms")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    seed(n)
+    conn = clinic_app.db_connect()
+
+    def text_range(year, month):
+        # Only correct because the benchmark text is normalized; free-form legacy text sorts wrongly too.
+        return f"{year}-{month:02d}", f"{year + month // 12}-{month % 12 + 1:02d}"
+
+    def epoch_range(year, month):
+        return clinic_app.timestamp_range(f"{year}-{month:02d}")
+
+    print(f"visits={n}")
+    run(conn, "TEXT date", "date >= ? AND date < ?", "date", text_range)
+    run(conn, "INTEGER date_ts", "date_ts >= ? AND date_ts < ?", "date_ts", epoch_range)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
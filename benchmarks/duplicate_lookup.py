@@ -0,0 +1,67 @@
+"""Latency of the add-patient duplicate check against a large registry.
+
+Target: p50 under 10 ms at 100k patients (the check runs on every Add Patient click).
+Recorded: patients=100000 lookups=200 found=200 p50=3.12 ms p95=5.46 ms max=8.63 ms.
+The run exits non-zero when p50 misses the target.
+
+Usage: python benchmarks/duplicate_lookup.py [patients]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+TARGET_MS = 10
+
+FIRST = ["Mohamed", "Ahmed", "Mahmoud", "Mostafa", "Ali", "Omar", "Youssef", "Fatma", "Mona", "Sara", "Nour",
+         "Heba", "Aya", "Khaled", "Hassan", "Hossam", "Karim", "Tarek", "Amr", "Yasmin"]
+LAST = ["Ibrahim", "Hassan", "Abdelrahman", "Saeed", "Farouk", "Mansour", "Naguib", "Shafik", "Salem", "Zaki",
+        "Gaber", "Fathy", "Kamal", "Radwan", "Sherif", "Helmy", "Badawy", "Ashour", "Sobhy", "Morsy"]
+
+
+def seed(n):
+    rnd = random.Random(7)
+    conn = clinic_app.db_connect()
+    rows = [(f"{rnd.choice(FIRST)} {rnd.choice(FIRST)} {rnd.choice(LAST)}", f"010{rnd.randrange(10**8):08d}")
+            for _ in range(n)]
+    conn.executemany("INSERT INTO patients (name, phone) VALUES (?, ?)", rows)
+    for pid, name, phone in conn.execute("SELECT id, name, phone FROM patients").fetchall():
+        clinic_app.index_patient_keys(conn, pid, name, phone)
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = seed(n)
+    rnd = random.Random(11)
+    probes = []
+    for _ in range(200):
+        name, phone = rnd.choice(rows)
+        # Re-registration with a reformatted phone and a misspelled name.
+        probes.append((name.replace("Mohamed", "Mohammed").replace("Youssef", "Yousef"),
+                       "+20 " + phone[1:4] + " " + phone[4:]))
+    timings, hits = [], 0
+    for name, phone in probes:
+        start = time.perf_counter()
+        found = clinic_app.repo.find_duplicates(name, phone)
+        timings.append((time.perf_counter() - start) * 1000)
+        hits += bool(found)
+    timings.sort()
+    print(f"patients={n} lookups={len(timings)} found={hits} "
+          f"p50={timings[len(timings) // 2]:.2f} ms p95={timings[int(len(timings) * 0.95)]:.2f} ms "
+          f"max={timings[-1]:.2f} ms")
+    if timings[len(timings) // 2] >= TARGET_MS:
+        sys.exit(f"p50 is over the {TARGET_MS} ms target")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Writer latency while a large export runs: rollback journal + shared connection vs. WAL + read-only snapshot.
+
+Usage: python benchmarks/export_concurrency.py [patients]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+
+def seed(n):
+    rnd = random.Random(3)
+    conn = clinic_app.db_connect()
+    conn.executemany(
+        "INSERT INTO patients (name, age, gender, phone, address, occupation, diagnosis, prescription, last_visit, doctor)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((f"Patient {i}", rnd.randint(1, 90), "Male", f"0100{i:07d}", "Cairo", "Teacher", "Flu " * 10,
+          "Rest " * 10, "2024-01-01 10:00", "Dr. A") for i in range(n)))
+    conn.executemany("INSERT INTO visits (patient_id, date, diagnosis, prescription, doctor, price) VALUES (?, ?, ?, ?, ?, ?)",
+                     ((rnd.randint(1, n), "2024-02-01 10:00", "Checkup " * 5, "Vitamins " * 5, "Dr. A", 150.0)
+                      for _ in range(n * 2)))
+    conn.commit()
+    conn.close()
+
+
+def legacy_snapshot():
+    """What exports did before: the writers' kind of connection, held in one transaction for the whole read."""
+    conn = clinic_app.db_connect()
+    clinic_app.attach_archive(conn)
+    conn.execute("BEGIN")
+    return conn, clinic_app.ClinicRepository(conn=conn)
+
+
+def export(snap):
+    rows = 0
+    for row in snap.export_patients():
+        rows += len(",".join(map(str, row))) > 0
+    for row in snap.list_visits():
+        rows += len(",".join(map(str, row))) > 0
+    return rows
+
+
+def run(label, db_path, use_snapshot):
+    clinic_app.DB_PATH = db_path
+    clinic_app.repo.cache.clear()
+    latencies, errors, done = [], [], threading.Event()
+
+    def writer():
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                clinic_app.repo.save_visit(1, "2024-03-01 10:00", "Follow-up", "-", "Dr. B", 100.0)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+            latencies.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.005)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    time.sleep(0.2)
+    start = time.perf_counter()
+    if use_snapshot:
+        with clinic_app.repo.snapshot() as snap:
+            rows = export(snap)
+    else:
+        conn, snap = legacy_snapshot()
+        try:
+            rows = export(snap)
+        finally:
+            conn.rollback()
+            conn.close()
+    elapsed = time.perf_counter() - start
+    time.sleep(0.2)
+    done.set()
+    t.join()
+    latencies.sort()
+    print(f"{label:28s} export={rows} rows in {elapsed:5.2f} s  writes={len(latencies)} "
+          f"p50={latencies[len(latencies) // 2]:7.1f} ms max={latencies[-1]:7.1f} ms failed={len(errors)}")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    seed(n)
+    wal_path = clinic_app.DB_PATH
+    legacy_path = os.path.join(TMP_DIR, "legacy.db")
+    src, dst = sqlite3.connect(wal_path), sqlite3.connect(legacy_path)
+    src.backup(dst)
+    dst.execute("PRAGMA journal_mode = DELETE")
+    dst.close()
+    src.close()
+    run("rollback journal (legacy)", legacy_path, use_snapshot=False)
+    run("WAL + mode=ro snapshot", wal_path, use_snapshot=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Near-duplicate images: hash cost, how well re-crops/re-scales are caught vs. false matches, and
+multi-index Hamming lookups vs. a linear scan of every stored hash.
+
+Usage: python benchmarks/image_dedupe.py [distinct images] [stored hashes]
+"""
+import io
+import os
+import random
+import sys
+import time
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+
+def xray(rnd, size=768):
+    """A grey, X-ray-like picture: dark field, a few bright overlapping bones and soft tissue."""
+    img = Image.new("L", (size, size), rnd.randint(10, 40))
+    draw = ImageDraw.Draw(img)
+    for _ in range(rnd.randint(3, 7)):
+        x, y = rnd.randrange(size), rnd.randrange(size)
+        w, h = rnd.randint(size // 10, size // 2), rnd.randint(size // 10, size // 2)
+        draw.ellipse((x - w, y - h, x + w, y + h), fill=rnd.randint(60, 140))
+    for _ in range(rnd.randint(2, 5)):
+        x0, y0, x1, y1 = (rnd.randrange(size) for _ in range(4))
+        draw.line((x0, y0, x1, y1), fill=rnd.randint(170, 250), width=rnd.randint(size // 40, size // 12))
+    return img.filter(ImageFilter.GaussianBlur(size // 100))
+
+
+def encode(img, fmt="JPEG", **kw):
+    out = io.BytesIO()
+    img.save(out, fmt, **kw)
+    return out.getvalue()
+
+
+def variants(img):
+    """What a re-upload of the same X-ray tends to look like."""
+    w, h = img.size
+    c = w // 25
+    return {
+        "jpeg q70": encode(img, quality=70),
+        "half size": encode(img.resize((w // 2, h // 2))),
+        "crop 4%": encode(img.crop((c, c, w - c, h - c))),
+        "crop 8% one side": encode(img.crop((2 * c, 0, w, h))),
+        "brighter": encode(img.point(lambda p: min(255, p + 20))),
+        "png": encode(img, "PNG"),
+    }
+
+
+def main():
+    distinct = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    stored = int(sys.argv[2]) if len(sys.argv) > 2 else 50_000
+    rnd = random.Random(3)
+    images = [xray(rnd) for _ in range(distinct)]
+    originals = [encode(img, quality=90) for img in images]
+
+    start = time.perf_counter()
+    hashes = [clinic_app.image_hashes(data) for data in originals]
+    took = (time.perf_counter() - start) * 1000 / distinct
+    print(f"hashing a 768 px JPEG: {took:.1f} ms")
+
+    bits, dbits = clinic_app.NEAR_DUPLICATE_BITS, clinic_app.NEAR_DUPLICATE_DHASH_BITS
+    def near(a, b):
+        return clinic_app.hamming(a[1], b[1]) <= bits and clinic_app.hamming(a[0], b[0]) <= dbits
+
+    caught = {}
+    for img, h in zip(images[:50], hashes):
+        for label, data in variants(img).items():
+            v = clinic_app.image_hashes(data)
+            caught.setdefault(label, []).append((near(h, v), clinic_app.hamming(h[1], v[1])))
+    for label, results in caught.items():
+        dist = sorted(d for _, d in results)
+        print(f"  {label:18s} caught {sum(ok for ok, _ in results):3d}/{len(results)}   "
+              f"pHash bits apart median {dist[len(dist) // 2]}, max {dist[-1]}")
+    false = sum(near(hashes[i], hashes[j]) for i in range(distinct) for j in range(i + 1, distinct))
+    print(f"  false matches among {distinct} distinct images: {false} of {distinct * (distinct - 1) // 2} pairs")
+
+    # Lookup cost at scale: random hashes stand in for a large archive, plus the real ones.
+    index = clinic_app.HammingIndex(bits)
+    pool = [(clinic_app._signed64(rnd.getrandbits(64)), clinic_app._signed64(rnd.getrandbits(64)))
+            for _ in range(stored)] + hashes
+    start = time.perf_counter()
+    for n, (dh, ph) in enumerate(pool):
+        index.add(ph, n)
+    print(f"index of {len(pool)} hashes built in {time.perf_counter() - start:.2f} s")
+    queries = [clinic_app.image_hashes(variants(img)["crop 4%"]) for img in images[:50]]
+    start = time.perf_counter()
+    index_hits = [sorted(k for _, k in index.search(ph)) for _, ph in queries]
+    index_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    start = time.perf_counter()
+    scan_hits = [sorted(n for n, (_, p) in enumerate(pool) if clinic_app.hamming(p, ph) <= bits) for _, ph in queries]
+    scan_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"lookup: multi-index {index_ms:.2f} ms, linear scan {scan_ms:.2f} ms per query "
+          f"({'same results' if index_hits == scan_hits else 'DIFFERENT results'})")
+
+    # End to end: store the originals plus one re-upload of each of the first 50, then report.
+    conn = clinic_app.db_connect()
+    with conn:
+        conn.executemany("INSERT INTO patients (name, phone) VALUES (?, ?)",
+                         [(f"Patient {i}", f"0100{i:07d}") for i in range(distinct)])
+        for i, data in enumerate(originals):
+            item = {"name": f"xray{i}.jpg", "type": "image", "data": data}
+            if i < 50:
+                copy = variants(images[i])["half size"]
+                clinic_app.repo._insert_files(conn, i + 1, [{"name": f"xray{i}_again.jpg", "type": "image", "data": copy}])
+            clinic_app.repo._insert_files(conn, i + 1, [item])
+    conn.close()
+    start = time.perf_counter()
+    hashed = clinic_app.IMAGE_HASHES.run_all()
+    print(f"background hashing of stored images: {hashed} in {time.perf_counter() - start:.1f} s")
+    start = time.perf_counter()
+    groups = clinic_app.IMAGE_HASHES.duplicate_groups()
+    print(f"duplicate report: {len(groups)} group(s) in {(time.perf_counter() - start) * 1000:.0f} ms, "
+          f"{clinic_app.format_bytes(sum(r.size for g in groups for r in g[1:]))} in copies")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Foreground latency while the integrity scrubber runs: idle vs. paced background pass vs. flat out.
+
+Usage: python benchmarks/integrity_scrub.py [patients] [files]
+"""
+import io
+import os
+import random
+import sys
+import threading
+import time
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def jpeg(rnd, size):
+    img = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    img.paste((rnd.randrange(256), rnd.randrange(256), 90), (0, 0, size // 3, size // 3))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def seed(patients, files):
+    rnd = random.Random(7)
+    conn = clinic_app.db_connect()
+    photos = [jpeg(rnd, 480) for _ in range(20)]
+    scans = [jpeg(rnd, 1400) for _ in range(10)]
+    with conn:
+        conn.executemany("INSERT INTO patients (name, phone, image) VALUES (?, ?, ?)",
+                         [(f"Patient {i}", f"0100{i:07d}", photos[i % len(photos)]) for i in range(patients)])
+        conn.executemany("INSERT INTO visits (patient_id, date, date_ts, diagnosis, price) VALUES (?, '', ?, 'Flu', 100)",
+                         [(rnd.randint(1, patients), 1_700_000_000 + i * 600) for i in range(patients * 4)])
+        for i in range(files):
+            pid = rnd.randint(1, patients)
+            if i % 2:
+                item = {"name": f"scan{i}.jpg", "type": "image", "data": scans[i % len(scans)]}
+            else:
+                text = " ".join(f"line {j} of report {i}: blood pressure {rnd.randint(90, 160)}" for j in range(4000))
+                item = {"name": f"report{i}.txt", "type": "document", "data": text.encode()}
+            clinic_app.repo._insert_files(conn, pid, [item])
+    conn.close()
+
+
+def probe(patients, seconds=None, until=None):
+    """Open random patients (uncached) back to back for *seconds* or until *until* finishes; ms latencies."""
+    rnd = random.Random(1)
+    timings = []
+    end = time.perf_counter() + (seconds or 3600)
+    while time.perf_counter() < end and not (until and not until.is_alive()):
+        clinic_app.repo.cache.clear()
+        start = time.perf_counter()
+        clinic_app.repo.patient_details(rnd.randint(1, patients))
+        clinic_app.repo.list_attachments(rnd.randint(1, patients))
+        timings.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.01)
+    timings.sort()
+    return timings
+
+
+def show(label, timings, extra=""):
+    n = len(timings)
+    print(f"{label:26s} p50={timings[n // 2]:6.2f} ms  p95={timings[int(n * 0.95)]:6.2f} ms  "
+          f"max={timings[-1]:7.2f} ms  {extra}")
+
+
+def main():
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 1500
+    seed(patients, files)
+    size = os.path.getsize(clinic_app.DB_PATH)
+    print(f"patients={patients} files={files} db={clinic_app.format_bytes(size)}")
+    show("no scrubber", probe(patients, 5))
+    for paced in (True, False):
+        scrubber = clinic_app.IntegrityScrubber()
+        scrubber.paced = paced
+        took = []
+
+        def work():
+            start = time.perf_counter()
+            if scrubber.scrub_pass(restart=True) is not None:
+                took.append(time.perf_counter() - start)
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+        # The paced pass takes far longer than is worth waiting for: sample it for a while.
+        timings = probe(patients, 10) if paced else probe(patients, until=worker)
+        where = scrubber.current
+        scrubber.stop()
+        worker.join()
+        if took:
+            show("unpaced scrub", timings, f"full pass of {scrubber.checked} items in {took[0]:.1f} s")
+        else:
+            show("paced scrub", timings, f"10 s: {scrubber.checked} items, now at {where}")
+
+
+if __name__ == "__main__":
+    main()
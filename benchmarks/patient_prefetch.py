@@ -0,0 +1,79 @@
+"""Patient form load after a double-click: cold read + photo decode vs. details prefetched on selection.
+
+Usage: python benchmarks/patient_prefetch.py [patients]
+"""
+import io
+import os
+import sys
+import time
+import random
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def photo(rnd):
+    # A gradient with some noise stored at the app's portrait size and quality.
+    size = clinic_app.PHOTO_MAX_DIM
+    noise = Image.frombytes("L", (size, size), rnd.randbytes(size * size)).convert("RGB")
+    img = Image.blend(Image.linear_gradient("L").resize((size, size)).convert("RGB"), noise, 0.15)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=clinic_app.PHOTO_JPEG_QUALITY)
+    return out.getvalue()
+
+
+def seed(n):
+    rnd = random.Random(5)
+    photos = [photo(rnd) for _ in range(8)]
+    conn = clinic_app.db_connect()
+    conn.executemany("INSERT INTO patients (name, phone, image) VALUES (?, ?, ?)",
+                     ((f"Patient {i}", f"0100{i:07d}", photos[i % len(photos)]) for i in range(n)))
+    conn.executemany("INSERT INTO visits (patient_id, date, diagnosis, price) VALUES (?, ?, 'Checkup', 150)",
+                     ((rnd.randint(1, n), f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 10:00")
+                      for _ in range(n * 20)))
+    conn.commit()
+    conn.close()
+
+
+def legacy_load(pid):
+    # What load_patient_by_id did before: fetch the row, then decode and shrink the photo on the click.
+    p = clinic_app.repo.get_patient(pid)
+    img = Image.open(io.BytesIO(p.image))
+    img.thumbnail((160, 160))
+    return p, img
+
+
+def timed(label, fn, pids, before=None):
+    timings = []
+    for pid in pids:
+        if before:
+            before(pid)
+        start = time.perf_counter()
+        fn(pid)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{label:36s} p50={timings[len(timings) // 2]:7.2f} ms p95={timings[int(len(timings) * 0.95)]:7.2f} ms")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seed(n)
+    repo = clinic_app.repo
+    pids = random.Random(3).sample(range(1, n + 1), 200)
+    print(f"patients={n} photo={len(repo.get_patient(1).image) // 1024} KB")
+    timed("legacy get_patient + decode", legacy_load, pids)
+    repo.cache.clear()
+    timed("patient_details cold", repo.patient_details, pids)
+    repo.cache.clear()
+    # The prefetcher has already warmed the row by the time the double-click lands.
+    timed("patient_details after prefetch", repo.patient_details, pids, before=repo.patient_details)
+    print("cache", repo.cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Patient record PDFs for long histories: the previous one-cell-per-field renderer vs. render_patient_record.
+
+Usage: python benchmarks/pdf_render.py [visits]
+"""
+import io
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+from fpdf import FPDF  # noqa: E402
+from PIL import Image  # noqa: E402
+
+DIAGNOSES = ["Checkup", "Hypertension follow-up", "Upper respiratory infection with persistent cough",
+             "Type 2 diabetes, HbA1c review and diet counselling", "Lower back pain"]
+PRESCRIPTIONS = ["", "Paracetamol 500 mg as needed", "Amlodipine 5 mg once daily",
+                 "Amoxicillin 500 mg three times daily for seven days, review if no improvement"]
+
+
+def legacy_render(path, patient, visits, files):
+    # The renderer this replaced, kept verbatim apart from writing to *path*.
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Helvetica", "B", 18)
+    pdf.cell(0, 10, clinic_app.CLINIC_NAME, new_x="LMARGIN", new_y="NEXT", align="C")
+    pdf.cell(0, 10, "Patient Record", new_x="LMARGIN", new_y="NEXT", align="C")
+    pdf.ln(6)
+    pdf.set_font("Helvetica", "B", 14)
+    pdf.cell(0, 8, f"Patient ID: {patient.id or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font("Helvetica", size=12)
+    for label, value in (("Name", patient.name), ("Age", patient.age), ("Gender", patient.gender),
+                         ("Phone", patient.phone), ("Address", patient.address), ("Occupation", patient.occupation),
+                         ("Last Visit", patient.last_visit), ("Doctor", patient.doctor)):
+        pdf.cell(0, 8, f"{label}: {value or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(6)
+    pdf.set_font("Helvetica", "B", 14)
+    pdf.cell(0, 8, "Visit History", new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font("Helvetica", size=12)
+    for visit in visits:
+        pdf.ln(4)
+        pdf.cell(0, 8, f"Visit ID: {visit.id or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(0, 8, f"Date: {visit.date or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(0, 8, f"Diagnosis: {visit.diagnosis or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(0, 8, f"Prescription: {visit.prescription or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(0, 8, f"Doctor: {visit.doctor or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(0, 8, f"Price: ${float(visit.price or 0.0):.2f}", new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(6)
+    pdf.set_font("Helvetica", "B", 14)
+    pdf.cell(0, 8, "Patient Files", new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font("Helvetica", size=12)
+    for fdata in files:
+        pdf.ln(4)
+        pdf.cell(0, 8, f"File Name: {fdata.file_name}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(0, 8, f"File Type: {fdata.file_type}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(0, 8, f"Upload Date: {fdata.upload_date}", new_x="LMARGIN", new_y="NEXT")
+        if fdata.file_type == "image" and fdata.file_data:
+            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
+            tmp.write(fdata.file_data)
+            tmp.close()
+            pdf.image(tmp.name, w=50)
+            os.unlink(tmp.name)
+    pdf.output(path)
+    return pdf.pages_count
+
+
+def seed(visits, images):
+    rnd = random.Random(21)
+    conn = clinic_app.db_connect()
+    conn.execute("INSERT INTO patients (name, age, gender, phone, address, doctor) "
+                 "VALUES ('Long History', 64, 'Male', '01001234567', '12 Nile Street, Giza', 'Dr. Basma')")
+    conn.executemany("INSERT INTO visits (patient_id, date, diagnosis, prescription, doctor, price) VALUES (1, ?, ?, ?, ?, ?)",
+                     ((f"{rnd.randint(2005, 2024)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 10:00",
+                       rnd.choice(DIAGNOSES), rnd.choice(PRESCRIPTIONS), rnd.choice(("Dr. Basma", "Dr. Samir")),
+                       rnd.choice((100, 150, 250))) for _ in range(visits)))
+    conn.commit()
+    scans = []
+    for i in range(images):
+        img = Image.linear_gradient("L").resize((1600, 1200)).convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=85)
+        data = out.getvalue()
+        scans.append({"name": f"scan{i}.jpg", "type": "image", "data": data, "thumbnail": clinic_app.make_thumbnail(data)})
+    with conn:
+        clinic_app.repo._insert_files(conn, 1, scans)
+    conn.close()
+
+
+def measure(label, fn, path):
+    start = time.perf_counter()
+    pages = fn(path)
+    elapsed = time.perf_counter() - start
+    # Traced again separately: tracemalloc slows the run down several times over.
+    tracemalloc.start()
+    fn(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:10s} pages={pages:5d} {pages / elapsed:7.1f} pages/s  {elapsed:6.2f} s  "
+          f"size={os.path.getsize(path) / 1024:8.0f} KB  peak Python memory={peak / 2 ** 20:6.1f} MB")
+
+
+def main():
+    visits = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seed(visits, 12)
+    repo = clinic_app.repo
+    print(f"visits={visits} files=12 scans")
+
+    def legacy(path):
+        return legacy_render(path, repo.get_patient(1), repo.patient_visits(1), repo.patient_files(1))
+
+    def current(path):
+        with repo.snapshot() as snap:
+            files = snap.attachment_rows(1)
+            thumbs = snap.attachment_thumbnails([f.id for f in files])
+            return clinic_app.render_patient_record(path, snap.get_patient(1), snap.iter_patient_visits(1), files,
+                                                    thumbs, snap.visit_summary(1))
+
+    measure("legacy", legacy, os.path.join(TMP_DIR, "legacy.pdf"))
+    clinic_app.current_pdf_template()  # built once per clinic, not per document
+    measure("table", current, os.path.join(TMP_DIR, "table.pdf"))
+
+
+if __name__ == "__main__":
+    main()
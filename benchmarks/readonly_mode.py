@@ -0,0 +1,123 @@
+"""Read-only reporting workstations: report-style reads on a default vs. a mode=ro + mmap connection while
+another process keeps writing, and how soon a PRAGMA data_version poll notices the writer's commits.
+
+Usage: python benchmarks/readonly_mode.py [patients] [seconds per phase]
+"""
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+# The clinic PC: books a visit every PAUSE seconds and stamps the commit time for the latency probe.
+WRITER = """
+import random, sqlite3, sys, time
+conn = sqlite3.connect(sys.argv[1], timeout=30)
+conn.execute("PRAGMA journal_mode=WAL")
+patients, pause, n = int(sys.argv[2]), float(sys.argv[3]), 0
+while True:
+    n += 1
+    with conn:
+        conn.execute("INSERT INTO visits (patient_id, date, date_ts, diagnosis, price) VALUES (?, '', ?, 'Flu', 100)",
+                     (n % patients + 1, time.time()))
+        conn.execute("INSERT INTO app_settings (key, value) VALUES ('bench.commit', ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (repr(time.time()),))
+    time.sleep(pause * random.uniform(0.5, 1.5))
+"""
+
+REPORT_SQL = ("SELECT p.doctor, count(*), sum(v.price) FROM visits v JOIN patients p ON p.id = v.patient_id "
+              "WHERE v.date_ts BETWEEN ? AND ? + 30 * 86400 GROUP BY p.doctor")
+DETAIL_SQL = "SELECT id, date_ts, diagnosis, price FROM visits WHERE patient_id=? ORDER BY date_ts DESC"
+
+
+def seed(patients):
+    rnd = random.Random(11)
+    conn = clinic_app.db_connect()
+    with conn:
+        conn.executemany("INSERT INTO patients (name, phone, doctor, address) VALUES (?, ?, ?, ?)",
+                         [(f"Patient {i}", f"0100{i:07d}", f"Dr {i % 12}", "x" * 200) for i in range(patients)])
+        conn.executemany("INSERT INTO visits (patient_id, date, date_ts, diagnosis, prescription, price) "
+                         "VALUES (?, '', ?, ?, ?, 100)",
+                         [(rnd.randint(1, patients), 1_600_000_000 + i * 300, f"Diagnosis {i % 97}", "y" * 150)
+                          for i in range(patients * 10)])
+    conn.close()
+
+
+def reads(conn, patients, seconds):
+    """Alternate a period report and random patient histories; per-query ms latencies."""
+    rnd = random.Random(2)
+    timings = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        if len(timings) % 10 == 0:
+            day = 1_600_000_000 + rnd.randrange(patients * 10) * 300
+            conn.execute(REPORT_SQL, (day, day)).fetchall()
+        else:
+            conn.execute(DETAIL_SQL, (rnd.randint(1, patients),)).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings
+
+
+def refresh_latency(samples, poll_ms):
+    """Poll data_version like DataVersionWatcher; ms from a (sparse) writer's commit until the poll saw it."""
+    conn = clinic_app.readonly_connect()
+    seen, lags = conn.execute("PRAGMA data_version").fetchone()[0], []
+    while len(lags) < samples:
+        time.sleep(poll_ms / 1000)
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != seen:
+            seen = version
+            stamp = conn.execute("SELECT value FROM app_settings WHERE key='bench.commit'").fetchone()
+            if stamp:
+                lags.append((time.time() - float(stamp[0])) * 1000)
+    conn.close()
+    lags.sort()
+    return lags
+
+
+def main():
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    seed(patients)
+    print(f"patients={patients} visits={patients * 10} db={clinic_app.format_bytes(os.path.getsize(clinic_app.DB_PATH))}")
+    writer = subprocess.Popen([sys.executable, "-c", WRITER, clinic_app.DB_PATH, str(patients), "0.005"])
+    try:
+        time.sleep(0.5)
+        for label, conn in (("default connection", sqlite3.connect(clinic_app.DB_PATH, timeout=30)),
+                            ("mode=ro + mmap", clinic_app.readonly_connect())):
+            reads(conn, patients, 1)  # warm the page cache for both alike
+            timings = reads(conn, patients, seconds)
+            n = len(timings)
+            print(f"{label:20s} {n / seconds:8.0f} queries/s  p50={timings[n // 2]:.3f} ms  "
+                  f"p95={timings[int(n * 0.95)]:.3f} ms  max={timings[-1]:.2f} ms")
+            conn.close()
+    finally:
+        writer.terminate()
+        writer.wait()
+    count = sqlite3.connect(clinic_app.DB_PATH).execute("SELECT count(*) FROM visits").fetchone()[0]
+    print(f"writer committed {count - patients * 10} visits meanwhile")
+
+    # One commit every ~3 s: each change is seen by the first poll after it, never batched with the next.
+    writer = subprocess.Popen([sys.executable, "-c", WRITER, clinic_app.DB_PATH, str(patients), "3"])
+    try:
+        for poll_ms in (clinic_app.READONLY_POLL_MS // 4, clinic_app.READONLY_POLL_MS):
+            lags = refresh_latency(8, poll_ms)
+            print(f"data_version poll every {poll_ms} ms: change seen after p50={lags[len(lags) // 2]:.0f} ms "
+                  f"max={lags[-1]:.0f} ms")
+    finally:
+        writer.terminate()
+        writer.wait()
+
+
+if __name__ == "__main__":
+    main()
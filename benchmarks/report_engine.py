@@ -0,0 +1,97 @@
+"""Monthly/quarterly clinic reports: cold build (queries, charts, PDF) vs. an unchanged period served from the cache.
+
+Usage: python benchmarks/report_engine.py [visits]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+DOCTORS = ["Dr. Adel", "Dr. Basma", "Dr. Fouad", "Dr. Hala", "Dr. Mona", "Dr. Samir", ""]
+DIAGNOSES = [f"Diagnosis {i}" for i in range(80)]
+
+
+def seed(n):
+    rnd = random.Random(11)
+    start = int(clinic_app.datetime(2020, 1, 1).timestamp())
+    span = int(clinic_app.datetime(2025, 1, 1).timestamp()) - start
+    patients = max(1000, n // 25)
+    conn = clinic_app.db_connect()
+    conn.executemany("INSERT INTO patients (name, age, gender, created_ts) VALUES (?, ?, ?, ?)",
+                     ((f"Patient {i}", rnd.choice((None, rnd.randint(1, 90))), rnd.choice(("Male", "Female", "")),
+                       start + rnd.randrange(span)) for i in range(patients)))
+
+    def rows():
+        for _ in range(n):
+            ts = start + rnd.randrange(span) // 60 * 60
+            yield (rnd.randint(1, patients), clinic_app.format_timestamp(ts), ts, rnd.choice(DIAGNOSES),
+                   rnd.choice(DOCTORS), rnd.choice((100, 150, 250)))
+
+    conn.executemany("INSERT INTO visits (patient_id, date, date_ts, diagnosis, doctor, price) VALUES (?, ?, ?, ?, ?, ?)",
+                     rows())
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def python_side(conn, period):
+    # The alternative to GROUP BY: pull the period's rows and aggregate in Python.
+    totals = {}
+    for doctor, diagnosis, price in conn.execute("SELECT doctor, diagnosis, price FROM all_visits "
+                                                 "WHERE date_ts >= ? AND date_ts < ?", (period.start_ts, period.end_ts)):
+        t = totals.setdefault(doctor, [0, 0.0])
+        t[0] += 1
+        t[1] += price or 0
+    return totals
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    seed(n)
+    print(f"visits={n}")
+    for period in (clinic_app.parse_report_period("2023-03"), clinic_app.parse_report_period("2023-Q2")):
+        with clinic_app.repo.snapshot() as snap:
+            conn = snap.connect()
+            start = time.perf_counter()
+            clinic_app.load_report_visits(conn, period)
+            data = clinic_app.collect_report(conn, period)
+            queries = time.perf_counter() - start
+            start = time.perf_counter()
+            python_side(conn, period)
+            rows = time.perf_counter() - start
+            start = time.perf_counter()
+            clinic_app.load_report_visits(conn, period)
+            clinic_app.report_fingerprint(conn, period)
+            fingerprint = time.perf_counter() - start
+        start = time.perf_counter()
+        clinic_app.report_charts(data)
+        charts = time.perf_counter() - start
+        start = time.perf_counter()
+        clinic_app.report_charts(data)
+        charts_again = time.perf_counter() - start
+        clinic_app.bar_chart_png.cache_clear()
+        clinic_app.column_chart_png.cache_clear()
+
+        start = time.perf_counter()
+        path, _, cached = clinic_app.generate_report(period)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        _, _, hit = clinic_app.generate_report(period)
+        warm = time.perf_counter() - start
+        assert not cached and hit
+        print(f"{period.label:12s} visits={data.visits:6d}  all GROUP BY queries {queries * 1000:7.1f} ms "
+              f"(doctor totals alone in Python {rows * 1000:6.1f} ms)  fingerprint {fingerprint * 1000:6.1f} ms")
+        print(f"{'':12s} charts {charts * 1000:6.1f} ms (cached {charts_again * 1000:5.2f} ms)  "
+              f"full build {cold * 1000:7.1f} ms  unchanged period from cache {warm * 1000:6.1f} ms  "
+              f"pdf {os.path.getsize(path) // 1024} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Memory per loaded patient-list row: legacy tuples+lists vs. PatientListRow models.
+
+Usage: python benchmarks/row_memory.py [rows]
+"""
+import os
+import sys
+import random
+import tempfile
+import tracemalloc
+
+TMP_DIR = tempfile.mkdtemp(prefix="clinic_bench_")
+os.environ["CLINIC_DB_PATH"] = os.path.join(TMP_DIR, "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clinic_app  # noqa: E402
+
+
+def seed(n):
+    conn = clinic_app.db_connect()
+    rnd = random.Random(42)
+    conn.executemany(
+        "INSERT INTO patients (name, age, gender, phone, address, occupation, diagnosis, prescription, last_visit, doctor)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((f"Patient {i}", rnd.randint(1, 90), rnd.choice(["Male", "Female"]), f"0100{i:07d}",
+          "Cairo", rnd.choice(["Engineer", None, "Teacher"]), "Flu", "Rest",
+          f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} {rnd.randint(9, 16):02d}:{rnd.choice(['00', '30'])}",
+          rnd.choice(["Dr. A", "Dr. B"])) for i in range(n)))
+    conn.commit()
+    conn.close()
+
+
+def legacy_load():
+    conn = clinic_app.db_connect()
+    c = conn.cursor()
+    c.execute("SELECT id, name, age, gender, phone, occupation, doctor, last_visit FROM patients ORDER BY id DESC")
+    rows = [["" if cell is None else cell for cell in row] for row in c.fetchall()]
+    conn.close()
+    return rows
+
+
+def measure(fn):
+    tracemalloc.start()
+    rows = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(rows), current, peak
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    seed(n)
+    for label, fn in (("tuples+lists", legacy_load), ("PatientListRow", clinic_app.repo.list_patients)):
+        count, current, peak = measure(fn)
+        print(f"{label:16s} rows={count:7d} retained={current / 2**20:7.1f} MiB "
+              f"({current / count:6.1f} B/row) peak={peak / 2**20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
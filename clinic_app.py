@@ -1,17 +1,41 @@
 import os
 import sys
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import io
 import tempfile
+import shutil
+import subprocess
 import traceback
 import mimetypes
+import json
+import time
+import threading
+import functools
+import bisect
+from collections import deque, namedtuple, OrderedDict
+import hashlib
+import hmac
+import getpass
+import zlib
+import lzma
+import math
+import gzip
+import base64
+import re
+import unicodedata
+import zipfile
+import html
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
 import customtkinter as ctk
-from tkinter import ttk, messagebox, filedialog, Toplevel
-from PIL import Image, UnidentifiedImageError
+from tkinter import ttk, messagebox, filedialog, simpledialog, Toplevel
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps, ImageTk, UnidentifiedImageError
 from fpdf import FPDF
 import openpyxl
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 # ---------------- Helpers ----------------
 def icon_label(icon, text):
@@ -35,11 +59,187 @@ ASSETS_DIR = get_resource_path("assets")
 if not os.path.exists(ASSETS_DIR):
     os.makedirs(ASSETS_DIR)
 LOGO_PATH = os.path.join(ASSETS_DIR, "logo.png")
-DB_PATH = os.path.join(os.path.expanduser("~"), "Documents", "clinic.db")
+DB_PATH = os.environ.get("CLINIC_DB_PATH") or os.path.join(os.path.expanduser("~"), "Documents", "clinic.db")
+# Display / reporting workstations: every connection is mode=ro, nothing is migrated or written.
+READ_ONLY = "--readonly" in sys.argv[1:] or os.environ.get("CLINIC_READONLY") == "1"
+READONLY_MMAP_BYTES = 1024 * 1024 * 1024
 CLINIC_NAME = "Dr. Abdulrahman Meawad"
 
+# ---------------- Patient Matching ----------------
+# Duplicate-candidate keys live in side tables (patient_phone_keys, patient_name_keys) so the
+# check at registration is a handful of index probes instead of a scan of patients.
+DEFAULT_COUNTRY_CODE = "20"
+DUPLICATE_NAME_THRESHOLD = 0.6
+DUPLICATE_MAX_CANDIDATES = 200  # per index probe; only these are fetched and trigram-scored
+_PHONE_SPLIT = re.compile(r"[,;/|]|\s{2,}")
+_ARABIC_FOLD = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ة": "ه", "ى": "ي", "ؤ": "و", "ئ": "ي"})
+_SOUNDEX_CODES = {c: d for d, letters in (("1", "bfpv"), ("2", "cgjkqsxz"), ("3", "dt"), ("4", "l"),
+                                          ("5", "mn"), ("6", "r")) for c in letters}
+
+def normalize_phone(raw, country_code=DEFAULT_COUNTRY_CODE):
+    """Return an E.164-style key ("+20100123") for one phone number, or None if it has no digits."""
+    digits = re.sub(r"\D", "", raw or "")
+    if len(digits) < 4:
+        return None
+    if (raw or "").strip().startswith("+"):
+        return "+" + digits
+    if digits.startswith("00"):
+        return "+" + digits[2:]
+    if digits.startswith("0"):
+        return "+" + country_code + digits[1:]
+    if digits.startswith(country_code) and len(digits) > 10:
+        return "+" + digits
+    return "+" + country_code + digits
+
+def phone_keys(raw):
+    """Normalized keys for every number in a phone field ("0100 123 / 0122 456" holds two)."""
+    keys = {normalize_phone(part) for part in _PHONE_SPLIT.split(raw or "")}
+    keys.discard(None)
+    return sorted(keys)
+
+def normalize_name(name):
+    """Lowercase, strip accents and tashkeel, fold Arabic letter variants and collapse whitespace."""
+    text = unicodedata.normalize("NFKD", (name or "").translate(_ARABIC_FOLD))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch) and ch != "ـ")
+    text = "".join(ch if ch.isalpha() else " " for ch in text.lower())
+    return " ".join(text.split())
+
+def _soundex(token):
+    if not token.isascii():
+        # Arabic script: the consonant skeleton (long vowels dropped) plays the role of Soundex.
+        return token[0] + "".join(ch for ch in token[1:] if ch not in "اوي")
+    code, last = token[0], _SOUNDEX_CODES.get(token[0])
+    for ch in token[1:]:
+        digit = _SOUNDEX_CODES.get(ch)
+        if digit and digit != last:
+            code += digit
+        if ch not in "hw":
+            last = digit
+    return (code + "000")[:4]
+
+def name_trigrams(name):
+    """Padded per-token trigram keys ("t:" prefixed) of a normalized name."""
+    grams = set()
+    for token in normalize_name(name).split():
+        padded = f"  {token} "
+        grams.update("t:" + padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def name_codes(name):
+    """Phonetic code of each token of a normalized name, in the order written."""
+    return [_soundex(t) for t in normalize_name(name).split()]
+
+def name_keys(name):
+    """Phonetic keys for the whole name: "p:" with token order ignored, "o:" in the order written.
+
+    Names are given first-name-first and shortened from the end ("Mohamed Ali" for "Mohamed Ali
+    Hassan"), so a prefix of an "o:" key finds registrations that gave fewer or more names.
+    """
+    codes = name_codes(name)
+    if not codes:
+        return set()
+    return {"p:" + " ".join(sorted(codes)), "o:" + " ".join(codes)}
+
+def name_similarity(a, b):
+    """Jaccard similarity of the padded trigrams of two names (0..1)."""
+    ga, gb = name_trigrams(a), name_trigrams(b)
+    return len(ga & gb) / len(ga | gb) if ga and gb else 0.0
+
+def index_patient_keys(conn, pid, name, phone):
+    """Replace one patient's rows in the duplicate-candidate side tables."""
+    conn.execute("DELETE FROM patient_phone_keys WHERE patient_id=?", (pid,))
+    conn.execute("DELETE FROM patient_name_keys WHERE patient_id=?", (pid,))
+    conn.executemany("INSERT OR IGNORE INTO patient_phone_keys (phone_key, patient_id) VALUES (?, ?)",
+                     [(k, pid) for k in phone_keys(phone)])
+    conn.executemany("INSERT OR IGNORE INTO patient_name_keys (name_key, patient_id) VALUES (?, ?)",
+                     [(k, pid) for k in name_keys(name)])
+
+# ---------------- Dates ----------------
+# Visit, last-visit and upload dates are stored as integer epoch seconds (date_ts, last_visit_ts,
+# upload_ts) next to the TEXT column, which keeps the normalized display form for sync peers and
+# older exports. Ordering and range filters use the integer column; text is formatted for display.
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+_DATE_INPUT_FORMATS = (
+    ("%Y-%m-%d %H:%M", True), ("%Y-%m-%d %H:%M:%S", True), ("%Y-%m-%d %H:%M:%S.%f", True),
+    ("%Y-%m-%dT%H:%M", True), ("%Y-%m-%dT%H:%M:%S", True), ("%Y/%m/%d %H:%M", True),
+    ("%d/%m/%Y %H:%M", True), ("%d-%m-%Y %H:%M", True), ("%d.%m.%Y %H:%M", True),
+    ("%Y-%m-%d", False), ("%Y/%m/%d", False), ("%d/%m/%Y", False), ("%d-%m-%Y", False), ("%d.%m.%Y", False),
+)
+_DATE_MIN_YEAR, _DATE_MAX_YEAR = 1900, 2100
+
+def _parse_datetime(text):
+    """Return (datetime, has_time) for a date typed in any accepted format; day-first when ambiguous."""
+    text = " ".join(str(text or "").split())
+    for fmt, has_time in _DATE_INPUT_FORMATS:
+        try:
+            value = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if _DATE_MIN_YEAR <= value.year <= _DATE_MAX_YEAR:
+            return value, has_time
+    raise ValueError(f"Unrecognized date {text!r}; use YYYY-MM-DD HH:MM")
+
+def parse_timestamp(text):
+    """Validate a typed date and return it as epoch seconds (local time); raises ValueError."""
+    return int(_parse_datetime(text)[0].timestamp())
+
+def format_timestamp(ts, fmt=DATE_FORMAT):
+    return datetime.fromtimestamp(ts).strftime(fmt) if ts is not None else ""
+
+def timestamp_range(text):
+    """Return the [start, end) epoch range covered by a year ("2024"), month ("2024-03") or day/minute."""
+    text = (text or "").strip()
+    for fmt in ("%Y", "%Y-%m", "%Y/%m", "%m/%Y"):
+        try:
+            start = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == "%Y":
+            end = start.replace(year=start.year + 1)
+        else:
+            end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        return int(start.timestamp()), int(end.timestamp())
+    start, has_time = _parse_datetime(text)
+    end = start + (timedelta(minutes=1) if has_time else timedelta(days=1))
+    return int(start.timestamp()), int(end.timestamp())
+
+def _timestamp_or_null(text):
+    try:
+        return parse_timestamp(text) if text else None
+    except ValueError:
+        return None
+
+def display_date_sql(ts_col, text_col):
+    """SQL expression that formats an epoch column for display, falling back to the stored text."""
+    return f"IFNULL(strftime('%Y-%m-%d %H:%M', {ts_col}, 'unixepoch', 'localtime'), IFNULL({text_col}, ''))"
+
+# ---------------- Passwords ----------------
+PASSWORD_HASH_ITERATIONS = 200_000
+
+def hash_password(password, salt=None):
+    """Return a salted PBKDF2 hash of *password* as 'pbkdf2_sha256$iterations$salt$hash'."""
+    salt = salt or os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("ascii"), PASSWORD_HASH_ITERATIONS)
+    return f"pbkdf2_sha256${PASSWORD_HASH_ITERATIONS}${salt}${digest.hex()}"
+
+def is_password_hash(value):
+    return isinstance(value, str) and value.startswith("pbkdf2_sha256$")
+
+def verify_password(password, stored):
+    """Check *password* against a hash from hash_password(); anything else never matches."""
+    if not is_password_hash(stored):
+        return False
+    try:
+        _, iterations, salt, expected = stored.split("$")
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("ascii"), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest.hex(), expected)
+
 # ---------------- Database ----------------
 def db_connect():
+    if READ_ONLY:
+        return readonly_connect()
     conn = sqlite3.connect(DB_PATH)
     try:
         conn.execute("PRAGMA foreign_keys = ON")
@@ -47,9 +247,406 @@ def db_connect():
         pass
     return conn
 
+def readonly_connect(path=None, check_same_thread=True):
+    """Open the database read-only (URI mode=ro); under WAL its reads never block or wait on writers.
+
+    On a read-only workstation pages are read through a memory map, straight from the OS page cache
+    instead of copied per read. Elsewhere these are side connections (snapshots, the scrubber, backup
+    checks, watchers) that should not each map up to a gigabyte next to the main one.
+    """
+    conn = sqlite3.connect(f"file:{path or DB_PATH}?mode=ro", uri=True, check_same_thread=check_same_thread)
+    if READ_ONLY:
+        conn.execute(f"PRAGMA mmap_size = {READONLY_MMAP_BYTES}")
+    return conn
+
+# Schema migrations, applied in order; PRAGMA user_version records how many have run.
+def _migrate_attachment_codec(conn):
+    conn.execute("ALTER TABLE patient_files ADD COLUMN codec TEXT")
+    conn.execute("ALTER TABLE patient_files ADD COLUMN orig_size INTEGER")
+
+def _migrate_cascade_deletes(conn):
+    # SQLite cannot alter a foreign key in place: rebuild both child tables.
+    conn.execute('''
+    CREATE TABLE visits_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER,
+        date TEXT,
+        diagnosis TEXT,
+        prescription TEXT,
+        doctor TEXT,
+        price REAL,
+        FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE
+    )''')
+    conn.execute("INSERT INTO visits_new (id, patient_id, date, diagnosis, prescription, doctor, price) "
+                 "SELECT id, patient_id, date, diagnosis, prescription, doctor, price FROM visits")
+    conn.execute("DROP TABLE visits")
+    conn.execute("ALTER TABLE visits_new RENAME TO visits")
+    conn.execute('''
+    CREATE TABLE patient_files_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER,
+        file_name TEXT,
+        file_type TEXT,
+        upload_date TEXT,
+        file_data BLOB,
+        codec TEXT,
+        orig_size INTEGER,
+        FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE
+    )''')
+    conn.execute("INSERT INTO patient_files_new (id, patient_id, file_name, file_type, upload_date, file_data, codec, orig_size) "
+                 "SELECT id, patient_id, file_name, file_type, upload_date, file_data, codec, orig_size FROM patient_files")
+    conn.execute("DROP TABLE patient_files")
+    conn.execute("ALTER TABLE patient_files_new RENAME TO patient_files")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_visits_patient ON visits(patient_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_files_patient ON patient_files(patient_id)")
+
+def _migrate_settings_and_sort_indexes(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS app_settings (key TEXT PRIMARY KEY, value TEXT)")
+    for table, cols in (("patients", ("name", "phone", "occupation", "doctor", "last_visit")),
+                        ("visits", ("date", "diagnosis", "doctor"))):
+        for col in cols:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{col} ON {table}({col} COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_age ON patients(age)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_visits_price ON visits(price)")
+
+def _migrate_duplicate_keys(conn):
+    for table, key in (("patient_phone_keys", "phone_key"), ("patient_name_keys", "name_key")):
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            {key} TEXT NOT NULL,
+            patient_id INTEGER NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
+            PRIMARY KEY ({key}, patient_id)
+        ) WITHOUT ROWID''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_patient ON {table}(patient_id)")
+    # Per-key posting counts let the lookup probe only the rarest trigrams of a name.
+    conn.execute("CREATE TABLE IF NOT EXISTS name_key_stats (name_key TEXT PRIMARY KEY, n INTEGER NOT NULL) WITHOUT ROWID")
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_name_keys_insert AFTER INSERT ON patient_name_keys BEGIN
+        INSERT INTO name_key_stats (name_key, n) VALUES (NEW.name_key, 1)
+        ON CONFLICT(name_key) DO UPDATE SET n = n + 1;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_name_keys_delete AFTER DELETE ON patient_name_keys BEGIN
+        UPDATE name_key_stats SET n = n - 1 WHERE name_key = OLD.name_key;
+    END''')
+    for pid, name, phone in conn.execute("SELECT id, name, phone FROM patients").fetchall():
+        index_patient_keys(conn, pid, name, phone)
+
+def _migrate_incremental_vacuum(conn):
+    # auto_vacuum only changes on an existing file through a full VACUUM, which rewrites the whole database;
+    # MaintenanceScheduler runs it in idle time instead of holding up startup.
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('maintenance.vacuum_pending', '1')")
+
+def _migrate_wal_journal(conn):
+    # WAL lets exports read a snapshot while visits are being saved; the mode is persistent in the file.
+    conn.execute("PRAGMA journal_mode = WAL")
+_migrate_wal_journal.transactional = False
+
+# Synced tables and the columns whose edits bump a row's version (blob payload and codec changes do not).
+SYNC_TABLES = {
+    "users": ("username", "password", "role"),
+    "patients": ("name", "age", "gender", "phone", "address", "occupation", "diagnosis", "prescription",
+                 "last_visit", "doctor", "image"),
+    "visits": ("patient_id", "date", "diagnosis", "prescription", "doctor", "price"),
+    "patient_files": ("patient_id", "file_name", "file_type", "upload_date"),
+    "appointments": ("patient_id", "doctor", "start_ts", "end_ts", "status", "notes"),
+}
+
+def _migrate_change_log(conn):
+    conn.execute("INSERT OR IGNORE INTO app_settings (key, value) VALUES ('sync.node_id', lower(hex(randomblob(8))))")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        op TEXT NOT NULL,
+        version INTEGER NOT NULL
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log(tbl, uid)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_pending_blobs (uid TEXT PRIMARY KEY)")
+    for table in ("users", "patients", "visits", "patient_files"):
+        _track_changes(conn, table, SYNC_TABLES[table])
+
+def _track_changes(conn, table, cols):
+    """Give *table* sync identity columns and the triggers that stamp versions and feed change_log."""
+    stamp = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+    node = "(SELECT value FROM app_settings WHERE key = 'sync.node_id')"
+    live = "NOT EXISTS (SELECT 1 FROM app_settings WHERE key = 'sync.muted')"
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN uid TEXT")
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TEXT")
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN node TEXT")
+    conn.execute(f"UPDATE {table} SET uid = lower(hex(randomblob(16))), version = 1, updated_at = {stamp}, node = {node}")
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_uid ON {table}(uid)")
+    # Existing rows count as changes so the first sync seeds a peer; after that, cost follows edits only.
+    conn.execute(f"INSERT INTO change_log (tbl, uid, op, version) SELECT '{table}', uid, 'U', version FROM {table}")
+    # The log keeps one entry per row: a new change replaces the row's previous entry.
+    log = ("DELETE FROM change_log WHERE tbl = '{t}' AND uid = {r}.uid; "
+           "INSERT INTO change_log (tbl, uid, op, version) VALUES ('{t}', {r}.uid, '{op}', {r}.version);")
+    # Local inserts get their identity here; rows arriving from a peer already carry one.
+    conn.execute(f'''CREATE TRIGGER trg_{table}_stamp_insert AFTER INSERT ON {table} WHEN NEW.uid IS NULL BEGIN
+        UPDATE {table} SET uid = lower(hex(randomblob(16))), version = 1, updated_at = {stamp}, node = {node}
+        WHERE id = NEW.id;
+    END''')
+    # Application updates leave version and node alone; sync writes set them and are not re-stamped.
+    conn.execute(f'''CREATE TRIGGER trg_{table}_stamp_update AFTER UPDATE OF {", ".join(cols)} ON {table}
+    WHEN NEW.version = OLD.version AND NEW.node IS OLD.node BEGIN
+        UPDATE {table} SET version = OLD.version + 1, updated_at = {stamp}, node = {node} WHERE id = NEW.id;
+    END''')
+    conn.execute(f'''CREATE TRIGGER trg_{table}_log_insert AFTER INSERT ON {table}
+    WHEN NEW.uid IS NOT NULL AND {live} BEGIN {log.format(t=table, r="NEW", op="U")} END''')
+    conn.execute(f'''CREATE TRIGGER trg_{table}_log_update AFTER UPDATE OF version, node ON {table}
+    WHEN (NEW.version != OLD.version OR NEW.node IS NOT OLD.node) AND {live} BEGIN {log.format(t=table, r="NEW", op="U")} END''')
+    conn.execute(f'''CREATE TRIGGER trg_{table}_log_delete AFTER DELETE ON {table}
+    WHEN {live} BEGIN {log.format(t=table, r="OLD", op="D")} END''')
+
+@contextmanager
+def change_log_muted(conn):
+    """Keep row moves that are not edits (archiving) out of change_log; use inside an open transaction."""
+    conn.execute("INSERT OR REPLACE INTO main.app_settings (key, value) VALUES ('sync.muted', '1')")
+    try:
+        yield conn
+    finally:
+        conn.execute("DELETE FROM main.app_settings WHERE key = 'sync.muted'")
+
+def _migrate_file_hashes(conn):
+    # sha256 is of the file as uploaded (before normalization), so a re-dropped scan is recognised.
+    conn.execute("ALTER TABLE patient_files ADD COLUMN sha256 TEXT")
+    conn.execute("ALTER TABLE patient_files ADD COLUMN thumbnail BLOB")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_files_sha256 ON patient_files(patient_id, sha256)")
+
+# table -> (display text column, epoch column)
+TIMESTAMP_COLUMNS = {
+    "patients": ("last_visit", "last_visit_ts"),
+    "visits": ("date", "date_ts"),
+    "patient_files": ("upload_date", "upload_ts"),
+}
+
+def backfill_timestamps(conn, schema="main", tables=TIMESTAMP_COLUMNS):
+    """Fill missing epoch columns from the text dates, accepting every format parse_timestamp does.
+
+    Commits unless the caller already has a transaction open.
+    """
+    standalone = not conn.in_transaction
+    conn.create_function("clinic_parse_timestamp", 1, _timestamp_or_null, deterministic=True)
+    for table in tables:
+        text_col, ts_col = TIMESTAMP_COLUMNS[table]
+        conn.execute(f"UPDATE {schema}.{table} SET {ts_col} = clinic_parse_timestamp({text_col}) "
+                     f"WHERE {ts_col} IS NULL AND {text_col} IS NOT NULL")
+    if standalone:
+        conn.commit()
+
+def _migrate_epoch_dates(conn):
+    for table, (text_col, ts_col) in TIMESTAMP_COLUMNS.items():
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {ts_col} INTEGER")
+    backfill_timestamps(conn)
+    # Writers set both columns; these catch the ones that only send text (sync peers, older code).
+    # Plain SQL understands the normalized form only; anything else stays NULL rather than misordered.
+    for table, (text_col, ts_col) in TIMESTAMP_COLUMNS.items():
+        derive = f"CAST(strftime('%s', NEW.{text_col}, 'utc') AS INTEGER)"
+        conn.execute(f'''CREATE TRIGGER trg_{table}_{ts_col}_insert AFTER INSERT ON {table}
+                        WHEN NEW.{ts_col} IS NULL AND NEW.{text_col} IS NOT NULL
+                        BEGIN UPDATE {table} SET {ts_col} = {derive} WHERE id = NEW.id; END''')
+        conn.execute(f'''CREATE TRIGGER trg_{table}_{ts_col}_update AFTER UPDATE OF {text_col} ON {table}
+                        WHEN NEW.{ts_col} IS OLD.{ts_col} AND NEW.{text_col} IS NOT OLD.{text_col}
+                        BEGIN UPDATE {table} SET {ts_col} = {derive} WHERE id = NEW.id; END''')
+    # The text sort indexes are superseded by range indexes on the epoch columns.
+    conn.execute("DROP INDEX IF EXISTS idx_visits_date")
+    conn.execute("DROP INDEX IF EXISTS idx_patients_last_visit")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_visits_date_ts ON visits(date_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_visits_patient_date_ts ON visits(patient_id, date_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_last_visit_ts ON patients(last_visit_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_files_upload_ts ON patient_files(patient_id, upload_ts)")
+
+def _migrate_appointments(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS appointments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL,
+        doctor TEXT NOT NULL,
+        start_ts INTEGER NOT NULL,
+        end_ts INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'booked',
+        notes TEXT,
+        visit_id INTEGER,
+        FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE,
+        FOREIGN KEY(visit_id) REFERENCES visits(id) ON DELETE SET NULL,
+        CHECK (end_ts > start_ts)
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_start ON appointments(start_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments(patient_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_visit ON appointments(visit_id)")
+    # Synced like visits; change_log also drives the in-memory AppointmentIndex.
+    _track_changes(conn, "appointments", SYNC_TABLES["appointments"])
+
+def _migrate_patient_created_ts(conn):
+    conn.execute("ALTER TABLE patients ADD COLUMN created_ts INTEGER")
+    # Registration time was never recorded; the earliest visit, upload or last_visit is the best estimate.
+    # Archived history is not consulted, so patients whose early visits were archived date from later.
+    conn.execute('''UPDATE patients SET created_ts = (SELECT MIN(t) FROM (
+                        SELECT MIN(date_ts) AS t FROM visits WHERE patient_id = patients.id
+                        UNION ALL SELECT MIN(upload_ts) FROM patient_files WHERE patient_id = patients.id
+                        UNION ALL SELECT patients.last_visit_ts))''')
+    # add_patient sets it; this catches other writers (sync peers on older versions, imports).
+    conn.execute('''CREATE TRIGGER trg_patients_created_ts_insert AFTER INSERT ON patients WHEN NEW.created_ts IS NULL
+                    BEGIN UPDATE patients SET created_ts = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = NEW.id; END''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_created_ts ON patients(created_ts)")
+
+def _migrate_integrity_scrub(conn):
+    # sha256 (of the upload) cannot be re-checked once an image was normalized; this is of the stored content.
+    conn.execute("ALTER TABLE patient_files ADD COLUMN content_sha256 TEXT")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS integrity_findings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        tbl TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        detail TEXT,
+        found_at INTEGER NOT NULL,
+        UNIQUE (kind, tbl, row_id)
+    )''')
+
+def _migrate_attachment_text(conn):
+    # Full-text index of attachment contents; rowid is the patient_files id (main and archive ids never overlap).
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS attachment_text USING fts5(
+                        file_name, body, patient_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')""")
+    # Files whose payload arrived after the row (sync peers), waiting for the indexer.
+    conn.execute("CREATE TABLE IF NOT EXISTS attachment_text_queue (file_id INTEGER PRIMARY KEY)")
+    # Archiving moves rows out under sync.muted; their text stays indexed.
+    conn.execute('''CREATE TRIGGER trg_patient_files_text_delete AFTER DELETE ON patient_files
+    WHEN NOT EXISTS (SELECT 1 FROM app_settings WHERE key = 'sync.muted') BEGIN
+        DELETE FROM attachment_text WHERE rowid = OLD.id;
+    END''')
+    conn.execute('''CREATE TRIGGER trg_patient_files_text_owner AFTER UPDATE OF patient_id ON patient_files BEGIN
+        UPDATE attachment_text SET patient_id = NEW.patient_id WHERE rowid = NEW.id;
+    END''')
+    conn.execute('''CREATE TRIGGER trg_patient_files_text_payload AFTER UPDATE OF file_data ON patient_files
+    WHEN OLD.file_data IS NULL AND NEW.file_data IS NOT NULL BEGIN
+        INSERT OR IGNORE INTO attachment_text_queue (file_id) VALUES (NEW.id);
+    END''')
+
+# Near-duplicate lookups read hashes from the index alone; the partial index finds images still to hash.
+IMAGE_HASH_INDEXES = [
+    ("idx_patient_files_phash", "patient_files(phash, dhash) WHERE phash IS NOT NULL"),
+    ("idx_patient_files_unhashed", "patient_files(id) WHERE phash IS NULL AND file_type = 'image'"),
+]
+
+def _migrate_image_hashes(conn):
+    conn.execute("ALTER TABLE patient_files ADD COLUMN phash INTEGER")
+    conn.execute("ALTER TABLE patient_files ADD COLUMN dhash INTEGER")
+    conn.execute("ALTER TABLE patients ADD COLUMN photo_phash INTEGER")
+    conn.execute("ALTER TABLE patients ADD COLUMN photo_dhash INTEGER")
+    for name, spec in IMAGE_HASH_INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {spec}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_photo_phash ON patients(photo_phash, photo_dhash) "
+                 "WHERE photo_phash IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_photo_unhashed ON patients(id) "
+                 "WHERE photo_phash IS NULL AND image IS NOT NULL")
+    # A photo replaced without a new hash (e.g. by a sync peer) is re-hashed in the background.
+    conn.execute('''CREATE TRIGGER trg_patients_photo_rehash AFTER UPDATE OF image ON patients
+    WHEN NEW.image IS NOT OLD.image AND NEW.photo_phash IS OLD.photo_phash BEGIN
+        UPDATE patients SET photo_phash = NULL, photo_dhash = NULL WHERE id = NEW.id;
+    END''')
+
+def _migrate_prune_name_key_stats(conn):
+    # Keys whose last patient is gone are dropped instead of lingering at n = 0; the counts are rebuilt once.
+    conn.execute("DROP TRIGGER IF EXISTS trg_name_keys_delete")
+    conn.execute('''
+    CREATE TRIGGER trg_name_keys_delete AFTER DELETE ON patient_name_keys BEGIN
+        UPDATE name_key_stats SET n = n - 1 WHERE name_key = OLD.name_key;
+        DELETE FROM name_key_stats WHERE name_key = OLD.name_key AND n <= 0;
+    END''')
+    conn.execute("DELETE FROM name_key_stats")
+    conn.execute("INSERT INTO name_key_stats (name_key, n) SELECT name_key, COUNT(*) FROM patient_name_keys GROUP BY name_key")
+
+def _migrate_hash_passwords(conn):
+    # Passwords were stored (and synced) as typed; the stamp trigger bumps each row so peers get the hash.
+    for uid, password in conn.execute("SELECT id, password FROM users").fetchall():
+        if not is_password_hash(password):
+            conn.execute("UPDATE users SET password=? WHERE id=?", (hash_password(password or ""), uid))
+
+def _migrate_sync_hardening(conn):
+    # Deletes applied from a peer are kept out of change_log; their tombstones are kept here instead.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS sync_tombstones (
+        tbl TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (tbl, uid)
+    )''')
+    # Deltas are encrypted from now on: republish everything and re-read every peer once.
+    conn.execute("DELETE FROM app_settings WHERE key = 'sync.published_seq' OR key LIKE 'sync.pulled.%'")
+
+def _migrate_phonetic_name_keys(conn):
+    # Name lookups are index probes on phonetic keys now; the trigram postings and their counts go.
+    conn.execute("DROP TRIGGER IF EXISTS trg_name_keys_insert")
+    conn.execute("DROP TRIGGER IF EXISTS trg_name_keys_delete")
+    conn.execute("DROP TABLE IF EXISTS name_key_stats")
+    conn.execute("DELETE FROM patient_name_keys")
+    for pid, name in conn.execute("SELECT id, name FROM patients").fetchall():
+        conn.executemany("INSERT OR IGNORE INTO patient_name_keys (name_key, patient_id) VALUES (?, ?)",
+                         [(k, pid) for k in name_keys(name)])
+
+def _migrate_sync_aead(conn):
+    # The passphrase is no longer stored, and deltas switch to AES-GCM under a per-folder salt:
+    # republish everything and re-read every peer once.
+    conn.execute("DELETE FROM app_settings WHERE key = 'sync.key' OR key = 'sync.published_seq' "
+                 "OR key LIKE 'sync.pulled.%'")
+
+MIGRATIONS = [
+    _migrate_attachment_codec,
+    _migrate_cascade_deletes,
+    _migrate_settings_and_sort_indexes,
+    _migrate_duplicate_keys,
+    _migrate_incremental_vacuum,
+    _migrate_change_log,
+    _migrate_wal_journal,
+    _migrate_file_hashes,
+    _migrate_epoch_dates,
+    _migrate_appointments,
+    _migrate_patient_created_ts,
+    _migrate_integrity_scrub,
+    _migrate_attachment_text,
+    _migrate_image_hashes,
+    _migrate_prune_name_key_stats,
+    _migrate_hash_passwords,
+    _migrate_sync_hardening,
+    _migrate_phonetic_name_keys,
+    _migrate_sync_aead,
+]
+
+def run_migrations(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    # Table rebuilds need foreign keys off; the pragma is a no-op inside a transaction.
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for number, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+            if not getattr(migrate, "transactional", True):
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                continue
+            conn.execute("BEGIN")
+            try:
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
+
 def initialize_database():
+    if READ_ONLY:
+        check_readonly_database()
+        return
     try:
         conn = db_connect()
+        # Takes effect right away on a new, empty file; existing ones are converted by a deferred VACUUM.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
         c = conn.cursor()
         c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -97,15 +694,3812 @@ def initialize_database():
         c.execute("SELECT id FROM users WHERE username='abdo'")
         if not c.fetchone():
             c.execute("INSERT INTO users (username, password, role) VALUES (?,?,?)",
-                      ("abdo", "202300488", "Admin"))
+                      ("abdo", hash_password("202300488"), "Admin"))
             conn.commit()
+        run_migrations(conn)
         conn.close()
     except Exception as e:
         print(f"DB init error: {e}")
         traceback.print_exc()
 
+def check_readonly_database():
+    """A read-only workstation cannot create or migrate the database; say so instead of failing later."""
+    try:
+        conn = readonly_connect()
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
+        if version < len(MIGRATIONS):
+            print(f"Read-only mode: {DB_PATH} is at schema version {version} of {len(MIGRATIONS)}; "
+                  "start the clinic PC once to upgrade it. Newer screens may fail until then.")
+    except Exception as e:
+        print(f"Read-only mode: cannot open {DB_PATH}: {e}")
+
 initialize_database()
 
+# ---------------- Archive ----------------
+ARCHIVE_PATH = os.path.join(os.path.dirname(DB_PATH), "archive.db")
+ARCHIVE_AFTER_DAYS = 730
+ARCHIVED_TABLES = {"visits": "date_ts", "patient_files": "upload_ts"}
+
+def _table_columns(conn, schema, table):
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def _archive_table_sql(conn, table, name):
+    """main's CREATE TABLE for *table* (key, AUTOINCREMENT, defaults) as archive.*name*.
+
+    The foreign key is dropped: SQLite cannot reference patients in another database, and
+    delete_patients removes archived rows itself.
+    """
+    sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+    sql = re.sub(r",\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)[^,)]*", "", sql, flags=re.IGNORECASE)
+    return re.sub(r"^CREATE TABLE\s+(\"\w+\"|\w+)", f'CREATE TABLE archive."{name}"', sql, count=1)
+
+def _create_archive_table(conn, table, archived=()):
+    """Create archive.*table* from the real DDL, rebuilding one left by an older version without a primary key."""
+    if not archived:
+        conn.execute(_archive_table_sql(conn, table, table))
+        return
+    keep = ", ".join(c for c in archived if c in _table_columns(conn, "main", table))
+    conn.execute("SAVEPOINT archive_rebuild")
+    try:
+        conn.execute(_archive_table_sql(conn, table, f"{table}_rebuild"))
+        conn.execute(f"INSERT INTO archive.{table}_rebuild ({keep}) SELECT {keep} FROM archive.{table}")
+        conn.execute(f"DROP TABLE archive.{table}")
+        conn.execute(f"ALTER TABLE archive.{table}_rebuild RENAME TO {table}")
+        conn.execute("RELEASE archive_rebuild")
+    except Exception:
+        conn.execute("ROLLBACK TO archive_rebuild")
+        conn.execute("RELEASE archive_rebuild")
+        raise
+
+def archive_stamp(schema):
+    """Extra SET terms for an edit in *schema*: archive tables have no stamp triggers, so a row
+    edited there bumps its own version (report fingerprints read it)."""
+    return ", version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')" if schema == "archive" else ""
+
+def attach_archive(conn, create=False, readonly=False):
+    """ATTACH archive.db as `archive` and create all_visits / all_patient_files union views.
+
+    Without an archive file (and create=False) the views cover the hot tables only. A read-only
+    connection leaves the archive schema alone and reads columns it lacks as NULL.
+    """
+    readonly = readonly or READ_ONLY
+    attached = create or os.path.exists(ARCHIVE_PATH)
+    if attached:
+        # ATTACH does not inherit mode=ro from the main database; ask for it (URI connections only).
+        conn.execute("ATTACH DATABASE ? AS archive", (f"file:{ARCHIVE_PATH}?mode=ro" if readonly else ARCHIVE_PATH,))
+    for table in ARCHIVED_TABLES:
+        cols = _table_columns(conn, "main", table)
+        archived = _table_columns(conn, "archive", table) if attached else []
+        if attached and not readonly:
+            if not archived or not any(r[5] for r in conn.execute(f"PRAGMA archive.table_info({table})")):
+                _create_archive_table(conn, table, archived)
+            else:
+                for col in cols:
+                    if col not in archived:
+                        conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {col}")
+            if archived and ARCHIVED_TABLES[table] not in archived:
+                backfill_timestamps(conn, "archive", (table,))
+            conn.execute(f"CREATE INDEX IF NOT EXISTS archive.idx_{table}_patient ON {table}(patient_id)")
+            # Period reports read archived history by date.
+            conn.execute(f"CREATE INDEX IF NOT EXISTS archive.idx_{table}_{ARCHIVED_TABLES[table]} "
+                         f"ON {table}({ARCHIVED_TABLES[table]})")
+            if table == "patient_files":
+                for name, spec in IMAGE_HASH_INDEXES:
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS archive.{name} ON {spec}")
+            archived = cols
+        col_list = ", ".join(cols)
+        conn.execute(f"DROP VIEW IF EXISTS temp.all_{table}")
+        archived_list = ", ".join(c if c in archived else f"NULL AS {c}" for c in cols)
+        union = f" UNION ALL SELECT {archived_list} FROM archive.{table}" if archived else ""
+        conn.execute(f"CREATE TEMP VIEW all_{table} AS SELECT {col_list} FROM main.{table}{union}")
+    return attached
+
+def archive_connect(create=False):
+    conn = db_connect()
+    try:
+        attach_archive(conn, create=create)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+def _finish_interrupted_moves(conn):
+    """Resolve rows left on both sides by a move that stopped between its copy and its delete.
+
+    Live and archived ids never overlap otherwise; the main copy wins, since it is the one the
+    application kept editing.
+    """
+    conn.execute("BEGIN")
+    try:
+        for table in ARCHIVED_TABLES:
+            conn.execute(f"DELETE FROM archive.{table} WHERE id IN (SELECT id FROM main.{table})")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def _commit_one(conn, schema, sql):
+    conn.execute("BEGIN")
+    try:
+        # Only main has change_log triggers, and muting writes to main: archive-only steps stay archive-only.
+        with change_log_muted(conn) if schema == "main" else nullcontext():
+            conn.execute(sql)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def _move_rows(conn, table, source, target, where, params=()):
+    """Move *table* rows matching *where* from *source* to *target*; return the number moved.
+
+    main runs in WAL mode, where a commit spanning attached databases is not atomic, so the copy is
+    committed and checked before the originals are deleted. A crash in between leaves a row on both
+    sides, never on neither.
+    """
+    cols = ", ".join(_table_columns(conn, "main", table))
+    conn.execute("DROP TABLE IF EXISTS temp.moving")
+    conn.execute(f"CREATE TEMP TABLE moving AS SELECT id FROM {source}.{table} {where}", params)
+    moving = "(SELECT id FROM temp.moving)"
+    _commit_one(conn, target, f"INSERT OR REPLACE INTO {target}.{table} ({cols}) "
+                              f"SELECT {cols} FROM {source}.{table} WHERE id IN {moving}")
+    missing = conn.execute(f"SELECT COUNT(*) FROM (SELECT {cols} FROM {source}.{table} WHERE id IN {moving} "
+                           f"EXCEPT SELECT {cols} FROM {target}.{table} WHERE id IN {moving})").fetchone()[0]
+    if missing:
+        raise sqlite3.DatabaseError(f"{missing} {table} row(s) did not reach {target}; nothing was deleted")
+    _commit_one(conn, source, f"DELETE FROM {source}.{table} WHERE id IN {moving}")
+    count = conn.execute("SELECT COUNT(*) FROM temp.moving").fetchone()[0]
+    conn.execute("DROP TABLE temp.moving")
+    return count
+
+def archive_old_records(days=ARCHIVE_AFTER_DAYS):
+    """Move visits and files older than *days* into archive.db; return moved counts."""
+    cutoff = int(time.time() - days * 86400)
+    conn = archive_connect(create=True)
+    try:
+        _finish_interrupted_moves(conn)
+        return {table: _move_rows(conn, table, "main", "archive", f"WHERE {ts_col} < ?", (cutoff,))
+                for table, ts_col in ARCHIVED_TABLES.items()}
+    finally:
+        conn.close()
+
+def restore_archived_records(patient_id=None):
+    """Move archived visits and files (all, or one patient's) back into the hot database."""
+    if not os.path.exists(ARCHIVE_PATH):
+        return {t: 0 for t in ARCHIVED_TABLES}
+    conn = archive_connect()
+    where, params = ("WHERE patient_id = ?", (patient_id,)) if patient_id is not None else ("", ())
+    try:
+        # An id already live is an interrupted move; its archived copy is dropped, not restored over it.
+        _finish_interrupted_moves(conn)
+        return {table: _move_rows(conn, table, "archive", "main", where, params) for table in ARCHIVED_TABLES}
+    finally:
+        conn.close()
+
+# ---------------- Attachment Codec ----------------
+CODEC_MIN_BYTES = 1024
+CODEC_LZMA_MIN_BYTES = 1024 * 1024
+CODEC_MAX_ENTROPY = 7.2  # bits per byte; above this the data is already compressed
+CODEC_SAMPLE_BYTES = 16 * 1024
+CODEC_CHUNK_BYTES = 64 * 1024
+PRECOMPRESSED_EXTS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".zip", ".gz", ".7z", ".rar",
+                      ".docx", ".xlsx", ".pptx", ".mp3", ".mp4"}
+
+def sample_entropy(data, samples=4):
+    """Shannon entropy (bits/byte) of a few slices spread across *data*."""
+    if not data:
+        return 0.0
+    per = CODEC_SAMPLE_BYTES // samples
+    step = max(per, len(data) // samples)
+    sample = b"".join(data[i:i + per] for i in range(0, len(data), step))
+    total = len(sample)
+    counts = (sample.count(bytes([b])) for b in range(256))
+    return -sum(n / total * math.log2(n / total) for n in counts if n)
+
+def encode_attachment(data, name=""):
+    """Return (stored_bytes, codec, original_size); codec is 'raw' when compression does not pay."""
+    size = len(data)
+    if (size < CODEC_MIN_BYTES or os.path.splitext(name)[1].lower() in PRECOMPRESSED_EXTS
+            or sample_entropy(data) > CODEC_MAX_ENTROPY):
+        return data, "raw", size
+    if size >= CODEC_LZMA_MIN_BYTES:
+        packed, codec = lzma.compress(data, preset=6), "lzma"
+    else:
+        packed, codec = zlib.compress(data, 6), "zlib"
+    if len(packed) > size * 0.9:
+        return data, "raw", size
+    return packed, codec, size
+
+def _decompressor(codec):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "lzma":
+        return lzma.LZMADecompressor()
+    return None
+
+def decode_attachment(data, codec):
+    if data is None or codec in (None, "raw"):
+        return data
+    d = _decompressor(codec)
+    if d is None:
+        raise ValueError(f"Unknown attachment codec: {codec}")
+    return d.decompress(data)
+
+def iter_attachment(conn, file_id, schema="main"):
+    """Stream one stored file's original bytes in chunks without loading the whole BLOB."""
+    codec = conn.execute(f"SELECT codec FROM {schema}.patient_files WHERE id=?", (file_id,)).fetchone()[0]
+    d = _decompressor(codec)
+    with conn.blobopen("patient_files", "file_data", file_id, readonly=True, name=schema) as blob:
+        while True:
+            chunk = blob.read(CODEC_CHUNK_BYTES)
+            if not chunk:
+                break
+            out = d.decompress(chunk) if d else chunk
+            if out:
+                yield out
+    if d is not None and hasattr(d, "flush"):
+        tail = d.flush()
+        if tail:
+            yield tail
+
+class AttachmentRecompressor:
+    """Background job that compresses legacy patient_files rows (codec IS NULL) in small batches."""
+    def __init__(self, batch=16, pause=0.2):
+        self.batch = batch
+        self.pause = pause
+        self.processed = 0
+        self.bytes_saved = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="recompress", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def run(self):
+        last_id = 0
+        try:
+            while not self._stop.is_set():
+                conn = db_connect()
+                try:
+                    # A row synced from a peer has no bytes (nor codec) until its blob is fetched; leave it be.
+                    rows = conn.execute("SELECT id, file_name, file_data FROM patient_files "
+                                        "WHERE codec IS NULL AND file_data IS NOT NULL AND id > ? ORDER BY id LIMIT ?",
+                                        (last_id, self.batch)).fetchall()
+                    if not rows:
+                        break
+                    updates = []
+                    for fid, name, data in rows:
+                        packed, codec, size = encode_attachment(bytes(data), name or "")
+                        updates.append((sqlite3.Binary(packed), codec, size, fid))
+                        self.bytes_saved += size - len(packed)
+                    conn.executemany("UPDATE patient_files SET file_data=?, codec=?, orig_size=IFNULL(orig_size, ?) "
+                                     "WHERE id=? AND codec IS NULL AND file_data IS NOT NULL", updates)
+                    conn.commit()
+                    self.processed += len(rows)
+                    last_id = rows[-1][0]
+                finally:
+                    conn.close()
+                time.sleep(self.pause)
+        except Exception as e:
+            print(f"Attachment recompression error: {e}")
+            traceback.print_exc()
+
+RECOMPRESSOR = AttachmentRecompressor()
+
+# ---------------- Row Models ----------------
+def row_model(name, fields, columns=None, shared=""):
+    """Build a compact named-tuple row type with a matching sqlite3 row_factory and SELECT list.
+
+    Text in the *shared* fields (gender, doctor and the like) is interned, so the thousands of rows
+    holding the same value share one string instead of each carrying its own copy.
+    """
+    cls = namedtuple(name, fields)
+    new = tuple.__new__
+    cls.columns = columns or ", ".join(cls._fields)
+    pooled = [cls._fields.index(f) for f in shared.split()]
+    if not pooled:
+        cls.row_factory = staticmethod(lambda cursor, row: new(cls, row))
+        return cls
+    intern = sys.intern
+
+    def row_factory(cursor, row):
+        row = list(row)
+        for i in pooled:
+            if type(row[i]) is str:
+                row[i] = intern(row[i])
+        return new(cls, row)
+    cls.row_factory = staticmethod(row_factory)
+    return cls
+
+Patient = row_model(
+    "Patient", "id name age gender phone address occupation diagnosis prescription last_visit doctor image",
+    "id, name, age, gender, phone, address, occupation, diagnosis, prescription, "
+    f"{display_date_sql('last_visit_ts', 'last_visit')}, doctor, image")
+PatientName = row_model("PatientName", "id name")
+PatientListRow = row_model(
+    "PatientListRow", "id name age gender phone occupation doctor last_visit",
+    "id, IFNULL(name,''), IFNULL(age,''), IFNULL(gender,''), IFNULL(phone,''), "
+    f"IFNULL(occupation,''), IFNULL(doctor,''), {display_date_sql('last_visit_ts', 'last_visit')}",
+    shared="gender occupation doctor last_visit")
+Visit = row_model("Visit", "id patient_id date diagnosis prescription doctor price",
+                  f"id, patient_id, {display_date_sql('date_ts', 'date')}, diagnosis, prescription, doctor, price")
+VisitListRow = row_model(
+    "VisitListRow", "id patient date diagnosis prescription doctor price",
+    f"v.id, COALESCE(p.name, 'Unknown'), {display_date_sql('v.date_ts', 'v.date')}, IFNULL(v.diagnosis,''), "
+    "IFNULL(v.prescription,''), IFNULL(v.doctor,''), CASE WHEN v.price IS NULL THEN '' ELSE printf('%.2f', v.price) END",
+    shared="patient diagnosis prescription doctor price")
+PatientFile = row_model("PatientFile", "file_name file_type upload_date file_data codec",
+                        f"file_name, file_type, {display_date_sql('upload_ts', 'upload_date')}, file_data, codec")
+PatientExportRow = row_model(
+    "PatientExportRow", "id name age gender phone address occupation diagnosis prescription last_visit doctor",
+    "id, IFNULL(name,''), IFNULL(age,''), IFNULL(gender,''), IFNULL(phone,''), IFNULL(address,''), "
+    "IFNULL(occupation,''), IFNULL(diagnosis,''), IFNULL(prescription,''), "
+    f"{display_date_sql('last_visit_ts', 'last_visit')}, IFNULL(doctor,'')")
+User = row_model("User", "id username role")
+UserListRow = row_model("UserListRow", "id username role", "id, IFNULL(username,''), IFNULL(role,'')")
+DuplicateCandidate = row_model("DuplicateCandidate", "id name phone last_visit score reason",
+                               "id, IFNULL(name,''), IFNULL(phone,''), "
+                               f"{display_date_sql('last_visit_ts', 'last_visit')}, 0.0, ''")
+AttachmentRow = row_model(
+    "AttachmentRow", "id file_name file_type size upload_date codec has_thumbnail pending sort_ts",
+    "id, IFNULL(file_name,''), IFNULL(file_type,''), IFNULL(orig_size, length(file_data)), "
+    f"{display_date_sql('upload_ts', 'upload_date')}, IFNULL(codec,'raw'), thumbnail IS NOT NULL, file_data IS NULL, "
+    "IFNULL(upload_ts, 0)")
+VisitSummary = row_model("VisitSummary", "visits first_visit last_visit total",
+                         "COUNT(*), strftime('%Y-%m-%d', MIN(date_ts), 'unixepoch', 'localtime'), "
+                         "strftime('%Y-%m-%d', MAX(date_ts), 'unixepoch', 'localtime'), IFNULL(SUM(price), 0)")
+# What the patient form shows: the row without its image BLOB, the photo already decoded and
+# downscaled (None if missing or undecodable), and the visit summary.
+PatientDetails = namedtuple("PatientDetails", "patient photo has_photo summary")
+Appointment = row_model("Appointment", "id patient_id doctor start_ts end_ts status notes visit_id")
+IntegrityFinding = row_model("IntegrityFinding", "id kind tbl row_id detail found_at")
+ImageMatch = row_model("ImageMatch", "kind id patient_id patient file_name size upload_date distance",
+                       "'file', f.id, f.patient_id, IFNULL(p.name,''), IFNULL(f.file_name,''), "
+                       f"IFNULL(f.orig_size, length(f.file_data)), {display_date_sql('f.upload_ts', 'f.upload_date')}, 0")
+AttachmentMatch = row_model("AttachmentMatch", "patient_id name phone hits score",
+                            "t.patient_id, IFNULL(p.name,''), IFNULL(p.phone,''), COUNT(*), MIN(t.score)")
+AttachmentSnippet = row_model("AttachmentSnippet", "id patient_id file_name snippet score",
+                              "rowid, patient_id, file_name, snippet(attachment_text, 1, '[', ']', '…', 12), "
+                              "bm25(attachment_text)")
+AppointmentListRow = row_model(
+    "AppointmentListRow", "id patient_id patient doctor start_ts end_ts status notes",
+    "a.id, a.patient_id, COALESCE(p.name, 'Unknown'), a.doctor, a.start_ts, a.end_ts, a.status, IFNULL(a.notes,'')")
+
+# ---------------- Table Sorting & Filtering ----------------
+TABLE_PAGE_SIZE = 500
+ATTACHMENT_PAGE_SIZE = 50
+_FILTER_OPS = (">=", "<=", ">", "<", "=")
+
+class TableQuery:
+    """Sort, per-column filter and paging state of one Treeview, rendered as SQL.
+
+    columns maps a Treeview column to (sql_expression, "text" | "num" | "date"). Text
+    filters are prefix matches (a leading * means "contains"); numeric filters accept
+    >, <, >=, <=, = or a plain value. Date filters take the same operators before a
+    year, month or day ("2024-03" is all of March) and compare epoch columns as
+    ranges. The sort column persists in app_settings.
+
+    Pages are keyset pages: each one starts after the (sort value, id) of the previous
+    page's last row, so a deep page costs the same as the first one.
+    """
+    def __init__(self, key, columns, id_expr="id", default_sort="id", default_desc=True, page_size=TABLE_PAGE_SIZE):
+        self.key = key
+        self.columns = columns
+        self.id_expr = id_expr
+        self.page_size = page_size
+        self.filters = {}
+        self.reset_page()
+        self.sort, self.desc = default_sort, default_desc
+        try:
+            state = json.loads(repo.get_setting(f"sort.{key}") or "{}")
+            if state.get("column") in columns:
+                self.sort, self.desc = state["column"], bool(state.get("desc"))
+        except Exception:
+            pass
+
+    def toggle_sort(self, column):
+        if column == self.sort:
+            self.desc = not self.desc
+        else:
+            self.sort, self.desc = column, False
+        self.reset_page()
+        if READ_ONLY:
+            return
+        try:
+            repo.set_setting(f"sort.{self.key}", json.dumps({"column": self.sort, "desc": self.desc}))
+        except Exception as e:
+            print(f"Failed to save sort state: {e}")
+
+    def set_filter(self, column, value):
+        value = (value or "").strip()
+        if value:
+            self.filters[column] = value
+        else:
+            self.filters.pop(column, None)
+        self.reset_page()
+
+    def clear_filters(self):
+        self.filters = {}
+        self.reset_page()
+
+    def reset_page(self):
+        self.page = 0
+        self.start = None  # (sort value, id) the current page starts after; None on the first page
+        self.next_key = None
+        self._starts = []
+
+    def next_page(self):
+        if self.next_key is None:
+            return False
+        self._starts.append(self.start)
+        self.start, self.page = self.next_key, self.page + 1
+        return True
+
+    def prev_page(self):
+        if not self._starts:
+            return False
+        self.start, self.page = self._starts.pop(), self.page - 1
+        return True
+
+    def where(self):
+        """Return (list of SQL conditions, params) for the active filters."""
+        clauses, params = [], []
+        for column, value in self.filters.items():
+            expr, kind = self.columns[column]
+            if kind == "date":
+                op = next((o for o in _FILTER_OPS if value.startswith(o)), "=")
+                start, end = timestamp_range(value[len(op):] if value.startswith(op) else value)
+                if op == "=":
+                    clauses.append(f"{expr} >= ? AND {expr} < ?")
+                    params.extend((start, end))
+                else:
+                    # ">" means after the whole period, "<=" up to its end.
+                    bound = end if op in (">", "<=") else start
+                    clauses.append(f"{expr} {'>=' if op.startswith('>') else '<'} ?")
+                    params.append(bound)
+            elif kind == "num":
+                op = next((o for o in _FILTER_OPS if value.startswith(o)), "=")
+                number = value[len(op):].strip() if value.startswith(op) else value
+                clauses.append(f"{expr} {op} ?")
+                params.append(float(number))
+            else:
+                contains = value.startswith("*")
+                text = value.lstrip("*").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                clauses.append(f"{expr} LIKE ? ESCAPE '\\'")
+                params.append(f"%{text}%" if contains else f"{text}%")
+        return clauses, params
+
+    def order_by(self):
+        direction = "DESC" if self.desc else "ASC"
+        expr = self.columns[self.sort][0]
+        if expr == self.id_expr:
+            return f"{expr} {direction}"
+        return f"{expr} {direction}, {self.id_expr} {direction}"
+
+    def keyset(self):
+        """(SQL conditions, params) selecting the rows after self.start in the current order.
+
+        NULL sort values come first ascending and last descending, as in ORDER BY.
+        """
+        if self.start is None:
+            return [], []
+        value, last_id = self.start
+        expr, op = self.columns[self.sort][0], "<" if self.desc else ">"
+        if expr == self.id_expr:
+            return [f"{self.id_expr} {op} ?"], [last_id]
+        if value is None:
+            rest = "" if self.desc else f" OR {expr} IS NOT NULL"
+            return [f"(({expr} IS NULL AND {self.id_expr} {op} ?){rest})"], [last_id]
+        rest = f" OR {expr} IS NULL" if self.desc else ""
+        return [f"({expr} {op} ? OR ({expr} = ? AND {self.id_expr} {op} ?){rest})"], [value, value, last_id]
+
+    def limit(self):
+        """One extra row tells the caller whether a next page exists."""
+        return f"LIMIT {self.page_size + 1}"
+
+    def sql(self, select_from, extra_where=(), extra_params=()):
+        """Page query for a "SELECT ... FROM ..." statement; each row gets the sort value and id in front."""
+        clauses, params = self.where()
+        keyset, key_params = self.keyset()
+        clauses = list(extra_where) + clauses + keyset
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        select = select_from.replace("SELECT ", f"SELECT {self.columns[self.sort][0]}, {self.id_expr}, ", 1)
+        return (f"{select}{where} ORDER BY {self.order_by()} {self.limit()}",
+                list(extra_params) + params + key_params)
+
+    def page_rows(self, model, rows):
+        """Strip the key columns sql() put in front of each row and remember where the next page starts."""
+        self.next_key = tuple(rows[self.page_size - 1][:2]) if len(rows) > self.page_size else None
+        return [model.row_factory(None, r[2:]) for r in rows]
+
+PATIENT_TABLE_COLUMNS = {
+    "id": ("id", "num"), "name": ("name COLLATE NOCASE", "text"), "age": ("age", "num"),
+    "gender": ("gender COLLATE NOCASE", "text"), "phone": ("phone COLLATE NOCASE", "text"),
+    "occupation": ("occupation COLLATE NOCASE", "text"), "doctor": ("doctor COLLATE NOCASE", "text"),
+    "last_visit": ("last_visit_ts", "date"),
+}
+VISIT_TABLE_COLUMNS = {
+    "id": ("v.id", "num"), "patient": ("p.name COLLATE NOCASE", "text"), "date": ("v.date_ts", "date"),
+    "diagnosis": ("v.diagnosis COLLATE NOCASE", "text"), "prescription": ("v.prescription COLLATE NOCASE", "text"),
+    "doctor": ("v.doctor COLLATE NOCASE", "text"), "price": ("v.price", "num"),
+}
+USER_TABLE_COLUMNS = {
+    "id": ("id", "num"), "username": ("username COLLATE NOCASE", "text"), "role": ("role COLLATE NOCASE", "text"),
+}
+
+# ---------------- Query Cache ----------------
+QUERY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+def _estimate_size(value):
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+class QueryCache:
+    """Read-through LRU cache of query results keyed by SQL and parameters.
+
+    Entries are bounded by estimated memory and tagged with the tables they read.
+    Writers invalidate per table; PRAGMA data_version on a watcher connection
+    catches commits made by other processes.
+    """
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, connect=None):
+        self.max_bytes = max_bytes
+        self._connect = connect
+        self._entries = OrderedDict()
+        self._by_table = {}
+        self._lock = threading.RLock()
+        self._watch = None
+        self._data_version = None
+        self.size = 0
+        self.epoch = 0  # bumped on every invalidation; a put() started under an older epoch is dropped
+        self.hits = self.misses = self.evictions = self.invalidations = self.external_changes = 0
+
+    def _current_version(self):
+        if self._watch is None:
+            # Shared with background readers, always used under self._lock
+            self._watch = self._connect() if self._connect else readonly_connect(check_same_thread=False)
+        return self._watch.execute("PRAGMA data_version").fetchone()[0]
+
+    def _check_external(self):
+        try:
+            version = self._current_version()
+        except Exception:
+            self._watch = None
+            self._drop_all()
+            return
+        if self._data_version is not None and version != self._data_version:
+            self.external_changes += 1
+            self._drop_all()
+        self._data_version = version
+
+    def note_local_write(self):
+        """Accept our own commit as the new data_version baseline (its tables were already invalidated)."""
+        with self._lock:
+            try:
+                self._data_version = self._current_version()
+            except Exception:
+                self._watch = None
+                self._drop_all()
+
+    def get(self, key):
+        with self._lock:
+            self._check_external()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, rows, tables, epoch=None):
+        size = _estimate_size(rows)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return  # a write landed while these rows were being read
+            self._remove(key)
+            self._entries[key] = (rows, size, tables)
+            self.size += size
+            for t in tables:
+                self._by_table.setdefault(t, set()).add(key)
+            while self.size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        for t in entry[2]:
+            keys = self._by_table.get(t)
+            if keys:
+                keys.discard(key)
+
+    def _drop_all(self):
+        self.epoch += 1
+        self._entries.clear()
+        self._by_table.clear()
+        self.size = 0
+
+    def invalidate(self, *tables):
+        with self._lock:
+            self.epoch += 1
+            for t in tables:
+                for key in list(self._by_table.pop(t, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._drop_all()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations,
+                    "external_changes": self.external_changes}
+
+class ClinicRepository:
+    """Typed, column-selective access to the clinic database, with cached reads."""
+    def __init__(self, connect=None, cache=None, conn=None):
+        self._connect = connect
+        self.cache = cache
+        self._conn = conn  # pinned connection of a snapshot(); reads share it and never close it
+
+    def connect(self, archive=False):
+        if self._conn is not None:
+            return self._conn
+        if archive:
+            conn = self.connect()
+            attach_archive(conn)
+            return conn
+        return (self._connect or db_connect)()
+
+    def _query(self, model, sql, params=(), one=False, tables=None, archive=False):
+        key = None
+        if tables and self.cache is not None:
+            key = (model, sql, tuple(params), one)
+            rows = self.cache.get(key)
+            if rows is not None:
+                return rows if one else list(rows)
+            epoch = self.cache.epoch
+        conn = self.connect(archive)
+        try:
+            # Snapshot repositories share one connection across models; set (or clear) the factory every time.
+            conn.row_factory = model.row_factory if model else None
+            cur = conn.execute(sql, params)
+            rows = cur.fetchone() if one else cur.fetchall()
+        finally:
+            if conn is not self._conn:
+                conn.close()
+        if key is not None and rows is not None:
+            # Rows are immutable tuples; the cache keeps its own tuple and every caller gets a fresh list.
+            self.cache.put(key, rows if one else tuple(rows), tables, epoch)
+        return rows
+
+    @contextmanager
+    def snapshot(self):
+        """Yield a read-only repository pinned to one point in time.
+
+        Every read goes through a single mode=ro connection inside one read transaction, so a long
+        export sees a consistent database and never holds a lock that stalls save_visit.
+        """
+        conn = readonly_connect()
+        try:
+            attach_archive(conn, readonly=True)
+            conn.execute("BEGIN")
+            yield ClinicRepository(cache=None, conn=conn)
+        finally:
+            conn.rollback()
+            conn.close()
+
+    @contextmanager
+    def _write(self, *tables):
+        """Run a write transaction and invalidate cached reads of *tables* once it commits."""
+        conn = self.connect()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if self.cache is not None:
+            self.cache.invalidate(*tables)
+            self.cache.note_local_write()
+
+    def authenticate(self, username, password):
+        row = self._query(None, "SELECT id, password FROM users WHERE username=?", (username,), one=True)
+        if row is None or not verify_password(password, row[1]):
+            return None
+        return self._query(User, f"SELECT {User.columns} FROM users WHERE id=?", (row[0],), one=True)
+
+    def get_setting(self, key, default=None):
+        row = self._query(None, "SELECT value FROM app_settings WHERE key=?", (key,), one=True)
+        return row[0] if row else default
+
+    def set_setting(self, key, value):
+        with self._write("app_settings") as conn:
+            conn.execute("INSERT INTO app_settings (key, value) VALUES (?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+
+    def integrity_findings(self):
+        return self._query(IntegrityFinding, f"SELECT {IntegrityFinding.columns} FROM integrity_findings "
+                                             "ORDER BY kind, tbl, row_id", tables=("integrity_findings",))
+
+    def list_patients(self, query=None, search=""):
+        """All patients newest first, or one sorted/filtered page when a TableQuery is given."""
+        select = f"SELECT {PatientListRow.columns} FROM patients"
+        where, params = [], []
+        if search:
+            like = f"%{search}%"
+            where, params = ["(name LIKE ? OR phone LIKE ? OR doctor LIKE ? OR occupation LIKE ?)"], [like] * 4
+        if query is None:
+            sql = select + (f" WHERE {where[0]}" if where else "") + " ORDER BY id DESC"
+        else:
+            sql, params = query.sql(select, where, params)
+            return query.page_rows(PatientListRow, self._query(None, sql, params, tables=("patients",)))
+        return self._query(PatientListRow, sql, params, tables=("patients",))
+
+    def search_patients(self, kw, query=None):
+        return self.list_patients(query, search=kw)
+
+    def search_attachments(self, text, limit=None):
+        """Patients whose files contain *text*, most matching files first, with a few snippets each.
+
+        Returns (matches, {patient_id: [AttachmentSnippet]}); both empty when *text* has no words.
+        """
+        match = fts_query(text)
+        if match is None:
+            return [], {}
+        matches = self._query(AttachmentMatch, f"SELECT {AttachmentMatch.columns} FROM (SELECT patient_id, "
+                                               "rank AS score FROM attachment_text "
+                                               "WHERE attachment_text MATCH ?) t JOIN patients p ON p.id = t.patient_id "
+                                               "GROUP BY t.patient_id ORDER BY COUNT(*) DESC, MIN(t.score) LIMIT ?",
+                              (match, limit or TEXT_SEARCH_LIMIT))
+        snippets = {}
+        if matches:
+            # bm25 order within a patient, so the first snippets shown are the best ones.
+            for row in self._query(AttachmentSnippet, f"SELECT {AttachmentSnippet.columns} FROM attachment_text "
+                                                      "WHERE attachment_text MATCH ? AND patient_id IN "
+                                                      "(SELECT value FROM json_each(?)) ORDER BY rank",
+                                   (match, json.dumps([m.patient_id for m in matches]))):
+                found = snippets.setdefault(row.patient_id, [])
+                if len(found) < TEXT_SNIPPETS_PER_PATIENT:
+                    found.append(row)
+        return matches, snippets
+
+    def export_patients(self):
+        return self._query(PatientExportRow, f"SELECT {PatientExportRow.columns} FROM patients")
+
+    def get_patient(self, pid):
+        return self._query(Patient, f"SELECT {Patient.columns} FROM patients WHERE id=?", (pid,), one=True)
+
+    def patient_details(self, pid):
+        """PatientDetails for the form, cached as one entry invalidated by patient and visit writes."""
+        key = (PatientDetails, pid)
+        if self.cache is not None:
+            details = self.cache.get(key)
+            if details is not None:
+                return details
+            epoch = self.cache.epoch
+        p = self.get_patient(pid)
+        if p is None:
+            return None
+        details = PatientDetails(p._replace(image=None), decode_photo(p.image) if p.image else None,
+                                 bool(p.image), self.visit_summary(pid))
+        if self.cache is not None:
+            self.cache.put(key, details, ("patients", "visits"), epoch)
+        return details
+
+    def get_patient_name(self, pid):
+        return self._query(PatientName, "SELECT id, name FROM patients WHERE id=?", (pid,), one=True)
+
+    def patient_names(self):
+        return self._query(PatientName, "SELECT id, name FROM patients ORDER BY name", tables=("patients",))
+
+    def count_patients(self):
+        return self._query(None, "SELECT COUNT(1) FROM patients", one=True, tables=("patients",))[0]
+
+    def list_visits(self, patient_id=None, query=None):
+        """Recent visits come from the hot table; one patient's history also includes archived visits."""
+        source = "visits" if patient_id is None else "all_visits"
+        select = f"SELECT {VisitListRow.columns} FROM {source} v LEFT JOIN patients p ON v.patient_id = p.id"
+        where, params = ([], []) if patient_id is None else (["v.patient_id = ?"], [patient_id])
+        if query is not None:
+            sql, params = query.sql(select, where, params)
+            return query.page_rows(VisitListRow, self._query(None, sql, params, tables=("visits", "patients"),
+                                                             archive=patient_id is not None))
+        sql = select + (f" WHERE {where[0]}" if where else "") + " ORDER BY v.id DESC"
+        return self._query(VisitListRow, sql, params, tables=("visits", "patients"), archive=patient_id is not None)
+
+    def get_visit(self, vid):
+        """A visit by id, archived or not (ids stay unique when visits move to archive.db)."""
+        return self._query(Visit, f"SELECT {Visit.columns} FROM all_visits WHERE id=?", (vid,), one=True, archive=True)
+
+    def patient_visits(self, pid):
+        return self._query(Visit, f"SELECT {Visit.columns} FROM all_visits WHERE patient_id=? ORDER BY date_ts DESC, id DESC", (pid,),
+                           archive=True)
+
+    @staticmethod
+    def _visit_range(pid, start_ts, end_ts):
+        where, params = ["patient_id=?"], [pid]
+        if start_ts is not None:
+            where.append("date_ts >= ?")
+            params.append(start_ts)
+        if end_ts is not None:
+            where.append("date_ts < ?")
+            params.append(end_ts)
+        return " AND ".join(where), params
+
+    def iter_patient_visits(self, pid, start_ts=None, end_ts=None, batch=500):
+        """Yield a patient's visits (archived included), newest first, without building a list."""
+        where, params = self._visit_range(pid, start_ts, end_ts)
+        conn = self.connect(archive=True)
+        try:
+            conn.row_factory = Visit.row_factory
+            cur = conn.execute(f"SELECT {Visit.columns} FROM all_visits WHERE {where} ORDER BY date_ts DESC, id DESC",
+                               params)
+            for rows in iter(lambda: cur.fetchmany(batch), []):
+                yield from rows
+        finally:
+            if conn is not self._conn:
+                conn.close()
+
+    def visit_summary(self, pid, start_ts=None, end_ts=None):
+        where, params = self._visit_range(pid, start_ts, end_ts)
+        return self._query(VisitSummary, f"SELECT {VisitSummary.columns} FROM all_visits WHERE {where}", params,
+                           one=True, archive=True)
+
+    def patient_files(self, pid):
+        """Return a patient's files (archived included) with file_data already decoded.
+
+        Files synced from another workstation whose payload has not arrived yet are fetched first.
+        """
+        sql = f"SELECT {PatientFile.columns} FROM all_patient_files WHERE patient_id=? ORDER BY upload_ts DESC, id DESC"
+        rows = self._query(PatientFile, sql, (pid,), archive=True)
+        if self._conn is None and any(f.file_data is None for f in rows) and SYNC.fetch_patient_blobs(pid):
+            rows = self._query(PatientFile, sql, (pid,), archive=True)
+        return [f._replace(file_data=decode_attachment(f.file_data, f.codec), codec="raw") for f in rows]
+
+    def list_attachments(self, pid, after=None, page_size=ATTACHMENT_PAGE_SIZE):
+        """One page of a patient's files (archived included) as metadata only; no file_data is read.
+
+        *after* is the (sort_ts, id) of the previous page's last row; None for the first page.
+        """
+        where, params = "patient_id=?", [pid]
+        if after is not None:
+            where += " AND (IFNULL(upload_ts, 0), id) < (?, ?)"
+            params += list(after)
+        return self._query(AttachmentRow, f"SELECT {AttachmentRow.columns} FROM all_patient_files WHERE {where} "
+                                          "ORDER BY IFNULL(upload_ts, 0) DESC, id DESC LIMIT ?",
+                           params + [page_size], tables=("patient_files",), archive=True)
+
+    def attachment_rows(self, pid):
+        """All of a patient's files as metadata, newest first."""
+        return self._query(AttachmentRow, f"SELECT {AttachmentRow.columns} FROM all_patient_files WHERE patient_id=? "
+                                          "ORDER BY IFNULL(upload_ts, 0) DESC, id DESC", (pid,), archive=True)
+
+    def count_attachments(self, pid):
+        return self._query(None, "SELECT COUNT(*) FROM all_patient_files WHERE patient_id=?", (pid,), one=True,
+                           tables=("patient_files",), archive=True)[0]
+
+    def attachment_thumbnails(self, ids):
+        """{file id: thumbnail JPEG bytes} for the given files that have one."""
+        rows = self._query(None, "SELECT id, thumbnail FROM all_patient_files "
+                                 "WHERE id IN (SELECT value FROM json_each(?)) AND thumbnail IS NOT NULL",
+                           (json.dumps(sorted(int(i) for i in ids)),), tables=("patient_files",), archive=True)
+        return {fid: bytes(thumb) for fid, thumb in rows}
+
+    def image_hash_rows(self):
+        """(kind, id, phash, dhash) of every hashed attachment and patient photo; read from indexes only."""
+        return self._query(None, "SELECT 'file', id, phash, dhash FROM all_patient_files WHERE phash IS NOT NULL "
+                                 "UNION ALL SELECT 'photo', id, photo_phash, photo_dhash FROM patients "
+                                 "WHERE photo_phash IS NOT NULL", tables=("patient_files", "patients"), archive=True)
+
+    def image_matches(self, keys):
+        """{(kind, id): ImageMatch} for ('file', file id) and ('photo', patient id) keys that still exist."""
+        ids = {"file": [], "photo": []}
+        for kind, rid in keys:
+            ids[kind].append(rid)
+        rows = self._query(ImageMatch, f"SELECT {ImageMatch.columns} FROM all_patient_files f "
+                                       "LEFT JOIN patients p ON p.id = f.patient_id WHERE f.id IN (SELECT value FROM json_each(?)) "
+                                       "UNION ALL SELECT 'photo', id, id, IFNULL(name,''), 'Patient photo', length(image), '', 0 "
+                                       "FROM patients WHERE id IN (SELECT value FROM json_each(?))",
+                           (json.dumps(ids["file"]), json.dumps(ids["photo"])), archive=True)
+        return {(r.kind, r.id): r for r in rows}
+
+    def attachment_hashes(self, ids):
+        """{file id: (phash, dhash)} for the given files that have been hashed."""
+        rows = self._query(None, "SELECT id, phash, dhash FROM all_patient_files "
+                                 "WHERE id IN (SELECT value FROM json_each(?)) AND phash IS NOT NULL",
+                           (json.dumps(sorted(int(i) for i in ids)),), tables=("patient_files",), archive=True)
+        return {fid: (ph, dh) for fid, ph, dh in rows}
+
+    def save_attachment_thumbnail(self, file_id, thumbnail):
+        # thumbnail is not a synced column, so this does not bump the row's version.
+        with self._write("patient_files") as conn:
+            conn.execute("UPDATE patient_files SET thumbnail=? WHERE id=?", (sqlite3.Binary(thumbnail), file_id))
+
+    def iter_attachment(self, file_id):
+        """Stream one file's original bytes, fetching a synced payload that has not arrived yet."""
+        conn = self.connect(archive=True)
+        try:
+            row = conn.execute("SELECT 'main', patient_id, file_data IS NULL FROM main.patient_files WHERE id=?",
+                               (file_id,)).fetchone()
+            if row is None and any(db[1] == "archive" for db in conn.execute("PRAGMA database_list")):
+                row = conn.execute("SELECT 'archive', patient_id, 0 FROM archive.patient_files WHERE id=?",
+                                   (file_id,)).fetchone()
+            if row is None:
+                raise ValueError(f"Attachment {file_id} not found")
+            schema, pid, pending = row
+            if pending and not (self._conn is None and not READ_ONLY and SYNC.fetch_patient_blobs(pid)):
+                raise ValueError("This file has not arrived from the other workstation yet")
+            yield from iter_attachment(conn, file_id, schema)
+        finally:
+            if conn is not self._conn:
+                conn.close()
+
+    def export_attachment(self, file_id, path):
+        """Stream one file to *path* (via a .part file) and return the number of bytes written."""
+        written = 0
+        try:
+            with open(path + ".part", "wb") as out:
+                for chunk in self.iter_attachment(file_id):
+                    out.write(chunk)
+                    written += len(chunk)
+            os.replace(path + ".part", path)
+        except Exception:
+            if os.path.exists(path + ".part"):
+                os.remove(path + ".part")
+            raise
+        return written
+
+    def list_users(self, query=None):
+        select = f"SELECT {UserListRow.columns} FROM users"
+        if query is not None:
+            sql, params = query.sql(select)
+            return query.page_rows(UserListRow, self._query(None, sql, params, tables=("users",)))
+        return self._query(UserListRow, select, (), tables=("users",))
+
+    def get_user(self, uid):
+        return self._query(User, f"SELECT {User.columns} FROM users WHERE id=?", (uid,), one=True)
+
+    def _insert_files(self, c, pid, files):
+        ts = int(time.time())
+        now = format_timestamp(ts)
+        rows = []
+        for f in files:
+            packed, codec, size = encode_attachment(f["data"], f["name"])
+            thumb = f.get("thumbnail")
+            rows.append((pid, f["name"], f["type"], now, ts, sqlite3.Binary(packed), codec, size, f.get("sha256"),
+                         f.get("checksum") or hashlib.sha256(f["data"]).hexdigest(),
+                         sqlite3.Binary(thumb) if thumb else None, f.get("phash"), f.get("dhash")))
+        c.executemany('''INSERT INTO patient_files (patient_id, file_name, file_type, upload_date, upload_ts, file_data, codec,
+                                                   orig_size, sha256, content_sha256, thumbnail, phash, dhash)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+
+    def add_encoded_files(self, items):
+        """Insert already-encoded files for several patients in one transaction, skipping duplicates.
+
+        Each item needs patient_id, name, type, data, codec, size, sha256, checksum and thumbnail (phash and dhash
+        are optional); returns one
+        flag per item, False where that patient already has a file with the same sha256.
+        """
+        ts = int(time.time())
+        now = format_timestamp(ts)
+        added = []
+        with self._write("patient_files") as conn:
+            for f in items:
+                cur = conn.execute('''INSERT INTO patient_files (patient_id, file_name, file_type, upload_date, upload_ts,
+                                                              file_data, codec, orig_size, sha256, content_sha256, thumbnail,
+                                                              phash, dhash)
+                                      SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+                                      WHERE NOT EXISTS (SELECT 1 FROM patient_files WHERE patient_id = ? AND sha256 = ?)''',
+                                   (f["patient_id"], f["name"], f["type"], now, ts, sqlite3.Binary(f["data"]), f["codec"],
+                                    f["size"], f["sha256"], f.get("checksum"),
+                                    sqlite3.Binary(f["thumbnail"]) if f["thumbnail"] else None, f.get("phash"), f.get("dhash"),
+                                    f["patient_id"], f["sha256"]))
+                added.append(cur.rowcount == 1)
+        return added
+
+    def patient_id_by_phone(self, phone):
+        """The one patient registered under this phone number, or None if there are none or several."""
+        ids = {r[0] for r in self._query(None, "SELECT patient_id FROM patient_phone_keys "
+                                               "WHERE phone_key IN (SELECT value FROM json_each(?))",
+                                         (json.dumps(phone_keys(phone)),))}
+        return ids.pop() if len(ids) == 1 else None
+
+    def add_patient(self, fields, image=None, files=()):
+        """Insert a patient (plus queued files) in one transaction and return the new id."""
+        last_ts = parse_timestamp(fields["last_visit"]) if fields.get("last_visit") else None
+        dhash, phash = image_hashes(image) if image else (None, None)
+        with self._write("patients", "patient_files") as conn:
+            c = conn.cursor()
+            c.execute('''INSERT INTO patients (name, age, gender, phone, address, occupation, diagnosis, prescription,
+                                               last_visit, last_visit_ts, doctor, image, created_ts, photo_phash, photo_dhash)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (fields["name"], fields["age"], fields["gender"], fields["phone"], fields["address"],
+                       fields["occupation"], fields["diagnosis"], fields["prescription"],
+                       format_timestamp(last_ts) or None, last_ts, fields["doctor"], sqlite3.Binary(image) if image else None,
+                       int(time.time()), phash, dhash))
+            pid = c.lastrowid
+            index_patient_keys(c, pid, fields["name"], fields["phone"])
+            if files:
+                self._insert_files(c, pid, files)
+        return pid
+
+    def update_patient(self, pid, fields, image=None, files=()):
+        """Update a patient; return False if it does not exist."""
+        with self._write("patients", "patient_files") as conn:
+            c = conn.cursor()
+            c.execute("SELECT id FROM patients WHERE id=?", (pid,))
+            if not c.fetchone():
+                return False
+            c.execute('''UPDATE patients SET name=?, age=?, gender=?, phone=?, address=?, occupation=?, diagnosis=?, prescription=?, doctor=? WHERE id=?''',
+                      (fields["name"], fields["age"], fields["gender"], fields["phone"], fields["address"],
+                       fields["occupation"], fields["diagnosis"], fields["prescription"], fields["doctor"], pid))
+            index_patient_keys(c, pid, fields["name"], fields["phone"])
+            if image is not None:
+                dhash, phash = image_hashes(image)
+                c.execute("UPDATE patients SET image=?, photo_phash=?, photo_dhash=? WHERE id=?",
+                          (sqlite3.Binary(image), phash, dhash, pid))
+            if files:
+                self._insert_files(c, pid, files)
+        return True
+
+    def find_duplicates(self, name, phone, exclude_id=None, limit=5):
+        """Likely duplicates of a patient being entered: same normalized phone, or a near-identical name.
+
+        Candidates come only from index probes: equal phone keys, an equal phonetic key, and "o:" keys
+        equal to a leading part of the name or extending it. Trigram similarity is computed afterwards
+        on that short list, never across the registry.
+        """
+        codes = name_codes(name)
+        found = {}
+
+        def note(pid, score, reason):
+            best, reasons = found.get(pid, (0.0, []))
+            if reason not in reasons:
+                found[pid] = (max(best, score), reasons + [reason])
+
+        conn = self.connect()
+        try:
+            for (pid,) in conn.execute("SELECT patient_id FROM patient_phone_keys "
+                                       "WHERE phone_key IN (SELECT value FROM json_each(?))",
+                                       (json.dumps(phone_keys(phone)),)):
+                note(pid, 1.0, "same phone")
+            if codes:
+                ordered = "o:" + " ".join(codes)
+                probes = [("SELECT patient_id FROM patient_name_keys WHERE name_key=? LIMIT ?",
+                           ("p:" + " ".join(sorted(codes)),), 0.8, "sounds alike")]
+                if len(codes) > 1:
+                    # A single given name matches far too many people to be worth a prefix probe.
+                    probes.append(("SELECT patient_id FROM patient_name_keys WHERE name_key >= ? AND name_key < ? LIMIT ?",
+                                   (ordered + " ", ordered + "!"), 0.7, "same leading names"))
+                    probes += [("SELECT patient_id FROM patient_name_keys WHERE name_key=? LIMIT ?",
+                                ("o:" + " ".join(codes[:n]),), 0.7, "same leading names") for n in range(2, len(codes))]
+                for sql, params, score, reason in probes:
+                    for (pid,) in conn.execute(sql, params + (DUPLICATE_MAX_CANDIDATES,)):
+                        note(pid, score, reason)
+            found.pop(exclude_id, None)
+            conn.row_factory = DuplicateCandidate.row_factory
+            rows = conn.execute(f"SELECT {DuplicateCandidate.columns} FROM patients "
+                                "WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(list(found)),)).fetchall()
+        finally:
+            conn.close()
+        for r in rows:
+            similarity = name_similarity(name, r.name) if codes else 0.0
+            if similarity >= DUPLICATE_NAME_THRESHOLD:
+                note(r.id, similarity, "similar name")
+        rows = [r._replace(score=round(found[r.id][0], 2), reason=", ".join(found[r.id][1])) for r in rows]
+        return sorted(rows, key=lambda r: r.score, reverse=True)[:limit]
+
+    def merge_patients(self, survivor, duplicates):
+        """Fold duplicate registrations into *survivor* in one transaction and return how many were removed.
+
+        Visits, files (archived ones too) and appointments move to the survivor, its blank fields are filled from
+        the duplicates, and the duplicate patient rows are deleted.
+        """
+        survivor = int(survivor)
+        dups = sorted({int(i) for i in duplicates} - {survivor})
+        if not dups:
+            return 0
+        id_json = json.dumps(dups)
+        with self._write("patients", "visits", "patient_files", "appointments") as conn:
+            archived = attach_archive(conn)
+            known = conn.execute("SELECT COUNT(*) FROM main.patients WHERE id = ? OR id IN (SELECT value FROM json_each(?))",
+                                 (survivor, id_json)).fetchone()[0]
+            if known != len(dups) + 1:
+                raise ValueError("Survivor and every duplicate must be existing patients")
+            for schema in ("main", "archive") if archived else ("main",):
+                for table in ARCHIVED_TABLES:
+                    conn.execute(f"UPDATE {schema}.{table} SET patient_id = ?{archive_stamp(schema)} "
+                                 "WHERE patient_id IN (SELECT value FROM json_each(?))", (survivor, id_json))
+            conn.execute("UPDATE main.appointments SET patient_id = ? WHERE patient_id IN (SELECT value FROM json_each(?))",
+                         (survivor, id_json))
+            conn.execute("UPDATE main.attachment_text SET patient_id = ? WHERE patient_id IN (SELECT value FROM json_each(?))",
+                         (survivor, id_json))
+            for col in ("age", "gender", "phone", "address", "occupation", "diagnosis", "prescription", "doctor", "image"):
+                conn.execute(f'''UPDATE main.patients SET {col} = COALESCE((
+                                    SELECT d.{col} FROM main.patients d
+                                    WHERE d.id IN (SELECT value FROM json_each(?1)) AND IFNULL(d.{col}, '') != ''
+                                    ORDER BY d.last_visit_ts DESC LIMIT 1), {col})
+                                WHERE id = ?2 AND IFNULL({col}, '') = '' ''', (id_json, survivor))
+            conn.execute("UPDATE main.patients SET (last_visit, last_visit_ts) = (SELECT last_visit, last_visit_ts "
+                         "FROM main.patients WHERE id = ?1 OR id IN (SELECT value FROM json_each(?2)) "
+                         "ORDER BY last_visit_ts IS NULL, last_visit_ts DESC LIMIT 1) WHERE id = ?1", (survivor, id_json))
+            conn.execute("UPDATE main.patients SET created_ts = (SELECT MIN(created_ts) FROM main.patients "
+                         "WHERE id = ?1 OR id IN (SELECT value FROM json_each(?2))) WHERE id = ?1", (survivor, id_json))
+            # Keys go explicitly too, not only through the cascade, so none outlive their patient.
+            for table in ("patient_name_keys", "patient_phone_keys"):
+                conn.execute(f"DELETE FROM main.{table} WHERE patient_id IN (SELECT value FROM json_each(?))", (id_json,))
+            cur = conn.execute("DELETE FROM main.patients WHERE id IN (SELECT value FROM json_each(?))", (id_json,))
+            name, phone = conn.execute("SELECT name, phone FROM main.patients WHERE id=?", (survivor,)).fetchone()
+            index_patient_keys(conn, survivor, name, phone)
+        return cur.rowcount
+
+    def delete_patient(self, pid):
+        self.delete_patients([pid])
+
+    def delete_patients(self, ids):
+        """Delete patients in one statement; visits, files and appointments follow through ON DELETE CASCADE."""
+        id_json = json.dumps([int(i) for i in ids])
+        with self._write("patients", "visits", "patient_files", "appointments") as conn:
+            if attach_archive(conn):
+                # Archived rows live in another database, out of reach of the cascade.
+                for table in ARCHIVED_TABLES:
+                    conn.execute(f"DELETE FROM archive.{table} WHERE patient_id IN (SELECT value FROM json_each(?))",
+                                 (id_json,))
+                conn.execute("DELETE FROM main.attachment_text WHERE patient_id IN (SELECT value FROM json_each(?))",
+                             (id_json,))
+            for table in ("patient_name_keys", "patient_phone_keys"):
+                conn.execute(f"DELETE FROM main.{table} WHERE patient_id IN (SELECT value FROM json_each(?))", (id_json,))
+            cur = conn.execute("DELETE FROM main.patients WHERE id IN (SELECT value FROM json_each(?))", (id_json,))
+        return cur.rowcount
+
+    def reassign_doctor(self, table, ids, doctor):
+        """Set doctor on the given patients or visits (archived ones included) in one transaction."""
+        if table not in ("patients", "visits"):
+            raise ValueError(f"Cannot reassign doctor on {table}")
+        id_json = json.dumps([int(i) for i in ids])
+        count = 0
+        with self._write(table) as conn:
+            schemas = ("main", "archive") if table in ARCHIVED_TABLES and attach_archive(conn) else ("main",)
+            for schema in schemas:
+                count += conn.execute(f"UPDATE {schema}.{table} SET doctor=?{archive_stamp(schema)} WHERE id IN (SELECT value FROM json_each(?))",
+                                      (doctor, id_json)).rowcount
+        return count
+
+    def export_patients_by_id(self, ids):
+        return self._query(PatientExportRow,
+                           f"SELECT {PatientExportRow.columns} FROM patients "
+                           "WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id",
+                           (json.dumps([int(i) for i in ids]),))
+
+    def export_visits_by_id(self, ids):
+        return self._query(VisitListRow,
+                           f"SELECT {VisitListRow.columns} FROM visits v LEFT JOIN patients p ON v.patient_id = p.id "
+                           "WHERE v.id IN (SELECT value FROM json_each(?)) ORDER BY v.id",
+                           (json.dumps([int(i) for i in ids]),))
+
+    def save_visit(self, pid, date, diagnosis, prescription, doctor, price, visit_id=None):
+        """Insert (or update, when visit_id is given) a visit and advance the patient's last_visit.
+
+        date is validated with parse_timestamp (ValueError if unrecognized) and stored normalized.
+        """
+        ts = parse_timestamp(date)
+        with self._write("visits", "patients") as conn:
+            return self._save_visit(conn, pid, ts, diagnosis, prescription, doctor, price, visit_id)
+
+    def _save_visit(self, conn, pid, ts, diagnosis, prescription, doctor, price, visit_id=None):
+        """save_visit inside the caller's transaction; returns the visit id."""
+        date = format_timestamp(ts)
+        c = conn.cursor()
+        if visit_id is None:
+            c.execute('''INSERT INTO visits (patient_id, date, date_ts, diagnosis, prescription, doctor, price)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''', (pid, date, ts, diagnosis, prescription, doctor, price))
+            visit_id = c.lastrowid
+        else:
+            # An archived visit is edited where it lives.
+            archived = not c.execute("SELECT 1 FROM main.visits WHERE id=?", (visit_id,)).fetchone() \
+                and attach_archive(conn)
+            schema = "archive" if archived else "main"
+            c.execute(f'''UPDATE {schema}.visits SET patient_id=?, date=?, date_ts=?, diagnosis=?, prescription=?,
+                             doctor=?, price=?{archive_stamp(schema)} WHERE id=?''',
+                      (pid, date, ts, diagnosis, prescription, doctor, price, visit_id))
+        # A back-dated visit must not move last_visit backwards.
+        c.execute("UPDATE patients SET last_visit=?, last_visit_ts=? WHERE id=? "
+                  "AND (last_visit_ts IS NULL OR last_visit_ts <= ?)", (date, ts, pid, ts))
+        return visit_id
+
+    def delete_visit(self, vid):
+        self.delete_visits([vid])
+
+    def delete_visits(self, ids):
+        """Delete visits, hot or archived; return how many were removed."""
+        id_json = json.dumps([int(i) for i in ids])
+        count = 0
+        with self._write("visits") as conn:
+            for schema in ("main", "archive") if attach_archive(conn) else ("main",):
+                count += conn.execute(f"DELETE FROM {schema}.visits WHERE id IN (SELECT value FROM json_each(?))",
+                                      (id_json,)).rowcount
+        return count
+
+    def list_appointments(self, start_ts, end_ts, doctor=None):
+        """Appointments starting in [start_ts, end_ts), optionally for one doctor, in time order."""
+        sql = (f"SELECT {AppointmentListRow.columns} FROM appointments a LEFT JOIN patients p ON p.id = a.patient_id "
+               "WHERE a.start_ts >= ? AND a.start_ts < ?")
+        params = [int(start_ts), int(end_ts)]
+        if doctor:
+            sql += " AND a.doctor = ? COLLATE NOCASE"
+            params.append(doctor)
+        return self._query(AppointmentListRow, sql + " ORDER BY a.start_ts, a.id", params,
+                           tables=("appointments", "patients"))
+
+    def get_appointment(self, aid):
+        return self._query(Appointment, f"SELECT {Appointment.columns} FROM appointments WHERE id=?", (aid,), one=True)
+
+    def appointment_doctors(self):
+        return [r[0] for r in self._query(None, "SELECT DISTINCT doctor FROM appointments ORDER BY doctor COLLATE NOCASE",
+                                          tables=("appointments",))]
+
+    def book_appointment(self, pid, doctor, start, minutes, notes="", appointment_id=None):
+        """Book (or move, when appointment_id is given) an appointment and return its id.
+
+        start is epoch seconds or a date parse_timestamp accepts. Raises ValueError when the doctor
+        already has a booking that overlaps.
+        """
+        doctor = " ".join((doctor or "").split())
+        if not doctor:
+            raise ValueError("Doctor is required")
+        start_ts = parse_timestamp(start) if isinstance(start, str) else int(start)
+        end_ts = start_ts + int(minutes) * 60
+        if end_ts <= start_ts:
+            raise ValueError("Duration must be positive")
+        with APPOINTMENTS.lock:
+            with self._write("appointments") as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._check_free(doctor, start_ts, end_ts, appointment_id)
+                if appointment_id is None:
+                    cur = conn.execute("INSERT INTO appointments (patient_id, doctor, start_ts, end_ts, notes) "
+                                       "VALUES (?, ?, ?, ?, ?)", (pid, doctor, start_ts, end_ts, notes))
+                    appointment_id = cur.lastrowid
+                else:
+                    conn.execute("UPDATE appointments SET patient_id=?, doctor=?, start_ts=?, end_ts=?, notes=? WHERE id=?",
+                                 (pid, doctor, start_ts, end_ts, notes, appointment_id))
+            APPOINTMENTS.refresh()
+        return appointment_id
+
+    def _check_free(self, doctor, start_ts, end_ts, exclude_id=None):
+        """Raise ValueError if the doctor is booked in [start_ts, end_ts); call inside BEGIN IMMEDIATE.
+
+        With the write lock held while the index catches up, no other workstation can commit an
+        overlapping booking between the check and the caller's own write.
+        """
+        clash = APPOINTMENTS.conflicts(doctor, start_ts, end_ts, exclude_id=exclude_id)
+        if clash:
+            begin, end, _ = clash[0]
+            raise ValueError(f"{doctor} is already booked {format_timestamp(begin)} – {format_timestamp(end, '%H:%M')}")
+
+    def set_appointment_status(self, aid, status):
+        """Set an appointment's status; making a cancelled or no-show booking blocking again checks for overlaps."""
+        if status not in APPOINTMENT_STATUSES:
+            raise ValueError(f"Unknown appointment status {status!r}")
+        with APPOINTMENTS.lock:
+            with self._write("appointments") as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                appt = conn.execute("SELECT doctor, start_ts, end_ts, status FROM appointments WHERE id=?", (aid,)).fetchone()
+                if appt is not None and status in APPOINTMENT_BLOCKING and appt[3] not in APPOINTMENT_BLOCKING:
+                    self._check_free(appt[0], appt[1], appt[2], aid)
+                cur = conn.execute("UPDATE appointments SET status=? WHERE id=?", (status, aid))
+            APPOINTMENTS.refresh()
+        return cur.rowcount
+
+    def delete_appointment(self, aid):
+        with self._write("appointments") as conn:
+            conn.execute("DELETE FROM appointments WHERE id=?", (aid,))
+
+    def complete_appointment(self, aid, diagnosis, prescription, price):
+        """Record the visit for a booked appointment and mark it completed, in one transaction.
+
+        The status is claimed with a conditional UPDATE under the write lock, so two workstations
+        completing the same appointment cannot both add a visit; the loser gets ValueError.
+        """
+        with self._write("visits", "patients", "appointments") as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            appt = conn.execute("SELECT patient_id, doctor, start_ts FROM appointments WHERE id=?", (aid,)).fetchone()
+            if appt is None:
+                raise ValueError("Appointment not found")
+            visit_id = self._save_visit(conn, appt[0], appt[2], diagnosis, prescription, appt[1], price)
+            # Status, not visit_id: archiving the visit clears it (ON DELETE SET NULL) on a completed appointment.
+            cur = conn.execute("UPDATE appointments SET status='completed', visit_id=? WHERE id=? AND status='booked'",
+                               (visit_id, aid))
+            if cur.rowcount == 0:
+                raise ValueError("Appointment is not booked; it may already be completed")
+        return visit_id
+
+    def add_user(self, username, password, role):
+        with self._write("users") as conn:
+            conn.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                         (username, hash_password(password), role))
+
+    def delete_user(self, uid):
+        with self._write("users") as conn:
+            conn.execute("DELETE FROM users WHERE id=?", (uid,))
+
+repo = ClinicRepository(cache=QueryCache())
+
+# ---------------- Appointments ----------------
+APPOINTMENT_STATUSES = ("booked", "completed", "cancelled", "no-show")
+APPOINTMENT_BLOCKING = ("booked", "completed")  # statuses that occupy the doctor's time
+APPOINTMENT_DEFAULT_MIN = 20
+APPOINTMENT_SLOT_MIN = 5  # free-slot search snaps start times to this grid
+APPOINTMENT_DAY_START_HOUR = 9
+APPOINTMENT_DAY_END_HOUR = 21
+APPOINTMENT_SEARCH_DAYS = 120
+
+class _DoctorBookings:
+    __slots__ = ("starts", "ends", "longest")
+
+    def __init__(self):
+        self.starts = []  # sorted (start_ts, id)
+        self.ends = {}    # id -> end_ts
+        self.longest = 0  # never shrinks, which keeps the overlap window conservative
+
+class AppointmentIndex:
+    """Per-doctor bookings held as bisect-sorted interval lists, kept current from change_log.
+
+    No booking of a doctor is longer than the longest one seen, so anything overlapping
+    [start, end) starts in [start - longest, end): a conflict check is one binary search plus the
+    few neighbours in that window, and the free-slot search jumps gap to gap the same way.
+    The first use loads every blocking appointment; after that only rows whose change_log entries
+    are newer than the last one seen are reloaded.
+    """
+    def __init__(self, connect=None):
+        self._connect = connect
+        self.lock = threading.RLock()
+        self._doctors = {}
+        self._rows = {}  # uid -> (doctor key, start_ts, id)
+        self._seq = None
+        self._synced = None
+        self._db_path = None
+        self._conn = None
+
+    @staticmethod
+    def _key(doctor):
+        return " ".join((doctor or "").split()).casefold()
+
+    def refresh(self):
+        """Bring the index up to date with the database; cheap when nothing changed."""
+        with self.lock:
+            if self._conn is not None and self._db_path != DB_PATH:
+                self._conn.close()
+                self._conn = None
+            if self._conn is None:
+                # Kept open (used only under self.lock): a fresh connection per lookup costs more than the lookup.
+                self._conn = self._connect() if self._connect else readonly_connect(check_same_thread=False)
+            conn = self._conn
+            try:
+                latest, synced = conn.execute(
+                    "SELECT IFNULL(MAX(seq), 0), (SELECT value FROM app_settings WHERE key = 'sync.appointments_applied') "
+                    "FROM change_log").fetchone()
+                if self._seq is None or self._db_path != DB_PATH or latest < self._seq or synced != self._synced:
+                    # First use, another database, a restored backup, or bookings applied from a sync peer.
+                    self._rebuild(conn)
+                elif latest > self._seq:
+                    # +tbl keeps the planner on the seq (rowid) range instead of the (tbl, uid) index.
+                    changed = conn.execute("SELECT uid FROM change_log WHERE seq > ? AND +tbl = 'appointments'",
+                                           (self._seq,)).fetchall()
+                    for uid in dict.fromkeys(r[0] for r in changed):
+                        self._remove(uid)
+                        row = conn.execute("SELECT uid, doctor, start_ts, end_ts, id FROM appointments "
+                                           "WHERE uid = ? AND status IN (SELECT value FROM json_each(?))",
+                                           (uid, json.dumps(APPOINTMENT_BLOCKING))).fetchone()
+                        if row:
+                            self._add(*row)
+                self._seq, self._synced = latest, synced
+            except Exception:
+                conn.close()
+                self._conn = self._seq = None
+                raise
+
+    def _rebuild(self, conn):
+        self._doctors, self._rows = {}, {}
+        rows = conn.execute("SELECT uid, doctor, start_ts, end_ts, id FROM appointments "
+                            "WHERE status IN (SELECT value FROM json_each(?)) ORDER BY start_ts, id",
+                            (json.dumps(APPOINTMENT_BLOCKING),)).fetchall()
+        for uid, doctor, start, end, aid in rows:
+            # Rows arrive in start order, so appending keeps each list sorted without insort.
+            bookings = self._doctors.setdefault(self._key(doctor), _DoctorBookings())
+            bookings.starts.append((start, aid))
+            bookings.ends[aid] = end
+            bookings.longest = max(bookings.longest, end - start)
+            self._rows[uid] = (self._key(doctor), start, aid)
+        self._db_path = DB_PATH
+
+    def _add(self, uid, doctor, start, end, aid):
+        key = self._key(doctor)
+        bookings = self._doctors.setdefault(key, _DoctorBookings())
+        bisect.insort(bookings.starts, (start, aid))
+        bookings.ends[aid] = end
+        bookings.longest = max(bookings.longest, end - start)
+        self._rows[uid] = (key, start, aid)
+
+    def _remove(self, uid):
+        entry = self._rows.pop(uid, None)
+        if entry is None:
+            return
+        key, start, aid = entry
+        bookings = self._doctors[key]
+        i = bisect.bisect_left(bookings.starts, (start, aid))
+        if i < len(bookings.starts) and bookings.starts[i] == (start, aid):
+            del bookings.starts[i]
+        bookings.ends.pop(aid, None)
+
+    def _overlapping(self, bookings, start, end, exclude_id):
+        lo = bisect.bisect_left(bookings.starts, (start - bookings.longest,))
+        hi = bisect.bisect_left(bookings.starts, (end,))
+        return [(s, bookings.ends[aid], aid) for s, aid in bookings.starts[lo:hi]
+                if bookings.ends[aid] > start and aid != exclude_id]
+
+    def conflicts(self, doctor, start, end, exclude_id=None):
+        """Return (start_ts, end_ts, id) of the doctor's bookings overlapping [start, end)."""
+        with self.lock:
+            self.refresh()
+            bookings = self._doctors.get(self._key(doctor))
+            return self._overlapping(bookings, start, end, exclude_id) if bookings else []
+
+    def next_free(self, doctor, after, minutes=APPOINTMENT_DEFAULT_MIN, exclude_id=None):
+        """Earliest start >= after, within clinic hours, where the doctor is free for *minutes*; None if none."""
+        duration, grid = int(minutes) * 60, APPOINTMENT_SLOT_MIN * 60
+        with self.lock:
+            self.refresh()
+            bookings = self._doctors.get(self._key(doctor))
+            t = int(after)
+            limit = t + APPOINTMENT_SEARCH_DAYS * 86400
+            while t < limit:
+                t = -(-t // grid) * grid
+                day = datetime.fromtimestamp(t)
+                opens = int(day.replace(hour=APPOINTMENT_DAY_START_HOUR, minute=0, second=0, microsecond=0).timestamp())
+                closes = int(day.replace(hour=APPOINTMENT_DAY_END_HOUR, minute=0, second=0, microsecond=0).timestamp())
+                if t < opens:
+                    t = opens
+                if t + duration > closes:
+                    t = int((day.replace(hour=APPOINTMENT_DAY_START_HOUR, minute=0, second=0, microsecond=0)
+                             + timedelta(days=1)).timestamp())
+                    continue
+                clash = self._overlapping(bookings, t, t + duration, exclude_id) if bookings else []
+                if not clash:
+                    return t
+                t = max(end for _, end, _ in clash)
+            return None
+
+APPOINTMENTS = AppointmentIndex()
+
+# ---------------- Backup ----------------
+BACKUP_DIR = os.path.join(os.path.dirname(DB_PATH), "clinic_backups")
+BACKUP_INTERVAL_MIN = 60
+BACKUP_KEEP_RECENT = 8
+BACKUP_KEEP_DAILY = 14
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+
+class BackupManager:
+    """Online snapshots of DB_PATH through the SQLite backup API, with rotation and verification."""
+    def __init__(self, db_path=None, backup_dir=None):
+        self.db_path = db_path or DB_PATH
+        self.backup_dir = backup_dir or BACKUP_DIR
+        self.last_result = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def list_backups(self):
+        """Return backup paths, newest first."""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        names = [n for n in os.listdir(self.backup_dir) if n.startswith("clinic_") and n.endswith(".db")]
+        return [os.path.join(self.backup_dir, n) for n in sorted(names, reverse=True)]
+
+    def _db_mtime(self):
+        mtimes = [os.path.getmtime(p) for p in (self.db_path, self.db_path + "-wal") if os.path.exists(p)]
+        return max(mtimes) if mtimes else 0
+
+    def is_stale(self):
+        backups = self.list_backups()
+        return not backups or self._db_mtime() > os.path.getmtime(backups[0])
+
+    def _copy(self, src_path, dst_path, progress=None):
+        src = sqlite3.connect(src_path)
+        dst = sqlite3.connect(dst_path)
+        try:
+            def paced(status, remaining, total):
+                if progress:
+                    progress(total - remaining, total)
+                time.sleep(BACKUP_STEP_SLEEP)
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=paced)
+        finally:
+            dst.close()
+            src.close()
+
+    def verify(self, path):
+        try:
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                return conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return False
+
+    def snapshot(self, force=False, label="", progress=None):
+        """Take a verified snapshot; skipped (returns None) when nothing changed since the last one."""
+        with self._lock:
+            if not force and not self.is_stale():
+                return None
+            os.makedirs(self.backup_dir, exist_ok=True)
+            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            base = os.path.join(self.backup_dir, f"clinic_{stamp}{'_' + label if label else ''}")
+            dest, n = base + ".db", 1
+            while os.path.exists(dest):
+                dest, n = f"{base}_{n}.db", n + 1
+            part = dest + ".part"
+            try:
+                self._copy(self.db_path, part, progress)
+                if not self.verify(part):
+                    raise sqlite3.DatabaseError("integrity_check failed on backup copy")
+                os.replace(part, dest)
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+            self.rotate()
+            return dest
+
+    def rotate(self):
+        """Keep the newest BACKUP_KEEP_RECENT snapshots plus the newest one per day for BACKUP_KEEP_DAILY days."""
+        keep, days = set(), set()
+        for i, path in enumerate(self.list_backups()):
+            day = os.path.basename(path)[len("clinic_"):len("clinic_") + 8]
+            if i < BACKUP_KEEP_RECENT:
+                keep.add(path)
+            if day not in days and len(days) < BACKUP_KEEP_DAILY:
+                days.add(day)
+                keep.add(path)
+            if path not in keep:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Backup rotation error: {e}")
+
+    def restore(self, path):
+        """Verify *path*, save a pre-restore snapshot, then copy the backup over the live database."""
+        if not self.verify(path):
+            raise sqlite3.DatabaseError(f"{path} failed integrity_check")
+        self.snapshot(force=True, label="pre_restore")
+        self._copy(path, self.db_path)
+        if repo.cache is not None:
+            repo.cache.clear()
+
+    def start_background(self, force=False):
+        """Run snapshot() on a worker thread unless one is already running; the result lands in last_result."""
+        if self._thread and self._thread.is_alive():
+            return False
+        def work():
+            try:
+                self.last_result = ("ok", self.snapshot(force=force))
+            except Exception as e:
+                print(f"Backup error: {e}")
+                traceback.print_exc()
+                self.last_result = ("error", str(e))
+        self._thread = threading.Thread(target=work, name="backup", daemon=True)
+        self._thread.start()
+        return True
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+BACKUPS = BackupManager()
+
+# ---------------- Maintenance ----------------
+MAINTENANCE_CHECK_MS = 30_000
+MAINTENANCE_IDLE_SEC = 120  # no key or mouse input for this long counts as idle
+MAINTENANCE_BUDGET_SEC = 0.25
+VACUUM_PAGES_PER_STEP = 256
+ANALYSIS_LIMIT = 400  # rows sampled per index by ANALYZE; keeps it fast on big tables
+ANALYZE_INTERVAL_HOURS = 24
+
+def database_stats(db_path=None):
+    """Size report from PRAGMAs and dbstat: totals, free pages, and per-table/index size and fragmentation.
+
+    SQLite builds without the dbstat virtual table get the totals only (objects empty, has_dbstat False).
+    """
+    conn = sqlite3.connect(db_path or DB_PATH)
+    has_dbstat = True
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = {0: "NONE", 1: "FULL", 2: "INCREMENTAL"}.get(conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+        owners = dict(conn.execute("SELECT name, tbl_name FROM sqlite_schema"))
+        objects = {}
+        prev = {}
+        try:
+            pages = conn.execute("SELECT name, pageno, pgsize, unused FROM dbstat ORDER BY name, path").fetchall()
+        except sqlite3.OperationalError:
+            pages, has_dbstat = [], False
+        # dbstat walks each b-tree in path order; a page that does not follow its predecessor is a fragment break.
+        for name, pageno, pgsize, unused in pages:
+            o = objects.setdefault(name, {"name": name, "table": owners.get(name, name), "pages": 0, "bytes": 0,
+                                          "unused": 0, "breaks": 0})
+            o["pages"] += 1
+            o["bytes"] += pgsize
+            o["unused"] += unused
+            if name in prev and pageno != prev[name] + 1:
+                o["breaks"] += 1
+            prev[name] = pageno
+    finally:
+        conn.close()
+    for o in objects.values():
+        o["unused_pct"] = round(100 * o["unused"] / o["bytes"], 1) if o["bytes"] else 0.0
+        o["fragmentation_pct"] = round(100 * o["breaks"] / (o["pages"] - 1), 1) if o["pages"] > 1 else 0.0
+    return {"file_bytes": page_size * page_count, "page_size": page_size, "page_count": page_count,
+            "freelist_pages": freelist, "freelist_bytes": freelist * page_size, "auto_vacuum": auto_vacuum,
+            "objects": sorted(objects.values(), key=lambda o: o["bytes"], reverse=True), "has_dbstat": has_dbstat}
+
+class MaintenanceScheduler:
+    """Incremental vacuum, ANALYZE and PRAGMA optimize in small budgeted slices while the UI is idle."""
+    def __init__(self, db_path=None, idle_sec=MAINTENANCE_IDLE_SEC, budget_sec=MAINTENANCE_BUDGET_SEC):
+        self.db_path = db_path or DB_PATH
+        self.idle_sec = idle_sec
+        self.budget_sec = budget_sec
+        self.last_result = None
+        self.pages_freed = 0
+        self._root = None
+        self._job = None
+        self._thread = None
+        self._bound = None  # the Tk root whose input already feeds _touch
+        self._last_input = time.monotonic()
+        self._analyze_queue = []
+
+    def start(self, root):
+        self.stop()
+        self._root = root
+        if self._bound is not root:
+            root.bind_all("<Any-KeyPress>", self._touch, add="+")
+            root.bind_all("<Any-ButtonPress>", self._touch, add="+")
+            self._bound = root
+        self._job = root.after(MAINTENANCE_CHECK_MS, self._check)
+
+    def stop(self):
+        if self._root is not None and self._job is not None:
+            try:
+                self._root.after_cancel(self._job)
+            except Exception:
+                pass
+        self._root = self._job = None
+
+    def _touch(self, event=None):
+        self._last_input = time.monotonic()
+
+    def _check(self):
+        if self._root is None:
+            return
+        if time.monotonic() - self._last_input >= self.idle_sec and not BACKUPS.is_running():
+            self.start_background()
+        self._job = self._root.after(MAINTENANCE_CHECK_MS, self._check)
+
+    def start_background(self, budget_sec=None):
+        """Run one step() on a worker thread unless one is already running; the result lands in last_result."""
+        if self.is_running():
+            return False
+        def work():
+            try:
+                self.last_result = ("ok", self.step(budget_sec))
+            except Exception as e:
+                print(f"Maintenance error: {e}")
+                traceback.print_exc()
+                self.last_result = ("error", str(e))
+        self._thread = threading.Thread(target=work, name="maintenance", daemon=True)
+        self._thread.start()
+        return True
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def _analyze_due(self):
+        last = repo.get_setting("maintenance.analyzed_at")
+        if not last:
+            return True
+        try:
+            age = datetime.now() - datetime.strptime(last, "%Y-%m-%d %H:%M")
+        except ValueError:
+            return True
+        return age.total_seconds() >= ANALYZE_INTERVAL_HOURS * 3600
+
+    def vacuum_pending(self):
+        return bool(repo.get_setting("maintenance.vacuum_pending"))
+
+    def step(self, budget_sec=None):
+        """One slice: reclaim free pages first, then ANALYZE tables one at a time when due, else PRAGMA optimize.
+
+        A full VACUUM still owed by the auto_vacuum migration runs first and takes the whole slice.
+        """
+        deadline = time.monotonic() + (budget_sec or self.budget_sec)
+        done = {"pages_freed": 0, "analyzed": [], "optimized": False, "vacuumed": False}
+        if self.vacuum_pending():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+            repo.set_setting("maintenance.vacuum_pending", "")
+            done["vacuumed"] = True
+            return done
+        conn = sqlite3.connect(self.db_path)
+        try:
+            while time.monotonic() < deadline:
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free:
+                    break
+                pages = min(free, VACUUM_PAGES_PER_STEP)
+                conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+                done["pages_freed"] += free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not self._analyze_queue and self._analyze_due():
+                self._analyze_queue = [r[0] for r in conn.execute(
+                    "SELECT name FROM sqlite_schema WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+                if not self._analyze_queue:
+                    repo.set_setting("maintenance.analyzed_at", datetime.now().strftime("%Y-%m-%d %H:%M"))
+            if self._analyze_queue:
+                conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+                while self._analyze_queue and time.monotonic() < deadline:
+                    table = self._analyze_queue.pop(0)
+                    conn.execute(f'ANALYZE "{table}"')
+                    done["analyzed"].append(table)
+                if not self._analyze_queue:
+                    repo.set_setting("maintenance.analyzed_at", datetime.now().strftime("%Y-%m-%d %H:%M"))
+            elif time.monotonic() < deadline:
+                conn.execute("PRAGMA optimize")
+                done["optimized"] = True
+            conn.commit()
+        finally:
+            conn.close()
+        self.pages_freed += done["pages_freed"]
+        return done
+
+    def run_all(self):
+        """Reclaim every free page and refresh all statistics now (CLI / admin use)."""
+        self._analyze_queue = []
+        repo.set_setting("maintenance.analyzed_at", "")
+        total = {"pages_freed": 0, "analyzed": [], "optimized": False, "vacuumed": False}
+        while True:
+            done = self.step(budget_sec=3600)
+            total["pages_freed"] += done["pages_freed"]
+            total["analyzed"] += done["analyzed"]
+            total["optimized"] |= done["optimized"]
+            total["vacuumed"] |= done["vacuumed"]
+            if not self._analyze_queue and not done["vacuumed"]:
+                return total
+
+MAINTENANCE = MaintenanceScheduler()
+
+# ---------------- Integrity Scrubber ----------------
+SCRUB_INTERVAL_HOURS = 24
+SCRUB_START_DELAY_MS = 180_000
+SCRUB_SLICE_SEC = 0.05  # work per slice before the scrubber rests
+SCRUB_PAUSE_SEC = 0.5
+SCRUB_BUSY_PAUSE_SEC = 5.0  # rest while the UI lags or a backup / maintenance step is running
+SCRUB_SAVE_SEC = 10  # progress is written back at least this often
+SCRUB_ORPHAN_ROWS = 500
+SCRUB_ORPHAN_TABLES = ("visits", "patient_files", "appointments")
+QUARANTINE_DIR = os.path.join(os.path.dirname(DB_PATH), "quarantine")
+# Finding kind -> (what is wrong, what its one-click fix does).
+SCRUB_KINDS = {
+    "orphan": ("Record belongs to a patient that does not exist", "Re-create the missing patient"),
+    "photo": ("Patient photo cannot be decoded", "Restore it from a backup, else remove the photo"),
+    "corrupt": ("Attachment cannot be decoded", "Restore it from a backup, else quarantine and delete it"),
+    "checksum": ("Attachment content changed after it was stored",
+                 "Restore it from a backup, else accept the current content"),
+    "structure": ("PRAGMA quick_check reported damage", "Rebuild the table's indexes"),
+}
+# The finding kinds each check produces; a finished check drops its findings that were not seen again.
+SCRUB_CHECK_KINDS = {"orphans": ("orphan",), "photos": ("photo",), "files": ("corrupt", "checksum"),
+                     "quick_check": ("structure",)}
+
+def foreground_busy():
+    """True while the UI is lagging or a backup / maintenance step is running; background jobs rest longer then."""
+    return UI_MONITOR.lag_ms > UI_MONITOR.threshold_ms / 2 or BACKUPS.is_running() or MAINTENANCE.is_running()
+
+def image_problem(data):
+    """Why *data* does not decode as an image, or None if it does."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft("RGB", (256, 256))  # JPEGs decode at reduced scale, but every byte is still read
+            img.load()
+        return None
+    except UnidentifiedImageError:
+        return "not a recognised image format"
+    except Exception as e:
+        return str(e) or type(e).__name__
+
+def check_attachment(chunks, file_type, orig_size):
+    """Hash an attachment's decoded *chunks*; return (sha256 hex or None, problem or None)."""
+    digest = hashlib.sha256()
+    size = 0
+    parts = [] if file_type == "image" else None
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+            if parts is not None:
+                parts.append(chunk)
+    except Exception as e:
+        return None, f"cannot be decompressed: {e}"
+    # A truncated zlib/lzma stream decodes without an error, just short.
+    if orig_size is not None and size != orig_size:
+        return digest.hexdigest(), f"decodes to {size} bytes instead of {orig_size}"
+    problem = image_problem(b"".join(parts)) if parts is not None else None
+    if problem:
+        return digest.hexdigest(), f"image does not decode: {problem}"
+    return digest.hexdigest(), None
+
+def expected_checksum(file_type, sha256, content_sha256):
+    # Only images are rewritten on upload; any other file was stored exactly as uploaded.
+    return content_sha256 or (sha256 if file_type != "image" else None)
+
+def quarantine(name, data):
+    """Keep bytes a fix is about to drop in QUARANTINE_DIR; return the file's path."""
+    os.makedirs(QUARANTINE_DIR, exist_ok=True)
+    safe = re.sub(r"[^\w.-]+", "_", name)
+    path = os.path.join(QUARANTINE_DIR, f"{datetime.now():%Y%m%d_%H%M%S}_{safe}")
+    with open(path, "wb") as f:
+        f.write(data or b"")
+    return path
+
+def _split_table(tbl):
+    return tuple(tbl.split(".", 1)) if "." in tbl else ("main", tbl)
+
+class IntegrityScrubber:
+    """Background pass that looks for damage nothing else notices, and one-click fixes for it.
+
+    Checks orphaned visits/files/appointments, undecodable patient photos, attachments that no
+    longer decode or whose content no longer matches its checksum, and PRAGMA quick_check one
+    table at a time. Work runs in short slices on a read-only connection with rests in between,
+    longer ones while the UI lags or a backup or maintenance step runs. The position survives
+    restarts; findings are kept in integrity_findings until a later pass no longer sees them.
+    """
+    def __init__(self, slice_sec=SCRUB_SLICE_SEC, pause_sec=SCRUB_PAUSE_SEC):
+        self.slice_sec = slice_sec
+        self.pause_sec = pause_sec
+        self.paced = True
+        self.checked = 0
+        self.current = None
+        self.last_result = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="scrub", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def run_now(self):
+        """Start a pass now (or finish the current one) without resting between slices."""
+        self.paced = False
+        if not self.start():
+            self._wake.set()
+
+    def due_in(self):
+        """Seconds until the next pass is due; 0 while one is unfinished."""
+        if repo.get_setting("scrub.position"):
+            return 0
+        last = repo.get_setting("scrub.completed_at")
+        return max(0, int(last) + SCRUB_INTERVAL_HOURS * 3600 - time.time()) if last else 0
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                wait = 0 if not self.paced else self.due_in()
+                if wait:
+                    self._wake.wait(min(wait, 3600))
+                    self._wake.clear()
+                    continue
+                self.last_result = ("ok", self.scrub_pass())
+                self.paced = True
+        except Exception as e:
+            print(f"Integrity scrub error: {e}")
+            traceback.print_exc()
+            self.last_result = ("error", str(e))
+
+    def _rest(self):
+        if self.paced:
+            self._stop.wait(SCRUB_BUSY_PAUSE_SEC if foreground_busy() else self.pause_sec)
+
+    def _checks(self, conn):
+        checks = []
+        for schema in [r[1] for r in conn.execute("PRAGMA database_list") if r[1] in ("main", "archive")]:
+            tables = [r[0] for r in conn.execute(f"SELECT name FROM {schema}.sqlite_schema "
+                                                 "WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+            checks += [("orphans", schema, t) for t in SCRUB_ORPHAN_TABLES if t in tables]
+            if schema == "main":
+                checks.append(("photos", schema, "patients"))
+            if "patient_files" in tables:
+                checks.append(("files", schema, "patient_files"))
+            checks += [("quick_check", schema, t) for t in tables]
+        return checks
+
+    def scrub_pass(self, restart=False):
+        """Run or resume one pass over every check; return the open finding count, or None if stopped."""
+        with self._lock:
+            state = {} if restart else json.loads(repo.get_setting("scrub.position") or "{}")
+            conn = readonly_connect()
+            try:
+                attach_archive(conn, readonly=True)
+                checks = self._checks(conn)
+                keys = [":".join(c) for c in checks]
+                if state.get("check") not in keys:
+                    state = {"check": keys[0], "last_id": 0, "started": int(time.time())}
+                started = state["started"]
+                found, baselines, saved = [], [], time.monotonic()
+                for i in range(keys.index(state["check"]), len(checks)):
+                    check, schema, table = checks[i]
+                    tbl = table if schema == "main" else f"{schema}.{table}"
+                    self.current = f"{check.replace('_', ' ')} {tbl}"
+                    done = False
+                    while not done:
+                        if self._stop.is_set():
+                            self._save(state, found, baselines)
+                            return None
+                        deadline = time.monotonic() + (self.slice_sec if self.paced else 1.0)
+                        conn.execute("BEGIN")  # a slice reads one consistent snapshot
+                        try:
+                            state["last_id"], done = getattr(self, f"_check_{check}")(
+                                conn, schema, table, state["last_id"], deadline, found, baselines)
+                        finally:
+                            conn.rollback()
+                        if done:
+                            state = dict(state, check=keys[i + 1], last_id=0) if i + 1 < len(keys) else None
+                            self._save(state, found, baselines, (started, check, tbl))
+                        elif found or time.monotonic() - saved > SCRUB_SAVE_SEC:
+                            self._save(state, found, baselines)
+                        else:
+                            self._rest()
+                            continue
+                        found, baselines, saved = [], [], time.monotonic()
+                        if state is not None:
+                            self._rest()
+            finally:
+                conn.close()
+                self.current = None
+            return len(repo.integrity_findings())
+
+    def _save(self, state, found, baselines, finished=None):
+        """Write findings, new checksums and the pass position in one short transaction."""
+        conn = db_connect()
+        try:
+            if any(schema != "main" for schema, _, _ in baselines):
+                attach_archive(conn)
+            for schema, fid, checksum in baselines:
+                conn.execute(f"UPDATE {schema}.patient_files SET content_sha256=? WHERE id=? AND content_sha256 IS NULL",
+                             (checksum, fid))
+            conn.executemany("""INSERT INTO integrity_findings (kind, tbl, row_id, detail, found_at) VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT(kind, tbl, row_id) DO UPDATE SET detail=excluded.detail,
+                                                                             found_at=excluded.found_at""", found)
+            if finished:
+                started, check, tbl = finished
+                conn.execute("DELETE FROM integrity_findings WHERE tbl=? AND found_at < ? "
+                             "AND kind IN (SELECT value FROM json_each(?))",
+                             (tbl, started, json.dumps(SCRUB_CHECK_KINDS[check])))
+            settings = [("scrub.position", json.dumps(state) if state else "")]
+            if state is None:
+                settings.append(("scrub.completed_at", str(int(time.time()))))
+            conn.executemany("INSERT INTO app_settings (key, value) VALUES (?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET value=excluded.value", settings)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # Each check reads rows after last_id until the deadline and returns (last_id, finished).
+    def _check_orphans(self, conn, schema, table, last_id, deadline, found, baselines):
+        tbl = table if schema == "main" else f"{schema}.{table}"
+        while time.monotonic() < deadline:
+            rows = conn.execute(f"""SELECT t.id, t.patient_id, EXISTS (SELECT 1 FROM main.patients p WHERE p.id = t.patient_id)
+                                    FROM {schema}.{table} t WHERE t.id > ? ORDER BY t.id LIMIT ?""",
+                                (last_id, SCRUB_ORPHAN_ROWS)).fetchall()
+            if not rows:
+                return last_id, True
+            now = int(time.time())
+            found += [("orphan", tbl, rid, f"patient #{pid} does not exist" if pid is not None else "no patient", now)
+                      for rid, pid, known in rows if not known]
+            self.checked += len(rows)
+            last_id = rows[-1][0]
+        return last_id, False
+
+    def _check_photos(self, conn, schema, table, last_id, deadline, found, baselines):
+        while time.monotonic() < deadline:
+            row = conn.execute("SELECT id, image FROM main.patients WHERE id > ? AND image IS NOT NULL ORDER BY id LIMIT 1",
+                               (last_id,)).fetchone()
+            if row is None:
+                return last_id, True
+            last_id = row[0]
+            problem = image_problem(row[1])
+            if problem:
+                found.append(("photo", "patients", last_id, problem, int(time.time())))
+            self.checked += 1
+        return last_id, False
+
+    def _check_files(self, conn, schema, table, last_id, deadline, found, baselines):
+        tbl = table if schema == "main" else f"{schema}.{table}"
+        while time.monotonic() < deadline:
+            row = conn.execute(f"""SELECT id, file_type, orig_size, sha256, content_sha256 FROM {schema}.patient_files
+                                   WHERE id > ? AND file_data IS NOT NULL ORDER BY id LIMIT 1""", (last_id,)).fetchone()
+            if row is None:
+                return last_id, True
+            fid, file_type, size, sha256, checksum = row
+            last_id = fid
+            digest, problem = check_attachment(iter_attachment(conn, fid, schema), file_type, size)
+            expected = expected_checksum(file_type, sha256, checksum)
+            if problem:
+                found.append(("corrupt", tbl, fid, problem, int(time.time())))
+            elif expected is not None and digest != expected:
+                found.append(("checksum", tbl, fid, f"content sha256 {digest[:16]}, stored {expected[:16]}",
+                              int(time.time())))
+            elif checksum is None:
+                # Files stored before checksums were kept get one on their first clean pass.
+                baselines.append((schema, fid, digest))
+            self.checked += 1
+        return last_id, False
+
+    def _check_quick_check(self, conn, schema, table, last_id, deadline, found, baselines):
+        problems = [r[0] for r in conn.execute(f"PRAGMA {schema}.quick_check({table})")]
+        if problems != ["ok"]:
+            tbl = table if schema == "main" else f"{schema}.{table}"
+            found.append(("structure", tbl, 0, "; ".join(problems[:5]), int(time.time())))
+        self.checked += 1
+        return 0, True
+
+    def _from_backups(self, sql, params):
+        """Yield (backup path, row) for *sql* run against each backup, newest first."""
+        for path in BACKUPS.list_backups():
+            try:
+                conn = readonly_connect(path)
+                try:
+                    row = conn.execute(sql, params).fetchone()
+                finally:
+                    conn.close()
+            except sqlite3.Error:
+                continue  # older than the columns asked for, or unreadable
+            if row is not None:
+                yield path, row
+
+    def fix(self, finding_id):
+        """Apply the one-click fix for one finding and return a sentence saying what was done."""
+        conn = db_connect()
+        try:
+            row = conn.execute(f"SELECT {IntegrityFinding.columns} FROM integrity_findings WHERE id=?",
+                               (finding_id,)).fetchone()
+            if row is None:
+                return "Already resolved"
+            finding = IntegrityFinding._make(row)
+            schema, table = _split_table(finding.tbl)
+            if not attach_archive(conn) and schema != "main":
+                message, resolved = "The archive no longer exists", True
+            else:
+                message, resolved = getattr(self, f"_fix_{finding.kind}")(conn, finding, schema, table)
+            if resolved:
+                conn.execute("DELETE FROM integrity_findings WHERE id=?", (finding.id,))
+            conn.commit()
+            return message
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def fix_all(self):
+        """Fix every open finding; return one line per finding."""
+        return [f"{f.kind} {f.tbl} #{f.row_id}: {self.fix(f.id)}" for f in repo.integrity_findings()]
+
+    def _fix_orphan(self, conn, finding, schema, table):
+        row = conn.execute(f"SELECT patient_id FROM {schema}.{table} WHERE id=?", (finding.row_id,)).fetchone()
+        if row is None:
+            return "The record no longer exists", True
+        pid = row[0]
+        if pid is not None and conn.execute("SELECT 1 FROM main.patients WHERE id=?", (pid,)).fetchone():
+            return f"Patient #{pid} exists again", True
+        name = f"Recovered patient #{pid}" if pid is not None else "Recovered records"
+        cur = conn.execute("INSERT INTO main.patients (id, name) VALUES (?, ?)", (pid, name))
+        if pid is None:
+            pid = cur.lastrowid
+            conn.execute(f"UPDATE {schema}.{table} SET patient_id=? WHERE id=?", (pid, finding.row_id))
+        index_patient_keys(conn, pid, name, "")
+        # Every other record orphaned from the same patient is reattached by the same insert.
+        schemas = {r[1] for r in conn.execute("PRAGMA database_list")}
+        for (tbl,) in conn.execute("SELECT DISTINCT tbl FROM integrity_findings WHERE kind='orphan'").fetchall():
+            other_schema, other = _split_table(tbl)
+            if other_schema in schemas:
+                conn.execute(f"DELETE FROM integrity_findings WHERE kind='orphan' AND tbl=? AND row_id IN "
+                             f"(SELECT id FROM {other_schema}.{other} WHERE patient_id=?)", (tbl, pid))
+        return f"Created patient #{pid} ({name}); edit it to restore the details", True
+
+    def _fix_photo(self, conn, finding, schema, table):
+        for path, (image,) in self._from_backups("SELECT image FROM patients WHERE id=? AND image IS NOT NULL",
+                                                 (finding.row_id,)):
+            if image_problem(image) is None:
+                conn.execute("UPDATE patients SET image=? WHERE id=?", (sqlite3.Binary(image), finding.row_id))
+                return f"Restored the photo from {os.path.basename(path)}", True
+        row = conn.execute("SELECT image FROM patients WHERE id=?", (finding.row_id,)).fetchone()
+        if row is None or row[0] is None:
+            return "The photo is already gone", True
+        kept = quarantine(f"patient_{finding.row_id}_photo", row[0])
+        conn.execute("UPDATE patients SET image=NULL WHERE id=?", (finding.row_id,))
+        return f"Removed the photo; its bytes were kept in {kept}", True
+
+    def _fix_corrupt(self, conn, finding, schema, table):
+        row = conn.execute(f"SELECT file_name, file_type, orig_size, sha256, content_sha256, codec "
+                           f"FROM {schema}.patient_files WHERE id=?", (finding.row_id,)).fetchone()
+        if row is None:
+            return "The file no longer exists", True
+        name, file_type, size, sha256, checksum, codec = row
+        expected = expected_checksum(file_type, sha256, checksum)
+        # Backups are of the main database only; archived files have none to come from.
+        if schema == "main":
+            for path, (data, old_codec) in self._from_backups(
+                    "SELECT file_data, codec FROM patient_files WHERE id=? AND file_data IS NOT NULL", (finding.row_id,)):
+                digest, problem = check_attachment((decode_attachment(data, old_codec) for _ in (0,)), file_type, size)
+                if problem is None and digest == (expected or digest):
+                    conn.execute("UPDATE patient_files SET file_data=?, codec=?, content_sha256=? WHERE id=?",
+                                 (sqlite3.Binary(data), old_codec, digest, finding.row_id))
+                    return f"Restored {name} from {os.path.basename(path)}", True
+        if finding.kind == "checksum":
+            digest, problem = check_attachment(iter_attachment(conn, finding.row_id, schema), file_type, size)
+            if problem is None:
+                conn.execute(f"UPDATE {schema}.patient_files SET content_sha256=? WHERE id=?", (digest, finding.row_id))
+                return f"No backup holds the original of {name}; accepted its current content", True
+        data = conn.execute(f"SELECT file_data FROM {schema}.patient_files WHERE id=?", (finding.row_id,)).fetchone()[0]
+        kept = quarantine(f"{finding.tbl}_{finding.row_id}_{name}" + ("" if codec in (None, "raw") else f".{codec}"), data)
+        # Only this copy is bad: the delete stays local, so peers keep (and can send back) theirs.
+        with change_log_muted(conn):
+            conn.execute(f"DELETE FROM {schema}.patient_files WHERE id=?", (finding.row_id,))
+        return f"Deleted {name}; its stored bytes were kept in {kept}", True
+
+    _fix_checksum = _fix_corrupt
+
+    def _fix_structure(self, conn, finding, schema, table):
+        conn.execute(f"REINDEX {schema}.{table}")
+        problems = [r[0] for r in conn.execute(f"PRAGMA {schema}.quick_check({table})")]
+        if problems == ["ok"]:
+            return f"Rebuilt the indexes of {finding.tbl}; quick_check is clean", True
+        conn.execute("UPDATE integrity_findings SET detail=?, found_at=? WHERE id=?",
+                     ("; ".join(problems[:5]), int(time.time()), finding.id))
+        return f"Rebuilt the indexes of {finding.tbl}, but quick_check still fails; restore a backup", False
+
+    def report(self):
+        """Plain-text repair report: one line per open finding with its fix."""
+        findings = repo.integrity_findings()
+        last = repo.get_setting("scrub.completed_at")
+        lines = [f"Last complete pass: {format_timestamp(int(last)) if last else 'never'}; "
+                 f"{len(findings)} open finding(s)"]
+        for f in findings:
+            problem, fix = SCRUB_KINDS[f.kind]
+            lines.append(f"  [{f.id}] {f.tbl} #{f.row_id}: {problem} ({f.detail}) -> {fix}")
+        return "\n".join(lines)
+
+    def status_text(self):
+        if self.current:
+            return f"Checking {self.current} ({self.checked} item(s) checked this session)"
+        last = repo.get_setting("scrub.completed_at")
+        return f"Last integrity pass: {format_timestamp(int(last)) if last else 'never'}"
+
+SCRUBBER = IntegrityScrubber()
+
+# ---------------- Attachment Text Index ----------------
+TEXT_INDEX_START_DELAY_MS = 90_000
+TEXT_INDEX_BATCH_SEC = 0.2  # extraction work per slice
+TEXT_INDEX_PAUSE_SEC = 0.5
+TEXT_INDEX_IDLE_SEC = 60  # how often a caught-up indexer looks for new files
+TEXT_INDEX_MAX_BYTES = 20 * 1024 * 1024
+TEXT_INDEX_MAX_CHARS = 200_000
+TEXT_INDEX_MAX_INFLATED = TEXT_INDEX_MAX_CHARS * 4  # bytes a .docx body or a PDF's streams may decompress to
+TEXT_SEARCH_LIMIT = 100
+TEXT_SNIPPETS_PER_PATIENT = 3
+
+def plain_text(data):
+    """Decode a text file, or None when it looks binary."""
+    if data[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return data.decode("utf-16", "replace")
+    if b"\x00" in data[:8192]:
+        return None
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1252", "replace")
+
+def docx_text(data):
+    """Paragraph text of a Word .docx (the document body only); None when the body is implausibly large."""
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        info = z.getinfo("word/document.xml")
+        if info.file_size > TEXT_INDEX_MAX_INFLATED:
+            return None  # a zip bomb, or a document far past what the index keeps anyway
+        with z.open(info) as f:
+            xml = f.read(TEXT_INDEX_MAX_INFLATED).decode("utf-8", "replace")
+    xml = re.sub(r"</w:p>|<w:br/>|<w:cr/>", "\n", xml).replace("<w:tab/>", " ")
+    return html.unescape(re.sub(r"<[^>]+>", "", xml))
+
+# A small PDF text extractor: enough for reports written by lab and practice software (Flate-compressed
+# content streams, simple or ToUnicode-mapped fonts). Scanned PDFs have no text to find.
+_PDF_OBJ = re.compile(rb"(\d+)\s+\d+\s+obj\b")
+_PDF_TOKEN = re.compile(rb"\s*(<[0-9A-Fa-f\s]*>|<<|>>|\[|\]|/[^\s/\[\]()<>{}%]*|[-+]?(?:\d+\.?\d*|\.\d+)|[A-Za-z'\"*]+\d*|%[^\r\n]*|.)", re.S)
+_PDF_ESCAPES = {ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t", ord("b"): b"\b", ord("f"): b"\f"}
+
+def _pdf_inflate(body, stream, limit):
+    filters = re.findall(rb"/(\w+Decode)\b", body.split(b"/DecodeParms")[0])
+    if not filters:
+        return stream
+    if filters != [b"FlateDecode"] or re.search(rb"/Subtype\s*/Image\b|/Length[123]\b", body):
+        return None  # images, embedded fonts, and rare text encodings
+    try:
+        # Output is capped: a few KB of deflate can expand to gigabytes.
+        return zlib.decompressobj().decompress(stream, limit)
+    except zlib.error:
+        return None
+
+def _pdf_objects(data):
+    """{object number: (dictionary bytes, decoded stream or None)}, including objects inside object streams.
+
+    All streams together decompress to at most TEXT_INDEX_MAX_INFLATED bytes; later ones are left out.
+    """
+    objects, pos, budget = {}, 0, TEXT_INDEX_MAX_INFLATED
+    while True:
+        m = _PDF_OBJ.search(data, pos)
+        if m is None:
+            break
+        start, end = m.end(), data.find(b"endobj", m.end())
+        if end < 0:
+            break
+        begin = data.find(b"stream", start, end)
+        stream = None
+        if begin >= 0:
+            body, i = data[start:begin], begin + 6
+            i += 2 if data[i:i + 2] == b"\r\n" else 1
+            length = re.search(rb"/Length\s+(\d+)(?!\s+\d+\s+R)", body)
+            stop = i + int(length.group(1)) if length else -1
+            if stop < 0 or b"endstream" not in data[stop:stop + 32]:
+                stop = data.find(b"endstream", i)
+            stream = _pdf_inflate(body, data[i:stop], budget) if budget > 0 else None
+            budget -= len(stream or b"")
+            end = data.find(b"endobj", stop)
+            if end < 0:
+                break
+        else:
+            body = data[start:end]
+        objects[int(m.group(1))] = (body, stream)
+        pos = end + 6
+    for body, stream in list(objects.values()):
+        if stream and b"/ObjStm" in body:
+            first = re.search(rb"/First\s+(\d+)", body)
+            if first is None:
+                continue
+            first = int(first.group(1))
+            numbers = [int(n) for n in stream[:first].split()]
+            offsets = [(numbers[k], first + numbers[k + 1]) for k in range(0, len(numbers) - 1, 2)]
+            for k, (num, offset) in enumerate(offsets):
+                stop = offsets[k + 1][1] if k + 1 < len(offsets) else len(stream)
+                objects.setdefault(num, (stream[offset:stop], None))
+    return objects
+
+def _utf16_hex(h):
+    h = re.sub(rb"\s", b"", h)
+    return bytes.fromhex((h + b"0" * (len(h) % 2)).decode("ascii")).decode("utf-16-be", "replace")
+
+def _pdf_cmap(data):
+    """{code bytes: text} from a ToUnicode CMap stream."""
+    cmap = {}
+    for block in re.findall(rb"beginbfchar(.*?)endbfchar", data, re.S):
+        for src, dst in re.findall(rb"<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f\s]*)>", block):
+            cmap[bytes.fromhex(src.decode("ascii"))] = _utf16_hex(dst)
+    for block in re.findall(rb"beginbfrange(.*?)endbfrange", data, re.S):
+        for lo, hi, dst in re.findall(rb"<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]+)>\s*(<[0-9A-Fa-f\s]*>|\[[^\]]*\])", block):
+            width, first, last = len(lo) // 2, int(lo, 16), min(int(hi, 16), int(lo, 16) + 0xFFFF)
+            if dst.startswith(b"["):
+                for k, item in enumerate(re.findall(rb"<([0-9A-Fa-f\s]*)>", dst)[:last - first + 1]):
+                    cmap[(first + k).to_bytes(width, "big")] = _utf16_hex(item)
+            else:
+                base = _utf16_hex(dst[1:-1]) or " "
+                for k in range(last - first + 1):
+                    cmap[(first + k).to_bytes(width, "big")] = base[:-1] + chr(min(ord(base[-1]) + k, 0x10FFFF))
+    return cmap
+
+def _pdf_fonts(objects):
+    """{font resource name: ToUnicode map} gathered from every font dictionary in the file."""
+    cmaps = {}
+    for num, (body, _) in objects.items():
+        ref = re.search(rb"/ToUnicode\s+(\d+)\s+\d+\s+R", body)
+        if ref and int(ref.group(1)) in objects and objects[int(ref.group(1))][1]:
+            cmaps[num] = _pdf_cmap(objects[int(ref.group(1))][1])
+    fonts = {}
+    for body, _ in objects.values():
+        for m in re.finditer(rb"/Font\s*(?:<<(.*?)>>|(\d+)\s+\d+\s+R)", body, re.S):
+            entries = m.group(1) if m.group(1) is not None else objects.get(int(m.group(2)), (b"", None))[0]
+            for name, num in re.findall(rb"/([^\s/\[\]()<>]+)\s+(\d+)\s+\d+\s+R", entries):
+                if int(num) in cmaps:
+                    fonts.setdefault(name, cmaps[int(num)])
+    return fonts
+
+def _pdf_string(data, i):
+    """Parse a literal string starting at data[i] == '('; return (bytes, index after it)."""
+    out, depth, i = bytearray(), 1, i + 1
+    while i < len(data):
+        ch = data[i]
+        if ch == 0x5C:  # backslash
+            nxt = data[i + 1:i + 2]
+            if nxt and nxt in b"01234567":
+                digits = re.match(rb"[0-7]{1,3}", data[i + 1:i + 4]).group()
+                out.append(int(digits, 8) & 0xFF)
+                i += 1 + len(digits)
+                continue
+            if nxt in (b"\n", b"\r"):
+                i += 3 if data[i + 1:i + 3] == b"\r\n" else 2
+                continue
+            out += _PDF_ESCAPES.get(nxt[0], nxt) if nxt else b""
+            i += 2
+            continue
+        if ch == 0x28:
+            depth += 1
+        elif ch == 0x29:
+            depth -= 1
+            if not depth:
+                return bytes(out), i + 1
+        out.append(ch)
+        i += 1
+    return bytes(out), i
+
+def _pdf_decode(raw, cmap):
+    if not cmap:
+        return raw.decode("cp1252", "replace")
+    widths = sorted({len(k) for k in cmap}, reverse=True)
+    out, i = [], 0
+    while i < len(raw):
+        for w in widths:
+            if raw[i:i + w] in cmap:
+                out.append(cmap[raw[i:i + w]])
+                i += w
+                break
+        else:
+            i += widths[-1]
+    return "".join(out)
+
+def _pdf_page_text(content, fonts):
+    # String operands are kept as bytearray so text such as "(40)" is never mistaken for a number.
+    out, operands, cmap, i = [], [], None, 0
+    while i < len(content):
+        if content[i:i + 1].isspace():
+            i += 1
+            continue
+        if content[i] == 0x28:
+            raw, i = _pdf_string(content, i)
+            operands.append(bytearray(raw))
+            continue
+        m = _PDF_TOKEN.match(content, i)
+        if m is None:
+            break
+        i, tok = m.end(), m.group(1)
+        if tok[:1] == b"<" and tok != b"<<":
+            operands.append(bytearray.fromhex(re.sub(rb"\s", b"", tok[1:-1]).decode("ascii").ljust(2, "0")))
+        elif tok[:1] in (b"/", b"[", b"]") or tok[:1].isdigit() or tok[:1] in b"+-.":
+            operands.append(tok)
+        elif tok[:1] == b"%" or tok in (b"<<", b">>") or not tok.strip():
+            continue
+        else:
+            if tok == b"Tf":
+                names = [o for o in operands if isinstance(o, bytes) and o[:1] == b"/"]
+                cmap = fonts.get(names[-1][1:]) if names else None
+            elif tok in (b"Tj", b"'", b'"', b"TJ"):
+                if tok in (b"'", b'"'):
+                    out.append("\n")
+                inside = tok == b"TJ"
+                for o in operands:
+                    if isinstance(o, bytearray):
+                        out.append(_pdf_decode(bytes(o), cmap))
+                    elif inside and re.fullmatch(rb"[-+]?(?:\d+\.?\d*|\.\d+)", o) and float(o) < -200:
+                        out.append(" ")
+            elif tok in (b"Td", b"TD"):
+                out.append("\n" if len(operands) >= 2 and float(operands[-1]) != 0 else " ")
+            elif tok in (b"T*", b"ET"):
+                out.append("\n")
+            operands = []
+    return "".join(out)
+
+def pdf_text(data):
+    """Text of a PDF's pages (those written with text operators)."""
+    objects = _pdf_objects(data)
+    fonts = _pdf_fonts(objects)
+    contents = set()
+    for body, _ in objects.values():
+        if re.search(rb"/Type\s*/Page\b", body):
+            m = re.search(rb"/Contents\s*(\[[^\]]*\]|\d+\s+\d+\s+R)", body)
+            if m:
+                contents.update(int(n) for n in re.findall(rb"(\d+)\s+\d+\s+R", m.group(1)))
+    pages = [_pdf_page_text(objects[n][1], fonts) for n in sorted(contents) if n in objects and objects[n][1]]
+    return "\n".join(pages)
+
+TEXT_EXTRACTORS = {".txt": plain_text, ".csv": plain_text, ".pdf": pdf_text, ".docx": docx_text}
+
+def extract_text(name, data):
+    """Searchable text of an attachment, or None for types that have none (images, binaries)."""
+    extractor = TEXT_EXTRACTORS.get(os.path.splitext(name or "")[1].lower())
+    text = extractor(data) if extractor else None
+    return re.sub(r"[ \t\r\f\v]+", " ", text)[:TEXT_INDEX_MAX_CHARS] if text else None
+
+def fts_query(text):
+    """An FTS5 MATCH expression for what a user typed: every word must appear; the last may be a prefix."""
+    words = re.findall(r"\w+", text or "")
+    if not words:
+        return None
+    return " ".join(f'"{w}"' for w in words) + "*"
+
+class AttachmentTextIndexer:
+    """Background job that extracts the text of new attachments into the attachment_text FTS5 table.
+
+    Files are taken in id order past a watermark per database (main and archive) kept in
+    app_settings, so the indexer resumes where it stopped and never re-reads an indexed file.
+    Files whose payload arrives later from a sync peer are queued by a trigger. Only
+    TEXT_EXTRACTORS types are read; images and other binaries are skipped by name.
+    """
+    def __init__(self, batch_sec=TEXT_INDEX_BATCH_SEC, pause=TEXT_INDEX_PAUSE_SEC):
+        self.batch_sec = batch_sec
+        self.pause = pause
+        self.indexed = 0
+        self.caught_up = False
+        self._purged = False
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="text-index", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Look for new files now instead of at the next idle check (call after an upload)."""
+        self._wake.set()
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                if self.index_batch():
+                    self._stop.wait(SCRUB_BUSY_PAUSE_SEC if foreground_busy() else self.pause)
+                    continue
+                self._wake.wait(TEXT_INDEX_IDLE_SEC)
+                self._wake.clear()
+        except Exception as e:
+            print(f"Attachment text index error: {e}")
+            traceback.print_exc()
+
+    def index_batch(self, budget_sec=None):
+        """Index files until the time budget runs out; return how many files were looked at (0 when caught up)."""
+        deadline = time.monotonic() + (budget_sec or self.batch_sec)
+        conn = db_connect()
+        try:
+            schemas = ["main", "archive"] if attach_archive(conn) else ["main"]
+            marks = {s: int(repo.get_setting(f"text_index.watermark.{s}") or 0) for s in schemas}
+            queued = [r[0] for r in conn.execute("SELECT file_id FROM attachment_text_queue ORDER BY file_id")]
+            rows, seen = [], 0
+            for fid in queued:
+                row = conn.execute("SELECT id, patient_id, file_name, file_type, orig_size, 'main' FROM main.patient_files "
+                                   "WHERE id=? AND file_data IS NOT NULL", (fid,)).fetchone()
+                seen += 1
+                if row is not None:
+                    self._extract(conn, row, rows)
+                if time.monotonic() >= deadline:
+                    queued = queued[:seen]
+                    break
+            for schema in schemas:
+                while time.monotonic() < deadline:
+                    row = conn.execute(f"""SELECT id, patient_id, file_name, file_type, orig_size, '{schema}'
+                                           FROM {schema}.patient_files f WHERE id > ? AND file_data IS NOT NULL
+                                           AND NOT EXISTS (SELECT 1 FROM main.attachment_text t WHERE t.rowid = f.id)
+                                           AND NOT EXISTS (SELECT 1 FROM main.attachment_text_queue q WHERE q.file_id = f.id)
+                                           ORDER BY id LIMIT 1""", (marks[schema],)).fetchone()
+                    if row is None:
+                        break
+                    marks[schema] = row[0]
+                    seen += 1
+                    self._extract(conn, row, rows)
+            # Payloads still on their way from a peer are skipped here and queued by trigger when they arrive.
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO attachment_text (rowid, file_name, body, patient_id) "
+                             "VALUES (?, ?, ?, ?)", rows)
+            conn.executemany("DELETE FROM attachment_text_queue WHERE file_id=?", [(fid,) for fid in queued[:seen]])
+            conn.executemany("INSERT INTO app_settings (key, value) VALUES (?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                             [(f"text_index.watermark.{s}", str(m)) for s, m in marks.items()])
+            if not seen and not self._purged:
+                # Text of files deleted from the archive (no trigger reaches it) is dropped once per session.
+                archived = " AND NOT EXISTS (SELECT 1 FROM archive.patient_files a WHERE a.id = t.rowid)" \
+                    if "archive" in schemas else ""
+                conn.execute("DELETE FROM attachment_text WHERE rowid IN (SELECT t.rowid FROM attachment_text t "
+                             "WHERE NOT EXISTS (SELECT 1 FROM main.patient_files f WHERE f.id = t.rowid)" + archived + ")")
+                self._purged = True
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.indexed += len(rows)
+        self.caught_up = not seen
+        return seen
+
+    def _extract(self, conn, row, rows):
+        fid, pid, name, file_type, size, schema = row
+        if (file_type == "image" or os.path.splitext(name or "")[1].lower() not in TEXT_EXTRACTORS
+                or (size or 0) > TEXT_INDEX_MAX_BYTES):
+            return
+        try:
+            text = extract_text(name, b"".join(iter_attachment(conn, fid, schema)))
+        except Exception as e:
+            print(f"Text extraction skipped for {name}: {e}")
+            text = None
+        # Files without text still get a row so the name is searchable and they are not read again.
+        rows.append((fid, name or "", text or "", pid))
+
+    def run_all(self):
+        """Index everything outstanding now (CLI use); return the number of files indexed."""
+        before = self.indexed
+        while self.index_batch(budget_sec=5):
+            pass
+        return self.indexed - before
+
+TEXT_INDEXER = AttachmentTextIndexer()
+
+# ---------------- Sync ----------------
+SYNC_DIR = os.environ.get("CLINIC_SYNC_DIR")
+SYNC_KEY = os.environ.get("CLINIC_SYNC_KEY")
+SYNC_INTERVAL_MIN = 5
+SYNC_BLOBS_PER_ROUND = 50
+SYNC_TABLE_ORDER = ("users", "patients", "visits", "patient_files", "appointments")  # parents before children
+SYNC_FILE_MAGIC = b"CLINICSYNC2\n"
+SYNC_SALT_FILE = "sync.salt"
+
+def _sync_encode(value):
+    return {"b64": base64.b64encode(value).decode("ascii")} if isinstance(value, bytes) else value
+
+def _sync_decode(value):
+    return sqlite3.Binary(base64.b64decode(value["b64"])) if isinstance(value, dict) else value
+
+def sync_folder_salt(root):
+    """The shared folder's random scrypt salt, created by whichever workstation syncs there first."""
+    path = os.path.join(root, SYNC_SALT_FILE)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        with open(path, "rb") as f:
+            salt = f.read()
+        if len(salt) != 16:
+            raise ValueError(f"{path} is damaged or still being written; try again")
+        return salt
+    salt = os.urandom(16)
+    with os.fdopen(fd, "wb") as f:
+        f.write(salt)
+    return salt
+
+@functools.lru_cache(maxsize=4)
+def derive_sync_key(passphrase, salt):
+    """Derive the AES-256 key every workstation shares from the sync passphrase and the folder's salt."""
+    return hashlib.scrypt(passphrase.encode("utf-8"), salt=salt, n=2 ** 14, r=8, p=1, dklen=32)
+
+def sync_seal(data, key):
+    """Encrypt and authenticate *data* for the shared folder (AES-256-GCM, random 96-bit nonce per file)."""
+    nonce = os.urandom(12)
+    return SYNC_FILE_MAGIC + nonce + AESGCM(key).encrypt(nonce, data, SYNC_FILE_MAGIC)
+
+def sync_open(sealed, key):
+    """Return the plaintext of a sync_seal() file; a wrong passphrase or an altered file raises ValueError."""
+    head = len(SYNC_FILE_MAGIC)
+    if not sealed.startswith(SYNC_FILE_MAGIC) or len(sealed) < head + 12 + 16:
+        raise ValueError("Not an encrypted sync file (or one written by an older version: update every workstation)")
+    try:
+        return AESGCM(key).decrypt(sealed[head:head + 12], sealed[head + 12:], SYNC_FILE_MAGIC)
+    except InvalidTag:
+        raise ValueError("Sync file failed authentication (wrong sync passphrase, or the file was altered)") from None
+
+class SyncEngine:
+    """Offline-first sync between workstations through a shared folder.
+
+    Each node publishes its change_log as deltas under <dir>/<node_id>/changes, and attachments and
+    patient photos under <dir>/<node_id>/blobs, every file encrypted with a key derived from the shared
+    sync passphrase and <dir>/sync.salt; peers pull deltas past their watermark, resolve conflicts
+    last-writer-wins on (version, updated_at, node), and fetch attachments lazily.
+
+    The passphrase is never stored: it comes from CLINIC_SYNC_KEY or is typed once per session.
+    """
+    def __init__(self, sync_dir=None, sync_key=None):
+        self.sync_dir = sync_dir
+        self.sync_key = sync_key
+        self.last_result = None
+        self._key = None
+        self._root = None
+        self._job = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def directory(self):
+        return self.sync_dir or SYNC_DIR or repo.get_setting("sync.dir")
+
+    def key(self):
+        return self.sync_key or SYNC_KEY
+
+    def _unlock(self, root):
+        if not self.key():
+            raise ValueError("No sync passphrase entered (the same one on every workstation)")
+        self._key = derive_sync_key(self.key(), sync_folder_salt(root))
+
+    def _state(self, conn, key, default=None):
+        row = conn.execute("SELECT value FROM app_settings WHERE key=?", (key,)).fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    def _set_state(self, conn, key, value):
+        conn.execute("INSERT INTO app_settings (key, value) VALUES (?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, str(value)))
+
+    def _write_sealed(self, path, data):
+        with open(path + ".part", "wb") as f:
+            f.write(sync_seal(data, self._key))
+        os.replace(path + ".part", path)
+
+    def _read_sealed(self, path):
+        with open(path, "rb") as f:
+            return sync_open(f.read(), self._key)
+
+    def _payload_columns(self, table):
+        # Photos travel as blobs (the row names them by hash) instead of inline in every delta.
+        cols = [c for c in SYNC_TABLES[table] if c not in ("patient_id", "image")]
+        if table == "patient_files":
+            cols += ["orig_size", "sha256"]
+        elif table == "patients":
+            cols += ["created_ts"]
+        return cols + ["version", "updated_at", "node"]
+
+    def _read_row(self, conn, table, uid):
+        cols = self._payload_columns(table)
+        select = ", ".join(f"t.{c}" for c in cols)
+        if "patient_id" in SYNC_TABLES[table]:
+            select += ", (SELECT p.uid FROM patients p WHERE p.id = t.patient_id)"
+            cols = cols + ["patient_uid"]
+        if table == "patients":
+            select += ", t.image"
+        row = conn.execute(f"SELECT {select} FROM {table} t WHERE t.uid=?", (uid,)).fetchone()
+        if row is None:
+            return None
+        out = {c: _sync_encode(v) for c, v in zip(cols, row)}
+        if table == "patients":
+            out["photo"] = hashlib.sha256(row[-1]).hexdigest() if row[-1] is not None else None
+        return out
+
+    def publish(self, conn, node, root):
+        """Write change_log entries newer than the last publish into one delta file; return the change count."""
+        since = int(self._state(conn, "sync.published_seq", 0))
+        entries = conn.execute("SELECT seq, tbl, uid, op, version FROM change_log WHERE seq > ? ORDER BY seq",
+                               (since,)).fetchall()
+        if not entries:
+            return 0
+        changes_dir = os.path.join(root, node, "changes")
+        blob_dir = os.path.join(root, node, "blobs")
+        os.makedirs(changes_dir, exist_ok=True)
+        os.makedirs(blob_dir, exist_ok=True)
+        if since == 0:
+            self._remove_published(changes_dir, blob_dir)
+        lines = []
+        for seq, table, uid, op, version in entries:
+            change = {"seq": seq, "table": table, "uid": uid, "op": op, "version": version}
+            if op == "U":
+                change["row"] = self._read_row(conn, table, uid)
+                if change["row"] is None:
+                    continue
+                if table == "patient_files":
+                    self._write_blob(conn, blob_dir, uid)
+                elif table == "patients" and change["row"]["photo"]:
+                    self._write_photo(conn, blob_dir, uid, change["row"]["photo"])
+            lines.append(json.dumps(change) + "\n")
+        path = os.path.join(changes_dir, f"{since + 1:012d}-{entries[-1][0]:012d}.sync")
+        self._write_sealed(path, gzip.compress("".join(lines).encode("utf-8")))
+        self._set_state(conn, "sync.published_seq", entries[-1][0])
+        conn.commit()
+        return len(lines)
+
+    def _remove_published(self, changes_dir, blob_dir):
+        # Everything is about to be republished; older files may be plaintext or in an older format.
+        for folder in (changes_dir, blob_dir):
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+
+    def _write_blob(self, conn, blob_dir, uid):
+        # Attachments travel beside the deltas, once per file, with "<codec> <orig_size>" as a one-line
+        # header: both describe these bytes, so they are applied together with them, never from the row.
+        path = os.path.join(blob_dir, f"{uid}.blob")
+        if os.path.exists(path):
+            return
+        codec, size, data = conn.execute("SELECT codec, orig_size, file_data FROM patient_files WHERE uid=?",
+                                         (uid,)).fetchone()
+        if data is None:
+            return  # still pending here; peers fetch it from the node that has it
+        header = codec or "raw"
+        if codec is not None and size is not None:
+            header += f" {size}"
+        self._write_sealed(path, header.encode("ascii") + b"\n" + bytes(data))
+
+    def _write_photo(self, conn, blob_dir, uid, digest):
+        # Named by content, so an unchanged photo is written once however often the patient is edited.
+        path = os.path.join(blob_dir, f"photo-{digest}.blob")
+        if not os.path.exists(path):
+            self._write_sealed(path, bytes(conn.execute("SELECT image FROM patients WHERE uid=?", (uid,)).fetchone()[0]))
+
+    def _read_photo(self, root, digest):
+        for peer in sorted(os.listdir(root)):
+            path = os.path.join(root, peer, "blobs", f"photo-{digest}.blob")
+            if os.path.exists(path):
+                data = self._read_sealed(path)
+                if hashlib.sha256(data).hexdigest() == digest:
+                    return data
+        return None
+
+    def pull(self, conn, node, root):
+        """Apply every peer delta past its watermark, one transaction per delta file; return (applied, skipped)."""
+        applied = skipped = 0
+        for peer in sorted(os.listdir(root)):
+            changes_dir = os.path.join(root, peer, "changes")
+            if peer == node or not os.path.isdir(changes_dir):
+                continue
+            done = int(self._state(conn, f"sync.pulled.{peer}", 0))
+            for name in sorted(os.listdir(changes_dir)):
+                if not name.endswith(".sync"):
+                    continue
+                last = int(name[:-len(".sync")].split("-")[1])
+                if last <= done:
+                    continue
+                text = gzip.decompress(self._read_sealed(os.path.join(changes_dir, name))).decode("utf-8")
+                changes = [c for c in map(json.loads, text.splitlines()) if c["seq"] > done]
+                try:
+                    a, s = self.apply(conn, changes, root)
+                    self._set_state(conn, f"sync.pulled.{peer}", last)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied, skipped, done = applied + a, skipped + s, last
+        return applied, skipped
+
+    def apply(self, conn, changes, root=None):
+        """Apply a batch of peer changes in the current transaction; return (applied, skipped).
+
+        change_log is muted meanwhile, so what arrives from a peer is not published back to it.
+        """
+        rank = {t: i for i, t in enumerate(SYNC_TABLE_ORDER)}
+        # Upserts parents first, then deletes children first, so foreign keys resolve within one batch.
+        changes = sorted(changes, key=lambda c: (c["op"] == "D", rank[c["table"]] * (1 if c["op"] == "U" else -1)))
+        applied = appointments = 0
+        with change_log_muted(conn):
+            for c in changes:
+                if c["table"] not in SYNC_TABLES:
+                    continue
+                ok = self._apply_upsert(conn, c, root) if c["op"] == "U" else self._apply_delete(conn, c)
+                applied += ok
+                appointments += ok and c["table"] == "appointments"
+        if appointments:
+            # AppointmentIndex follows change_log, which these rows bypassed; this tells it to reload.
+            conn.execute("INSERT INTO app_settings (key, value) VALUES ('sync.appointments_applied', 1) "
+                         "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+        return applied, len(changes) - applied
+
+    def _local(self, conn, table, uid, row=None):
+        local = conn.execute(f"SELECT id, version, updated_at, node, uid FROM {table} WHERE uid=?", (uid,)).fetchone()
+        if local is None and table == "users" and row is not None:
+            # The same username created on two nodes is one account; converge on the winning uid.
+            local = conn.execute("SELECT id, version, updated_at, node, uid FROM users WHERE username=?",
+                                 (row["username"],)).fetchone()
+        return local
+
+    def _apply_upsert(self, conn, c, root=None):
+        table, row = c["table"], {k: _sync_decode(v) for k, v in c["row"].items()}
+        local = self._local(conn, table, c["uid"], row)
+        incoming = (row["version"], row["updated_at"] or "", row["node"] or "")
+        if local is not None and (local[1], local[2] or "", local[3] or "") >= incoming:
+            return False
+        if local is None:
+            tomb = conn.execute("SELECT MAX(version) FROM (SELECT version FROM change_log WHERE tbl=? AND uid=? AND op='D' "
+                                "UNION ALL SELECT version FROM sync_tombstones WHERE tbl=? AND uid=?)",
+                                (table, c["uid"], table, c["uid"])).fetchone()
+            if tomb[0] is not None and tomb[0] >= row["version"]:
+                return False
+        if "patient_uid" in row:
+            parent = conn.execute("SELECT id FROM patients WHERE uid=?", (row.pop("patient_uid"),)).fetchone()
+            if parent is None:
+                return False  # the patient was deleted here, or never reached this node
+            row["patient_id"] = parent[0]
+        if table == "users" and not is_password_hash(row.get("password")):
+            row["password"] = hash_password(row.get("password") or "")  # a peer still on plaintext passwords
+        if "photo" in row:
+            digest = row.pop("photo")
+            photo = self._read_photo(root, digest) if digest and root else None
+            if digest is None:
+                row["image"] = None
+            elif photo is not None:
+                row["image"] = sqlite3.Binary(photo)
+            else:
+                print(f"Sync: photo {digest} of patient {c['uid']} is missing from the sync folder")
+        row["uid"] = c["uid"]
+        cols = list(row)
+        if local is None:
+            cur = conn.execute(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                               [row[k] for k in cols])
+            rid = cur.lastrowid
+            if table == "patient_files":
+                conn.execute("INSERT OR IGNORE INTO sync_pending_blobs (uid) VALUES (?)", (c["uid"],))
+        else:
+            rid = local[0]
+            conn.execute(f"UPDATE {table} SET {', '.join(k + '=?' for k in cols)} WHERE id=?",
+                         [row[k] for k in cols] + [rid])
+        if table == "patients":
+            index_patient_keys(conn, rid, row["name"], row["phone"])
+        return True
+
+    def _apply_delete(self, conn, c):
+        table = c["table"]
+        conn.execute("INSERT INTO sync_tombstones (tbl, uid, version) VALUES (?, ?, ?) "
+                     "ON CONFLICT(tbl, uid) DO UPDATE SET version = MAX(version, excluded.version)",
+                     (table, c["uid"], c["version"]))
+        local = self._local(conn, table, c["uid"])
+        if local is None or local[1] > c["version"]:
+            return False  # already gone, or edited here after the peer deleted it
+        # The cleanup triggers of a local delete are muted along with change_log.
+        if table == "patients":
+            for t in ("attachment_text", "patient_name_keys", "patient_phone_keys"):
+                conn.execute(f"DELETE FROM {t} WHERE patient_id=?", (local[0],))
+        elif table == "patient_files":
+            conn.execute("DELETE FROM attachment_text WHERE rowid=?", (local[0],))
+        conn.execute(f"DELETE FROM {table} WHERE id=?", (local[0],))
+        return True
+
+    def fetch_blobs(self, conn, root, uids=None, limit=None):
+        """Fill pending attachment payloads from any node's blob folder; return how many arrived."""
+        if uids is None:
+            sql, params = "SELECT uid FROM sync_pending_blobs", ()
+            if limit:
+                sql, params = sql + " LIMIT ?", (limit,)
+            uids = [r[0] for r in conn.execute(sql, params)]
+        fetched = 0
+        for uid in uids:
+            for peer in sorted(os.listdir(root)):
+                path = os.path.join(root, peer, "blobs", f"{uid}.blob")
+                if not os.path.exists(path):
+                    continue
+                header, _, data = self._read_sealed(path).partition(b"\n")
+                codec, _, size = header.decode("ascii").partition(" ")
+                if not size:
+                    # Blobs from older peers (or of never-compressed rows) carry no size; measure it.
+                    size = len(decode_attachment(data, codec))
+                conn.execute("UPDATE patient_files SET file_data=?, codec=?, orig_size=? WHERE uid=?",
+                             (sqlite3.Binary(data), codec, int(size), uid))
+                conn.execute("DELETE FROM sync_pending_blobs WHERE uid=?", (uid,))
+                conn.commit()
+                fetched += 1
+                break
+        return fetched
+
+    def fetch_patient_blobs(self, pid):
+        """On-demand fetch of one patient's pending attachments (e.g. before opening or printing them)."""
+        root = self.directory()
+        if not root or not os.path.isdir(root) or not self.key():
+            return 0
+        self._unlock(root)
+        conn = db_connect()
+        try:
+            uids = [r[0] for r in conn.execute(
+                "SELECT f.uid FROM patient_files f JOIN sync_pending_blobs s ON s.uid = f.uid WHERE f.patient_id=?", (pid,))]
+            return self.fetch_blobs(conn, root, uids) if uids else 0
+        finally:
+            conn.close()
+
+    def sync_once(self):
+        """Publish local changes, pull peers' changes and fetch a batch of pending blobs; return a summary."""
+        root = self.directory()
+        if not root:
+            raise ValueError("No sync folder configured")
+        os.makedirs(root, exist_ok=True)
+        with self._lock:
+            self._unlock(root)
+            conn = db_connect()
+            try:
+                node = self._state(conn, "sync.node_id")
+                published = self.publish(conn, node, root)
+                applied, skipped = self.pull(conn, node, root)
+                blobs = self.fetch_blobs(conn, root, limit=SYNC_BLOBS_PER_ROUND)
+            finally:
+                conn.close()
+        if repo.cache is not None:
+            repo.cache.clear()
+        return {"published": published, "applied": applied, "skipped": skipped, "blobs": blobs}
+
+    def start(self, root):
+        self._root = root
+        if self.directory():
+            self._job = root.after(SYNC_INTERVAL_MIN * 60_000, self._tick)
+
+    def stop(self):
+        if self._root is not None and self._job is not None:
+            try:
+                self._root.after_cancel(self._job)
+            except Exception:
+                pass
+        self._root = self._job = None
+
+    def _tick(self):
+        if self._root is None:
+            return
+        if self.key():  # nothing to do until the passphrase has been entered this session
+            self.start_background()
+        self._job = self._root.after(SYNC_INTERVAL_MIN * 60_000, self._tick)
+
+    def start_background(self):
+        """Run sync_once() on a worker thread unless one is already running; the result lands in last_result."""
+        if self.is_running():
+            return False
+        def work():
+            try:
+                self.last_result = ("ok", self.sync_once())
+            except Exception as e:
+                print(f"Sync error: {e}")
+                traceback.print_exc()
+                self.last_result = ("error", str(e))
+        self._thread = threading.Thread(target=work, name="sync", daemon=True)
+        self._thread.start()
+        return True
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+SYNC = SyncEngine()
+
+# ---------------- Upload Ingestion ----------------
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024  # 8 MB per file
+IMAGE_MAX_DIM = 2560
+PHOTO_MAX_DIM = 1024
+PHOTO_JPEG_QUALITY = 85
+SCAN_JPEG_QUALITY = 92
+PNG_TRANSCODE_MIN_BYTES = 512 * 1024
+KEEP_ORIGINALS = os.environ.get("CLINIC_KEEP_ORIGINALS") == "1"
+IMAGE_EXTS = [".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp"]
+DOCUMENT_EXTS = [".pdf", ".doc", ".docx", ".txt"]
+THUMBNAIL_SIZE = 128
+FORM_PHOTO_SIZE = 160
+
+_ingest_pool = None
+
+def ingest_pool():
+    global _ingest_pool
+    if _ingest_pool is None:
+        _ingest_pool = ThreadPoolExecutor(max_workers=max(2, min(4, (os.cpu_count() or 2) - 1)),
+                                          thread_name_prefix="ingest")
+    return _ingest_pool
+
+def classify_file(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTS:
+        return "image"
+    if ext in DOCUMENT_EXTS:
+        return "document"
+    mime, _ = mimetypes.guess_type(path)
+    return "image" if (mime and mime.startswith("image")) else "other"
+
+def _is_grayscale(img):
+    if img.mode not in ("RGB", "RGBA"):
+        return img.mode in ("L", "LA", "1")
+    r, g, b = img.convert("RGB").split()
+    return ImageChops.difference(r, g).getbbox() is None and ImageChops.difference(g, b).getbbox() is None
+
+def normalize_image(blob, name, category="scan"):
+    """Apply EXIF orientation, cap dimensions and transcode bloated formats.
+
+    'photo' (patient portraits) is re-encoded as JPEG; 'scan' (clinical images) stays
+    lossless unless the upload already was a JPEG. Returns (name, data); the input is
+    returned untouched when it cannot be improved.
+    """
+    try:
+        img = Image.open(io.BytesIO(blob))
+        fmt = img.format
+        if fmt == "GIF" or getattr(img, "n_frames", 1) > 1:
+            return name, blob
+        rotated = img.getexif().get(0x0112, 1) != 1
+        if rotated:
+            img = ImageOps.exif_transpose(img)
+        max_dim = PHOTO_MAX_DIM if category == "photo" else IMAGE_MAX_DIM
+        resized = max(img.size) > max_dim
+        if resized:
+            img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        base = os.path.splitext(name)[0]
+        out = io.BytesIO()
+        if category == "photo" or fmt == "JPEG":
+            if not (rotated or resized or fmt != "JPEG"):
+                return name, blob
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                flat = Image.new("RGB", img.size, "white")
+                flat.paste(img, mask=img.split()[-1])
+                img = flat
+            elif img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            quality = PHOTO_JPEG_QUALITY if category == "photo" else SCAN_JPEG_QUALITY
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+            new_name = f"{base}.jpg"
+        else:
+            if not (rotated or resized or fmt != "PNG" or len(blob) >= PNG_TRANSCODE_MIN_BYTES):
+                return name, blob
+            if img.mode not in ("1", "L", "LA", "P", "RGB", "RGBA", "I;16"):
+                img = img.convert("RGBA" if "A" in img.mode else "RGB")
+            if img.mode in ("RGB", "RGBA") and _is_grayscale(img):
+                img = img.convert("LA" if img.mode == "RGBA" else "L")
+            img.save(out, "PNG", optimize=True)
+            new_name = f"{base}.png"
+        data = out.getvalue()
+        if len(data) >= len(blob) and not (rotated or resized):
+            return name, blob
+        return new_name, data
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        print(f"Image normalization skipped for {name}: {e}")
+        return name, blob
+
+def keep_original(name, blob):
+    """Store the untouched upload in archive.db, keyed by SHA-256."""
+    conn = archive_connect(create=True)
+    try:
+        conn.execute("""CREATE TABLE IF NOT EXISTS archive.original_uploads (
+            sha256 TEXT PRIMARY KEY, file_name TEXT, stored_at TEXT, data BLOB)""")
+        conn.execute("INSERT OR IGNORE INTO archive.original_uploads VALUES (?, ?, ?, ?)",
+                     (hashlib.sha256(blob).hexdigest(), name, datetime.now().strftime("%Y-%m-%d %H:%M"),
+                      sqlite3.Binary(blob)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE):
+    """Small JPEG preview of an image file, or None if it cannot be decoded."""
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (size, size))  # JPEG decoders can downscale while decoding
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=80)
+        return out.getvalue()
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+def decode_photo(data, size=FORM_PHOTO_SIZE):
+    """Patient photo decoded and downscaled for the form, or None if it cannot be decoded."""
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (size, size))
+        img.thumbnail((size, size))
+        img.load()
+        return img
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+def ingest_upload(path, category="scan"):
+    """Read and normalize one upload; return a queued-file dict with original_size for reporting.
+
+    sha256 identifies the upload (duplicate detection); checksum is of the bytes actually stored;
+    dhash/phash (images) find near-duplicates.
+    """
+    with open(path, "rb") as f:
+        blob = f.read()
+    name, ftype = os.path.basename(path), classify_file(path)
+    data, thumb, dhash, phash = blob, None, None, None
+    if ftype == "image":
+        name, data = normalize_image(blob, name, category)
+        if data is not blob and KEEP_ORIGINALS:
+            keep_original(os.path.basename(path), blob)
+        if category != "photo":
+            thumb = make_thumbnail(data)
+            dhash, phash = image_hashes(data)
+    sha256 = hashlib.sha256(blob).hexdigest()
+    return {"name": name, "type": ftype, "data": data, "original_size": len(blob), "sha256": sha256,
+            "checksum": sha256 if data is blob else hashlib.sha256(data).hexdigest(), "thumbnail": thumb,
+            "dhash": dhash, "phash": phash}
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024.0
+
+# ---------------- Image Hashes ----------------
+HASH_BITS_MASK = (1 << 64) - 1
+NEAR_DUPLICATE_BITS = 12  # pHash distance at which two images count as the same picture
+NEAR_DUPLICATE_DHASH_BITS = 16  # second opinion from dHash, to keep unrelated images with a similar layout apart
+IMAGE_HASH_START_DELAY_MS = 150_000
+IMAGE_HASH_BATCH_SEC = 0.2
+IMAGE_HASH_PAUSE_SEC = 0.5
+IMAGE_HASH_IDLE_SEC = 300
+_DCT_SIZE = 32
+_DCT_COS = [[math.cos((2 * n + 1) * u * math.pi / (2 * _DCT_SIZE)) for n in range(_DCT_SIZE)] for u in range(8)]
+
+def _signed64(bits):
+    return bits - (1 << 64) if bits >> 63 else bits
+
+def image_hashes(data):
+    """(dHash, pHash) of an image as signed 64-bit integers, or (None, None) if it cannot be decoded.
+
+    dHash compares neighbouring pixels of a 9x8 thumbnail; pHash keeps the sign of the low 8x8 DCT
+    frequencies of a 32x32 one. Both survive re-encoding, rescaling and small crops.
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("L", (_DCT_SIZE * 4, _DCT_SIZE * 4))
+        img = ImageOps.exif_transpose(img).convert("L")
+        img.thumbnail((_DCT_SIZE * 8, _DCT_SIZE * 8), Image.BOX)
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None, None
+    px = img.resize((9, 8), Image.LANCZOS).tobytes()  # mode L: one byte per pixel
+    dhash = 0
+    for y in range(8):
+        for x in range(8):
+            dhash = dhash << 1 | (px[y * 9 + x] < px[y * 9 + x + 1])
+    px = img.resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS).tobytes()
+    rows = [[sum(c * p for c, p in zip(cos, px[y * _DCT_SIZE:(y + 1) * _DCT_SIZE])) for cos in _DCT_COS]
+            for y in range(_DCT_SIZE)]
+    coeffs = [sum(cos[y] * rows[y][u] for y in range(_DCT_SIZE)) for cos in _DCT_COS for u in range(8)]
+    median = sorted(coeffs[1:])[31]  # the DC term is overall brightness, not structure
+    phash = 0
+    for c in coeffs:
+        phash = phash << 1 | (c > median)
+    return _signed64(dhash), _signed64(phash)
+
+def hamming(a, b):
+    return ((a ^ b) & HASH_BITS_MASK).bit_count()
+
+def distinct_images(ids, hashes, bits=NEAR_DUPLICATE_BITS):
+    """The ids (in the given order) that are not a near-duplicate of an earlier one; hashes maps id -> (phash, dhash)."""
+    kept = []
+    for i in ids:
+        h = hashes.get(i)
+        if h is None or not any(hamming(h[0], hashes[k][0]) <= bits and hamming(h[1], hashes[k][1])
+                                <= NEAR_DUPLICATE_DHASH_BITS for k in kept if k in hashes):
+            kept.append(i)
+    return kept
+
+class HammingIndex:
+    """Multi-index hashing over 64-bit hashes: each hash is filed under its four 16-bit chunks.
+
+    Two hashes at most *radius* bits apart differ in at most radius // 4 bits on one of the chunks
+    (pigeonhole), so a search probes each chunk table with the values that close to the query's and
+    checks the full distance only for what those buckets hold, instead of every stored hash.
+    """
+    def __init__(self, radius):
+        self.radius = radius
+        self.hashes = []
+        self.keys = []
+        self.tables = [{} for _ in range(4)]
+        self.masks = [m for m in range(1 << 16) if m.bit_count() <= radius // 4]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, h, key):
+        h &= HASH_BITS_MASK
+        n = len(self.keys)
+        self.hashes.append(h)
+        self.keys.append(key)
+        for i, table in enumerate(self.tables):
+            table.setdefault(h >> (16 * i) & 0xFFFF, []).append(n)
+
+    def search(self, h):
+        """[(distance, key)] for every key stored within the index radius of *h*."""
+        h &= HASH_BITS_MASK
+        found, seen = [], set()
+        for i, table in enumerate(self.tables):
+            chunk = h >> (16 * i) & 0xFFFF
+            for mask in self.masks:
+                for n in table.get(chunk ^ mask, ()):
+                    if n not in seen:
+                        seen.add(n)
+                        d = (h ^ self.hashes[n]).bit_count()
+                        if d <= self.radius:
+                            found.append((d, self.keys[n]))
+        return found
+
+class ImageHashIndex:
+    """Near-duplicate lookup over every hashed image: attachments (archived ones too) and patient photos.
+
+    The HammingIndex is keyed by pHash and kept in step with repo.image_hash_rows(): new or changed hashes
+    are added, and it is rebuilt once a quarter of its entries are stale. A background job hashes
+    images that were stored before hashing existed or arrived from a sync peer without a hash.
+    """
+    def __init__(self, bits=NEAR_DUPLICATE_BITS, batch_sec=IMAGE_HASH_BATCH_SEC, pause=IMAGE_HASH_PAUSE_SEC):
+        self.bits = bits
+        self.batch_sec = batch_sec
+        self.pause = pause
+        self.hashed = 0
+        self.caught_up = False
+        self._rows = None
+        self._hashes = {}
+        self._index = HammingIndex(bits)
+        self._stale = 0
+        self._lock = threading.Lock()
+        self._failed = set()
+        self._cursor = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def _sync(self):
+        rows = repo.image_hash_rows()
+        if rows is self._rows:
+            return
+        current = {(kind, rid): (ph, dh) for kind, rid, ph, dh in rows}
+        self._stale += sum(1 for k, h in self._hashes.items() if current.get(k) != h)
+        if self._stale > len(current) // 4:
+            self._index, self._stale = HammingIndex(self.bits), 0
+            changed = current
+        else:
+            changed = {k: h for k, h in current.items() if self._hashes.get(k) != h}
+        for key, (ph, _) in changed.items():
+            self._index.add(ph, key)
+        self._hashes, self._rows = current, rows
+
+    def lookup(self, phash, dhash):
+        """[(distance, (kind, id))] of stored images that nearly duplicate (phash, dhash), closest first."""
+        with self._lock:
+            self._sync()
+            found = {}
+            for d, key in self._index.search(phash):
+                h = self._hashes.get(key)
+                # Entries of deleted or re-hashed rows stay in the index until the next rebuild.
+                if h is not None and hamming(h[0], phash) == d and hamming(h[1], dhash) <= NEAR_DUPLICATE_DHASH_BITS:
+                    found[key] = d
+        return sorted((d, key) for key, d in found.items())
+
+    def near_duplicates(self, items, queued=()):
+        """{index in *items*: [ImageMatch]} for new uploads (ingest_upload dicts) that look like a stored
+        image, a file already queued (*queued*) or an earlier item of the same batch."""
+        found = {}
+        earlier = [f for f in queued if f.get("phash") is not None]
+        for i, item in enumerate(items):
+            if item.get("phash") is None:
+                continue
+            hits = self.lookup(item["phash"], item["dhash"])
+            matches = []
+            if hits:
+                rows = repo.image_matches([key for _, key in hits])
+                matches = [rows[key]._replace(distance=d) for d, key in hits if key in rows]
+            for f in earlier:
+                d = hamming(f["phash"], item["phash"])
+                if d <= self.bits and hamming(f["dhash"], item["dhash"]) <= NEAR_DUPLICATE_DHASH_BITS:
+                    matches.append(ImageMatch("queued", None, None, "", f["name"], len(f["data"]), "", d))
+            if matches:
+                found[i] = matches
+            earlier.append(item)
+        return found
+
+    def duplicate_groups(self):
+        """Groups of near-duplicate images across the whole database, biggest reclaimable size first.
+
+        Each group is a list of ImageMatch rows, largest file first; distance is to that first image.
+        """
+        with self._lock:
+            self._sync()
+            parent = {}
+            def root(k):
+                while parent.get(k, k) != k:
+                    k = parent[k] = parent.get(parent[k], parent[k])
+                return k
+            for key, (ph, dh) in self._hashes.items():
+                for d, other in self._index.search(ph):
+                    h = self._hashes.get(other)
+                    if other != key and h is not None and hamming(h[0], ph) == d \
+                            and hamming(h[1], dh) <= NEAR_DUPLICATE_DHASH_BITS:
+                        parent[root(other)] = root(key)
+            members = {}
+            for key in self._hashes:
+                members.setdefault(root(key), []).append(key)
+            hashes = dict(self._hashes)
+        rows = repo.image_matches([k for keys in members.values() for k in keys])
+        groups = []
+        for keys in members.values():
+            group = sorted((rows[k] for k in keys if k in rows), key=lambda r: -(r.size or 0))
+            if len(group) > 1:
+                first = hashes[(group[0].kind, group[0].id)][0]
+                groups.append([r._replace(distance=hamming(first, hashes[(r.kind, r.id)][0])) for r in group])
+        return sorted(groups, key=lambda g: -sum(r.size or 0 for r in g[1:]))
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="image-hash", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                if self.hash_batch():
+                    self._stop.wait(SCRUB_BUSY_PAUSE_SEC if foreground_busy() else self.pause)
+                    continue
+                self._wake.wait(IMAGE_HASH_IDLE_SEC)
+                self._wake.clear()
+                self._cursor = {}
+        except Exception as e:
+            print(f"Image hashing error: {e}")
+            traceback.print_exc()
+
+    def hash_batch(self, budget_sec=None):
+        """Hash unhashed images until the time budget runs out; return how many were looked at (0 when done)."""
+        deadline = time.monotonic() + (budget_sec or self.batch_sec)
+        conn = db_connect()
+        try:
+            sources = [("file", "main")] + ([("file", "archive")] if attach_archive(conn) else []) + [("photo", "main")]
+            files, photos, seen = [], [], 0
+            for kind, schema in sources:
+                while time.monotonic() < deadline:
+                    cursor = self._cursor.get((kind, schema), 0)
+                    if kind == "file":
+                        row = conn.execute(f"SELECT id FROM {schema}.patient_files WHERE phash IS NULL AND file_type = 'image' "
+                                           "AND id > ? AND file_data IS NOT NULL ORDER BY id LIMIT 1", (cursor,)).fetchone()
+                    else:
+                        row = conn.execute("SELECT id, image FROM main.patients WHERE photo_phash IS NULL "
+                                           "AND image IS NOT NULL AND id > ? ORDER BY id LIMIT 1", (cursor,)).fetchone()
+                    if row is None:
+                        break
+                    self._cursor[(kind, schema)] = row[0]
+                    if (kind, schema, row[0]) in self._failed:
+                        continue
+                    seen += 1
+                    data = b"".join(iter_attachment(conn, row[0], schema)) if kind == "file" else bytes(row[1])
+                    dhash, phash = image_hashes(data)
+                    if phash is None:
+                        self._failed.add((kind, schema, row[0]))
+                    elif kind == "file":
+                        files.append((schema, phash, dhash, row[0]))
+                    else:
+                        photos.append((phash, dhash, row[0]))
+            # phash columns are not synced, so these updates do not bump row versions.
+            conn.execute("BEGIN")
+            for schema, phash, dhash, fid in files:
+                conn.execute(f"UPDATE {schema}.patient_files SET phash=?, dhash=? WHERE id=?", (phash, dhash, fid))
+            conn.executemany("UPDATE main.patients SET photo_phash=?, photo_dhash=? WHERE id=?", photos)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.hashed += len(files) + len(photos)
+        self.caught_up = not seen
+        return seen
+
+    def run_all(self):
+        """Hash every outstanding image now (CLI use); return the number hashed."""
+        before = self.hashed
+        self._cursor = {}
+        while self.hash_batch(budget_sec=5):
+            pass
+        return self.hashed - before
+
+IMAGE_HASHES = ImageHashIndex()
+
+# ---------------- Scanner Folder ----------------
+SCAN_DIR = os.environ.get("CLINIC_SCAN_DIR")
+SCAN_POLL_SEC = 2.0
+SCAN_MAX_BYTES = 64 * 1024 * 1024
+SCAN_MAX_IN_FLIGHT = 8  # files beyond this wait in the folder until the ingest pool catches up
+SCAN_BATCH_FILES = 20
+SCAN_BATCH_BYTES = 32 * 1024 * 1024
+SCAN_BATCH_SEC = 2.0
+SCAN_FOLDERS = ("processed", "duplicates", "unmatched", "failed")
+# Only an explicit "P<id>_" prefix names a patient; a bare leading number is as likely a date or a scan counter.
+_SCAN_NAME_ID = re.compile(r"^P(\d+)_", re.IGNORECASE)
+
+def process_scan(path):
+    """Ingest-pool worker: hash, normalize, thumbnail and encode one scanner file."""
+    item = ingest_upload(path, "scan")
+    stored, codec, size = encode_attachment(item.pop("data"), item["name"])
+    item.update(data=stored, codec=codec, size=size)
+    return item
+
+class ScannerService:
+    """Watches the scanner/X-ray drop folder and files new scans under the matching patient.
+
+    A file matches by a "P<id>_" prefix in its name ("P123_chest.png") or by a sidecar <file>.json
+    holding patient_id or phone; a sidecar that arrives after its file brings it back from unmatched/.
+    Stable files are hashed, normalized and thumbnailed on the ingest thread pool and inserted in
+    batched transactions; each handled file then moves into processed/, duplicates/, unmatched/ or failed/.
+    """
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.counts = {"ingested": 0, "duplicates": 0, "unmatched": 0, "failed": 0}
+        self.waiting = 0
+        self.in_flight = 0
+        self.last_error = None
+        self._seen = {}  # path -> (size, mtime) at the previous poll; a file is taken once it stops changing
+        self._sidecars = set()  # sidecars already checked against unmatched/
+        self._futures = {}
+        self._batch = []
+        self._batch_started = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def directory(self):
+        return self.folder or SCAN_DIR or repo.get_setting("scanner.dir")
+
+    def start(self):
+        folder = self.directory()
+        if not folder or self.is_running():
+            return False
+        for sub in SCAN_FOLDERS:
+            os.makedirs(os.path.join(folder, sub), exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(folder,), name="scanner", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, wait=False):
+        self._stop.set()
+        if wait and self._thread:
+            self._thread.join(timeout=30)
+
+    def restart(self):
+        self.stop(wait=True)
+        return self.start()
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def run(self, folder):
+        pool = ingest_pool()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll(folder, pool)
+                except Exception as e:
+                    print(f"Scanner error: {e}")
+                    traceback.print_exc()
+                    self.last_error = str(e)
+                self._stop.wait(0.2 if self._futures else SCAN_POLL_SEC)
+        finally:
+            # Unfinished files were never moved, so the next run picks them up again.
+            for fut in self._futures:
+                fut.cancel()
+            self._futures.clear()
+            if self._batch:
+                try:
+                    self.flush(folder)
+                except Exception as e:
+                    print(f"Scanner error: {e}")
+            self.waiting = self.in_flight = 0
+
+    def poll(self, folder, pool):
+        self._requeue_unmatched(folder)
+        ready = self._stable_files(folder)
+        taken = 0
+        for path in ready:
+            # Back-pressure: the pool only ever holds SCAN_MAX_IN_FLIGHT files; the folder is the queue.
+            if len(self._futures) >= SCAN_MAX_IN_FLIGHT:
+                break
+            taken += 1
+            pid, sidecar = self.match(path)
+            if pid is None:
+                self._finish(folder, path, sidecar, "unmatched")
+            elif os.path.getsize(path) > SCAN_MAX_BYTES:
+                self._finish(folder, path, sidecar, "failed")
+            else:
+                self._futures[pool.submit(process_scan, path)] = (path, pid, sidecar)
+        self.waiting = len(ready) - taken
+        for fut in [f for f in self._futures if f.done()]:
+            path, pid, sidecar = self._futures.pop(fut)
+            try:
+                item = fut.result()
+            except Exception as e:
+                self.last_error = f"{os.path.basename(path)}: {e}"
+                self._finish(folder, path, sidecar, "failed")
+                continue
+            if not self._batch:
+                self._batch_started = time.monotonic()
+            item.update(patient_id=pid, path=path, sidecar=sidecar)
+            self._batch.append(item)
+        self.in_flight = len(self._futures)
+        if self._batch and (len(self._batch) >= SCAN_BATCH_FILES or not self._futures
+                            or sum(len(i["data"]) for i in self._batch) >= SCAN_BATCH_BYTES
+                            or time.monotonic() - self._batch_started >= SCAN_BATCH_SEC):
+            self.flush(folder)
+
+    def flush(self, folder):
+        """Insert the collected files in one transaction, then move each out of the drop folder."""
+        added = repo.add_encoded_files(self._batch)
+        TEXT_INDEXER.wake()
+        batch, self._batch = self._batch, []
+        for item, new in zip(batch, added):
+            self._finish(folder, item["path"], item["sidecar"], "processed" if new else "duplicates")
+
+    def _stable_files(self, folder):
+        current = {}
+        for entry in os.scandir(folder):
+            if not entry.is_file() or entry.name.startswith(".") or entry.name.lower().endswith((".json", ".part", ".tmp")):
+                continue
+            st = entry.stat()
+            current[entry.path] = (st.st_size, st.st_mtime)
+        busy = {p for p, _, _ in self._futures.values()} | {i["path"] for i in self._batch}
+        ready = [p for p, sig in current.items() if self._seen.get(p) == sig and p not in busy]
+        self._seen = current
+        return sorted(ready, key=lambda p: current[p][1])
+
+    def _requeue_unmatched(self, folder):
+        """Move files back from unmatched/ when their sidecar shows up in the drop folder after them."""
+        sidecars = {e.name for e in os.scandir(folder) if e.is_file() and e.name.lower().endswith(".json")}
+        new, self._sidecars = sidecars - self._sidecars, sidecars
+        if not new:
+            return
+        stems = {name[:-5] for name in new}
+        unmatched = os.path.join(folder, "unmatched")
+        for entry in os.scandir(unmatched):
+            if entry.is_file() and (entry.name in stems or os.path.splitext(entry.name)[0] in stems):
+                os.replace(entry.path, os.path.join(folder, entry.name))
+                self.counts["unmatched"] = max(0, self.counts["unmatched"] - 1)
+
+    def match(self, path):
+        """Return (patient id or None, sidecar path or None) for one dropped file."""
+        base = os.path.splitext(path)[0]
+        sidecar = next((p for p in (path + ".json", base + ".json") if os.path.exists(p)), None)
+        pid = None
+        if sidecar:
+            try:
+                with open(sidecar, encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("patient_id") is not None:
+                    pid = int(meta["patient_id"])
+                elif meta.get("phone"):
+                    pid = repo.patient_id_by_phone(str(meta["phone"]))
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                self.last_error = f"{os.path.basename(sidecar)}: {e}"
+        else:
+            m = _SCAN_NAME_ID.match(os.path.basename(path))
+            pid = int(m.group(1)) if m else None
+        if pid is not None and repo.get_patient_name(pid) is None:
+            pid = None
+        return pid, sidecar
+
+    def _finish(self, folder, path, sidecar, outcome):
+        self.counts["ingested" if outcome == "processed" else outcome] += 1
+        for src in (path, sidecar):
+            if not src or not os.path.exists(src):
+                continue
+            dest = os.path.join(folder, outcome, os.path.basename(src))
+            if os.path.exists(dest):
+                stem, ext = os.path.splitext(dest)
+                dest = f"{stem}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}{ext}"
+            os.replace(src, dest)
+
+    def status_text(self):
+        if not self.is_running():
+            return ""
+        c = self.counts
+        text = f"Scanner: {self.waiting} waiting, {self.in_flight} processing, {c['ingested']} filed"
+        extra = [f"{c[k]} {k}" for k in ("duplicates", "unmatched", "failed") if c[k]]
+        return text + (f" ({', '.join(extra)})" if extra else "")
+
+SCANNER = ScannerService()
+
+# ---------------- UI Latency Monitor ----------------
+UI_HEARTBEAT_MS = 100
+UI_LAG_THRESHOLD_MS = 250
+UI_PROFILE = os.environ.get("CLINIC_UI_PROFILE") == "1"
+TRACE_DIR = os.path.join(os.path.expanduser("~"), "Documents", "clinic_traces")
+
+class UiLatencyMonitor:
+    """Measure Tk event-loop lag with an after() heartbeat and blame the handler that caused it."""
+    def __init__(self, interval_ms=UI_HEARTBEAT_MS, threshold_ms=UI_LAG_THRESHOLD_MS,
+                 profile=UI_PROFILE, sample_ms=10):
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        self.profile = profile
+        self.sample_ms = sample_ms
+        self.root = None
+        self.stalls = deque(maxlen=500)
+        self.events = deque(maxlen=20000)
+        self.stack_counts = {}
+        self._stack = []
+        self._seen = []
+        self._after_id = None
+        self._expected = None
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._main_ident = threading.main_thread().ident
+        self._sampler = None
+        self._sampler_stop = threading.Event()
+        self._running = False
+        self.lag_ms = 0.0  # of the latest heartbeat; background jobs back off while it is high
+
+    def start(self, root):
+        self.stop()
+        self.root = root
+        self._running = True
+        self._expected = time.perf_counter() + self.interval_ms / 1000.0
+        self._after_id = root.after(self.interval_ms, self._tick)
+        if self.profile:
+            self._sampler_stop.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name="ui-sampler", daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self._running = False
+        self.lag_ms = 0.0
+        self._sampler_stop.set()
+        if self._sampler is not None:
+            self._sampler.join(timeout=1)
+            self._sampler = None
+        if self.root is not None and self._after_id is not None:
+            try:
+                self.root.after_cancel(self._after_id)
+            except Exception:
+                pass
+        self._after_id = None
+
+    def _us(self, t):
+        return int((t - self._t0) * 1_000_000)
+
+    def _tick(self):
+        if not self._running:
+            return
+        now = time.perf_counter()
+        lag_ms = (now - self._expected) * 1000.0
+        self.lag_ms = lag_ms
+        with self._lock:
+            active = [" > ".join(self._stack)] if self._stack else []
+            culprits = list(dict.fromkeys(self._seen + active))
+            self._seen = []
+        if lag_ms > self.threshold_ms:
+            stall = {"at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                     "lag_ms": round(lag_ms, 1),
+                     "handlers": culprits or ["<idle/unknown>"]}
+            self.stalls.append(stall)
+            self.events.append({"name": "event-loop stall", "ph": "X", "pid": 1, "tid": 1,
+                                "ts": self._us(now - lag_ms / 1000.0), "dur": int(lag_ms * 1000),
+                                "args": {"handlers": stall["handlers"]}})
+        self._expected = now + self.interval_ms / 1000.0
+        try:
+            self._after_id = self.root.after(self.interval_ms, self._tick)
+        except Exception:
+            self._running = False
+
+    @contextmanager
+    def track(self, name):
+        start = time.perf_counter()
+        with self._lock:
+            self._stack.append(name)
+            self._seen.append(" > ".join(self._stack))
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                if self._stack:
+                    self._stack.pop()
+            self.events.append({"name": name, "ph": "X", "pid": 1, "tid": 1,
+                                "ts": self._us(start), "dur": int((end - start) * 1_000_000)})
+
+    def _sample_loop(self):
+        while not self._sampler_stop.wait(self.sample_ms / 1000.0):
+            if not self._running or self._expected is None:
+                continue
+            overdue_ms = (time.perf_counter() - self._expected) * 1000.0
+            if overdue_ms < self.threshold_ms / 2:
+                continue
+            frame = sys._current_frames().get(self._main_ident)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame, limit=40)
+            folded = ";".join(f"{os.path.basename(f.filename)}:{f.name}:{f.lineno}" for f in stack)
+            with self._lock:
+                self.stack_counts[folded] = self.stack_counts.get(folded, 0) + 1
+            self.events.append({"name": stack[-1].name if stack else "?", "ph": "i", "s": "t",
+                                "pid": 1, "tid": 2, "ts": self._us(time.perf_counter()),
+                                "args": {"stack": folded}})
+
+    def summary(self):
+        worst = sorted(self.stalls, key=lambda s: s["lag_ms"], reverse=True)
+        return {"stalls": len(self.stalls), "worst": worst[:10]}
+
+    def export_trace(self, path=None):
+        """Write a Chrome/Perfetto trace JSON (plus folded stacks when profiling) and return its path."""
+        try:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            if not path:
+                path = os.path.join(TRACE_DIR, f"ui_trace_{int(datetime.now().timestamp())}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                           "otherData": {"threshold_ms": self.threshold_ms, "stalls": list(self.stalls)}}, f)
+            if self.stack_counts:
+                with open(os.path.splitext(path)[0] + ".folded", "w", encoding="utf-8") as f:
+                    for stack, count in sorted(self.stack_counts.items(), key=lambda kv: -kv[1]):
+                        f.write(f"{stack} {count}\n")
+            return path
+        except Exception as e:
+            print(f"Error exporting UI trace: {e}")
+            traceback.print_exc()
+            return None
+
+UI_MONITOR = UiLatencyMonitor()
+
+def ui_handler(func):
+    """Record the wrapped Tk handler with UI_MONITOR so stalls can be attributed to it."""
+    name = func.__qualname__.replace(".<locals>", "")
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with UI_MONITOR.track(name):
+            return func(*args, **kwargs)
+    return wrapper
+
 # ---------------- UI Setup ----------------
 try:
     ctk.set_appearance_mode("Light")
@@ -119,81 +4513,665 @@ def pil_to_ctk_image(pil_image, size):
     except:
         return None
 
-# ---------------- PDF Export ----------------
-def save_patient_record_pdf(patient_data, visits_data, files_data=None):
-    try:
-        pdf = FPDF()
-        pdf.add_page()
+def open_with_default_app(path):
+    if sys.platform.startswith("win"):
+        os.startfile(path)
+    elif sys.platform == "darwin":
+        subprocess.Popen(["open", path])
+    else:
+        subprocess.Popen(["xdg-open", path])
+
+class TableControls:
+    """Clickable sort headings, a column filter bar and a pager for a TableQuery-backed Treeview."""
+    def __init__(self, tree, query, container, table_frame, on_change):
+        self.tree = tree
+        self.query = query
+        self.on_change = on_change
+        self.titles = {col: tree.heading(col, "text") for col in query.columns}
+        for col in query.columns:
+            tree.heading(col, command=lambda c=col: self.sort_by(c))
+
+        bar = ctk.CTkFrame(container, fg_color="transparent")
+        bar.pack(fill="x", padx=10, pady=(0, 5), before=table_frame)
+        ctk.CTkLabel(bar, text="Column filter:").pack(side="left", padx=(0, 5))
+        self.col_cb = ctk.CTkComboBox(bar, values=list(self.titles.values()), width=140)
+        self.col_cb.set(list(self.titles.values())[1 if len(self.titles) > 1 else 0])
+        self.col_cb.pack(side="left", padx=5)
+        self.value_e = ctk.CTkEntry(bar, placeholder_text="prefix, *contains, >10", width=180)
+        self.value_e.pack(side="left", padx=5)
+        self.value_e.bind("<Return>", lambda e: self.apply_filter())
+        ctk.CTkButton(bar, text="Filter", width=70, command=self.apply_filter).pack(side="left", padx=5)
+        ctk.CTkButton(bar, text="Clear", width=70, command=self.clear_filters,
+                     fg_color="#7f8c8d", hover_color="#95a5a6").pack(side="left", padx=5)
+        self.filter_lbl = ctk.CTkLabel(bar, text="")
+        self.filter_lbl.pack(side="left", padx=10)
+
+        pager = ctk.CTkFrame(container, fg_color="transparent")
+        pager.pack(fill="x", padx=10, pady=(0, 5), after=table_frame)
+        self.next_btn = ctk.CTkButton(pager, text="Next ▶", width=80, command=self.next_page)
+        self.next_btn.pack(side="right", padx=5)
+        self.page_lbl = ctk.CTkLabel(pager, text="")
+        self.page_lbl.pack(side="right", padx=5)
+        self.prev_btn = ctk.CTkButton(pager, text="◀ Prev", width=80, command=self.prev_page)
+        self.prev_btn.pack(side="right", padx=5)
+        self.refresh_headings()
+
+    def refresh_headings(self):
+        for col, title in self.titles.items():
+            arrow = (" ▼" if self.query.desc else " ▲") if col == self.query.sort else ""
+            self.tree.heading(col, text=title + arrow)
+
+    @ui_handler
+    def sort_by(self, col):
+        self.query.toggle_sort(col)
+        self.refresh_headings()
+        self.on_change()
 
-        # Header
-        pdf.set_font("Helvetica", "B", 18)
-        pdf.cell(0, 10, CLINIC_NAME, new_x="LMARGIN", new_y="NEXT", align="C")
-        pdf.cell(0, 10, "Patient Record", new_x="LMARGIN", new_y="NEXT", align="C")
-        pdf.ln(6)
+    def apply_filter(self):
+        col = next((c for c, t in self.titles.items() if t == self.col_cb.get()), None)
+        if col is None:
+            return
+        previous = self.query.filters.get(col)
+        self.query.set_filter(col, self.value_e.get())
+        try:
+            self.query.where()
+        except ValueError:
+            self.query.set_filter(col, previous)
+            kind = "a date like 2024-03 or 2024-03-15" if self.query.columns[col][1] == "date" else "a number"
+            messagebox.showerror("Error", f"{self.titles[col]} filter must be {kind}, optionally prefixed by >, <, >=, <= or =")
+            return
+        self.value_e.delete(0, "end")
+        self._show_filters()
+        self.on_change()
+
+    def clear_filters(self):
+        self.query.clear_filters()
+        self._show_filters()
+        self.on_change()
+
+    def _show_filters(self):
+        self.filter_lbl.configure(text=", ".join(f"{self.titles[c]}: {v}" for c, v in self.query.filters.items()))
+
+    def next_page(self):
+        if self.query.next_page():
+            self.on_change()
+
+    def prev_page(self):
+        if self.query.prev_page():
+            self.on_change()
+
+    def show(self, rows):
+        """Fill the tree with one page of rows; the look-ahead row only enables Next."""
+        has_more = len(rows) > self.query.page_size
+        self.tree.delete(*self.tree.get_children())
+        for row in rows[:self.query.page_size]:
+            self.tree.insert("", "end", values=row)
+        self.page_lbl.configure(text=f"Page {self.query.page + 1}")
+        self.prev_btn.configure(state="normal" if self.query.page > 0 else "disabled")
+        self.next_btn.configure(state="normal" if has_more else "disabled")
 
-        # Patient info
-        pdf.set_font("Helvetica", "B", 14)
-        pdf.cell(0, 8, f"Patient ID: {patient_data[0] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.set_font("Helvetica", size=12)
-        pdf.cell(0, 8, f"Name: {patient_data[1] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.cell(0, 8, f"Age: {patient_data[2] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.cell(0, 8, f"Gender: {patient_data[3] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.cell(0, 8, f"Phone: {patient_data[4] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.cell(0, 8, f"Address: {patient_data[5] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.cell(0, 8, f"Occupation: {patient_data[6] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.cell(0, 8, f"Last Visit: {patient_data[9] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-        pdf.cell(0, 8, f"Doctor: {patient_data[10] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-
-        # Visits
-        pdf.ln(6)
-        pdf.set_font("Helvetica", "B", 14)
-        pdf.cell(0, 8, "Visit History", new_x="LMARGIN", new_y="NEXT")
-        pdf.set_font("Helvetica", size=12)
-        if visits_data:
-            for visit in visits_data:
-                pdf.ln(4)
-                pdf.cell(0, 8, f"Visit ID: {visit[0] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-                pdf.cell(0, 8, f"Date: {visit[2] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-                pdf.cell(0, 8, f"Diagnosis: {visit[3] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-                pdf.cell(0, 8, f"Prescription: {visit[4] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-                pdf.cell(0, 8, f"Doctor: {visit[5] or 'N/A'}", new_x="LMARGIN", new_y="NEXT")
-                price = visit[6] or 0.0
-                pdf.cell(0, 8, f"Price: ${float(price):.2f}", new_x="LMARGIN", new_y="NEXT")
-        else:
-            pdf.cell(0, 8, "No visit history found", new_x="LMARGIN", new_y="NEXT")
+# ---------------- PDF Export ----------------
+# Visit table layout: (heading, width in mm, alignment); the widths fill an A4 page between 10 mm margins.
+PDF_VISIT_COLUMNS = (("Date", 28, "L"), ("Diagnosis", 58, "L"), ("Prescription", 54, "L"),
+                     ("Doctor", 32, "L"), ("Price", 18, "R"))
+PDF_ROW_HEIGHT = 5.5
+PDF_THUMBNAIL_MM = 28
+
+def _pdf_text(value, default=""):
+    # The core fonts are Latin-1 only; anything else prints as '?' instead of failing the export.
+    text = default if value is None or value == "" else str(value)
+    return text.encode("latin-1", "replace").decode("latin-1")
+
+class PdfTemplate:
+    """Per-clinic header artwork, prepared once and reused by every patient record."""
+    def __init__(self, clinic_name, logo_path=None):
+        self.clinic_name = _pdf_text(clinic_name)
+        self.logo = None
+        if logo_path and os.path.exists(logo_path):
+            try:
+                img = Image.open(logo_path)
+                img.thumbnail((160, 160))
+                out = io.BytesIO()
+                img.save(out, "PNG")
+                self.logo = out.getvalue()
+            except Exception as e:
+                print(f"PDF logo skipped: {e}")
 
-        # Files
-        pdf.ln(6)
+    def draw_header(self, pdf, title):
+        top = pdf.get_y()
+        if self.logo:
+            pdf.image(io.BytesIO(self.logo), x=pdf.l_margin, y=top, h=12)
         pdf.set_font("Helvetica", "B", 14)
-        pdf.cell(0, 8, "Patient Files", new_x="LMARGIN", new_y="NEXT")
-        pdf.set_font("Helvetica", size=12)
-        if files_data:
-            for fdata in files_data:
-                pdf.ln(4)
-                pdf.cell(0, 8, f"File Name: {fdata[0]}", new_x="LMARGIN", new_y="NEXT")
-                pdf.cell(0, 8, f"File Type: {fdata[1]}", new_x="LMARGIN", new_y="NEXT")
-                pdf.cell(0, 8, f"Upload Date: {fdata[2]}", new_x="LMARGIN", new_y="NEXT")
-                if fdata[1]=="image" and fdata[3]:
-                    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-                    tmp.write(fdata[3]); tmp.close()
-                    pdf.image(tmp.name, w=50)
-                    os.unlink(tmp.name)
-        else:
-            pdf.cell(0, 8, "No files attached", new_x="LMARGIN", new_y="NEXT")
-
-        # Save in Documents
-        docs = os.path.join(os.path.expanduser("~"), "Documents")
-        fname = os.path.join(
-            docs,
-            f"patient_record_{patient_data[1].replace(' ','_')}_{int(datetime.now().timestamp())}.pdf"
-        )
-        pdf.output(fname)
-        return fname
+        pdf.cell(0, 7, self.clinic_name, align="C", new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font("Helvetica", "", 10)
+        pdf.cell(0, 5, title, align="C", new_x="LMARGIN", new_y="NEXT")
+        pdf.set_y(max(pdf.get_y(), top + 12) + 1)
+        pdf.line(pdf.l_margin, pdf.get_y(), pdf.w - pdf.r_margin, pdf.get_y())
+        pdf.ln(2)
+
+@functools.lru_cache(maxsize=4)
+def pdf_template(clinic_name=CLINIC_NAME, logo_path=LOGO_PATH, logo_mtime=None):
+    return PdfTemplate(clinic_name, logo_path)
+
+def current_pdf_template():
+    mtime = os.path.getmtime(LOGO_PATH) if os.path.exists(LOGO_PATH) else None
+    return pdf_template(CLINIC_NAME, LOGO_PATH, mtime)
+
+class ClinicPDF(FPDF):
+    """Clinic document pages: the template header and a page footer on every page, and the current
+    table's column headings repeated at the top of each page it continues onto."""
+    def __init__(self, template, title):
+        super().__init__(format="A4")
+        self.template = template
+        self.title_text = _pdf_text(title)
+        self.table_columns = None
+        self._fitted = {}  # (text, width, font) -> (fitted text, its width); diagnoses, drugs and doctors repeat a lot
+        self.set_margins(10, 10, 10)
+        self.set_auto_page_break(True, margin=14)
+
+    def header(self):
+        self.template.draw_header(self, self.title_text)
+        if self.table_columns:
+            self.table_heading()
+
+    def footer(self):
+        self.set_y(-11)
+        self.set_font("Helvetica", "I", 8)
+        self.cell(0, 5, f"Printed {datetime.now().strftime(DATE_FORMAT)}", align="L")
+        self.cell(0, 5, f"Page {self.page_no()}/{{nb}}", align="R")
+
+    def section(self, text):
+        self.ln(3)
+        self.set_font("Helvetica", "B", 12)
+        self.cell(0, 7, _pdf_text(text), new_x="LMARGIN", new_y="NEXT")
+
+    def fit(self, text, width):
+        return self.fit_measured(text, width)[0]
+
+    def fit_measured(self, text, width):
+        # One line per cell keeps every row the same height; long text is cut with "...".
+        key = (text, width, self.font_style, self.font_size_pt)
+        fitted = self._fitted.get(key)
+        if fitted is None:
+            if len(self._fitted) > 4096:
+                self._fitted.clear()
+            cut = self._fit(text, width)
+            fitted = self._fitted[key] = (cut, self.get_string_width(cut))
+        return fitted
+
+    def _fit(self, text, width):
+        room = width - 2 * self.c_margin
+        if self.get_string_width(text) <= room:
+            return text
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.get_string_width(text[:mid] + "...") <= room:
+                lo = mid
+            else:
+                hi = mid - 1
+        return text[:lo] + "..."
+
+    def table_heading(self):
+        self.set_font("Helvetica", "B", 9)
+        self.set_fill_color(226, 232, 240)
+        for heading, width, align in self.table_columns:
+            self.cell(width, PDF_ROW_HEIGHT + 0.5, heading, align=align, fill=True)
+        self.ln()
+        self.set_font("Helvetica", "", 9)
+
+    def table_row(self, values, shade):
+        # Drawn with text() rather than cell(): a row is the hot path of a long history and
+        # cell() re-runs its whole layout machinery for every field.
+        if self.y + PDF_ROW_HEIGHT > self.page_break_trigger:
+            self.add_page()  # header() repeats the column headings
+        y = self.y
+        if shade:
+            self.set_fill_color(247, 250, 252)
+            self.rect(self.l_margin, y, sum(c[1] for c in self.table_columns), PDF_ROW_HEIGHT, style="F")
+        baseline = y + (PDF_ROW_HEIGHT + self.font_size * 0.7) / 2
+        x = self.l_margin
+        for (_, width, align), value in zip(self.table_columns, values):
+            text, text_width = self.fit_measured(_pdf_text(value), width)
+            if text:
+                self.text(x + (width - self.c_margin - text_width if align == "R" else self.c_margin), baseline, text)
+            x += width
+        self.set_y(y + PDF_ROW_HEIGHT)
+
+    def key_values(self, pairs, columns=2):
+        width = (self.w - self.l_margin - self.r_margin) / columns
+        for i, (key, value) in enumerate(pairs):
+            self.set_font("Helvetica", "B", 9)
+            self.cell(26, 5.5, f"{key}:")
+            self.set_font("Helvetica", "", 9)
+            last = i % columns == columns - 1 or i == len(pairs) - 1
+            self.cell(width - 26, 5.5, self.fit(_pdf_text(value, "N/A"), width - 26),
+                      new_x="LMARGIN" if last else "RIGHT", new_y="NEXT" if last else "TOP")
+
+def render_patient_record(path, patient, visits, files=(), thumbnails=None, summary=None, period=None,
+                          template=None):
+    """Write one patient's record to *path* and return the number of pages.
+
+    visits may be any iterable (e.g. ClinicRepository.iter_patient_visits) and is consumed row by
+    row into a one-line-per-visit table, so a long history never sits in memory as a list. files are
+    AttachmentRow metadata; thumbnails maps file id -> stored preview JPEG and is printed as a grid
+    instead of embedding full-size images. summary is a VisitSummary and period a label for the
+    date range, both optional.
+    """
+    pdf = ClinicPDF(template or current_pdf_template(), f"Patient Record - {patient.name or ''}")
+    pdf.set_title(_pdf_text(f"Patient record {patient.id}"))
+    pdf.add_page()
+
+    pdf.key_values([("Patient ID", patient.id), ("Name", patient.name), ("Age", patient.age),
+                    ("Gender", patient.gender), ("Phone", patient.phone), ("Doctor", patient.doctor),
+                    ("Occupation", patient.occupation), ("Last Visit", patient.last_visit),
+                    ("Address", patient.address)])
+    if patient.diagnosis or patient.prescription:
+        pdf.key_values([("Diagnosis", patient.diagnosis), ("Prescription", patient.prescription)], columns=1)
+
+    if summary is not None:
+        pdf.section("Summary" + (f" ({period})" if period else ""))
+        pdf.key_values([("Visits", summary.visits), ("Total billed", f"${float(summary.total or 0):,.2f}"),
+                        ("First visit", summary.first_visit), ("Last visit", summary.last_visit)])
+
+    pdf.section("Visit History" + (f" ({period})" if period and summary is None else ""))
+    pdf.table_columns = PDF_VISIT_COLUMNS
+    pdf.table_heading()
+    count = 0
+    for v in visits:
+        price = f"{float(v.price):.2f}" if v.price not in (None, "") else ""
+        pdf.table_row((v.date, v.diagnosis, v.prescription, v.doctor, price), shade=count % 2 == 1)
+        count += 1
+    pdf.table_columns = None
+    if not count:
+        pdf.set_font("Helvetica", "I", 9)
+        pdf.cell(0, 6, "No visit history found", new_x="LMARGIN", new_y="NEXT")
+
+    pdf.section("Patient Files")
+    files = list(files)
+    if files:
+        pdf.table_columns = (("File", 90, "L"), ("Type", 30, "L"), ("Size", 30, "R"), ("Uploaded", 40, "L"))
+        pdf.table_heading()
+        for i, f in enumerate(files):
+            pdf.table_row((f.file_name, f.file_type, format_bytes(f.size or 0), f.upload_date), shade=i % 2 == 1)
+        pdf.table_columns = None
+        shown = [f for f in files if thumbnails and f.id in thumbnails]
+        per_row = int((pdf.w - pdf.l_margin - pdf.r_margin) // (PDF_THUMBNAIL_MM + 4))
+        for i, f in enumerate(shown):
+            if i % per_row == 0:
+                pdf.ln(3)
+                if pdf.get_y() + PDF_THUMBNAIL_MM + 5 > pdf.page_break_trigger:
+                    pdf.add_page()
+                row_y = pdf.get_y()
+            x = pdf.l_margin + (i % per_row) * (PDF_THUMBNAIL_MM + 4)
+            try:
+                pdf.image(io.BytesIO(thumbnails[f.id]), x=x, y=row_y, w=PDF_THUMBNAIL_MM, h=PDF_THUMBNAIL_MM,
+                          keep_aspect_ratio=True)
+            except Exception as e:
+                print(f"PDF thumbnail skipped for {f.file_name}: {e}")
+            pdf.set_xy(x, row_y + PDF_THUMBNAIL_MM)
+            pdf.set_font("Helvetica", "", 7)
+            pdf.cell(PDF_THUMBNAIL_MM, 4, pdf.fit(_pdf_text(f.file_name), PDF_THUMBNAIL_MM), align="C")
+            pdf.set_y(row_y + PDF_THUMBNAIL_MM + 4)
+    else:
+        pdf.set_font("Helvetica", "I", 9)
+        pdf.cell(0, 6, "No files attached", new_x="LMARGIN", new_y="NEXT")
+
+    pdf.output(path)
+    return pdf.pages_count
+
+def save_patient_record_pdf(source, pid, start_ts=None, end_ts=None, summary=True, thumbnails=True, path=None):
+    """Render patient *pid* from *source* (a repository, normally a snapshot) into Documents.
+
+    start_ts/end_ts limit the visits to [start_ts, end_ts). Returns the file path, or None if the
+    patient does not exist or rendering failed.
+    """
+    try:
+        patient = source.get_patient(pid)
+        if not patient:
+            return None
+        period = None
+        if start_ts is not None or end_ts is not None:
+            period = (f"{format_timestamp(start_ts, '%Y-%m-%d') if start_ts is not None else '...'} to "
+                      f"{format_timestamp(end_ts - 1, '%Y-%m-%d') if end_ts is not None else '...'}")
+        files = source.attachment_rows(pid)
+        previews = None
+        if thumbnails:
+            previews = source.attachment_thumbnails([f.id for f in files if f.has_thumbnail])
+            # One preview per picture: re-uploads at another crop or resolution are listed but not shown again.
+            hashes = source.attachment_hashes([f.id for f in files if f.file_type == "image"])
+            shown = set(distinct_images([f.id for f in files if f.file_type == "image"], hashes))
+            previews = {fid: thumb for fid, thumb in previews.items() if fid in shown}
+            for f in files:
+                if f.file_type == "image" and f.id not in previews and f.id in shown and not f.pending:
+                    thumb = make_thumbnail(b"".join(source.iter_attachment(f.id)))
+                    if thumb:
+                        previews[f.id] = thumb
+        if path is None:
+            docs = os.path.join(os.path.expanduser("~"), "Documents")
+            path = os.path.join(docs, f"patient_record_{(patient.name or 'patient').replace(' ', '_')}_"
+                                      f"{int(datetime.now().timestamp())}.pdf")
+        render_patient_record(path, patient, source.iter_patient_visits(pid, start_ts, end_ts), files, previews,
+                              source.visit_summary(pid, start_ts, end_ts) if summary else None, period)
+        return path
     except Exception as e:
         print(f"Error saving PDF: {e}")
         traceback.print_exc()
         return None
 
+def ask_pdf_options():
+    """Modal options for a patient record PDF; returns save_patient_record_pdf keyword arguments or None.
+
+    From/To accept a year, month or day ("2024", "2024-03", "2024-03-15") and include the whole of it.
+    """
+    result = {}
+    top = Toplevel()
+    top.title("Export Patient Record")
+    top.resizable(False, False)
+    frame = ctk.CTkFrame(top, corner_radius=8)
+    frame.pack(fill="both", expand=True, padx=15, pady=15)
+
+    ctk.CTkLabel(frame, text="Visits from:").grid(row=0, column=0, sticky="w", padx=10, pady=5)
+    e_from = ctk.CTkEntry(frame, placeholder_text="all (or 2024, 2024-03...)", width=200)
+    e_from.grid(row=0, column=1, padx=10, pady=5)
+    ctk.CTkLabel(frame, text="Visits to:").grid(row=1, column=0, sticky="w", padx=10, pady=5)
+    e_to = ctk.CTkEntry(frame, placeholder_text="all (or 2024, 2024-03...)", width=200)
+    e_to.grid(row=1, column=1, padx=10, pady=5)
+    summary_var = ctk.BooleanVar(value=True)
+    ctk.CTkCheckBox(frame, text="Include summary", variable=summary_var).grid(
+        row=2, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+    thumbs_var = ctk.BooleanVar(value=True)
+    ctk.CTkCheckBox(frame, text="Include image thumbnails", variable=thumbs_var).grid(
+        row=3, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+    def export():
+        try:
+            start = timestamp_range(e_from.get())[0] if e_from.get().strip() else None
+            end = timestamp_range(e_to.get())[1] if e_to.get().strip() else None
+        except ValueError as e:
+            messagebox.showerror("Error", str(e), parent=top)
+            return
+        if start is not None and end is not None and end <= start:
+            messagebox.showerror("Error", "'Visits to' must not be before 'Visits from'", parent=top)
+            return
+        result.update(start_ts=start, end_ts=end, summary=summary_var.get(), thumbnails=thumbs_var.get())
+        top.destroy()
+
+    buttons = ctk.CTkFrame(frame, fg_color="transparent")
+    buttons.grid(row=4, column=0, columnspan=2, pady=(10, 5))
+    ctk.CTkButton(buttons, text="Export", width=100, command=export,
+                  fg_color="#9b59b6", hover_color="#8e44ad").pack(side="left", padx=5)
+    ctk.CTkButton(buttons, text="Cancel", width=100, command=top.destroy,
+                  fg_color="#7f8c8d", hover_color="#95a5a6").pack(side="left", padx=5)
+    top.grab_set()
+    top.wait_window()
+    return result or None
+
+# ---------------- Reports ----------------
+REPORT_CACHE_DIR = os.path.join(os.path.dirname(DB_PATH), "report_cache")
+REPORT_LAYOUT_VERSION = 1  # part of the cache key; bump when the report layout changes
+REPORT_TOP_DIAGNOSES = 10
+AGE_BUCKETS = (("0-17", 0, 17), ("18-34", 18, 34), ("35-49", 35, 49), ("50-64", 50, 64), ("65+", 65, 200))
+CHART_WIDTH = 1400  # pixels; charts are drawn at roughly 2x their printed size
+CHART_COLORS = {"visits": (49, 130, 206), "revenue": (56, 161, 105), "patients": (221, 107, 32),
+                "demographics": (128, 90, 213)}
+
+ReportPeriod = namedtuple("ReportPeriod", "key label start_ts end_ts trend_format")
+ReportData = namedtuple("ReportData", "period visits patients revenue new_patients doctors diagnoses trend genders ages")
+
+def report_period(kind, year, number):
+    """ReportPeriod for month *number* (1-12) or quarter *number* (1-4) of *year*, in local time."""
+    if kind == "month" and 1 <= number <= 12:
+        first, months = number, 1
+    elif kind == "quarter" and 1 <= number <= 4:
+        first, months = 3 * number - 2, 3
+    else:
+        raise ValueError(f"No {kind} {number}")
+    start = datetime(year, first, 1)
+    m = first - 1 + months
+    end = datetime(year + m // 12, m % 12 + 1, 1)
+    if kind == "month":
+        return ReportPeriod(f"{year}-{number:02d}", start.strftime("%B %Y"), int(start.timestamp()),
+                            int(end.timestamp()), "%d")
+    return ReportPeriod(f"{year}-Q{number}", f"Q{number} {year}", int(start.timestamp()), int(end.timestamp()), "%Y-%m")
+
+def parse_report_period(text):
+    """ReportPeriod for "2024-03" (a month) or "2024-Q1" (a quarter)."""
+    m = re.fullmatch(r"\s*(\d{4})-(?:(\d{1,2})|[Qq]([1-4]))\s*", text or "")
+    if not m:
+        raise ValueError(f"Period must look like 2024-03 or 2024-Q1, got {text!r}")
+    year, month, quarter = m.groups()
+    return report_period("month", int(year), int(month)) if month else report_period("quarter", int(year), int(quarter))
+
+def load_report_visits(conn, period):
+    """Copy the period's visits (archived included) into temp.report_visits.
+
+    This is the one range scan a report makes; the fingerprint and every GROUP BY read the copy,
+    which is small and contiguous, instead of looking rows up through the date index again.
+    """
+    conn.execute("DROP TABLE IF EXISTS temp.report_visits")
+    conn.execute("""CREATE TEMP TABLE report_visits AS
+                    SELECT id, patient_id, doctor, diagnosis, price, date_ts, version, updated_at
+                    FROM all_visits WHERE date_ts >= ? AND date_ts < ?""", (period.start_ts, period.end_ts))
+
+def report_fingerprint(conn, period):
+    """A string that changes whenever anything a period's report shows changes.
+
+    Covers the period's visits (count, ids and row versions, so edits, deletes and re-dated visits
+    all count), the age and gender of the patients seen, and who registered in the period. Other
+    patient edits (a new visit moving last_visit, a phone number) leave it alone. Reads
+    temp.report_visits (load_report_visits).
+    """
+    visits = conn.execute("SELECT COUNT(*), TOTAL(id), TOTAL(version), MAX(updated_at) FROM report_visits").fetchone()
+    seen = conn.execute("""SELECT COUNT(*), group_concat(id || ':' || IFNULL(age, '') || ':' || IFNULL(gender, ''))
+                           FROM (SELECT id, age, gender FROM patients
+                                 WHERE id IN (SELECT patient_id FROM report_visits) ORDER BY id)""").fetchone()
+    new = conn.execute("SELECT COUNT(*), TOTAL(id) FROM patients WHERE created_ts >= ? AND created_ts < ?",
+                       (period.start_ts, period.end_ts)).fetchone()
+    digest = hashlib.sha1(repr((visits, seen, new)).encode("utf-8")).hexdigest()
+    return f"{REPORT_LAYOUT_VERSION}|{CLINIC_NAME}|{period.key}|{digest}"
+
+def collect_report(conn, period):
+    """Run the period's GROUP BY queries over temp.report_visits (load_report_visits) and return a ReportData."""
+    params = (period.start_ts, period.end_ts)
+    seen = "id IN (SELECT patient_id FROM report_visits)"
+    visits, patients, revenue = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT patient_id), TOTAL(price) FROM report_visits").fetchone()
+    new_patients = conn.execute("SELECT COUNT(*) FROM patients WHERE created_ts >= ? AND created_ts < ?",
+                                params).fetchone()[0]
+    doctors = conn.execute("""SELECT COALESCE(NULLIF(TRIM(doctor), ''), 'Unassigned') AS d, COUNT(*), TOTAL(price)
+                              FROM report_visits GROUP BY d ORDER BY 2 DESC, d""").fetchall()
+    diagnoses = conn.execute("""SELECT MIN(TRIM(diagnosis)), COUNT(*) FROM report_visits
+                                WHERE TRIM(IFNULL(diagnosis, '')) != ''
+                                GROUP BY lower(TRIM(diagnosis)) ORDER BY 2 DESC, 1 LIMIT ?""",
+                             (REPORT_TOP_DIAGNOSES,)).fetchall()
+    bucket = f"strftime('{period.trend_format}', {{}}, 'unixepoch', 'localtime')"
+    trend = {b: [n, r, 0] for b, n, r in conn.execute(
+        f"SELECT {bucket.format('date_ts')} AS b, COUNT(*), TOTAL(price) FROM report_visits GROUP BY b")}
+    for b, n in conn.execute(f"SELECT {bucket.format('created_ts')} AS b, COUNT(*) FROM patients "
+                             "WHERE created_ts >= ? AND created_ts < ? GROUP BY b", params):
+        trend.setdefault(b, [0, 0.0, 0])[2] = n
+    genders = conn.execute(f"""SELECT COALESCE(NULLIF(TRIM(gender), ''), 'Unknown') AS g, COUNT(*) FROM patients
+                               WHERE {seen} GROUP BY g ORDER BY 2 DESC, g""").fetchall()
+    cases = " ".join(f"WHEN CAST(age AS INTEGER) BETWEEN {lo} AND {hi} THEN '{name}'" for name, lo, hi in AGE_BUCKETS)
+    counts = dict(conn.execute(f"""SELECT CASE WHEN age IS NULL OR TRIM(age) = '' THEN 'Unknown' {cases}
+                                   ELSE 'Unknown' END AS b, COUNT(*) FROM patients WHERE {seen} GROUP BY b"""))
+    ages = [(name, counts[name]) for name, _, _ in AGE_BUCKETS + (("Unknown", 0, 0),) if counts.get(name)]
+    return ReportData(period, visits, patients, revenue, new_patients, [tuple(r) for r in doctors],
+                      [tuple(r) for r in diagnoses], [(b,) + tuple(v) for b, v in sorted(trend.items())],
+                      [tuple(r) for r in genders], ages)
+
+def _chart_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 has only the fixed bitmap font
+        return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=64)
+def bar_chart_png(title, items, color, value_format="{:,.0f}"):
+    """Horizontal bar chart of (label, value) *items* as PNG bytes; cached on its inputs."""
+    font, title_font = _chart_font(24), _chart_font(30)
+    bar, gap, label_w, top = 34, 12, 380, 70
+    img = Image.new("RGB", (CHART_WIDTH, top + max(1, len(items)) * (bar + gap) + 20), "white")
+    draw = ImageDraw.Draw(img)
+    draw.text((20, 18), title, fill=(26, 32, 44), font=title_font)
+    peak = max((v for _, v in items), default=0) or 1
+    room = CHART_WIDTH - label_w - 200
+    for i, (label, value) in enumerate(items):
+        y = top + i * (bar + gap)
+        text = str(label)
+        while draw.textlength(text, font=font) > label_w - 30 and len(text) > 1:
+            text = text[:-2] + "…"
+        draw.text((20, y + 4), text, fill=(45, 55, 72), font=font)
+        end = label_w + max(2, int(room * value / peak))
+        draw.rectangle((label_w, y, end, y + bar), fill=color)
+        draw.text((end + 12, y + 4), value_format.format(value), fill=(45, 55, 72), font=font)
+    if not items:
+        draw.text((20, top), "No data for this period", fill=(113, 128, 150), font=font)
+    out = io.BytesIO()
+    img.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+@functools.lru_cache(maxsize=64)
+def column_chart_png(title, items, color, value_format="{:,.0f}"):
+    """Vertical bars of (label, value) *items* in order (a time series) as PNG bytes; cached on its inputs."""
+    font, title_font = _chart_font(20), _chart_font(30)
+    height, top, bottom, left = 520, 70, 50, 30
+    img = Image.new("RGB", (CHART_WIDTH, height), "white")
+    draw = ImageDraw.Draw(img)
+    draw.text((20, 18), title, fill=(26, 32, 44), font=title_font)
+    base = height - bottom
+    draw.line((left, base, CHART_WIDTH - left, base), fill=(160, 174, 192), width=2)
+    if not items:
+        draw.text((left, top), "No data for this period", fill=(113, 128, 150), font=font)
+    peak = max((v for _, v in items), default=0) or 1
+    slot = (CHART_WIDTH - 2 * left) / max(1, len(items))
+    label_every = max(1, math.ceil(len(items) * 60 / (CHART_WIDTH - 2 * left)))
+    for i, (label, value) in enumerate(items):
+        x0 = left + i * slot + slot * 0.15
+        x1 = left + (i + 1) * slot - slot * 0.15
+        y = base - (base - top - 30) * value / peak
+        draw.rectangle((x0, y, x1, base), fill=color)
+        if len(items) <= 16:
+            text = value_format.format(value)
+            draw.text(((x0 + x1 - draw.textlength(text, font=font)) / 2, y - 26), text, fill=(45, 55, 72), font=font)
+        if i % label_every == 0:
+            text = str(label)
+            draw.text(((x0 + x1 - draw.textlength(text, font=font)) / 2, base + 10), text, fill=(45, 55, 72), font=font)
+    out = io.BytesIO()
+    img.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+def report_charts(data):
+    """(title, PNG bytes) for each chart of a report, in print order."""
+    unit = "day" if data.period.trend_format == "%d" else "month"
+    trend = data.trend
+    return [
+        (f"Visits per {unit}", column_chart_png(f"Visits per {unit}", tuple((b, n) for b, n, _, _ in trend),
+                                                CHART_COLORS["visits"])),
+        (f"Revenue per {unit}", column_chart_png(f"Revenue per {unit}", tuple((b, r) for b, _, r, _ in trend),
+                                                 CHART_COLORS["revenue"])),
+        ("Visits per doctor", bar_chart_png("Visits per doctor", tuple((d, n) for d, n, _ in data.doctors),
+                                            CHART_COLORS["visits"])),
+        ("Top diagnoses", bar_chart_png("Top diagnoses", tuple(data.diagnoses), CHART_COLORS["visits"])),
+        ("Patients seen by age", bar_chart_png("Patients seen by age", tuple(data.ages), CHART_COLORS["demographics"])),
+        ("Patients seen by gender", bar_chart_png("Patients seen by gender", tuple(data.genders),
+                                                  CHART_COLORS["demographics"])),
+    ]
+
+def render_report_pdf(path, data, template=None):
+    """Write a ReportData as a PDF: key figures, then each chart followed by its table."""
+    pdf = ClinicPDF(template or current_pdf_template(), f"Clinic Report - {data.period.label}")
+    pdf.set_title(_pdf_text(f"Clinic report {data.period.label}"))
+    pdf.add_page()
+    pdf.section("Key figures")
+    pdf.key_values([("Visits", f"{data.visits:,}"), ("Revenue", f"${data.revenue:,.2f}"),
+                    ("Patients seen", f"{data.patients:,}"), ("New patients", f"{data.new_patients:,}"),
+                    ("Avg. per visit", f"${data.revenue / data.visits:,.2f}" if data.visits else "N/A"),
+                    ("Doctors", len(data.doctors))])
+    tables = {
+        "Visits per doctor": ((("Doctor", 100, "L"), ("Visits", 40, "R"), ("Revenue", 50, "R")),
+                              [(d, f"{n:,}", f"{r:,.2f}") for d, n, r in data.doctors]),
+        "Top diagnoses": ((("Diagnosis", 150, "L"), ("Visits", 40, "R")), [(d, f"{n:,}") for d, n in data.diagnoses]),
+    }
+    trend_rows = [(b, f"{n:,}", f"{r:,.2f}", f"{p:,}") for b, n, r, p in data.trend]
+    unit = "Day" if data.period.trend_format == "%d" else "Month"
+    tables[f"Revenue per {unit.lower()}"] = (((unit, 40, "L"), ("Visits", 50, "R"), ("Revenue", 50, "R"),
+                                             ("New patients", 50, "R")), trend_rows)
+    image_w = pdf.w - pdf.l_margin - pdf.r_margin
+    for title, png in report_charts(data):
+        with Image.open(io.BytesIO(png)) as img:
+            image_h = image_w * img.height / img.width
+        if pdf.y + image_h + 6 > pdf.page_break_trigger:
+            pdf.add_page()
+        pdf.ln(3)
+        pdf.image(io.BytesIO(png), x=pdf.l_margin, w=image_w)
+        if title in tables:
+            pdf.table_columns, rows = tables[title]
+            pdf.table_heading()
+            for i, row in enumerate(rows):
+                pdf.table_row(row, shade=i % 2 == 1)
+            pdf.table_columns = None
+    pdf.output(path)
+    return pdf.pages_count
+
+def _report_paths(period, fingerprint):
+    digest = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]
+    base = os.path.join(REPORT_CACHE_DIR, f"report_{period.key}_{digest}")
+    return base + ".pdf", base + ".json"
+
+def generate_report(period, force=False):
+    """Build (or reuse) the PDF report for *period*; return (pdf path, ReportData, from_cache).
+
+    Finished reports are kept in REPORT_CACHE_DIR under the period and its report_fingerprint, so
+    asking again for a period whose data has not changed only costs the fingerprint query.
+    """
+    with repo.snapshot() as snap:
+        conn = snap.connect()
+        load_report_visits(conn, period)
+        fingerprint = report_fingerprint(conn, period)
+        pdf_path, json_path = _report_paths(period, fingerprint)
+        if not force and os.path.exists(pdf_path) and os.path.exists(json_path):
+            try:
+                with open(json_path, encoding="utf-8") as f:
+                    saved = json.load(f)
+                data = ReportData(period, *(saved[k] for k in ReportData._fields[1:]))
+                return pdf_path, data, True
+            except Exception as e:
+                print(f"Cached report unreadable, rebuilding: {e}")
+        data = collect_report(conn, period)
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    render_report_pdf(pdf_path + ".part", data)
+    with open(json_path + ".part", "w", encoding="utf-8") as f:
+        json.dump({k: getattr(data, k) for k in ReportData._fields[1:]}, f)
+    os.replace(pdf_path + ".part", pdf_path)
+    os.replace(json_path + ".part", json_path)
+    # Older versions of this period's report are superseded.
+    prefix = f"report_{period.key}_"
+    for name in os.listdir(REPORT_CACHE_DIR):
+        full = os.path.join(REPORT_CACHE_DIR, name)
+        if name.startswith(prefix) and full not in (pdf_path, json_path):
+            try:
+                os.remove(full)
+            except OSError:
+                pass
+    return pdf_path, data, False
+
+# ---------------- Excel Export ----------------
+PATIENT_EXPORT_HEADERS = ["ID","Name","Age","Gender","Phone","Address","Occupation","Diagnosis","Prescription","Last Visit","Doctor"]
+VISIT_EXPORT_HEADERS = ["Visit ID","Patient","Date","Diagnosis","Prescription","Doctor","Price ($)"]
+
+def export_rows_to_excel(path, title, headers, rows):
+    """Write rows to a single-sheet workbook and return the number of data rows."""
+    wb=openpyxl.Workbook(); ws=wb.active; ws.title=title
+    ws.append(headers)
+    for r in rows: ws.append(r)
+    wb.save(path)
+    return ws.max_row-1
+
+def ask_excel_path():
+    return filedialog.asksaveasfilename(defaultextension=".xlsx",filetypes=[("Excel files","*.xlsx")])
+
 # ---------------- Login Window ----------------
 class LoginWindow(ctk.CTk):
     def __init__(self):
@@ -227,20 +5205,80 @@ class LoginWindow(ctk.CTk):
         user=self.username.get().strip(); pwd=self.password.get().strip()
         if not user or not pwd:
             messagebox.showerror("Login Failed","Enter both username and password");return
-        conn=db_connect(); c=conn.cursor()
-        c.execute("SELECT id,username,role FROM users WHERE username=? AND password=?", (user,pwd))
-        row=c.fetchone(); conn.close()
+        row=repo.authenticate(user,pwd)
         if not row:
             messagebox.showerror("Login Failed","Invalid credentials");return
         self.destroy()
-        ClinicApp({"id":row[0],"username":row[1],"role":row[2]}).mainloop()
+        ClinicApp(row._asdict()).mainloop()
+
+# ---------------- Read-only Mode ----------------
+READONLY_POLL_MS = 2000
+
+class DataVersionWatcher:
+    """Refreshes the open view of a read-only workstation when another connection commits.
+
+    PRAGMA data_version on a dedicated mode=ro connection is a header read: polling it takes no
+    lock the writing workstation could wait on, and nothing is reloaded while the data is unchanged.
+    """
+    def __init__(self, app, interval_ms=READONLY_POLL_MS):
+        self.app = app
+        self.interval_ms = interval_ms
+        self.refreshes = 0
+        self._conn = None
+        self._version = None
+
+    def start(self):
+        self.app.after(self.interval_ms, self.poll)
+
+    def stop(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def version(self):
+        if self._conn is None:
+            self._conn = readonly_connect()
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def poll(self):
+        try:
+            version = self.version()
+            if self._version is not None and version != self._version:
+                self.refresh_view(getattr(self.app, "view", None))
+            self._version = version
+        except Exception as e:
+            print(f"Read-only refresh failed: {e}")
+            self.stop()  # reopen next time, e.g. after the file was replaced by a restore
+        try:
+            self.app.after(self.interval_ms, self.poll)
+        except Exception:
+            pass  # window closed
+
+    def refresh_view(self, view):
+        """Reload *view* in place, keeping the selected rows and scroll position."""
+        if view is None or not hasattr(view, "refresh"):
+            return
+        tree = view.table.tree if hasattr(view, "table") else getattr(view, "tree", None)
+        if tree is None:
+            view.refresh()
+            self.refreshes += 1
+            return
+        keep = {str(tree.item(i, "values")[0]) for i in tree.selection() if tree.item(i, "values")}
+        top = tree.yview()[0]
+        view.refresh()
+        self.refreshes += 1
+        again = [i for i in tree.get_children() if tree.item(i, "values") and str(tree.item(i, "values")[0]) in keep]
+        if again:
+            tree.selection_set(again)
+        tree.yview_moveto(top)
 
 # ---------------- Main Application ----------------
 class ClinicApp(ctk.CTk):
     def __init__(self,current_user):
         super().__init__()
         self.current_user=current_user
-        self.title(f"{CLINIC_NAME} — Dashboard ({current_user['username']} - {current_user['role']})")
+        self.title(f"{CLINIC_NAME} — Dashboard ({current_user['username']} - {current_user['role']})"
+                   + (" (read-only)" if READ_ONLY else ""))
         try:
             self.iconbitmap(os.path.join("assets","logo.ico"))
         except:
@@ -257,40 +5295,174 @@ class ClinicApp(ctk.CTk):
         nav=ctk.CTkFrame(self,fg_color="#2c5282",height=60); nav.pack(fill="x",padx=10)
         ctk.CTkButton(nav,text="Manage Patients",command=self.open_patients,fg_color="#3182ce").pack(side="left",padx=10,pady=10)
         ctk.CTkButton(nav,text="Visit History",command=self.open_visits,fg_color="#319795").pack(side="left",padx=10,pady=10)
-        if current_user['role']=="Admin":
+        ctk.CTkButton(nav,text="Appointments",command=self.open_appointments,fg_color="#2b6cb0").pack(side="left",padx=10,pady=10)
+        ctk.CTkButton(nav,text="Reports",command=self.open_reports,fg_color="#805ad5").pack(side="left",padx=10,pady=10)
+        if current_user['role']=="Admin" and not READ_ONLY:
             ctk.CTkButton(nav,text="Manage Users",command=self.open_users,fg_color="#38a169").pack(side="left",padx=10,pady=10)
+            ctk.CTkButton(nav,text="Maintenance",command=self.open_maintenance,fg_color="#4a5568").pack(side="left",padx=10,pady=10)
         ctk.CTkButton(nav,text="Export Excel",command=self.export_patients_excel,fg_color="#dd6b20").pack(side="left",padx=10,pady=10)
         ctk.CTkButton(nav,text="Logout",command=self.logout,fg_color="#e53e3e").pack(side="right",padx=10,pady=10)
+        self.scanner_status=ctk.CTkLabel(nav,text="",text_color="white"); self.scanner_status.pack(side="right",padx=10)
         self.content=ctk.CTkFrame(self,fg_color="#f0f4f8"); self.content.pack(fill="both",expand=True,padx=10,pady=(0,10))
+        self.protocol("WM_DELETE_WINDOW",self.on_close)
+        self.bind("<Control-Shift-T>",lambda e: self.export_ui_trace())
+        UI_MONITOR.start(self)
+        self.view=None
+        self.watcher=None
+        if READ_ONLY:
+            # Backups, background jobs, sync and the scanner all write: they belong to the clinic PC.
+            self.scanner_status.configure(text="Read-only")
+            self.watcher=DataVersionWatcher(self); self.watcher.start()
+        else:
+            self.after(60_000,self.scheduled_backup)
+            self.after(120_000,RECOMPRESSOR.start)
+            self.after(SCRUB_START_DELAY_MS,SCRUBBER.start)
+            self.after(TEXT_INDEX_START_DELAY_MS,TEXT_INDEXER.start)
+            self.after(IMAGE_HASH_START_DELAY_MS,IMAGE_HASHES.start)
+            MAINTENANCE.start(self)
+            SYNC.start(self)
+            SCANNER.start(); self.poll_scanner()
         self.open_patients()
 
     def clear_content(self):
         for w in self.content.winfo_children(): w.destroy()
 
+    @ui_handler
     def open_patients(self):
-        self.clear_content(); PatientsView(self.content)
+        self.clear_content(); self.view=PatientsView(self.content)
 
+    @ui_handler
     def open_visits(self):
-        self.clear_content(); VisitsView(self.content)
+        self.clear_content(); self.view=VisitsView(self.content)
+
+    @ui_handler
+    def open_appointments(self):
+        self.clear_content(); self.view=AppointmentsView(self.content)
+
+    @ui_handler
+    def open_reports(self):
+        self.clear_content(); self.view=ReportsView(self.content)
 
+    @ui_handler
     def open_users(self):
         if self.current_user['role']!="Admin":
             messagebox.showerror("Permission denied","Admin only");return
-        self.clear_content(); UsersView(self.content)
+        self.clear_content(); self.view=UsersView(self.content)
+
+    @ui_handler
+    def open_maintenance(self):
+        if self.current_user['role']!="Admin":
+            messagebox.showerror("Permission denied","Admin only");return
+        self.clear_content(); self.view=MaintenanceView(self.content)
 
     def logout(self):
-        self.destroy(); LoginWindow().mainloop()
+        SCANNER.stop(wait=True); self.stop_monitoring(); remove_attachment_open_dir(); self.destroy(); LoginWindow().mainloop()
 
+    def on_close(self):
+        RECOMPRESSOR.stop(); SCRUBBER.stop(); TEXT_INDEXER.stop(); IMAGE_HASHES.stop(); SCANNER.stop(); self.stop_monitoring(); remove_attachment_open_dir(); self.destroy()
+
+    def poll_scanner(self):
+        try:
+            self.scanner_status.configure(text=SCANNER.status_text())
+            self.after(1000,self.poll_scanner)
+        except Exception:
+            pass  # window closed
+
+    def scheduled_backup(self):
+        BACKUPS.start_background()
+        self.after(BACKUP_INTERVAL_MIN*60_000,self.scheduled_backup)
+
+    def stop_monitoring(self):
+        UI_MONITOR.stop(); MAINTENANCE.stop(); SYNC.stop()
+        if self.watcher: self.watcher.stop()
+        if UI_MONITOR.stalls or UI_MONITOR.profile:
+            path=UI_MONITOR.export_trace()
+            if path: print(f"UI trace written to {path}")
+
+    def export_ui_trace(self):
+        path=UI_MONITOR.export_trace()
+        if not path:
+            messagebox.showerror("Error","Failed to export UI trace");return
+        s=UI_MONITOR.summary()
+        worst="\n".join(f"{w['lag_ms']} ms — {', '.join(w['handlers'])}" for w in s["worst"][:5]) or "none"
+        messagebox.showinfo("UI Trace",f"Stalls recorded: {s['stalls']}\nWorst:\n{worst}\n\nTrace written to:\n{path}")
+
+    @ui_handler
     def export_patients_excel(self):
-        path=filedialog.asksaveasfilename(defaultextension=".xlsx",filetypes=[("Excel files","*.xlsx")])
+        path=ask_excel_path()
         if not path: return
-        wb=openpyxl.Workbook(); ws=wb.active; ws.title="Patients"
-        headers=["ID","Name","Age","Gender","Phone","Address","Occupation","Diagnosis","Prescription","Last Visit","Doctor"]
-        ws.append(headers)
-        conn=db_connect(); c=conn.cursor()
-        c.execute("SELECT id,name,age,gender,phone,address,occupation,diagnosis,prescription,last_visit,doctor FROM patients")
-        for r in c.fetchall(): ws.append([cell or "" for cell in r])
-        wb.save(path); messagebox.showinfo("Exported",f"Exported {ws.max_row-1} patients to:\n{path}")
+        with repo.snapshot() as snap: rows=snap.export_patients()
+        count=export_rows_to_excel(path,"Patients",PATIENT_EXPORT_HEADERS,rows)
+        messagebox.showinfo("Exported",f"Exported {count} patients to:\n{path}")
+
+# ---------------- Patient Prefetch ----------------
+PREFETCH_NEIGHBOURS = 3
+PREFETCH_DELAY_MS = 60
+
+_prefetch_pool = None
+
+def prefetch_pool():
+    """One worker shared by every list's prefetcher; views come and go, the thread does not."""
+    global _prefetch_pool
+    if _prefetch_pool is None:
+        _prefetch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+    return _prefetch_pool
+
+class PatientPrefetcher:
+    """Warms repo.patient_details for a Treeview's selected row and its neighbours in the background.
+
+    Results live in the query cache, so they are bounded and invalidated by writes like any other read.
+    Only the latest selection is worked on; rows the user has already moved past are skipped.
+    """
+    def __init__(self, tree, neighbours=PREFETCH_NEIGHBOURS):
+        self.tree = tree
+        self.neighbours = neighbours
+        self.prefetched = 0
+        self._after = None
+        self._generation = 0
+        tree.bind("<<TreeviewSelect>>", self._on_select, add="+")
+        tree.bind("<Destroy>", self._on_destroy, add="+")
+
+    def _on_destroy(self, event=None):
+        # Drop the pending timer and make queued work for this list stop at its next row.
+        if self._after is not None:
+            self.tree.after_cancel(self._after)
+            self._after = None
+        self._generation += 1
+
+    def _on_select(self, event=None):
+        # Holding an arrow key fires a select per row; wait until the selection settles.
+        if self._after is not None:
+            self.tree.after_cancel(self._after)
+        self._after = self.tree.after(PREFETCH_DELAY_MS, self._schedule)
+
+    def _schedule(self):
+        self._after = None
+        try:
+            sel = self.tree.selection()
+            if not sel:
+                return
+            items = self.tree.get_children()
+            i = self.tree.index(sel[0])
+            order = [i]
+            for d in range(1, self.neighbours + 1):
+                order += [i + d, i - d]  # below first: lists are read top to bottom
+            pids = [int(self.tree.item(items[j], "values")[0]) for j in order if 0 <= j < len(items)]
+        except Exception as e:
+            print(f"Prefetch skipped: {e}")
+            return
+        self._generation += 1
+        prefetch_pool().submit(self._warm, pids, self._generation)
+
+    def _warm(self, pids, generation):
+        for pid in pids:
+            if generation != self._generation:
+                return
+            try:
+                repo.patient_details(pid)
+                self.prefetched += 1
+            except Exception as e:
+                print(f"Prefetch of patient {pid} failed: {e}")
 
 # ---------------- Patients View ----------------
 class PatientsView:
@@ -298,6 +5470,9 @@ class PatientsView:
         self.parent = parent
         self.current_image_blob = None
         self.patient_files = []
+        self._checking_duplicates = False
+        self.search_kw = ""
+        self.query = TableQuery("patients", PATIENT_TABLE_COLUMNS)
 
         parent.grid_columnconfigure(0, weight=1)
         parent.grid_columnconfigure(1, weight=2)
@@ -329,13 +5504,14 @@ class PatientsView:
         ctk.CTkLabel(left, text="Patient Information",
                     font=ctk.CTkFont(size=18, weight="bold")).pack(pady=10)
 
-        ctk.CTkButton(left, text=icon_label("🖼️ Upload Patient Photo", "[Photo] Upload Patient Photo"),
-                     command=self.upload_photo,
-                     fg_color="#27ae60", hover_color="#229954").pack(pady=10, padx=20, fill="x")
+        if not READ_ONLY:
+            ctk.CTkButton(left, text=icon_label("🖼️ Upload Patient Photo", "[Photo] Upload Patient Photo"),
+                         command=self.upload_photo,
+                         fg_color="#27ae60", hover_color="#229954").pack(pady=10, padx=20, fill="x")
 
-        ctk.CTkButton(left, text=icon_label("📎 Upload Patient Files", "[Files] Upload Patient Files"),
-                     command=self.upload_files,
-                     fg_color="#3498db", hover_color="#2980b9").pack(pady=5, padx=20, fill="x")
+            ctk.CTkButton(left, text=icon_label("📎 Upload Patient Files", "[Files] Upload Patient Files"),
+                         command=self.upload_files,
+                         fg_color="#3498db", hover_color="#2980b9").pack(pady=5, padx=20, fill="x")
 
         photo_frame = ctk.CTkFrame(left, width=160, height=160, corner_radius=8)
         photo_frame.pack(pady=10)
@@ -344,6 +5520,9 @@ class PatientsView:
         self.photo_label = ctk.CTkLabel(photo_frame, text="No Photo", font=ctk.CTkFont(size=12))
         self.photo_label.pack(expand=True)
 
+        self.summary_label = ctk.CTkLabel(left, text="", font=ctk.CTkFont(size=12))
+        self.summary_label.pack(pady=(0, 5))
+
         form_frame = ctk.CTkFrame(left, corner_radius=8, fg_color="transparent")
         form_frame.pack(fill="both", expand=True, padx=10, pady=10)
 
@@ -401,17 +5580,22 @@ class PatientsView:
         ctk.CTkLabel(form_frame, text="Actions:",
                     font=ctk.CTkFont(size=14, weight="bold")).pack(anchor="w", padx=10, pady=(20, 10))
 
-        ctk.CTkButton(form_frame, text=icon_label("➕ Add Patient", "[+] Add Patient"), command=self.add_patient,
-                     fg_color="#27ae60", hover_color="#229954", height=40).pack(fill="x", padx=10, pady=5)
+        if not READ_ONLY:
+            ctk.CTkButton(form_frame, text=icon_label("➕ Add Patient", "[+] Add Patient"), command=self.add_patient,
+                         fg_color="#27ae60", hover_color="#229954", height=40).pack(fill="x", padx=10, pady=5)
 
         ctk.CTkButton(form_frame, text=icon_label("📂 Load Patient", "[Open] Load Patient"), command=self.load_patient_by_id,
                      fg_color="#3498db", hover_color="#2980b9", height=40).pack(fill="x", padx=10, pady=5)
 
-        ctk.CTkButton(form_frame, text=icon_label("✏️ Update Patient", "[Edit] Update Patient"), command=self.update_patient,
-                     fg_color="#f39c12", hover_color="#e67e22", height=40).pack(fill="x", padx=10, pady=5)
+        if not READ_ONLY:
+            ctk.CTkButton(form_frame, text=icon_label("✏️ Update Patient", "[Edit] Update Patient"), command=self.update_patient,
+                         fg_color="#f39c12", hover_color="#e67e22", height=40).pack(fill="x", padx=10, pady=5)
 
-        ctk.CTkButton(form_frame, text=icon_label("🗑️ Delete Patient", "[Del] Delete Patient"), command=self.delete_patient,
-                     fg_color="#e74c3c", hover_color="#c0392b", height=40).pack(fill="x", padx=10, pady=5)
+            ctk.CTkButton(form_frame, text=icon_label("🗑️ Delete Patient", "[Del] Delete Patient"), command=self.delete_patient,
+                         fg_color="#e74c3c", hover_color="#c0392b", height=40).pack(fill="x", padx=10, pady=5)
+
+        ctk.CTkButton(form_frame, text=icon_label("📁 Browse Files", "[Files] Browse Files"), command=self.browse_files,
+                     fg_color="#2b6cb0", hover_color="#2c5282", height=40).pack(fill="x", padx=10, pady=5)
 
         ctk.CTkButton(form_frame, text=icon_label("📄 Export to PDF", "[PDF] Export to PDF"), command=self.export_patient_pdf,
                      fg_color="#9b59b6", hover_color="#8e44ad", height=40).pack(fill="x", padx=10, pady=5)
@@ -430,21 +5614,37 @@ class PatientsView:
         search_frame = ctk.CTkFrame(right, fg_color="transparent")
         search_frame.pack(fill="x", padx=10, pady=5)
 
+        self.search_mode = ctk.CTkSegmentedButton(search_frame, values=["Patients", "File text"])
+        self.search_mode.set("Patients")
+        self.search_mode.pack(side="left", padx=(0, 5))
         self.search = ctk.CTkEntry(search_frame, placeholder_text="Search by name, phone or doctor")
         self.search.pack(side="left", fill="x", expand=True, padx=(0, 5))
+        self.search.bind("<Return>", lambda e: self.search_patients())
 
         ctk.CTkButton(search_frame, text=icon_label("🔍 Search", "[?] Search"), width=100,
                      command=self.search_patients).pack(side="left", padx=5)
         ctk.CTkButton(search_frame, text=icon_label("🔄 Refresh", "[R] Refresh"), width=100,
                      command=self.load_all_patients).pack(side="left", padx=5)
 
+        bulk_frame = ctk.CTkFrame(right, fg_color="transparent")
+        bulk_frame.pack(fill="x", padx=10, pady=(0, 5))
+
+        ctk.CTkLabel(bulk_frame, text="Selected rows:").pack(side="left", padx=(0, 5))
+        if not READ_ONLY:
+            ctk.CTkButton(bulk_frame, text=icon_label("🗑️ Delete Selected", "[Del] Delete Selected"), width=130,
+                         command=self.delete_selected, fg_color="#e74c3c", hover_color="#c0392b").pack(side="left", padx=5)
+            ctk.CTkButton(bulk_frame, text=icon_label("👨‍⚕️ Reassign Doctor", "[Dr] Reassign Doctor"), width=130,
+                         command=self.reassign_selected, fg_color="#f39c12", hover_color="#e67e22").pack(side="left", padx=5)
+        ctk.CTkButton(bulk_frame, text=icon_label("📊 Export Selected", "[XLS] Export Selected"), width=130,
+                     command=self.export_selected, fg_color="#dd6b20").pack(side="left", padx=5)
+
         table_frame = ctk.CTkFrame(right, fg_color="transparent")
         table_frame.pack(fill="both", expand=True, padx=10, pady=10)
         table_frame.grid_columnconfigure(0, weight=1)
         table_frame.grid_rowconfigure(0, weight=1)
 
         cols = ("id", "name", "age", "gender", "phone", "occupation", "doctor", "last_visit")
-        self.tree = ttk.Treeview(table_frame, columns=cols, show="headings", height=20)
+        self.tree = ttk.Treeview(table_frame, columns=cols, show="headings", height=20, selectmode="extended")
 
         self.tree.heading("id", text="ID")
         self.tree.column("id", width=50, anchor="center")
@@ -479,19 +5679,36 @@ class PatientsView:
         self.tree.configure(xscrollcommand=h_scrollbar.set)
 
         self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+        self.table = TableControls(self.tree, self.query, right, table_frame, self.refresh)
 
         self.tree.bind("<Double-1>", self.on_double)
+        self.prefetcher = PatientPrefetcher(self.tree)
 
         self.load_all_patients()
 
+    @ui_handler
     def upload_photo(self):
         try:
             path = filedialog.askopenfilename(title="Select patient photo",
                                              filetypes=[("Image files","*.png *.jpg *.jpeg *.bmp")])
             if not path:
                 return
-            with open(path, "rb") as f:
-                blob = f.read()
+            self.photo_label.configure(text="Processing...")
+            self._when_done([ingest_pool().submit(ingest_upload, path, "photo")], self._photo_ready)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load image: {e}")
+
+    def _when_done(self, futures, callback):
+        """Poll worker-pool futures from the Tk loop and hand their results to callback."""
+        if all(f.done() for f in futures):
+            callback(futures)
+        else:
+            self.parent.after(50, lambda: self._when_done(futures, callback))
+
+    @ui_handler
+    def _photo_ready(self, futures):
+        try:
+            blob = futures[0].result()["data"]
             self.current_image_blob = blob
             pil_img = Image.open(io.BytesIO(blob))
             pil_img.thumbnail((160, 160))
@@ -502,8 +5719,10 @@ class PatientsView:
             else:
                 self.photo_label.configure(text="Photo Loaded")
         except Exception as e:
+            self.photo_label.configure(text="No Photo")
             messagebox.showerror("Error", f"Failed to load image: {e}")
 
+    @ui_handler
     def upload_files(self):
         try:
             paths = filedialog.askopenfilenames(
@@ -515,45 +5734,70 @@ class PatientsView:
             if not paths:
                 return
 
-            MAX_BYTES = 8 * 1024 * 1024  # 8 MB per file
-            self.patient_files = []
+            futures = []
 
             for path in paths:
                 try:
                     size = os.path.getsize(path)
                 except Exception:
                     size = 0
-                if size > MAX_BYTES:
+                if size > MAX_UPLOAD_BYTES:
                     messagebox.showwarning("File skipped", f"{os.path.basename(path)} is larger than 8MB and was skipped.")
                     continue
+                futures.append(ingest_pool().submit(ingest_upload, path))
 
-                with open(path, "rb") as f:
-                    blob = f.read()
-
-                # Use simple categories to match existing PDF condition, or switch to MIME below
-                ext = os.path.splitext(path)[1].lower()
-                if ext in [".png", ".jpg", ".jpeg", ".bmp", ".gif"]:
-                    ftype = "image"
-                elif ext in [".pdf", ".doc", ".docx", ".txt"]:
-                    ftype = "document"
-                else:
-                    # Optional: use mimetypes to be more precise
-                    mime, _ = mimetypes.guess_type(path)
-                    ftype = "image" if (mime and mime.startswith("image")) else "other"
-
-                self.patient_files.append({
-                    "name": os.path.basename(path),
-                    "type": ftype,
-                    "data": blob
-                })
-
-            if self.patient_files:
-                messagebox.showinfo("Success", f"Queued {len(self.patient_files)} file(s) to attach to this patient")
-            else:
+            if not futures:
                 messagebox.showwarning("No files", "No files were added (all may have been skipped).")
+                return
+            self._when_done(futures, self._files_ready)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to upload files: {e}")
 
+    @ui_handler
+    def _files_ready(self, futures):
+        failed, added = [], []
+        for fut in futures:
+            try:
+                added.append(fut.result())
+            except Exception as e:
+                failed.append(str(e))
+        if any(f.get("phash") is not None for f in added):
+            # Hash lookups are quick, but the first one after a write re-reads the hashes: keep it off the Tk thread.
+            check = ingest_pool().submit(IMAGE_HASHES.near_duplicates, added, list(self.patient_files))
+            self._when_done([check], lambda fs: self._queue_files(added, failed, fs[0]))
+        else:
+            self._queue_files(added, failed, None)
+
+    @ui_handler
+    def _queue_files(self, added, failed, check):
+        dupes = {}
+        if check is not None:
+            try:
+                dupes = check.result()
+            except Exception as e:
+                print(f"Near-duplicate check failed: {e}")
+        if dupes:
+            listing = "\n".join(
+                f"{added[i]['name']}  looks like  {m.file_name}"
+                + (f" (patient #{m.patient_id} {m.patient}, {m.upload_date})" if m.patient_id else " (already queued)")
+                for i, matches in dupes.items() for m in matches[:3])
+            if not messagebox.askyesno("Possible duplicate images",
+                                       f"These images look like ones already on record:\n\n{listing}\n\n"
+                                       "Attach them anyway? (No skips them)"):
+                added = [f for i, f in enumerate(added) if i not in dupes]
+        self.patient_files.extend(added)  # earlier selections stay queued until the patient is saved
+        if failed:
+            messagebox.showwarning("Files skipped", "Some files could not be read:\n" + "\n".join(failed))
+        if added:
+            original = sum(f["original_size"] for f in added)
+            stored = sum(len(f["data"]) for f in added)
+            messagebox.showinfo("Success", f"Queued {len(added)} file(s) to attach to this patient "
+                                           f"({len(self.patient_files)} in total)\n"
+                                           f"Stored size {format_bytes(stored)} (saved {format_bytes(original - stored)})")
+        else:
+            messagebox.showwarning("No files", "No files were added (all may have been skipped).")
+
+    @ui_handler
     def add_patient(self):
         try:
             name = self.e_name.get().strip()
@@ -581,35 +5825,47 @@ class PatientsView:
             presc = self.e_presc.get().strip()
             doctor = self.e_doctor.get().strip()
             last_visit = datetime.now().strftime("%Y-%m-%d %H:%M")
+            fields = {"name": name, "age": age, "gender": gender, "phone": phone, "address": address,
+                      "occupation": occupation, "diagnosis": diag, "prescription": presc,
+                      "last_visit": last_visit, "doctor": doctor}
 
-            conn = db_connect()
-            c = conn.cursor()
-
-            c.execute('''INSERT INTO patients (name, age, gender, phone, address, occupation, diagnosis, prescription, last_visit, doctor, image)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                      (name, age, gender, phone, address, occupation, diag, presc, last_visit, doctor,
-                       sqlite3.Binary(self.current_image_blob) if self.current_image_blob else None))
-            conn.commit()
+            if self._checking_duplicates:
+                return
+            self._checking_duplicates = True
+            # The lookup is a few index probes, but a first read after a write can wait on the disk.
+            check = ingest_pool().submit(repo.find_duplicates, name, phone)
+            self._when_done([check], lambda fs: self._save_new_patient(fields, fs[0]))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to add patient: {e}")
 
-            patient_id = c.lastrowid
+    @ui_handler
+    def _save_new_patient(self, fields, check):
+        self._checking_duplicates = False
+        try:
+            try:
+                dupes = check.result()
+            except Exception as e:
+                print(f"Duplicate check failed: {e}")
+                dupes = []
+            if dupes:
+                listing = "\n".join(f"#{d.id}  {d.name}  {d.phone}  ({d.reason})" for d in dupes)
+                if not messagebox.askyesno("Possible duplicate",
+                                           f"This patient may already be registered:\n\n{listing}\n\n"
+                                           "Add as a new patient anyway?"):
+                    return
 
+            repo.add_patient(fields, image=self.current_image_blob, files=self.patient_files)
             if self.patient_files:
-                for file_info in self.patient_files:
-                    c.execute('''INSERT INTO patient_files (patient_id, file_name, file_type, upload_date, file_data)
-                                 VALUES (?, ?, ?, ?, ?)''',
-                              (patient_id, file_info["name"], file_info["type"],
-                               datetime.now().strftime("%Y-%m-%d %H:%M"),
-                               sqlite3.Binary(file_info["data"])))
-                conn.commit()
-                self.patient_files = []  # clear queued files after successful save
+                TEXT_INDEXER.wake()
+            self.patient_files = []  # clear queued files after successful save
 
-            conn.close()
             messagebox.showinfo("Success", "Patient added successfully")
             self.clear_form()
             self.load_all_patients()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to add patient: {e}")
 
+    @ui_handler
     def load_patient_by_id(self):
         try:
             pid = self.e_id.get().strip()
@@ -619,69 +5875,62 @@ class PatientsView:
 
             pid_int = int(pid)
 
-            conn = db_connect()
-            c = conn.cursor()
-
-            c.execute("SELECT id, name, age, gender, phone, address, occupation, diagnosis, prescription, last_visit, doctor, image FROM patients WHERE id=?", (pid_int,))
-            row = c.fetchone()
-            if not row:
-                conn.close()
+            details = repo.patient_details(pid_int)
+            if not details:
                 messagebox.showerror("Error", "Patient not found")
                 return
-
-            (pid, name, age, gender, phone, address, occupation, diag, presc, last_visit, doctor, image_blob) = row
+            p = details.patient
 
             self.e_id.delete(0, "end")
-            self.e_id.insert(0, str(pid))
+            self.e_id.insert(0, str(p.id))
 
             self.e_name.delete(0, "end")
-            self.e_name.insert(0, name or "")
+            self.e_name.insert(0, p.name or "")
 
             self.e_age.delete(0, "end")
-            self.e_age.insert(0, str(age) if age is not None else "")
+            self.e_age.insert(0, str(p.age) if p.age is not None else "")
 
-            self.gender_cb.set(gender or "Male")
+            self.gender_cb.set(p.gender or "Male")
 
             self.e_phone.delete(0, "end")
-            self.e_phone.insert(0, phone or "")
+            self.e_phone.insert(0, p.phone or "")
 
             self.e_address.delete(0, "end")
-            self.e_address.insert(0, address or "")
+            self.e_address.insert(0, p.address or "")
 
             self.e_occupation.delete(0, "end")
-            self.e_occupation.insert(0, occupation or "")
+            self.e_occupation.insert(0, p.occupation or "")
 
             self.e_diag.delete(0, "end")
-            self.e_diag.insert(0, diag or "")
+            self.e_diag.insert(0, p.diagnosis or "")
 
             self.e_presc.delete(0, "end")
-            self.e_presc.insert(0, presc or "")
+            self.e_presc.insert(0, p.prescription or "")
 
             self.e_doctor.delete(0, "end")
-            self.e_doctor.insert(0, doctor or "")
+            self.e_doctor.insert(0, p.doctor or "")
 
-            self.current_image_blob = image_blob
-            if image_blob:
-                try:
-                    pil_img = Image.open(io.BytesIO(image_blob))
-                    pil_img.thumbnail((160, 160))
-                    ctk_img = pil_to_ctk_image(pil_img, size=(160, 160))
-                    if ctk_img:
-                        self.photo_label.configure(image=ctk_img, text="")
-                        self.photo_label.image = ctk_img
-                    else:
-                        self.photo_label.configure(text="Photo")
-                except Exception:
-                    self.photo_label.configure(text="Invalid Image")
+            # The stored photo is kept as is on update; only a newly uploaded one is written.
+            self.current_image_blob = None
+            if details.has_photo:
+                ctk_img = pil_to_ctk_image(details.photo, size=(FORM_PHOTO_SIZE, FORM_PHOTO_SIZE)) if details.photo else None
+                if ctk_img:
+                    self.photo_label.configure(image=ctk_img, text="")
+                    self.photo_label.image = ctk_img
+                else:
+                    self.photo_label.configure(text="Photo" if details.photo else "Invalid Image")
             else:
                 self.photo_label.configure(image=None, text="No Photo")
 
-            conn.close()
+            v = details.summary
+            self.summary_label.configure(text=f"{v.visits} visit(s), last {v.last_visit}, total {v.total:,.2f}"
+                                         if v.visits else "No visits yet")
         except ValueError:
             messagebox.showerror("Error", "ID must be a number")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load patient: {e}")
 
+    @ui_handler
     def update_patient(self):
         try:
             pid = self.e_id.get().strip()
@@ -716,32 +5965,17 @@ class PatientsView:
             presc = self.e_presc.get().strip()
             doctor = self.e_doctor.get().strip()
 
-            conn = db_connect()
-            c = conn.cursor()
-
-            c.execute("SELECT id FROM patients WHERE id=?", (pid_int,))
-            if not c.fetchone():
-                conn.close()
+            updated = repo.update_patient(pid_int, {"name": name, "age": age, "gender": gender, "phone": phone,
+                                                    "address": address, "occupation": occupation,
+                                                    "diagnosis": diag, "prescription": presc, "doctor": doctor},
+                                          image=self.current_image_blob, files=self.patient_files)
+            if not updated:
                 messagebox.showerror("Error", "Patient not found")
                 return
-
-            c.execute('''UPDATE patients SET name=?, age=?, gender=?, phone=?, address=?, occupation=?, diagnosis=?, prescription=?, doctor=? WHERE id=?''',
-                      (name, age, gender, phone, address, occupation, diag, presc, doctor, pid_int))
-
-            if self.current_image_blob is not None:
-                c.execute("UPDATE patients SET image=? WHERE id=?", (sqlite3.Binary(self.current_image_blob), pid_int))
-
             if self.patient_files:
-                for file_info in self.patient_files:
-                    c.execute('''INSERT INTO patient_files (patient_id, file_name, file_type, upload_date, file_data)
-                                 VALUES (?, ?, ?, ?, ?)''',
-                              (pid_int, file_info["name"], file_info["type"],
-                               datetime.now().strftime("%Y-%m-%d %H:%M"),
-                               sqlite3.Binary(file_info["data"])))
-                self.patient_files = []
+                TEXT_INDEXER.wake()
+            self.patient_files = []
 
-            conn.commit()
-            conn.close()
             messagebox.showinfo("Success", "Patient updated successfully")
             self.clear_form()
             self.load_all_patients()
@@ -750,6 +5984,7 @@ class PatientsView:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to update patient: {e}")
 
+    @ui_handler
     def delete_patient(self):
         try:
             pid = self.e_id.get().strip()
@@ -759,24 +5994,13 @@ class PatientsView:
 
             pid_int = int(pid)
 
-            conn = db_connect()
-            c = conn.cursor()
-
-            c.execute("SELECT name FROM patients WHERE id=?", (pid_int,))
-            row = c.fetchone()
+            row = repo.get_patient_name(pid_int)
             if not row:
-                conn.close()
                 messagebox.showerror("Error", "Patient not found")
                 return
 
-            patient_name = row[0]
-
-            if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete patient '{patient_name}'?\nThis will also remove all their visits and files."):
-                c.execute("DELETE FROM visits WHERE patient_id=?", (pid_int,))
-                c.execute("DELETE FROM patient_files WHERE patient_id=?", (pid_int,))
-                c.execute("DELETE FROM patients WHERE id=?", (pid_int,))
-                conn.commit()
-                conn.close()
+            if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete patient '{row.name}'?\nThis will also remove all their visits and files."):
+                repo.delete_patient(pid_int)
                 messagebox.showinfo("Success", "Patient deleted successfully")
                 self.clear_form()
                 self.load_all_patients()
@@ -785,6 +6009,24 @@ class PatientsView:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to delete patient: {e}")
 
+    @ui_handler
+    def browse_files(self):
+        try:
+            pid = self.e_id.get().strip()
+            if not pid:
+                messagebox.showerror("Error", "Load a patient first")
+                return
+            patient = repo.get_patient(int(pid))
+            if not patient:
+                messagebox.showerror("Error", "Patient not found")
+                return
+            AttachmentBrowser(patient.id, patient.name)
+        except ValueError:
+            messagebox.showerror("Error", "ID must be a number")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open files: {e}")
+
+    @ui_handler
     def export_patient_pdf(self):
         try:
             pid = self.e_id.get().strip()
@@ -794,25 +6036,16 @@ class PatientsView:
 
             pid_int = int(pid)
 
-            conn = db_connect()
-            c = conn.cursor()
-
-            c.execute("SELECT id, name, age, gender, phone, address, occupation, diagnosis, prescription, last_visit, doctor, image FROM patients WHERE id=?", (pid_int,))
-            patient_row = c.fetchone()
-            if not patient_row:
-                conn.close()
+            if not repo.get_patient_name(pid_int):
                 messagebox.showerror("Error", "Patient not found")
                 return
+            options = ask_pdf_options()
+            if options is None:
+                return
 
-            c.execute("SELECT id, patient_id, date, diagnosis, prescription, doctor, price FROM visits WHERE patient_id=? ORDER BY date DESC", (pid_int,))
-            visits_rows = c.fetchall()
-
-            c.execute("SELECT file_name, file_type, upload_date, file_data FROM patient_files WHERE patient_id=? ORDER BY upload_date DESC", (pid_int,))
-            files_rows = c.fetchall()
-
-            conn.close()
-
-            pdf_path = save_patient_record_pdf(patient_row, visits_rows, files_rows)
+            SYNC.fetch_patient_blobs(pid_int)  # a snapshot cannot see payloads that land after it starts
+            with repo.snapshot() as snap:
+                pdf_path = save_patient_record_pdf(snap, pid_int, **options)
             if pdf_path and os.path.exists(pdf_path):
                 messagebox.showinfo("Success", f"Patient record exported to PDF:\n{pdf_path}")
             else:
@@ -831,62 +6064,466 @@ class PatientsView:
             self.current_image_blob = None
             self.patient_files = []
             self.photo_label.configure(image=None, text="No Photo")
+            self.summary_label.configure(text="")
+        except Exception as e:
+            print(f"Error clearing form: {e}")
+
+    @ui_handler
+    def load_all_patients(self):
+        self.search_kw = ""
+        self.query.reset_page()
+        self.refresh()
+
+    @ui_handler
+    def refresh(self):
+        try:
+            self.table.show(repo.list_patients(self.query, search=self.search_kw))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load patients: {e}")
+
+    @ui_handler
+    def search_patients(self):
+        try:
+            kw = self.search.get().strip()
+            if self.search_mode.get() == "File text":
+                if kw:
+                    AttachmentSearchWindow(kw, self.show_patient)
+                return
+            if not kw:
+                self.load_all_patients()
+                return
+
+            self.search_kw = kw
+            self.query.reset_page()
+            self.refresh()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to search patients: {e}")
+
+    def show_patient(self, pid):
+        self.e_id.delete(0, "end")
+        self.e_id.insert(0, str(pid))
+        self.load_patient_by_id()
+
+    def selected_ids(self):
+        return [self.tree.item(i, "values")[0] for i in self.tree.selection()]
+
+    @ui_handler
+    def delete_selected(self):
+        try:
+            ids = self.selected_ids()
+            if not ids:
+                messagebox.showerror("Error", "Select one or more patients to delete")
+                return
+            if messagebox.askyesno("Confirm Delete", f"Delete {len(ids)} selected patient(s)?\n"
+                                                     "This will also remove all their visits and files."):
+                count = repo.delete_patients(ids)
+                messagebox.showinfo("Success", f"Deleted {count} patient(s)")
+                self.clear_form()
+                self.load_all_patients()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to delete patients: {e}")
+
+    @ui_handler
+    def reassign_selected(self):
+        try:
+            ids = self.selected_ids()
+            if not ids:
+                messagebox.showerror("Error", "Select one or more patients")
+                return
+            doctor = simpledialog.askstring("Reassign Doctor", f"New doctor for {len(ids)} selected patient(s):")
+            if not doctor or not doctor.strip():
+                return
+            count = repo.reassign_doctor("patients", ids, doctor.strip())
+            messagebox.showinfo("Success", f"Reassigned {count} patient(s) to {doctor.strip()}")
+            self.load_all_patients()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to reassign doctor: {e}")
+
+    @ui_handler
+    def export_selected(self):
+        try:
+            ids = self.selected_ids()
+            if not ids:
+                messagebox.showerror("Error", "Select one or more patients to export")
+                return
+            path = ask_excel_path()
+            if not path:
+                return
+            count = export_rows_to_excel(path, "Patients", PATIENT_EXPORT_HEADERS, repo.export_patients_by_id(ids))
+            messagebox.showinfo("Exported", f"Exported {count} patients to:\n{path}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export patients: {e}")
+
+    @ui_handler
+    def on_double(self, event):
+        try:
+            sel = self.tree.selection()
+            if not sel:
+                return
+            pid = self.tree.item(sel[0], "values")[0]
+            self.e_id.delete(0, "end")
+            self.e_id.insert(0, str(pid))
+            self.load_patient_by_id()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load patient: {e}")
+
+# ---------------- Attachment Browser ----------------
+ATTACHMENT_ICON_SIZE = 48
+ATTACHMENT_OPEN_DIR = None  # this session's folder, from attachment_open_dir()
+
+def attachment_open_dir():
+    """Private folder (mode 0700, random name) that opened attachments are written to for this session."""
+    global ATTACHMENT_OPEN_DIR
+    if ATTACHMENT_OPEN_DIR is None or not os.path.isdir(ATTACHMENT_OPEN_DIR):
+        # Older versions shared one predictable folder between sessions and users.
+        shutil.rmtree(os.path.join(tempfile.gettempdir(), "clinic_attachments"), ignore_errors=True)
+        ATTACHMENT_OPEN_DIR = tempfile.mkdtemp(prefix="clinic_attachments_")
+    return ATTACHMENT_OPEN_DIR
+
+def remove_attachment_open_dir():
+    """Delete this session's opened attachments (files a viewer still holds open on Windows stay behind)."""
+    global ATTACHMENT_OPEN_DIR
+    if ATTACHMENT_OPEN_DIR is not None:
+        shutil.rmtree(ATTACHMENT_OPEN_DIR, ignore_errors=True)
+        ATTACHMENT_OPEN_DIR = None
+
+class AttachmentBrowser:
+    """Paged list of one patient's files built from metadata only.
+
+    Thumbnails come from the stored previews (images uploaded before previews existed get one
+    generated in the background, once); a file's bytes are streamed only when it is opened or exported.
+    """
+    def __init__(self, pid, name):
+        self.pid = pid
+        self.page = 0
+        self.starts = [None]  # (sort_ts, id) each visited page starts after
+        self.rows = {}
+        self.icons = {}  # file id -> PhotoImage; Tk needs a live reference
+        self.top = Toplevel()
+        self.top.title(f"Files — {name}")
+        self.top.geometry("860x620")
+
+        ttk.Style().configure("Attachments.Treeview", rowheight=ATTACHMENT_ICON_SIZE + 6)
+        table_frame = ctk.CTkFrame(self.top, fg_color="transparent")
+        table_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        table_frame.grid_columnconfigure(0, weight=1)
+        table_frame.grid_rowconfigure(0, weight=1)
+        self.tree = ttk.Treeview(table_frame, columns=("type", "size", "date"), show="tree headings",
+                                 style="Attachments.Treeview", selectmode="extended")
+        self.tree.heading("#0", text="File")
+        self.tree.column("#0", width=380, anchor="w")
+        for col, text, width in (("type", "Type", 100), ("size", "Size", 100), ("date", "Uploaded", 140)):
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor="center")
+        v_scrollbar = ctk.CTkScrollbar(table_frame, orientation="vertical", command=self.tree.yview)
+        v_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.tree.configure(yscrollcommand=v_scrollbar.set)
+        self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+        self.tree.bind("<Double-1>", lambda e: self.open_selected())
+
+        bar = ctk.CTkFrame(self.top, fg_color="transparent")
+        bar.pack(fill="x", padx=10, pady=(0, 10))
+        ctk.CTkButton(bar, text=icon_label("📂 Open", "[Open] Open"), width=100, command=self.open_selected).pack(side="left", padx=5)
+        ctk.CTkButton(bar, text=icon_label("💾 Export...", "[Save] Export..."), width=110,
+                     command=self.export_selected, fg_color="#dd6b20").pack(side="left", padx=5)
+        ctk.CTkButton(bar, text=icon_label("🔄 Refresh", "[R] Refresh"), width=100, command=self.load).pack(side="left", padx=5)
+        self.status = ctk.CTkLabel(bar, text="")
+        self.status.pack(side="left", padx=10)
+        self.next_btn = ctk.CTkButton(bar, text="Next ▶", width=80, command=lambda: self.turn(1))
+        self.next_btn.pack(side="right", padx=5)
+        self.page_lbl = ctk.CTkLabel(bar, text="")
+        self.page_lbl.pack(side="right", padx=5)
+        self.prev_btn = ctk.CTkButton(bar, text="◀ Prev", width=80, command=lambda: self.turn(-1))
+        self.prev_btn.pack(side="right", padx=5)
+
+        self.load()
+
+    def _icon(self, data):
+        try:
+            img = Image.open(io.BytesIO(data))
+            img.thumbnail((ATTACHMENT_ICON_SIZE, ATTACHMENT_ICON_SIZE))
+            return ImageTk.PhotoImage(img)
+        except Exception:
+            return None
+
+    @ui_handler
+    def load(self):
+        try:
+            total = repo.count_attachments(self.pid)
+            pages = max(1, -(-total // ATTACHMENT_PAGE_SIZE))
+            rows = repo.list_attachments(self.pid, self.starts[self.page])
+            while not rows and self.page > 0:  # the page emptied since it was opened
+                self.starts.pop()
+                self.page -= 1
+                rows = repo.list_attachments(self.pid, self.starts[self.page])
+            thumbs = repo.attachment_thumbnails([r.id for r in rows if r.has_thumbnail])
+            self.tree.delete(*self.tree.get_children())
+            self.rows, self.icons = {r.id: r for r in rows}, {}
+            for r in rows:
+                icon = self._icon(thumbs[r.id]) if r.id in thumbs else None
+                if icon:
+                    self.icons[r.id] = icon
+                size = "not synced yet" if r.pending else format_bytes(r.size or 0)
+                self.tree.insert("", "end", iid=str(r.id), text=f" {r.file_name}", image=icon or "",
+                                 values=(r.file_type, size, r.upload_date))
+            self.page_lbl.configure(text=f"Page {self.page + 1} of {pages} ({total} files)")
+            self.prev_btn.configure(state="normal" if self.page > 0 else "disabled")
+            self.next_btn.configure(state="normal" if len(rows) == ATTACHMENT_PAGE_SIZE and self.page < pages - 1
+                                    else "disabled")
+            missing = [r.id for r in rows if r.file_type == "image" and not r.has_thumbnail and not r.pending]
+            if missing:
+                self._run(self._make_thumbnails, missing, self._thumbnails_ready)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to list files: {e}", parent=self.top)
+
+    def turn(self, step):
+        if step > 0 and self.rows:
+            last = list(self.rows.values())[-1]
+            del self.starts[self.page + 1:]
+            self.starts.append((last.sort_ts, last.id))
+            self.page += 1
+        elif step < 0 and self.page > 0:
+            self.starts.pop()
+            self.page -= 1
+        self.load()
+
+    def _run(self, fn, arg, callback):
+        future = ingest_pool().submit(fn, arg)
+        def poll():
+            try:
+                if not future.done():
+                    self.top.after(50, poll)
+                    return
+                callback(future)
+            except Exception:
+                pass  # window closed
+        poll()
+
+    @staticmethod
+    def _make_thumbnails(ids):
+        made = {}
+        for fid in ids:
+            thumb = make_thumbnail(b"".join(repo.iter_attachment(fid)))
+            if thumb:
+                if not READ_ONLY:
+                    repo.save_attachment_thumbnail(fid, thumb)
+                made[fid] = thumb
+        return made
+
+    @ui_handler
+    def _thumbnails_ready(self, future):
+        try:
+            made = future.result()
         except Exception as e:
-            print(f"Error clearing form: {e}")
+            print(f"Thumbnail generation failed: {e}")
+            return
+        for fid, thumb in made.items():
+            icon = self._icon(thumb)
+            if icon and self.tree.exists(str(fid)):
+                self.icons[fid] = icon
+                self.tree.item(str(fid), image=icon)
+
+    def selected(self):
+        rows = [self.rows[int(i)] for i in self.tree.selection() if int(i) in self.rows]
+        if not rows:
+            messagebox.showerror("Error", "Select a file first", parent=self.top)
+        return rows
+
+    @ui_handler
+    def open_selected(self):
+        rows = self.selected()
+        if not rows:
+            return
+        folder = attachment_open_dir()
+        jobs = [(r.id, os.path.join(folder, f"{r.id}_{os.path.basename(r.file_name) or 'file'}"))
+                for r in rows]
+        self.status.configure(text="Opening...")
+        self._run(self._export, jobs, self._opened)
+
+    @ui_handler
+    def export_selected(self):
+        rows = self.selected()
+        if not rows:
+            return
+        if len(rows) == 1:
+            path = filedialog.asksaveasfilename(parent=self.top, initialfile=rows[0].file_name)
+            jobs = [(rows[0].id, path)] if path else []
+        else:
+            folder = filedialog.askdirectory(parent=self.top, title="Export files to")
+            jobs = [(r.id, os.path.join(folder, f"{r.id}_{os.path.basename(r.file_name) or 'file'}"))
+                    for r in rows] if folder else []
+        if jobs:
+            self.status.configure(text="Exporting...")
+            self._run(self._export, jobs, self._exported)
+
+    @staticmethod
+    def _export(jobs):
+        return [(path, repo.export_attachment(fid, path)) for fid, path in jobs]
+
+    @ui_handler
+    def _opened(self, future):
+        try:
+            for path, _ in future.result():
+                open_with_default_app(path)
+            self.status.configure(text="")
+        except Exception as e:
+            self.status.configure(text="")
+            messagebox.showerror("Error", f"Failed to open file: {e}", parent=self.top)
 
-    def load_all_patients(self):
+    @ui_handler
+    def _exported(self, future):
         try:
-            conn = db_connect()
-            c = conn.cursor()
+            done = future.result()
+            self.status.configure(text=f"Exported {len(done)} file(s), {format_bytes(sum(n for _, n in done))}")
+        except Exception as e:
+            self.status.configure(text="")
+            messagebox.showerror("Error", f"Failed to export: {e}", parent=self.top)
+
+class AttachmentSearchWindow:
+    """Patients whose attachments contain the searched words, best match first, with snippets per file."""
+    def __init__(self, text, on_patient):
+        self.text = text
+        self.on_patient = on_patient
+        self.files = {}
+        self.top = Toplevel()
+        self.top.title(f"Files containing: {text}")
+        self.top.geometry("820x560")
+
+        table_frame = ctk.CTkFrame(self.top, fg_color="transparent")
+        table_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        table_frame.grid_columnconfigure(0, weight=1)
+        table_frame.grid_rowconfigure(0, weight=1)
+        self.tree = ttk.Treeview(table_frame, columns=("phone", "hits"), show="tree headings", selectmode="browse")
+        self.tree.heading("#0", text="Patient / file")
+        self.tree.column("#0", width=560, anchor="w")
+        self.tree.heading("phone", text="Phone")
+        self.tree.column("phone", width=120, anchor="center")
+        self.tree.heading("hits", text="Files")
+        self.tree.column("hits", width=60, anchor="center")
+        v_scrollbar = ctk.CTkScrollbar(table_frame, orientation="vertical", command=self.tree.yview)
+        v_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.tree.configure(yscrollcommand=v_scrollbar.set)
+        self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+        self.tree.bind("<Double-1>", lambda e: self.open_selected())
 
-            for i in self.tree.get_children():
-                self.tree.delete(i)
+        bar = ctk.CTkFrame(self.top, fg_color="transparent")
+        bar.pack(fill="x", padx=10, pady=(0, 10))
+        ctk.CTkButton(bar, text=icon_label("📂 Open", "[Open] Open"), width=100, command=self.open_selected).pack(side="left", padx=5)
+        self.status = ctk.CTkLabel(bar, text="Searching...")
+        self.status.pack(side="left", padx=10)
+        self._run(repo.search_attachments, text, self._results)
 
-            c.execute("SELECT id, name, age, gender, phone, occupation, doctor, last_visit FROM patients ORDER BY id DESC")
-            for row in c.fetchall():
-                display_row = ["" if cell is None else cell for cell in row]
-                self.tree.insert("", "end", values=display_row)
-            conn.close()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load patients: {e}")
+    _run = AttachmentBrowser._run
 
-    def search_patients(self):
+    @ui_handler
+    def _results(self, future):
         try:
-            kw = self.search.get().strip()
-            if not kw:
-                self.load_all_patients()
-                return
+            matches, snippets = future.result()
+        except Exception as e:
+            self.status.configure(text="")
+            messagebox.showerror("Error", f"Search failed: {e}", parent=self.top)
+            return
+        for m in matches:
+            node = self.tree.insert("", "end", iid=f"p{m.patient_id}", text=f"#{m.patient_id}  {m.name}",
+                                    values=(m.phone, m.hits), open=True)
+            for f in snippets.get(m.patient_id, []):
+                self.files[f.id] = f
+                snippet = " ".join(f.snippet.split())
+                self.tree.insert(node, "end", iid=f"f{f.id}", text=f"{f.file_name}: {snippet}", values=("", ""))
+        note = "" if TEXT_INDEXER.caught_up else "  (files are still being indexed; results may be incomplete)"
+        self.status.configure(text=f"{len(matches)} patient(s){note}")
+
+    @ui_handler
+    def open_selected(self):
+        sel = self.tree.selection()
+        if not sel:
+            messagebox.showerror("Error", "Select a patient or file first", parent=self.top)
+            return
+        if sel[0].startswith("p"):
+            self.on_patient(int(sel[0][1:]))
+            return
+        f = self.files[int(sel[0][1:])]
+        path = os.path.join(attachment_open_dir(), f"{f.id}_{os.path.basename(f.file_name) or 'file'}")
+        self.status.configure(text="Opening...")
+        self._run(AttachmentBrowser._export, [(f.id, path)], self._opened)
+
+    _opened = AttachmentBrowser._opened
+
+class ImageDuplicatesWindow:
+    """Groups of near-duplicate images across all patients, largest reclaimable size first."""
+    def __init__(self):
+        self.rows = {}
+        self.top = Toplevel()
+        self.top.title("Near-duplicate images")
+        self.top.geometry("900x560")
 
-            conn = db_connect()
-            c = conn.cursor()
+        table_frame = ctk.CTkFrame(self.top, fg_color="transparent")
+        table_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        table_frame.grid_columnconfigure(0, weight=1)
+        table_frame.grid_rowconfigure(0, weight=1)
+        columns = (("patient", "Patient", 200, "w"), ("size", "Size", 90, "e"), ("date", "Uploaded", 130, "center"),
+                   ("distance", "Bits apart", 80, "e"))
+        self.tree = ttk.Treeview(table_frame, columns=[c[0] for c in columns], show="tree headings", selectmode="browse")
+        self.tree.heading("#0", text="Image")
+        self.tree.column("#0", width=340, anchor="w")
+        for col, text, width, anchor in columns:
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor=anchor)
+        v_scrollbar = ctk.CTkScrollbar(table_frame, orientation="vertical", command=self.tree.yview)
+        v_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.tree.configure(yscrollcommand=v_scrollbar.set)
+        self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+        self.tree.bind("<Double-1>", lambda e: self.open_selected())
 
-            for i in self.tree.get_children():
-                self.tree.delete(i)
+        bar = ctk.CTkFrame(self.top, fg_color="transparent")
+        bar.pack(fill="x", padx=10, pady=(0, 10))
+        ctk.CTkButton(bar, text=icon_label("📂 Open", "[Open] Open"), width=100, command=self.open_selected).pack(side="left", padx=5)
+        self.status = ctk.CTkLabel(bar, text="Comparing images...")
+        self.status.pack(side="left", padx=10)
+        self._run(lambda _: IMAGE_HASHES.duplicate_groups(), None, self._groups)
 
-            q = "SELECT id, name, age, gender, phone, occupation, doctor, last_visit FROM patients WHERE name LIKE ? OR phone LIKE ? OR doctor LIKE ? OR occupation LIKE ?"
-            for row in c.execute(q, (f"%{kw}%", f"%{kw}%", f"%{kw}%", f"%{kw}%")):
-                display_row = ["" if cell is None else cell for cell in row]
-                self.tree.insert("", "end", values=display_row)
-            conn.close()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to search patients: {e}")
+    _run = AttachmentBrowser._run
 
-    def on_double(self, event):
+    @ui_handler
+    def _groups(self, future):
         try:
-            sel = self.tree.selection()
-            if not sel:
-                return
-            pid = self.tree.item(sel[0], "values")[0]
-            self.e_id.delete(0, "end")
-            self.e_id.insert(0, str(pid))
-            self.load_patient_by_id()
+            groups = future.result()
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to load patient: {e}")
+            self.status.configure(text="")
+            messagebox.showerror("Error", f"Duplicate search failed: {e}", parent=self.top)
+            return
+        reclaim = 0
+        for n, group in enumerate(groups, 1):
+            extra = sum(r.size or 0 for r in group[1:])
+            reclaim += extra
+            node = self.tree.insert("", "end", iid=f"g{n}", open=True,
+                                    text=f"Group {n}: {len(group)} images, {format_bytes(extra)} in copies")
+            for r in group:
+                iid = f"{r.kind}{r.id}"
+                self.rows[iid] = r
+                self.tree.insert(node, "end", iid=iid, text=r.file_name,
+                                 values=(f"#{r.patient_id} {r.patient}", format_bytes(r.size or 0), r.upload_date, r.distance))
+        note = "" if IMAGE_HASHES.caught_up else "  (older images are still being hashed; the list may be incomplete)"
+        self.status.configure(text=f"{len(groups)} group(s), {format_bytes(reclaim)} in copies{note}")
+
+    @ui_handler
+    def open_selected(self):
+        r = self.rows.get(next(iter(self.tree.selection()), ""))
+        if r is None or r.kind != "file":
+            messagebox.showerror("Error", "Select an attachment first", parent=self.top)
+            return
+        path = os.path.join(attachment_open_dir(), f"{r.id}_{os.path.basename(r.file_name) or 'file'}")
+        self.status.configure(text="Opening...")
+        self._run(AttachmentBrowser._export, [(r.id, path)], self._opened)
+
+    _opened = AttachmentBrowser._opened
 
 # ---------------- Visits View ----------------
 class VisitsView:
     def __init__(self, parent):
         self.parent = parent
+        self.patient_filter = None
+        self.query = TableQuery("visits", VISIT_TABLE_COLUMNS, id_expr="v.id")
 
         parent.grid_columnconfigure(0, weight=1)
         parent.grid_rowconfigure(0, weight=1)
@@ -902,12 +6539,17 @@ class VisitsView:
         btn_frame = ctk.CTkFrame(frame, fg_color="transparent")
         btn_frame.pack(fill="x", padx=10, pady=5)
 
-        ctk.CTkButton(btn_frame, text=icon_label("➕ Add Visit", "[+] Add Visit"), command=self.open_add,
-                     fg_color="#27ae60", hover_color="#229954").pack(side="left", padx=5)
-        ctk.CTkButton(btn_frame, text=icon_label("✏️ Edit Selected", "[Edit] Edit Selected"), command=self.open_edit,
-                     fg_color="#f39c12", hover_color="#e67e22").pack(side="left", padx=5)
-        ctk.CTkButton(btn_frame, text=icon_label("🗑️ Delete Selected", "[Del] Delete Selected"), fg_color="#e74c3c",
-                     hover_color="#c0392b", command=self.delete_selected).pack(side="left", padx=5)
+        if not READ_ONLY:
+            ctk.CTkButton(btn_frame, text=icon_label("➕ Add Visit", "[+] Add Visit"), command=self.open_add,
+                         fg_color="#27ae60", hover_color="#229954").pack(side="left", padx=5)
+            ctk.CTkButton(btn_frame, text=icon_label("✏️ Edit Selected", "[Edit] Edit Selected"), command=self.open_edit,
+                         fg_color="#f39c12", hover_color="#e67e22").pack(side="left", padx=5)
+            ctk.CTkButton(btn_frame, text=icon_label("🗑️ Delete Selected", "[Del] Delete Selected"), fg_color="#e74c3c",
+                         hover_color="#c0392b", command=self.delete_selected).pack(side="left", padx=5)
+            ctk.CTkButton(btn_frame, text=icon_label("👨‍⚕️ Reassign Doctor", "[Dr] Reassign Doctor"), command=self.reassign_selected,
+                         fg_color="#805ad5", hover_color="#6b46c1").pack(side="left", padx=5)
+        ctk.CTkButton(btn_frame, text=icon_label("📊 Export Selected", "[XLS] Export Selected"), command=self.export_selected,
+                     fg_color="#dd6b20").pack(side="left", padx=5)
 
         filter_frame = ctk.CTkFrame(frame, fg_color="transparent")
         filter_frame.pack(fill="x", padx=10, pady=5)
@@ -929,7 +6571,7 @@ class VisitsView:
         table_frame.grid_rowconfigure(0, weight=1)
 
         cols = ("id", "patient", "date", "diagnosis", "prescription", "doctor", "price")
-        self.tree = ttk.Treeview(table_frame, columns=cols, show="headings", height=20)
+        self.tree = ttk.Treeview(table_frame, columns=cols, show="headings", height=20, selectmode="extended")
 
         self.tree.heading("id", text="Visit ID")
         self.tree.column("id", width=80, anchor="center")
@@ -961,48 +6603,36 @@ class VisitsView:
         self.tree.configure(xscrollcommand=h_scrollbar.set)
 
         self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+        self.table = TableControls(self.tree, self.query, frame, table_frame, self.refresh)
 
-        self.tree.bind("<Double-1>", lambda e: self.open_edit())
+        if not READ_ONLY:
+            self.tree.bind("<Double-1>", lambda e: self.open_edit())
 
         self.load_visits()
 
+    @ui_handler
     def populate_filter(self):
         try:
-            conn = db_connect()
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM patients ORDER BY name")
-            rows = c.fetchall()
-            conn.close()
-            opts = ["All Patients"] + [f"{r[1]} (ID: {r[0]})" for r in rows]
+            opts = ["All Patients"] + [f"{r.name} (ID: {r.id})" for r in repo.patient_names()]
             self.filter_cb.configure(values=opts)
             self.filter_cb.set("All Patients")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to populate filter: {e}")
 
+    @ui_handler
     def load_visits(self):
-        try:
-            conn = db_connect()
-            c = conn.cursor()
-
-            for i in self.tree.get_children():
-                self.tree.delete(i)
+        self.patient_filter = None
+        self.query.reset_page()
+        self.refresh()
 
-            q = """SELECT v.id, COALESCE(p.name, 'Unknown'), v.date, v.diagnosis, v.prescription, v.doctor, v.price
-                   FROM visits v LEFT JOIN patients p ON v.patient_id = p.id
-                   ORDER BY v.id DESC"""
-            for row in c.execute(q):
-                formatted_row = list(row)
-                if formatted_row[6] is not None:
-                    try:
-                        formatted_row[6] = f"{float(formatted_row[6]):.2f}"
-                    except (ValueError, TypeError):
-                        formatted_row[6] = str(formatted_row[6])
-                display_row = ["" if cell is None else cell for cell in formatted_row]
-                self.tree.insert("", "end", values=display_row)
-            conn.close()
+    @ui_handler
+    def refresh(self):
+        try:
+            self.table.show(repo.list_visits(self.patient_filter, self.query))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load visits: {e}")
 
+    @ui_handler
     def clear_filter(self):
         try:
             self.filter_cb.set("All Patients")
@@ -1010,6 +6640,7 @@ class VisitsView:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to clear filter: {e}")
 
+    @ui_handler
     def apply_filter(self):
         try:
             sel = self.filter_var.get()
@@ -1023,44 +6654,24 @@ class VisitsView:
                 self.load_visits()
                 return
 
-            conn = db_connect()
-            c = conn.cursor()
-
-            for i in self.tree.get_children():
-                self.tree.delete(i)
-
-            q = """SELECT v.id, COALESCE(p.name, 'Unknown'), v.date, v.diagnosis, v.prescription, v.doctor, v.price
-                   FROM visits v LEFT JOIN patients p ON v.patient_id = p.id
-                   WHERE v.patient_id = ?
-                   ORDER BY v.id DESC"""
-            for row in c.execute(q, (pid,)):
-                formatted_row = list(row)
-                if formatted_row[6] is not None:
-                    try:
-                        formatted_row[6] = f"{float(formatted_row[6]):.2f}"
-                    except (ValueError, TypeError):
-                        formatted_row[6] = str(formatted_row[6])
-                display_row = ["" if cell is None else cell for cell in formatted_row]
-                self.tree.insert("", "end", values=display_row)
-            conn.close()
+            self.patient_filter = pid
+            self.query.reset_page()
+            self.refresh()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to apply filter: {e}")
 
+    @ui_handler
     def open_add(self):
         try:
             # Guard when no patients exist
-            conn = db_connect()
-            c = conn.cursor()
-            c.execute("SELECT COUNT(1) FROM patients")
-            count = c.fetchone()[0]
-            conn.close()
-            if count == 0:
+            if repo.count_patients() == 0:
                 messagebox.showerror("Error", "No patients found. Please add a patient first.")
                 return
             self._open_popup(mode="add")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to open add visit dialog: {e}")
 
+    @ui_handler
     def open_edit(self):
         try:
             sel = self.tree.selection()
@@ -1086,13 +6697,7 @@ class VisitsView:
 
             # Patient selection
             ttk.Label(form_frame, text="Patient:").place(x=20, y=20)
-            conn = db_connect()
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM patients ORDER BY name")
-            patients = c.fetchall()
-            conn.close()
-
-            opts = [f"{r[1]} (ID: {r[0]})" for r in patients]
+            opts = [f"{r.name} (ID: {r.id})" for r in repo.patient_names()]
             patient_var = ctk.StringVar()
             patient_cb = ttk.Combobox(form_frame, values=opts, textvariable=patient_var, width=50, state="readonly")
             patient_cb.place(x=120, y=20)
@@ -1132,11 +6737,7 @@ class VisitsView:
             # If editing, load data
             if mode == "edit" and visit_id:
                 try:
-                    conn = db_connect()
-                    c = conn.cursor()
-                    c.execute("SELECT id, patient_id, date, diagnosis, prescription, doctor, price FROM visits WHERE id=?", (visit_id,))
-                    v = c.fetchone()
-                    conn.close()
+                    v = repo.get_visit(visit_id)
                     if v:
                         _, patient_id, date, diagnosis, prescription, doctor, price = v
 
@@ -1175,6 +6776,7 @@ class VisitsView:
                 except Exception:
                     return None
 
+            @ui_handler
             def save_visit():
                 try:
                     if not opts:
@@ -1192,7 +6794,7 @@ class VisitsView:
                         messagebox.showerror("Error", "Date is required")
                         return
                     try:
-                        datetime.strptime(dt, "%Y-%m-%d %H:%M")
+                        parse_timestamp(dt)
                     except ValueError:
                         messagebox.showerror("Error", "Date must be in format YYYY-MM-DD HH:MM")
                         return
@@ -1213,20 +6815,8 @@ class VisitsView:
                             messagebox.showerror("Error", "Price must be a number")
                             return
 
-                    conn = db_connect()
-                    c = conn.cursor()
-
-                    if mode == "add":
-                        c.execute('''INSERT INTO visits (patient_id, date, diagnosis, prescription, doctor, price)
-                                     VALUES (?, ?, ?, ?, ?, ?)''', (pid, dt, diag, presc, doc, price))
-                        c.execute("UPDATE patients SET last_visit=? WHERE id=?", (dt, pid))
-                    else:
-                        c.execute('''UPDATE visits SET patient_id=?, date=?, diagnosis=?, prescription=?, doctor=?, price=? WHERE id=?''',
-                                  (pid, dt, diag, presc, doc, price, visit_id))
-                        c.execute("UPDATE patients SET last_visit=? WHERE id=?", (dt, pid))
-
-                    conn.commit()
-                    conn.close()
+                    repo.save_visit(pid, dt, diag, presc, doc, price,
+                                    visit_id=None if mode == "add" else visit_id)
                     messagebox.showinfo("Success", "Visit saved successfully")
                     popup.destroy()
                     self.load_visits()
@@ -1238,28 +6828,418 @@ class VisitsView:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to create visit dialog: {e}")
 
+    @ui_handler
     def delete_selected(self):
         try:
-            sel = self.tree.selection()
-            if not sel:
+            ids = self.selected_ids()
+            if not ids:
                 messagebox.showerror("Error", "Select a visit to delete")
                 return
-            vid = self.tree.item(sel[0], "values")[0]
-            if messagebox.askyesno("Confirm Delete", "Are you sure you want to delete this visit?"):
-                conn = db_connect()
-                c = conn.cursor()
-                c.execute("DELETE FROM visits WHERE id=?", (vid,))
-                conn.commit()
-                conn.close()
-                messagebox.showinfo("Success", "Visit deleted successfully")
+            prompt = ("Are you sure you want to delete this visit?" if len(ids) == 1
+                      else f"Are you sure you want to delete {len(ids)} visits?")
+            if messagebox.askyesno("Confirm Delete", prompt):
+                count = repo.delete_visits(ids)
+                messagebox.showinfo("Success", "Visit deleted successfully" if count == 1 else f"Deleted {count} visits")
                 self.load_visits()
                 self.populate_filter()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to delete visit: {e}")
 
+    def selected_ids(self):
+        return [self.tree.item(i, "values")[0] for i in self.tree.selection()]
+
+    @ui_handler
+    def reassign_selected(self):
+        try:
+            ids = self.selected_ids()
+            if not ids:
+                messagebox.showerror("Error", "Select one or more visits")
+                return
+            doctor = simpledialog.askstring("Reassign Doctor", f"New doctor for {len(ids)} selected visit(s):")
+            if not doctor or not doctor.strip():
+                return
+            count = repo.reassign_doctor("visits", ids, doctor.strip())
+            messagebox.showinfo("Success", f"Reassigned {count} visit(s) to {doctor.strip()}")
+            self.load_visits()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to reassign doctor: {e}")
+
+    @ui_handler
+    def export_selected(self):
+        try:
+            ids = self.selected_ids()
+            if not ids:
+                messagebox.showerror("Error", "Select one or more visits to export")
+                return
+            path = ask_excel_path()
+            if not path:
+                return
+            count = export_rows_to_excel(path, "Visits", VISIT_EXPORT_HEADERS, repo.export_visits_by_id(ids))
+            messagebox.showinfo("Exported", f"Exported {count} visits to:\n{path}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export visits: {e}")
+
+# ---------------- Appointments View ----------------
+class AppointmentsView:
+    def __init__(self, parent):
+        self.mode = "Day"
+        self.day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        parent.grid_columnconfigure(0, weight=1)
+        parent.grid_rowconfigure(0, weight=1)
+
+        frame = ctk.CTkFrame(parent, corner_radius=8, fg_color="#e2e8f0")
+        frame.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+
+        ctk.CTkLabel(frame, text="Appointments", font=ctk.CTkFont(size=18, weight="bold")).pack(pady=10)
+
+        btn_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        if not READ_ONLY:
+            btn_frame.pack(fill="x", padx=10, pady=5)
+        ctk.CTkButton(btn_frame, text=icon_label("➕ Book", "[+] Book"), command=self.open_add,
+                     fg_color="#27ae60", hover_color="#229954").pack(side="left", padx=5)
+        ctk.CTkButton(btn_frame, text=icon_label("✏️ Edit / Move", "[Edit] Edit / Move"), command=self.open_edit,
+                     fg_color="#f39c12", hover_color="#e67e22").pack(side="left", padx=5)
+        ctk.CTkButton(btn_frame, text=icon_label("✅ Complete", "[OK] Complete"), command=self.complete_selected,
+                     fg_color="#319795").pack(side="left", padx=5)
+        ctk.CTkButton(btn_frame, text=icon_label("🚫 Cancel", "[X] Cancel"), command=lambda: self.set_status("cancelled"),
+                     fg_color="#805ad5", hover_color="#6b46c1").pack(side="left", padx=5)
+        ctk.CTkButton(btn_frame, text="No-show", command=lambda: self.set_status("no-show"),
+                     fg_color="#718096").pack(side="left", padx=5)
+        ctk.CTkButton(btn_frame, text=icon_label("🗑️ Delete", "[Del] Delete"), command=self.delete_selected,
+                     fg_color="#e74c3c", hover_color="#c0392b").pack(side="left", padx=5)
+
+        nav_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        nav_frame.pack(fill="x", padx=10, pady=5)
+        self.mode_btn = ctk.CTkSegmentedButton(nav_frame, values=["Day", "Week"], command=self.set_mode)
+        self.mode_btn.set(self.mode)
+        self.mode_btn.pack(side="left", padx=5)
+        ctk.CTkButton(nav_frame, text="◀", width=40, command=lambda: self.shift(-1)).pack(side="left", padx=5)
+        ctk.CTkButton(nav_frame, text="Today", width=70, command=self.today).pack(side="left", padx=5)
+        ctk.CTkButton(nav_frame, text="▶", width=40, command=lambda: self.shift(1)).pack(side="left", padx=5)
+        self.range_lbl = ctk.CTkLabel(nav_frame, text="", font=ctk.CTkFont(weight="bold"))
+        self.range_lbl.pack(side="left", padx=10)
+        ctk.CTkLabel(nav_frame, text="Doctor:").pack(side="left", padx=(20, 5))
+        self.doctor_cb = ctk.CTkComboBox(nav_frame, width=180, command=lambda _: self.refresh())
+        self.doctor_cb.pack(side="left", padx=5)
+        self.populate_doctors()
+
+        table_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        table_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        table_frame.grid_columnconfigure(0, weight=1)
+        table_frame.grid_rowconfigure(0, weight=1)
+
+        columns = (("id", "ID", 60, "center"), ("day", "Day", 120, "center"), ("time", "Time", 110, "center"),
+                   ("patient", "Patient", 180, "w"), ("doctor", "Doctor", 140, "w"), ("status", "Status", 90, "center"),
+                   ("notes", "Notes", 260, "w"))
+        self.tree = ttk.Treeview(table_frame, columns=[c[0] for c in columns], show="headings", height=20)
+        for col, text, width, anchor in columns:
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor=anchor)
+        self.tree.tag_configure("cancelled", foreground="#a0aec0")
+        self.tree.tag_configure("no-show", foreground="#a0aec0")
+        self.tree.tag_configure("completed", foreground="#2f855a")
+
+        v_scrollbar = ctk.CTkScrollbar(table_frame, orientation="vertical", command=self.tree.yview)
+        v_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.tree.configure(yscrollcommand=v_scrollbar.set)
+        self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+        if not READ_ONLY:
+            self.tree.bind("<Double-1>", lambda e: self.open_edit())
+
+        self.refresh()
+
+    def period(self):
+        start = self.day - timedelta(days=self.day.weekday()) if self.mode == "Week" else self.day
+        return start, start + timedelta(days=7 if self.mode == "Week" else 1)
+
+    @ui_handler
+    def set_mode(self, mode):
+        self.mode = mode
+        self.refresh()
+
+    @ui_handler
+    def shift(self, step):
+        self.day += timedelta(days=step * (7 if self.mode == "Week" else 1))
+        self.refresh()
+
+    @ui_handler
+    def today(self):
+        self.day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.refresh()
+
+    def populate_doctors(self):
+        try:
+            self.doctor_cb.configure(values=["All Doctors"] + repo.appointment_doctors())
+            if not self.doctor_cb.get():
+                self.doctor_cb.set("All Doctors")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load doctors: {e}")
+
+    @ui_handler
+    def refresh(self):
+        try:
+            start, end = self.period()
+            self.range_lbl.configure(text=start.strftime("%a %d %b %Y") if self.mode == "Day" else
+                                     f"{start:%d %b} – {end - timedelta(days=1):%d %b %Y}")
+            doctor = self.doctor_cb.get()
+            rows = repo.list_appointments(start.timestamp(), end.timestamp(),
+                                          None if doctor in ("", "All Doctors") else doctor)
+            self.tree.delete(*self.tree.get_children())
+            for r in rows:
+                self.tree.insert("", "end", iid=str(r.id), tags=(r.status,), values=(
+                    r.id, format_timestamp(r.start_ts, "%a %Y-%m-%d"),
+                    f"{format_timestamp(r.start_ts, '%H:%M')} – {format_timestamp(r.end_ts, '%H:%M')}",
+                    r.patient, r.doctor, r.status, r.notes))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load appointments: {e}")
+
+    def selected_id(self):
+        sel = self.tree.selection()
+        if not sel:
+            messagebox.showerror("Error", "Select an appointment first")
+            return None
+        return int(sel[0])
+
+    @ui_handler
+    def open_add(self):
+        if repo.count_patients() == 0:
+            messagebox.showerror("Error", "No patients found. Please add a patient first.")
+            return
+        self._open_popup()
+
+    @ui_handler
+    def open_edit(self):
+        aid = self.selected_id()
+        if aid is not None:
+            self._open_popup(repo.get_appointment(aid))
+
+    def _open_popup(self, appt=None):
+        try:
+            popup = Toplevel()
+            popup.title("Book Appointment" if appt is None else "Edit Appointment")
+            popup.geometry("620x400")
+            popup.resizable(False, False)
+            ttk.Label(popup, text="Appointment", font=("Arial", 16, "bold")).pack(pady=10)
+            form_frame = ctk.CTkFrame(popup, corner_radius=8)
+            form_frame.pack(fill="both", expand=True, padx=20, pady=10)
+
+            ttk.Label(form_frame, text="Patient:").place(x=20, y=20)
+            opts = [f"{r.name} (ID: {r.id})" for r in repo.patient_names()]
+            patient_var = ctk.StringVar()
+            ttk.Combobox(form_frame, values=opts, textvariable=patient_var, width=50, state="readonly").place(x=140, y=20)
+            ttk.Label(form_frame, text="Doctor:").place(x=20, y=60)
+            doc_e = ttk.Entry(form_frame, width=40)
+            doc_e.place(x=140, y=60)
+            ttk.Label(form_frame, text="Start (YYYY-MM-DD HH:MM):").place(x=20, y=100)
+            start_e = ttk.Entry(form_frame, width=22)
+            start_e.place(x=220, y=100)
+            ttk.Label(form_frame, text="Minutes:").place(x=20, y=140)
+            min_e = ttk.Entry(form_frame, width=8)
+            min_e.place(x=140, y=140)
+            ttk.Label(form_frame, text="Notes:").place(x=20, y=180)
+            notes_e = ttk.Entry(form_frame, width=55)
+            notes_e.place(x=140, y=180)
+
+            if appt is None:
+                patient_var.set(opts[0] if opts else "")
+                start = max(datetime.now(), self.day.replace(hour=APPOINTMENT_DAY_START_HOUR))
+                start_e.insert(0, start.strftime("%Y-%m-%d %H:%M"))
+                min_e.insert(0, str(APPOINTMENT_DEFAULT_MIN))
+                doctor = self.doctor_cb.get()
+                if doctor not in ("", "All Doctors"):
+                    doc_e.insert(0, doctor)
+            else:
+                patient_var.set(next((o for o in opts if o.endswith(f"(ID: {appt.patient_id})")), opts[0] if opts else ""))
+                doc_e.insert(0, appt.doctor)
+                start_e.insert(0, format_timestamp(appt.start_ts))
+                min_e.insert(0, str((appt.end_ts - appt.start_ts) // 60))
+                notes_e.insert(0, appt.notes or "")
+
+            def minutes():
+                value = int(min_e.get().strip() or APPOINTMENT_DEFAULT_MIN)
+                if value <= 0:
+                    raise ValueError("Minutes must be positive")
+                return value
+
+            @ui_handler
+            def find_slot():
+                try:
+                    after = parse_timestamp(start_e.get()) if start_e.get().strip() else time.time()
+                    slot = APPOINTMENTS.next_free(doc_e.get(), after, minutes(),
+                                                  exclude_id=appt.id if appt is not None else None)
+                except ValueError as e:
+                    messagebox.showerror("Error", str(e))
+                    return
+                if slot is None:
+                    messagebox.showinfo("No Free Slot", f"No free slot in the next {APPOINTMENT_SEARCH_DAYS} days")
+                    return
+                start_e.delete(0, "end")
+                start_e.insert(0, format_timestamp(slot))
+
+            @ui_handler
+            def save():
+                try:
+                    pid = int(patient_var.get().split("(ID: ")[1].split(")")[0])
+                except (IndexError, ValueError):
+                    messagebox.showerror("Error", "Select a valid patient")
+                    return
+                try:
+                    repo.book_appointment(pid, doc_e.get(), start_e.get(), minutes(), notes_e.get().strip(),
+                                          appointment_id=appt.id if appt is not None else None)
+                except ValueError as e:
+                    messagebox.showerror("Cannot Book", str(e))
+                    return
+                popup.destroy()
+                self.populate_doctors()
+                self.refresh()
+
+            ttk.Button(form_frame, text="Next Free Slot", command=find_slot).place(x=420, y=98)
+            ttk.Button(form_frame, text="Save Appointment", command=save).place(x=240, y=240)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open appointment dialog: {e}")
+
+    @ui_handler
+    def complete_selected(self):
+        aid = self.selected_id()
+        if aid is None:
+            return
+        diagnosis = simpledialog.askstring("Complete Appointment", "Diagnosis:")
+        if diagnosis is None:
+            return
+        prescription = simpledialog.askstring("Complete Appointment", "Prescription:") or ""
+        price = simpledialog.askfloat("Complete Appointment", "Price ($):", initialvalue=0.0, minvalue=0.0)
+        if price is None:
+            return
+        try:
+            vid = repo.complete_appointment(aid, diagnosis.strip(), prescription.strip(), price)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        messagebox.showinfo("Success", f"Visit #{vid} recorded")
+        self.refresh()
+
+    @ui_handler
+    def set_status(self, status):
+        aid = self.selected_id()
+        if aid is not None:
+            repo.set_appointment_status(aid, status)
+            self.refresh()
+
+    @ui_handler
+    def delete_selected(self):
+        aid = self.selected_id()
+        if aid is not None and messagebox.askyesno("Confirm Delete", "Delete this appointment?"):
+            repo.delete_appointment(aid)
+            self.refresh()
+
+# ---------------- Reports View ----------------
+class ReportsView:
+    """Pick a month or quarter, build (or reuse) its report on a worker and show the key figures."""
+    def __init__(self, parent):
+        self.path = None
+        self._future = None
+        parent.grid_columnconfigure(0, weight=1)
+        parent.grid_rowconfigure(0, weight=1)
+
+        frame = ctk.CTkFrame(parent, corner_radius=8, fg_color="#e2e8f0")
+        frame.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+        ctk.CTkLabel(frame, text="Clinic Reports", font=ctk.CTkFont(size=18, weight="bold")).pack(pady=10)
+
+        bar = ctk.CTkFrame(frame, fg_color="transparent")
+        bar.pack(fill="x", padx=10, pady=5)
+        now = datetime.now()
+        self.kind = ctk.CTkOptionMenu(bar, values=["Month", "Quarter"], width=110, command=lambda _: self._numbers())
+        self.kind.pack(side="left", padx=5)
+        self.number = ctk.CTkOptionMenu(bar, values=[], width=130)
+        self.number.pack(side="left", padx=5)
+        self.year = ctk.CTkOptionMenu(bar, values=[str(y) for y in range(now.year, now.year - 15, -1)], width=90)
+        self.year.pack(side="left", padx=5)
+        self._numbers()
+        self.number.set(now.strftime("%B"))
+        ctk.CTkButton(bar, text=icon_label("📊 Generate", "[R] Generate"), width=120,
+                     command=lambda: self.generate(False), fg_color="#805ad5").pack(side="left", padx=5)
+        ctk.CTkButton(bar, text=icon_label("🔄 Rebuild", "[R] Rebuild"), width=100,
+                     command=lambda: self.generate(True)).pack(side="left", padx=5)
+        self.open_btn = ctk.CTkButton(bar, text=icon_label("📄 Open PDF", "[PDF] Open PDF"), width=110,
+                                      command=self.open_pdf, state="disabled", fg_color="#9b59b6")
+        self.open_btn.pack(side="left", padx=5)
+        self.status = ctk.CTkLabel(bar, text="")
+        self.status.pack(side="left", padx=10)
+
+        self.text = ctk.CTkTextbox(frame, font=ctk.CTkFont(family="Courier", size=13))
+        self.text.pack(fill="both", expand=True, padx=10, pady=10)
+
+    def _numbers(self):
+        if self.kind.get() == "Month":
+            values = [datetime(2000, m, 1).strftime("%B") for m in range(1, 13)]
+        else:
+            values = [f"Q{q} (months {3 * q - 2}-{3 * q})" for q in range(1, 5)]
+        self.number.configure(values=values)
+        self.number.set(values[0])
+
+    def period(self):
+        kind = self.kind.get().lower()
+        values = self.number.cget("values")
+        return report_period(kind, int(self.year.get()), values.index(self.number.get()) + 1)
+
+    @ui_handler
+    def generate(self, force):
+        if self._future is not None and not self._future.done():
+            return
+        try:
+            period = self.period()
+        except Exception as e:
+            messagebox.showerror("Error", f"Invalid period: {e}")
+            return
+        self.status.configure(text=f"Building {period.label}...")
+        self._started = time.perf_counter()
+        self._future = ingest_pool().submit(generate_report, period, force)
+        self._poll()
+
+    def _poll(self):
+        try:
+            if not self._future.done():
+                self.status.after(100, self._poll)
+                return
+            self.show(*self._future.result())
+        except Exception as e:
+            try:
+                self.status.configure(text="")
+                messagebox.showerror("Error", f"Failed to build report: {e}")
+            except Exception:
+                pass  # view was closed
+
+    def show(self, path, data, cached):
+        self.path = path
+        self.open_btn.configure(state="normal")
+        took = time.perf_counter() - self._started
+        self.status.configure(text=f"{'From cache' if cached else 'Built'} in {took:.2f} s")
+        lines = [f"{data.period.label}", "",
+                 f"Visits         {data.visits:>10,}", f"Revenue        {data.revenue:>10,.2f}",
+                 f"Patients seen  {data.patients:>10,}", f"New patients   {data.new_patients:>10,}", "",
+                 "Visits per doctor"]
+        lines += [f"  {d[:30]:30s} {n:>7,} {r:>12,.2f}" for d, n, r in data.doctors] or ["  none"]
+        lines += ["", "Top diagnoses"]
+        lines += [f"  {d[:40]:40s} {n:>7,}" for d, n in data.diagnoses] or ["  none"]
+        lines += ["", "Patients seen by age"] + [f"  {b:10s} {n:>7,}" for b, n in data.ages]
+        lines += ["", "Patients seen by gender"] + [f"  {g:10s} {n:>7,}" for g, n in data.genders]
+        self.text.configure(state="normal")
+        self.text.delete("1.0", "end")
+        self.text.insert("1.0", "\n".join(lines))
+        self.text.configure(state="disabled")
+
+    @ui_handler
+    def open_pdf(self):
+        try:
+            if self.path and os.path.exists(self.path):
+                open_with_default_app(self.path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open report: {e}")
+
 # ---------------- Users View ----------------
 class UsersView:
     def __init__(self, parent):
+        self.query = TableQuery("users", USER_TABLE_COLUMNS, default_sort="id", default_desc=False)
         parent.grid_columnconfigure(0, weight=1)
         parent.grid_rowconfigure(0, weight=1)
 
@@ -1318,6 +7298,7 @@ class UsersView:
         self.tree.configure(xscrollcommand=h_scrollbar.set)
 
         self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+        self.table = TableControls(self.tree, self.query, frame, table_frame, self.load_users)
 
         action_frame = ctk.CTkFrame(frame, fg_color="transparent")
         action_frame.pack(fill="x", padx=10, pady=10)
@@ -1325,9 +7306,22 @@ class UsersView:
         ctk.CTkButton(action_frame, text=icon_label("🗑️ Delete Selected", "[Del] Delete Selected"), fg_color="#e74c3c",
                      hover_color="#c0392b", command=self.delete_selected).pack(side="left", padx=5)
         ctk.CTkButton(action_frame, text=icon_label("🔄 Refresh", "[R] Refresh"), command=self.load_users).pack(side="left", padx=5)
+        ctk.CTkButton(action_frame, text=icon_label("💾 Backup Now", "[B] Backup Now"), command=self.backup_now,
+                     fg_color="#2b6cb0", hover_color="#2c5282").pack(side="right", padx=5)
+        ctk.CTkButton(action_frame, text=icon_label("♻️ Restore Backup", "[R] Restore Backup"), command=self.restore_backup,
+                     fg_color="#718096", hover_color="#4a5568").pack(side="right", padx=5)
+        ctk.CTkButton(action_frame, text=icon_label("🗄️ Archive Old Records", "[A] Archive Old Records"),
+                     command=self.archive_records, fg_color="#805ad5", hover_color="#6b46c1").pack(side="right", padx=5)
+        ctk.CTkButton(action_frame, text=icon_label("🔁 Sync Now", "[S] Sync Now"), command=self.sync_now,
+                     fg_color="#319795", hover_color="#2c7a7b").pack(side="right", padx=5)
+        ctk.CTkButton(action_frame, text=icon_label("🖨️ Scanner Folder", "[F] Scanner Folder"), command=self.scanner_folder,
+                     fg_color="#718096", hover_color="#4a5568").pack(side="right", padx=5)
+        self.backup_status = ctk.CTkLabel(action_frame, text="")
+        self.backup_status.pack(side="right", padx=10)
 
         self.load_users()
 
+    @ui_handler
     def add_user(self):
         try:
             uname = self.u_name.get().strip()
@@ -1342,11 +7336,7 @@ class UsersView:
                 messagebox.showerror("Error", "Role is required")
                 return
 
-            conn = db_connect()
-            c = conn.cursor()
-            c.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", (uname, pwd, role))
-            conn.commit()
-            conn.close()
+            repo.add_user(uname, pwd, role)
             messagebox.showinfo("Success", "User added successfully")
             self.u_name.delete(0, "end")
             self.u_pass.delete(0, "end")
@@ -1357,21 +7347,116 @@ class UsersView:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to add user: {e}")
 
+    @ui_handler
     def load_users(self):
         try:
-            conn = db_connect()
-            c = conn.cursor()
+            self.table.show(repo.list_users(self.query))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load users: {e}")
 
-            for i in self.tree.get_children():
-                self.tree.delete(i)
+    @ui_handler
+    def backup_now(self):
+        if not BACKUPS.start_background(force=True):
+            messagebox.showinfo("Backup", "A backup is already running")
+            return
+        self.backup_status.configure(text="Backing up...")
+        self._poll_backup()
 
-            for row in c.execute("SELECT id, username, role FROM users"):
-                display_row = ["" if cell is None else cell for cell in row]
-                self.tree.insert("", "end", values=display_row)
-            conn.close()
+    def _poll_backup(self):
+        try:
+            if BACKUPS.is_running():
+                self.backup_status.after(300, self._poll_backup)
+                return
+            status, detail = BACKUPS.last_result or ("error", "no result")
+            if status == "ok":
+                self.backup_status.configure(text=f"Backup saved: {os.path.basename(detail)}" if detail else "No changes since last backup")
+            else:
+                self.backup_status.configure(text="Backup failed")
+                messagebox.showerror("Error", f"Backup failed: {detail}")
+        except Exception:
+            pass  # view was closed while the backup ran
+
+    @ui_handler
+    def scanner_folder(self):
+        try:
+            folder = filedialog.askdirectory(title="Select the folder scanners save into",
+                                             initialdir=SCANNER.directory() or os.path.expanduser("~"))
+            if not folder:
+                return
+            repo.set_setting("scanner.dir", folder)
+            SCANNER.restart()
+            messagebox.showinfo("Scanner Folder", f"Watching {folder}\n\nStart file names with P and the patient ID "
+                                                  "(e.g. P123_chest.png) or drop a <file>.json sidecar with "
+                                                  "patient_id or phone.")
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to load users: {e}")
+            messagebox.showerror("Error", f"Failed to start the scanner folder: {e}")
+
+    @ui_handler
+    def sync_now(self):
+        if not SYNC.directory():
+            folder = filedialog.askdirectory(title="Select the shared sync folder")
+            if not folder:
+                return
+            repo.set_setting("sync.dir", folder)
+        if not SYNC.key():
+            passphrase = simpledialog.askstring("Sync", "Sync passphrase (the same on every workstation):", show="*")
+            if not passphrase:
+                return
+            SYNC.sync_key = passphrase  # kept in memory for this session only
+        if not SYNC.start_background():
+            messagebox.showinfo("Sync", "A sync is already running")
+            return
+        self.backup_status.configure(text="Syncing...")
+        self._poll_sync()
+
+    def _poll_sync(self):
+        try:
+            if SYNC.is_running():
+                self.backup_status.after(300, self._poll_sync)
+                return
+            status, detail = SYNC.last_result or ("error", "no result")
+            if status == "ok":
+                self.backup_status.configure(text=f"Synced: sent {detail['published']}, received {detail['applied']}, "
+                                                  f"{detail['blobs']} file(s) fetched")
+                self.load_users()
+            else:
+                self.backup_status.configure(text="Sync failed")
+                messagebox.showerror("Error", f"Sync failed: {detail}")
+        except Exception:
+            pass  # view was closed while the sync ran
+
+    @ui_handler
+    def archive_records(self):
+        try:
+            days = simpledialog.askinteger("Archive Old Records", "Move visits and files older than how many days?",
+                                           initialvalue=ARCHIVE_AFTER_DAYS, minvalue=1)
+            if not days:
+                return
+            moved = archive_old_records(days)
+            for t in ARCHIVED_TABLES:
+                repo.cache.invalidate(t)
+            messagebox.showinfo("Success", f"Archived {moved['visits']} visit(s) and {moved['patient_files']} file(s) "
+                                           f"to:\n{ARCHIVE_PATH}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to archive records: {e}")
+
+    @ui_handler
+    def restore_backup(self):
+        try:
+            path = filedialog.askopenfilename(title="Select backup to restore", initialdir=BACKUPS.backup_dir,
+                                              filetypes=[("Clinic backups", "*.db")])
+            if not path:
+                return
+            if not messagebox.askyesno("Confirm Restore", f"Replace the current database with\n{os.path.basename(path)}?\n"
+                                       "A safety snapshot of the current data is taken first."):
+                return
+            BACKUPS.restore(path)
+            messagebox.showinfo("Success", "Backup restored successfully")
+            self.load_users()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to restore backup: {e}")
 
+    @ui_handler
     def delete_selected(self):
         try:
             sel = self.tree.selection()
@@ -1380,26 +7465,356 @@ class UsersView:
                 return
             uid = self.tree.item(sel[0], "values")[0]
 
-            conn = db_connect()
-            c = conn.cursor()
-            c.execute("SELECT username FROM users WHERE id=?", (uid,))
-            row = c.fetchone()
-            if row and row[0] == "abdo":
-                conn.close()
+            row = repo.get_user(uid)
+            if row and row.username == "abdo":
                 messagebox.showerror("Error", "Cannot delete the default admin user")
                 return
 
             if messagebox.askyesno("Confirm Delete", "Are you sure you want to delete this user?"):
-                c.execute("DELETE FROM users WHERE id=?", (uid,))
-                conn.commit()
-                conn.close()
+                repo.delete_user(uid)
                 messagebox.showinfo("Success", "User deleted successfully")
                 self.load_users()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to delete user: {e}")
 
+# ---------------- Maintenance View ----------------
+class MaintenanceView:
+    def __init__(self, parent):
+        self.stats = None
+        self._loader = None
+        self._scrubbing = False
+        parent.grid_columnconfigure(0, weight=1)
+        parent.grid_rowconfigure(0, weight=1)
+
+        frame = ctk.CTkFrame(parent, corner_radius=8, fg_color="#e2e8f0")
+        frame.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+
+        ctk.CTkLabel(frame, text="Database Maintenance (Admin)",
+                    font=ctk.CTkFont(size=18, weight="bold")).pack(pady=10)
+
+        self.summary = ctk.CTkLabel(frame, text="Collecting statistics...", justify="left", anchor="w")
+        self.summary.pack(fill="x", padx=20, pady=5)
+
+        table_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        table_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        table_frame.grid_columnconfigure(0, weight=1)
+        table_frame.grid_rowconfigure(0, weight=1)
+
+        columns = (("name", "Table / Index", 260, "w"), ("table", "Table", 160, "w"), ("pages", "Pages", 90, "e"),
+                   ("size", "Size", 100, "e"), ("unused", "Unused %", 90, "e"), ("frag", "Fragmentation %", 120, "e"))
+        self.tree = ttk.Treeview(table_frame, columns=[c[0] for c in columns], show="headings", height=15)
+        for col, text, width, anchor in columns:
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor=anchor)
+
+        v_scrollbar = ctk.CTkScrollbar(table_frame, orientation="vertical", command=self.tree.yview)
+        v_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.tree.configure(yscrollcommand=v_scrollbar.set)
+        self.tree.grid(row=0, column=0, sticky="nsew", padx=(0, 5))
+
+        action_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        action_frame.pack(fill="x", padx=10, pady=10)
+        ctk.CTkButton(action_frame, text=icon_label("🔄 Refresh", "[R] Refresh"), command=self.refresh).pack(side="left", padx=5)
+        ctk.CTkButton(action_frame, text=icon_label("🖼 Duplicate Images", "[D] Duplicate Images"),
+                     command=ImageDuplicatesWindow).pack(side="left", padx=5)
+        ctk.CTkButton(action_frame, text=icon_label("🧹 Run Maintenance Now", "[M] Run Maintenance Now"),
+                     command=self.run_now, fg_color="#2b6cb0", hover_color="#2c5282").pack(side="right", padx=5)
+        self.status = ctk.CTkLabel(action_frame, text="")
+        self.status.pack(side="right", padx=10)
+
+        integrity = ctk.CTkFrame(frame, fg_color="transparent")
+        integrity.pack(fill="x", padx=10, pady=(0, 10))
+        integrity.grid_columnconfigure(0, weight=1)
+        ctk.CTkLabel(integrity, text="Integrity", font=ctk.CTkFont(size=15, weight="bold")).grid(row=0, column=0, sticky="w")
+        self.scrub_status = ctk.CTkLabel(integrity, text="", anchor="w")
+        self.scrub_status.grid(row=1, column=0, columnspan=2, sticky="ew")
+        columns = (("kind", "Problem", 280, "w"), ("table", "Table", 150, "w"), ("row", "Row", 70, "e"),
+                   ("detail", "Detail", 330, "w"), ("fix", "Fix", 330, "w"))
+        self.findings = ttk.Treeview(integrity, columns=[c[0] for c in columns], show="headings", height=6)
+        for col, text, width, anchor in columns:
+            self.findings.heading(col, text=text)
+            self.findings.column(col, width=width, anchor=anchor)
+        self.findings.grid(row=2, column=0, sticky="ew", pady=5)
+        f_scrollbar = ctk.CTkScrollbar(integrity, orientation="vertical", command=self.findings.yview)
+        f_scrollbar.grid(row=2, column=1, sticky="ns")
+        self.findings.configure(yscrollcommand=f_scrollbar.set)
+        buttons = ctk.CTkFrame(integrity, fg_color="transparent")
+        buttons.grid(row=3, column=0, columnspan=2, sticky="ew")
+        ctk.CTkButton(buttons, text=icon_label("🔍 Check Now", "[C] Check Now"), command=self.scrub_now).pack(side="left", padx=5)
+        ctk.CTkButton(buttons, text=icon_label("🛠 Fix Selected", "[F] Fix Selected"), command=lambda: self.fix(False),
+                     fg_color="#2b6cb0", hover_color="#2c5282").pack(side="left", padx=5)
+        ctk.CTkButton(buttons, text=icon_label("🛠 Fix All", "[F] Fix All"), command=lambda: self.fix(True),
+                     fg_color="#c05621", hover_color="#9c4221").pack(side="left", padx=5)
+        self._fixing = None
+
+        self.refresh()
+        self.show_findings()
+        self._poll_scrub()
+
+    @ui_handler
+    def refresh(self):
+        # dbstat reads every page of the file, so collect on a worker thread and poll for the result.
+        if self._loader and self._loader.is_alive():
+            return
+        self.stats = None
+        def work():
+            try:
+                self.stats = database_stats()
+            except Exception as e:
+                self.stats = e
+        self._loader = threading.Thread(target=work, name="dbstat", daemon=True)
+        self._loader.start()
+        self._poll_stats()
+
+    def _poll_stats(self):
+        try:
+            if self._loader.is_alive():
+                self.summary.after(200, self._poll_stats)
+                return
+            if isinstance(self.stats, Exception):
+                self.summary.configure(text=f"Failed to collect statistics: {self.stats}")
+                return
+            self.show_stats(self.stats)
+        except Exception:
+            pass  # view was closed while statistics were collected
+
+    def show_stats(self, s):
+        cache = repo.cache.stats() if repo.cache is not None else {}
+        analyzed = repo.get_setting("maintenance.analyzed_at") or "never"
+        self.summary.configure(text=(
+            f"File size: {format_bytes(s['file_bytes'])}  ({s['page_count']} pages of {s['page_size']} bytes)\n"
+            f"Free pages: {s['freelist_pages']}  ({format_bytes(s['freelist_bytes'])} reclaimable)    "
+            f"Auto-vacuum: {s['auto_vacuum']}{' (full VACUUM pending, runs when idle)' if MAINTENANCE.vacuum_pending() else ''}"
+            f"    Last ANALYZE: {analyzed}    Pages freed this session: {MAINTENANCE.pages_freed}\n"
+            f"Query cache: {cache.get('entries', 0)} entries, {format_bytes(cache.get('bytes', 0))}, "
+            f"hit rate {cache.get('hit_rate', 0.0):.0%}"
+            + ("" if s["has_dbstat"] else "\nPer-table sizes need SQLite's dbstat module, which this build lacks.")))
+        self.tree.delete(*self.tree.get_children())
+        for o in s["objects"]:
+            self.tree.insert("", "end", values=(o["name"], o["table"], o["pages"], format_bytes(o["bytes"]),
+                                                o["unused_pct"], o["fragmentation_pct"]))
+
+    def show_findings(self):
+        self.findings.delete(*self.findings.get_children())
+        for f in repo.integrity_findings():
+            problem, fix = SCRUB_KINDS[f.kind]
+            self.findings.insert("", "end", iid=str(f.id), values=(problem, f.tbl, f.row_id or "", f.detail, fix))
+
+    def _poll_scrub(self):
+        try:
+            self.scrub_status.configure(text=f"{SCRUBBER.status_text()}    Open findings: {len(self.findings.get_children())}")
+            if SCRUBBER.current is None and self._scrubbing:
+                self.show_findings()
+            self._scrubbing = SCRUBBER.current is not None
+            self.scrub_status.after(1000, self._poll_scrub)
+        except Exception:
+            pass  # view was closed
+
+    @ui_handler
+    def scrub_now(self):
+        SCRUBBER.run_now()
+        self._scrubbing = True
+
+    @ui_handler
+    def fix(self, everything):
+        if self._fixing is not None and not self._fixing.done():
+            return
+        ids = [] if everything else [int(i) for i in self.findings.selection()]
+        if not everything and not ids:
+            messagebox.showwarning("Select", "Select the findings to fix")
+            return
+        count = len(self.findings.get_children()) if everything else len(ids)
+        if not count or not messagebox.askyesno("Confirm", f"Apply the fix to {count} finding(s)?"):
+            return
+        work = SCRUBBER.fix_all if everything else (lambda: [SCRUBBER.fix(i) for i in ids])
+        self._fixing = ingest_pool().submit(work)
+        self.scrub_status.configure(text="Fixing...")
+        self._poll_fix()
+
+    def _poll_fix(self):
+        try:
+            if not self._fixing.done():
+                self.scrub_status.after(200, self._poll_fix)
+                return
+            self.show_findings()
+            messagebox.showinfo("Integrity", "\n".join(self._fixing.result()) or "Nothing to fix")
+        except Exception as e:
+            try:
+                self.show_findings()
+                messagebox.showerror("Error", f"Fix failed: {e}")
+            except Exception:
+                pass  # view was closed
+
+    @ui_handler
+    def run_now(self):
+        if not MAINTENANCE.start_background(budget_sec=5):
+            messagebox.showinfo("Maintenance", "Maintenance is already running")
+            return
+        self.status.configure(text="Running maintenance...")
+        self._poll_maintenance()
+
+    def _poll_maintenance(self):
+        try:
+            if MAINTENANCE.is_running():
+                self.status.after(300, self._poll_maintenance)
+                return
+            status, detail = MAINTENANCE.last_result or ("error", "no result")
+            if status == "ok":
+                self.status.configure(text="Ran the pending full VACUUM" if detail["vacuumed"] else
+                                      f"Freed {detail['pages_freed']} page(s), analyzed {len(detail['analyzed'])} table(s)")
+                self.refresh()
+            else:
+                self.status.configure(text="Maintenance failed")
+                messagebox.showerror("Error", f"Maintenance failed: {detail}")
+        except Exception:
+            pass
+
+def run_cli(argv):
+    """Handle maintenance commands that run without the GUI; return True if one was handled."""
+    import argparse
+    parser = argparse.ArgumentParser(description=f"{CLINIC_NAME} — clinic management")
+    parser.add_argument("--backup", action="store_true", help="take a verified snapshot of the database now")
+    parser.add_argument("--list-backups", action="store_true", help="list available snapshots")
+    parser.add_argument("--restore", metavar="BACKUP", help="restore the database from a snapshot")
+    parser.add_argument("--archive", nargs="?", type=int, const=ARCHIVE_AFTER_DAYS, metavar="DAYS",
+                        help=f"move visits/files older than DAYS (default {ARCHIVE_AFTER_DAYS}) to archive.db")
+    parser.add_argument("--recompress", action="store_true", help="compress legacy uncompressed attachments")
+    parser.add_argument("--unarchive", nargs="?", const="all", metavar="PATIENT_ID",
+                        help="move archived records (all, or one patient's) back to the main database")
+    parser.add_argument("--find-duplicates", nargs="+", metavar=("NAME", "PHONE"),
+                        help="list registered patients that look like NAME (and PHONE)")
+    parser.add_argument("--merge", nargs="+", type=int, metavar=("SURVIVOR", "DUPLICATE"),
+                        help="move visits and files of the DUPLICATE patients onto SURVIVOR and delete them")
+    parser.add_argument("--maintain", action="store_true",
+                        help="reclaim free pages and refresh planner statistics now")
+    parser.add_argument("--db-stats", action="store_true", help="print database size and fragmentation per table")
+    parser.add_argument("--scrub", action="store_true",
+                        help="check for orphaned records, damaged photos/attachments and b-tree damage now")
+    parser.add_argument("--scrub-fix", action="store_true", help="apply the fix for every open integrity finding")
+    parser.add_argument("--index-text", action="store_true", help="extract the text of attachments not yet indexed")
+    parser.add_argument("--search-files", metavar="TEXT", help="list patients whose attachments contain TEXT")
+    parser.add_argument("--hash-images", action="store_true", help="compute perceptual hashes of images stored without one")
+    parser.add_argument("--image-duplicates", action="store_true", help="list groups of near-duplicate images")
+    parser.add_argument("--report", metavar="PERIOD", help="write the clinic report for a month (2024-03) or quarter (2024-Q1)")
+    parser.add_argument("--sync", nargs="?", const="", metavar="DIR",
+                        help="exchange changes with other workstations through the shared folder DIR (remembered); "
+                             "the passphrase comes from CLINIC_SYNC_KEY or is asked for")
+    parser.add_argument("--sync-reset-node", action="store_true",
+                        help="give this database a new sync identity (run after copying clinic.db to another PC)")
+    parser.add_argument("--watch", nargs="?", const="", metavar="DIR",
+                        help="file scanner drops from DIR (remembered) until interrupted")
+    parser.add_argument("--readonly", action="store_true",
+                        help="open the database read-only for a display/reporting workstation (also CLINIC_READONLY=1)")
+    args = parser.parse_args(argv)
+    if args.backup:
+        path = BACKUPS.snapshot(force=True)
+        print(f"Backup written to {path}")
+    elif args.list_backups:
+        for path in BACKUPS.list_backups():
+            print(f"{path}  {os.path.getsize(path) // 1024} KB")
+    elif args.restore:
+        BACKUPS.restore(args.restore)
+        print(f"Restored {DB_PATH} from {args.restore}")
+    elif args.archive is not None:
+        print(f"Archived: {archive_old_records(args.archive)}")
+    elif args.recompress:
+        RECOMPRESSOR.run()
+        print(f"Recompressed {RECOMPRESSOR.processed} file(s), saved {format_bytes(RECOMPRESSOR.bytes_saved)}")
+    elif args.unarchive:
+        pid = None if args.unarchive == "all" else int(args.unarchive)
+        print(f"Restored from archive: {restore_archived_records(pid)}")
+    elif args.find_duplicates:
+        name, phone = args.find_duplicates[0], " ".join(args.find_duplicates[1:])
+        for d in repo.find_duplicates(name, phone, limit=20):
+            print(f"#{d.id}  {d.name}  {d.phone}  last visit {d.last_visit or '-'}  score {d.score}  ({d.reason})")
+    elif args.merge:
+        if len(args.merge) < 2:
+            parser.error("--merge needs a SURVIVOR id and at least one DUPLICATE id")
+        print(f"Merged {repo.merge_patients(args.merge[0], args.merge[1:])} duplicate(s) into patient {args.merge[0]}")
+    elif args.maintain:
+        done = MAINTENANCE.run_all()
+        print(f"Freed {done['pages_freed']} page(s), analyzed {len(done['analyzed'])} table(s)"
+              + (" after the pending full VACUUM" if done["vacuumed"] else ""))
+    elif args.db_stats:
+        s = database_stats()
+        print(f"{format_bytes(s['file_bytes'])} in {s['page_count']} pages, {s['freelist_pages']} free, "
+              f"auto_vacuum={s['auto_vacuum']}")
+        if not s["has_dbstat"]:
+            print("Per-table sizes need SQLite's dbstat module, which this build lacks.")
+        for o in s["objects"]:
+            print(f"{o['name']:40s} {format_bytes(o['bytes']):>10s}  unused {o['unused_pct']:5.1f}%  "
+                  f"fragmented {o['fragmentation_pct']:5.1f}%")
+    elif args.scrub:
+        SCRUBBER.paced = False
+        start = time.perf_counter()
+        SCRUBBER.scrub_pass(restart=True)
+        print(f"Checked {SCRUBBER.checked} item(s) in {time.perf_counter() - start:.1f} s")
+        print(SCRUBBER.report())
+    elif args.scrub_fix:
+        for line in SCRUBBER.fix_all() or ["Nothing to fix"]:
+            print(line)
+    elif args.index_text:
+        start = time.perf_counter()
+        print(f"Indexed {TEXT_INDEXER.run_all()} file(s) in {time.perf_counter() - start:.1f} s")
+    elif args.search_files:
+        matches, snippets = repo.search_attachments(args.search_files)
+        for m in matches:
+            print(f"#{m.patient_id}  {m.name}  {m.phone}  {m.hits} file(s)")
+            for f in snippets.get(m.patient_id, []):
+                print(f"    {f.file_name}: {' '.join(f.snippet.split())}")
+    elif args.hash_images:
+        start = time.perf_counter()
+        print(f"Hashed {IMAGE_HASHES.run_all()} image(s) in {time.perf_counter() - start:.1f} s")
+    elif args.image_duplicates:
+        groups = IMAGE_HASHES.duplicate_groups()
+        for n, group in enumerate(groups, 1):
+            print(f"Group {n}: {format_bytes(sum(r.size or 0 for r in group[1:]))} in copies")
+            for r in group:
+                print(f"    {r.kind} #{r.id}  {r.file_name}  patient #{r.patient_id} {r.patient}  "
+                      f"{format_bytes(r.size or 0)}  {r.distance} bit(s) apart")
+        print(f"{len(groups)} group(s)")
+    elif args.report:
+        try:
+            period = parse_report_period(args.report)
+        except ValueError as e:
+            parser.error(str(e))
+        start = time.perf_counter()
+        path, data, cached = generate_report(period)
+        print(f"{period.label}: {data.visits} visit(s), revenue {data.revenue:,.2f}, {data.new_patients} new patient(s)")
+        print(f"Report {'reused from cache' if cached else 'written'} in {time.perf_counter() - start:.2f} s: {path}")
+    elif args.sync is not None:
+        if args.sync:
+            repo.set_setting("sync.dir", os.path.abspath(args.sync))
+        if not SYNC.key():
+            SYNC.sync_key = getpass.getpass("Sync passphrase (the same on every workstation): ")
+        done = SYNC.sync_once()
+        print(f"Sent {done['published']} change(s), applied {done['applied']} (skipped {done['skipped']}), "
+              f"fetched {done['blobs']} file(s)")
+    elif args.sync_reset_node:
+        node = os.urandom(8).hex()
+        repo.set_setting("sync.node_id", node)
+        repo.set_setting("sync.published_seq", "0")
+        print(f"This database now syncs as node {node}")
+    elif args.watch is not None:
+        if args.watch:
+            repo.set_setting("scanner.dir", os.path.abspath(args.watch))
+        if not SCANNER.start():
+            parser.error("no scanner folder configured")
+        print(f"Watching {SCANNER.directory()} (Ctrl+C to stop)")
+        try:
+            while SCANNER.is_running():
+                time.sleep(5)
+                print(SCANNER.status_text())
+        except KeyboardInterrupt:
+            SCANNER.stop(wait=True)
+    else:
+        return False
+    return True
+
 if __name__ == "__main__":
     try:
+        if run_cli(sys.argv[1:]):
+            sys.exit(0)
         LoginWindow().mainloop()
     except Exception as e:
         print(f"Fatal error: {e}")
@@ -0,0 +1,169 @@
+"""Streaming bulk export of patients, visits and file metadata to CSV or JSON Lines.
+
+Runs without the GUI stack (no customtkinter/PIL import), reads through a read-only
+connection and writes rows as the cursor yields them, so memory stays flat at any table size.
+
+    python clinic_export.py patients patients.csv.gz --columns id,name,phone
+    python clinic_export.py visits visits.jsonl --since 2024-01-01 --until 2024-12-31
+"""
+import os
+import sys
+import csv
+import json
+import gzip
+import io
+import time
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+
+DB_PATH = os.environ.get("CLINIC_DB_PATH") or os.path.join(os.path.expanduser("~"), "Documents", "clinic.db")
+FETCH_ROWS = 5000
+GZIP_LEVEL = 1  # most of the size win for a fraction of the CPU of level 9
+
+def _display_date(ts_col, text_col):
+    # Same rendering as the app: the epoch column in local time, else whatever text was stored.
+    return f"IFNULL(strftime('%Y-%m-%d %H:%M', {ts_col}, 'unixepoch', 'localtime'), {text_col})"
+
+# Export name -> FROM clause, the epoch column used by --since/--until, and output column -> SQL expression.
+EXPORTS = {
+    "patients": {
+        "from": "patients",
+        "date": "last_visit_ts",
+        "columns": {
+            "id": "id", "name": "name", "age": "age", "gender": "gender", "phone": "phone", "address": "address",
+            "occupation": "occupation", "diagnosis": "diagnosis", "prescription": "prescription",
+            "last_visit": _display_date("last_visit_ts", "last_visit"), "doctor": "doctor",
+        },
+    },
+    "visits": {
+        "from": "visits v LEFT JOIN patients p ON p.id = v.patient_id",
+        "date": "v.date_ts",
+        "columns": {
+            "id": "v.id", "patient_id": "v.patient_id", "patient": "p.name",
+            "date": _display_date("v.date_ts", "v.date"),
+            "diagnosis": "v.diagnosis", "prescription": "v.prescription", "doctor": "v.doctor", "price": "v.price",
+        },
+    },
+    "files": {
+        "from": "patient_files",
+        "date": "upload_ts",
+        "columns": {
+            "id": "id", "patient_id": "patient_id", "file_name": "file_name", "file_type": "file_type",
+            "upload_date": _display_date("upload_ts", "upload_date"), "size": "IFNULL(orig_size, length(file_data))",
+            "stored_size": "length(file_data)", "codec": "IFNULL(codec, 'raw')",
+        },
+    },
+}
+
+def _parse_day(value, name):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"{name} must be a date like 2024-01-31, got {value!r}")
+
+def build_query(table, columns=None, since=None, until=None):
+    """Return (sql, params, column names) for one export; --until is inclusive of that whole day."""
+    if table not in EXPORTS:
+        raise ValueError(f"Unknown export {table!r}; choose from {', '.join(EXPORTS)}")
+    spec = EXPORTS[table]
+    names = list(columns) if columns else list(spec["columns"])
+    unknown = [c for c in names if c not in spec["columns"]]
+    if unknown:
+        raise ValueError(f"Unknown column(s) for {table}: {', '.join(unknown)}; "
+                         f"available: {', '.join(spec['columns'])}")
+    where, params = [], []
+    # Days are local-time midnights, compared against the indexed epoch columns.
+    if since:
+        where.append(f"{spec['date']} >= ?")
+        params.append(int(_parse_day(since, "since").timestamp()))
+    if until:
+        where.append(f"{spec['date']} < ?")
+        params.append(int((_parse_day(until, "until") + timedelta(days=1)).timestamp()))
+    sql = f"SELECT {', '.join(spec['columns'][c] for c in names)} FROM {spec['from']}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    order = spec["columns"]["id"]
+    return f"{sql} ORDER BY {order}", params, names
+
+def _open_output(path, compress):
+    if path == "-" and compress:
+        # GzipFile leaves the stream it wraps open; closing this finishes the gzip member on stdout.
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb", compresslevel=GZIP_LEVEL),
+                                encoding="utf-8", newline="")
+    if path == "-":
+        return sys.stdout
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=GZIP_LEVEL)
+    return open(path, "w", encoding="utf-8", newline="")
+
+def export_table(table, path, fmt=None, columns=None, since=None, until=None, compress=None, db_path=None):
+    """Stream one export to *path* ("-" for stdout) as CSV or JSONL and return the number of rows written.
+
+    fmt and compress default from the file name (.csv / .jsonl, optional .gz). Files are written to
+    a .part sibling and renamed when complete.
+    """
+    base = path[:-3] if path.endswith(".gz") else path
+    compress = path.endswith(".gz") if compress is None else compress
+    fmt = fmt or ("jsonl" if base.endswith((".jsonl", ".json")) else "csv")
+    if fmt not in ("csv", "jsonl"):
+        raise ValueError(f"Unknown format {fmt!r}; use csv or jsonl")
+    sql, params, names = build_query(table, columns, since, until)
+    conn = sqlite3.connect(f"file:{db_path or DB_PATH}?mode=ro", uri=True)
+    target = path if path == "-" else path + ".part"
+    count = 0
+    try:
+        cur = conn.execute(sql, params)
+        out = _open_output(target, compress)
+        try:
+            if fmt == "csv":
+                writer = csv.writer(out)
+                writer.writerow(names)
+                for rows in iter(lambda: cur.fetchmany(FETCH_ROWS), []):
+                    writer.writerows(rows)
+                    count += len(rows)
+            else:
+                encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+                for rows in iter(lambda: cur.fetchmany(FETCH_ROWS), []):
+                    out.write("".join(encode(dict(zip(names, row))) + "\n" for row in rows))
+                    count += len(rows)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+            if path == "-":
+                sys.stdout.flush()
+    except Exception:
+        if target != path and os.path.exists(target):
+            os.remove(target)
+        raise
+    finally:
+        conn.close()
+    if target != path:
+        os.replace(target, path)
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream clinic data to CSV or JSON Lines.")
+    parser.add_argument("table", choices=sorted(EXPORTS), help="what to export")
+    parser.add_argument("output", help="output file (.csv, .jsonl, optionally .gz) or - for stdout")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="override the format implied by the file name")
+    parser.add_argument("--gzip", action="store_true", default=None, help="gzip the output")
+    parser.add_argument("--columns", help="comma-separated columns to include (default: all)")
+    parser.add_argument("--since", metavar="YYYY-MM-DD", help="only rows dated on or after this day")
+    parser.add_argument("--until", metavar="YYYY-MM-DD", help="only rows dated on or before this day")
+    parser.add_argument("--db", help=f"database file (default {DB_PATH})")
+    args = parser.parse_args(argv)
+    columns = [c.strip() for c in args.columns.split(",") if c.strip()] if args.columns else None
+    start = time.perf_counter()
+    try:
+        count = export_table(args.table, args.output, args.format, columns, args.since, args.until,
+                             args.gzip, args.db)
+    except (ValueError, sqlite3.Error) as e:
+        parser.exit(2, f"Export failed: {e}\n")
+    elapsed = time.perf_counter() - start
+    print(f"Exported {count} {args.table} row(s) to {args.output} in {elapsed:.2f} s "
+          f"({count / elapsed if elapsed else 0:,.0f} rows/s)", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""Every test runs against its own clinic.db (and archive, backup and quarantine folders) in tmp_path.
+
+clinic_app opens DB_PATH at import, so the session database is pointed at a temporary folder before
+the import; the `clinic` fixture then re-points the module and its singletons at a fresh database.
+"""
+import os
+import sys
+import tempfile
+
+os.environ["CLINIC_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="clinic_tests_"), "clinic.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import clinic_app  # noqa: E402
+
+
+@pytest.fixture
+def clinic(tmp_path, monkeypatch):
+    db = str(tmp_path / "clinic.db")
+    monkeypatch.setattr(clinic_app, "DB_PATH", db)
+    monkeypatch.setattr(clinic_app, "ARCHIVE_PATH", str(tmp_path / "archive.db"))
+    monkeypatch.setattr(clinic_app, "QUARANTINE_DIR", str(tmp_path / "quarantine"))
+    monkeypatch.setattr(clinic_app, "REPORT_CACHE_DIR", str(tmp_path / "report_cache"))
+    monkeypatch.setattr(clinic_app, "TRACE_DIR", str(tmp_path / "traces"))
+    monkeypatch.setattr(clinic_app, "BACKUPS", clinic_app.BackupManager(db, str(tmp_path / "clinic_backups")))
+    monkeypatch.setattr(clinic_app, "MAINTENANCE", clinic_app.MaintenanceScheduler(db))
+    monkeypatch.setattr(clinic_app, "APPOINTMENTS", clinic_app.AppointmentIndex())
+    monkeypatch.setattr(clinic_app, "SYNC", clinic_app.SyncEngine())
+    monkeypatch.setattr(clinic_app.repo, "cache", clinic_app.QueryCache())
+    monkeypatch.setattr(clinic_app, "PASSWORD_HASH_ITERATIONS", 1000)
+    clinic_app.initialize_database()
+    yield clinic_app
+
+
+def add_patient(app, name="Patient", phone="0100", files=(), **fields):
+    values = {"name": name, "age": 40, "gender": "Female", "phone": phone, "address": "", "occupation": "",
+              "diagnosis": "", "prescription": "", "doctor": "Dr A"}
+    values.update(fields)
+    return app.repo.add_patient(values, files=[{"name": n, "type": clinic_type(n), "data": d} for n, d in files])
+
+
+def clinic_type(name):
+    return clinic_app.classify_file(name)
@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from conftest import add_patient
+
+NINE = 1_900_000_000 - 1_900_000_000 % 3600  # an hour boundary, far from any real booking
+
+
+def book(clinic, pid, start, minutes=30, doctor="Dr A", **kw):
+    return clinic.repo.book_appointment(pid, doctor, start, minutes, **kw)
+
+
+def test_overlapping_bookings_are_refused(clinic):
+    pid = add_patient(clinic, "Alice")
+    book(clinic, pid, NINE)
+    with pytest.raises(ValueError):
+        book(clinic, pid, NINE + 15 * 60)
+    with pytest.raises(ValueError):
+        book(clinic, pid, NINE - 10 * 60, doctor="  dr  a ")
+    book(clinic, pid, NINE + 30 * 60)  # back to back is fine
+    book(clinic, pid, NINE, doctor="Dr B")
+
+
+def test_moving_a_booking(clinic):
+    pid = add_patient(clinic, "Alice")
+    first = book(clinic, pid, NINE)
+    second = book(clinic, pid, NINE + 60 * 60)
+    assert book(clinic, pid, NINE + 10 * 60, appointment_id=first) == first  # overlaps only its old slot
+    with pytest.raises(ValueError):
+        book(clinic, pid, NINE + 50 * 60, appointment_id=first)
+    assert clinic.repo.get_appointment(first).start_ts == NINE + 10 * 60
+    assert clinic.APPOINTMENTS.conflicts("Dr A", NINE, NINE + 10 * 60) == []
+    assert [c[2] for c in clinic.APPOINTMENTS.conflicts("Dr A", NINE + 60 * 60, NINE + 61 * 60)] == [second]
+
+
+def test_rebooking_a_cancelled_slot_checks_for_overlap(clinic):
+    pid = add_patient(clinic, "Alice")
+    first = book(clinic, pid, NINE)
+    clinic.repo.set_appointment_status(first, "cancelled")
+    book(clinic, pid, NINE)
+    with pytest.raises(ValueError):
+        clinic.repo.set_appointment_status(first, "booked")
+    assert clinic.repo.get_appointment(first).status == "cancelled"
+
+
+def test_index_follows_other_writers_incrementally(clinic, monkeypatch):
+    pid = add_patient(clinic, "Alice")
+    book(clinic, pid, NINE)
+    rebuilds = []
+    rebuild = clinic.APPOINTMENTS._rebuild
+    monkeypatch.setattr(clinic.APPOINTMENTS, "_rebuild", lambda conn: rebuilds.append(1) or rebuild(conn))
+    conn = clinic.db_connect()
+    with conn:  # another workstation books directly
+        conn.execute("INSERT INTO appointments (patient_id, doctor, start_ts, end_ts) VALUES (?, 'Dr A', ?, ?)",
+                     (pid, NINE + 2 * 3600, NINE + 3 * 3600))
+    conn.close()
+    assert len(clinic.APPOINTMENTS.conflicts("Dr A", NINE + 2 * 3600, NINE + 2 * 3600 + 60)) == 1
+    with pytest.raises(ValueError):
+        book(clinic, pid, NINE + 2 * 3600 + 600)
+    assert rebuilds == []
+
+
+def test_complete_checks_status_not_visit(clinic):
+    pid = add_patient(clinic, "Alice")
+    aid = book(clinic, pid, NINE)
+    clinic.repo.complete_appointment(aid, "Flu", "Rest", 100)
+    conn = clinic.db_connect()
+    with conn:  # what archiving the visit does through ON DELETE SET NULL
+        conn.execute("UPDATE appointments SET visit_id = NULL WHERE id=?", (aid,))
+    conn.close()
+    with pytest.raises(ValueError):
+        clinic.repo.complete_appointment(aid, "Flu", "Rest", 100)
+
+
+def test_completing_twice_adds_one_visit(clinic):
+    pid = add_patient(clinic, "Alice")
+    aid = book(clinic, pid, NINE)
+    visit_id = clinic.repo.complete_appointment(aid, "Flu", "Rest", 100)
+    with pytest.raises(ValueError):
+        clinic.repo.complete_appointment(aid, "Cold", "Tea", 50)
+    assert [v.id for v in clinic.repo.list_visits(pid)] == [visit_id]
+    assert clinic.repo.get_appointment(aid).visit_id == visit_id
+
+
+def test_concurrent_completions_add_one_visit(clinic):
+    pid = add_patient(clinic, "Alice")
+    aid = book(clinic, pid, NINE)
+    start, results = threading.Barrier(4), []
+
+    def complete():
+        start.wait()
+        try:
+            results.append(clinic.repo.complete_appointment(aid, "Flu", "Rest", 100))
+        except ValueError:
+            results.append(None)
+
+    threads = [threading.Thread(target=complete) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(None) == 3
+    assert [v.id for v in clinic.repo.list_visits(pid)] == [r for r in results if r]
+
+
+def test_only_booked_appointments_can_be_completed(clinic):
+    pid = add_patient(clinic, "Alice")
+    aid = book(clinic, pid, NINE)
+    clinic.repo.set_appointment_status(aid, "cancelled")
+    with pytest.raises(ValueError):
+        clinic.repo.complete_appointment(aid, "Flu", "Rest", 100)
+    with pytest.raises(ValueError):
+        clinic.repo.complete_appointment(aid + 1, "Flu", "Rest", 100)
+    assert clinic.repo.list_visits(pid) == [] and clinic.repo.get_patient(pid).last_visit == ""
@@ -0,0 +1,96 @@
+import sqlite3
+
+from conftest import add_patient
+
+
+def archived_visit(clinic):
+    pid = add_patient(clinic, "Alice")
+    old = clinic.repo.save_visit(pid, "2015-03-01", "Flu", "Rest", "Dr A", 100)
+    recent = clinic.repo.save_visit(pid, clinic.format_timestamp(clinic.time.time()), "Cold", "Tea", "Dr A", 50)
+    assert clinic.archive_old_records() == {"visits": 1, "patient_files": 0}
+    clinic.repo.cache.clear()
+    return pid, old, recent
+
+
+def test_archive_tables_keep_the_real_schema(clinic):
+    archived_visit(clinic)
+    conn = sqlite3.connect(clinic.ARCHIVE_PATH)
+    info = {r[1]: r for r in conn.execute("PRAGMA table_info(visits)")}
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE name='visits'").fetchone()[0]
+    conn.close()
+    assert info["id"][5] == 1
+    assert "AUTOINCREMENT" in sql and "FOREIGN KEY" not in sql
+    assert info["version"][3] == 1  # NOT NULL DEFAULT 0 survives
+
+
+def test_archive_built_by_older_versions_is_rebuilt(clinic):
+    pid, old, _ = archived_visit(clinic)
+    conn = sqlite3.connect(clinic.ARCHIVE_PATH)
+    with conn:
+        conn.execute("CREATE TABLE visits_old AS SELECT * FROM visits")
+        conn.execute("DROP TABLE visits")
+        conn.execute("ALTER TABLE visits_old RENAME TO visits")
+    conn.close()
+    assert clinic.repo.get_visit(old).diagnosis == "Flu"
+    conn = sqlite3.connect(clinic.ARCHIVE_PATH)
+    assert [r[1] for r in conn.execute("PRAGMA table_info(visits)") if r[5]] == ["id"]
+    conn.close()
+
+
+def test_archived_visits_can_be_edited_reassigned_and_deleted(clinic):
+    pid, old, recent = archived_visit(clinic)
+    assert clinic.repo.get_visit(old).diagnosis == "Flu"
+
+    clinic.repo.save_visit(pid, "2015-03-02", "Bronchitis", "Rest", "Dr A", 120, visit_id=old)
+    assert clinic.repo.get_visit(old).diagnosis == "Bronchitis"
+    assert clinic.repo.get_visit(recent).diagnosis == "Cold"
+
+    assert clinic.repo.reassign_doctor("visits", [old, recent], "Dr B") == 2
+    assert {v.doctor for v in clinic.repo.patient_visits(pid)} == {"Dr B"}
+
+    assert clinic.repo.delete_visits([old]) == 1
+    assert clinic.repo.get_visit(old) is None
+    assert [v.id for v in clinic.repo.patient_visits(pid)] == [recent]
+
+
+def test_interrupted_move_is_finished_without_losing_the_live_copy(clinic):
+    pid, old, _ = archived_visit(clinic)
+    # A restore that copied the row back but stopped before deleting it from the archive.
+    conn = clinic.archive_connect()
+    cols = ", ".join(clinic._table_columns(conn, "main", "visits"))
+    with conn:
+        conn.execute(f"INSERT INTO main.visits ({cols}) SELECT {cols} FROM archive.visits WHERE id=?", (old,))
+        conn.execute("UPDATE main.visits SET diagnosis='Edited after the crash' WHERE id=?", (old,))
+    conn.close()
+
+    assert clinic.restore_archived_records(pid) == {"visits": 0, "patient_files": 0}
+    clinic.repo.cache.clear()
+    visits = clinic.repo.patient_visits(pid)
+    assert sorted(v.id for v in visits) == sorted({v.id for v in visits})
+    assert clinic.repo.get_visit(old).diagnosis == "Edited after the crash"
+
+
+def test_restore_round_trip(clinic):
+    pid, old, recent = archived_visit(clinic)
+    assert clinic.restore_archived_records() == {"visits": 1, "patient_files": 0}
+    conn = clinic.archive_connect()
+    assert conn.execute("SELECT COUNT(*) FROM archive.visits").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM change_log WHERE op='D'").fetchone()[0] == 0
+    conn.close()
+    clinic.repo.cache.clear()
+    assert {v.id for v in clinic.repo.patient_visits(pid)} == {old, recent}
+
+
+def test_snapshot_export_is_consistent_while_visits_are_saved(clinic):
+    pid = add_patient(clinic, "Alice")
+    clinic.repo.save_visit(pid, "2024-01-01", "Flu", "Rest", "Dr A", 100)
+    with clinic.repo.snapshot() as snap:
+        before = snap.export_patients()
+        count = snap.count_patients()
+        # Commits from the clinic PC do not wait on the export, and the export does not see them.
+        clinic.repo.save_visit(pid, "2024-06-01", "Cold", "Tea", "Dr B", 50)
+        add_patient(clinic, "Bob")
+        assert snap.export_patients() == before
+        assert snap.count_patients() == count == 1
+    assert clinic.repo.count_patients() == 2
+    assert clinic.repo.export_patients() != before
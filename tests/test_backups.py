@@ -0,0 +1,49 @@
+import os
+import sqlite3
+
+from conftest import add_patient
+
+
+def test_snapshot_is_verified_and_skipped_when_unchanged(clinic):
+    add_patient(clinic, "Alice")
+    first = clinic.BACKUPS.snapshot()
+    assert first and clinic.BACKUPS.verify(first)
+    assert not os.path.exists(first + ".part")
+    assert clinic.BACKUPS.snapshot() is None
+    assert clinic.BACKUPS.snapshot(force=True) != first
+
+
+def test_restore_keeps_a_pre_restore_snapshot(clinic):
+    add_patient(clinic, "Alice")
+    backup = clinic.BACKUPS.snapshot(force=True)
+    add_patient(clinic, "Bob")
+    assert clinic.repo.count_patients() == 2
+    clinic.BACKUPS.restore(backup)
+    assert clinic.repo.count_patients() == 1
+    assert any("pre_restore" in p for p in clinic.BACKUPS.list_backups())
+
+
+def test_restore_rejects_a_corrupt_file(clinic, tmp_path):
+    bad = tmp_path / "clinic_bad.db"
+    bad.write_bytes(b"SQLite format 3\x00" + b"\xff" * 4096)
+    try:
+        clinic.BACKUPS.restore(str(bad))
+    except sqlite3.DatabaseError:
+        pass
+    else:
+        raise AssertionError("restore accepted a corrupt backup")
+
+
+def test_rotation_keeps_the_recent_ones(clinic, monkeypatch):
+    monkeypatch.setattr(clinic, "BACKUP_KEEP_RECENT", 3)
+    monkeypatch.setattr(clinic, "BACKUP_KEEP_DAILY", 1)
+    for _ in range(6):
+        clinic.BACKUPS.snapshot(force=True)
+    assert len(clinic.BACKUPS.list_backups()) == 3
+
+
+def test_users_view_handlers_are_tracked_once(clinic):
+    for name in ("backup_now", "delete_selected", "restore_backup"):
+        handler = getattr(clinic.UsersView, name)
+        assert hasattr(handler, "__wrapped__"), name
+        assert not hasattr(handler.__wrapped__, "__wrapped__"), name
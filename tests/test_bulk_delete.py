@@ -0,0 +1,52 @@
+import pytest
+
+from conftest import add_patient
+
+
+def counts(clinic, pid):
+    conn = clinic.db_connect()
+    found = {table: conn.execute(f"SELECT COUNT(*) FROM {table} WHERE patient_id=?", (pid,)).fetchone()[0]
+             for table in ("visits", "patient_files", "appointments", "patient_name_keys", "patient_phone_keys")}
+    conn.close()
+    return found
+
+
+def patient_with_history(clinic, name, phone):
+    pid = add_patient(clinic, name, phone, files=[("notes.txt", b"seen twice")])
+    clinic.repo.save_visit(pid, "2024-03-01", "Flu", "Rest", "Dr A", 100)
+    clinic.repo.book_appointment(pid, "Dr A", clinic.parse_timestamp("2030-01-0%d 10:00" % pid), 30)
+    return pid
+
+
+def test_deleting_patients_cascades_to_their_rows_only(clinic):
+    a, b, c = (patient_with_history(clinic, n, p) for n, p in (("Alice", "0100"), ("Bob", "0200"), ("Carol", "0300")))
+    assert all(counts(clinic, pid)["visits"] == 1 for pid in (a, b, c))
+    assert clinic.repo.delete_patients([a, b]) == 2
+    assert [p.id for p in clinic.repo.list_patients()] == [c]
+    assert all(n == 0 for pid in (a, b) for n in counts(clinic, pid).values())
+    assert all(counts(clinic, c).values())
+
+
+def test_deleting_a_patient_removes_archived_visits(clinic):
+    pid = add_patient(clinic, "Alice")
+    clinic.repo.save_visit(pid, "2015-03-01", "Flu", "Rest", "Dr A", 100)
+    assert clinic.archive_old_records()["visits"] == 1
+    clinic.repo.delete_patient(pid)
+    conn = clinic.db_connect()
+    assert clinic.attach_archive(conn)
+    assert conn.execute("SELECT COUNT(*) FROM archive.visits").fetchone()[0] == 0
+    conn.close()
+
+
+def test_bulk_visit_delete_and_reassign_reach_hot_and_archived_rows(clinic):
+    pid = add_patient(clinic, "Alice")
+    old = clinic.repo.save_visit(pid, "2015-03-01", "Flu", "Rest", "Dr A", 100)
+    recent = clinic.repo.save_visit(pid, clinic.format_timestamp(clinic.time.time()), "Cold", "Tea", "Dr A", 50)
+    keep = clinic.repo.save_visit(pid, clinic.format_timestamp(clinic.time.time()), "Cough", "Tea", "Dr A", 20)
+    clinic.archive_old_records()
+    assert clinic.repo.reassign_doctor("visits", [old, recent], "Dr B") == 2
+    assert [v.doctor for v in clinic.repo.list_visits(pid)] == ["Dr A", "Dr B", "Dr B"]
+    assert clinic.repo.delete_visits([old, recent, 999]) == 2
+    assert [v.id for v in clinic.repo.list_visits(pid)] == [keep]
+    with pytest.raises(ValueError):
+        clinic.repo.reassign_doctor("users", [1], "Dr B")
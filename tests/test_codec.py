@@ -0,0 +1,34 @@
+import io
+
+from PIL import Image
+
+from conftest import add_patient
+
+
+def test_attachment_codec_round_trip(clinic):
+    text = b"Patient reports mild headache. " * 4000
+    packed, codec, size = clinic.encode_attachment(text, "notes.txt")
+    assert codec == "zlib" and size == len(text) and len(packed) < len(text) // 10
+    assert clinic.decode_attachment(packed, codec) == text
+    big = b"ECG lead II " * 100_000
+    packed, codec, _ = clinic.encode_attachment(big, "ecg.csv")
+    assert codec == "lzma" and clinic.decode_attachment(packed, codec) == big
+    out = io.BytesIO()
+    Image.new("RGB", (50, 50)).save(out, "JPEG")
+    jpeg = out.getvalue()
+    assert clinic.encode_attachment(jpeg, "x.jpg") == (jpeg, "raw", len(jpeg))
+
+
+def test_recompressor_converts_legacy_rows_losslessly(clinic):
+    pid = add_patient(clinic)
+    text = b"Discharge summary line\n" * 2000
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("INSERT INTO patient_files (patient_id, file_name, file_type, file_data) VALUES (?, ?, ?, ?)",
+                     (pid, "summary.txt", "document", text))
+    clinic.AttachmentRecompressor(pause=0).run()
+    codec, stored = conn.execute("SELECT codec, length(file_data) FROM patient_files").fetchone()
+    fid = conn.execute("SELECT id FROM patient_files").fetchone()[0]
+    assert codec == "zlib" and stored < len(text)
+    assert b"".join(clinic.iter_attachment(conn, fid)) == text
+    conn.close()
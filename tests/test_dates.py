@@ -0,0 +1,52 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import add_patient
+
+
+def ts(*parts):
+    return int(datetime(*parts).timestamp())
+
+
+def test_ambiguous_dates_are_day_first(clinic):
+    assert clinic.parse_timestamp("03/04/2024") == ts(2024, 4, 3)
+    assert clinic.parse_timestamp("03-04-2024 09:15") == ts(2024, 4, 3, 9, 15)
+    assert clinic.parse_timestamp("03.04.2024") == ts(2024, 4, 3)
+    # Year-first input is never swapped.
+    assert clinic.parse_timestamp("2024/03/04") == ts(2024, 3, 4)
+    assert clinic.parse_timestamp("  2024-03-04   10:30 ") == ts(2024, 3, 4, 10, 30)
+    with pytest.raises(ValueError):
+        clinic.parse_timestamp("04/13/2024")
+
+
+def test_years_outside_the_accepted_range_are_rejected(clinic):
+    assert clinic.parse_timestamp("1900-01-01 00:00") == ts(1900, 1, 1)
+    assert clinic.parse_timestamp("31/12/2100") == ts(2100, 12, 31)
+    for text in ("1899-12-31", "2101-01-01", "01/01/0024", "", None, "yesterday"):
+        with pytest.raises(ValueError):
+            clinic.parse_timestamp(text)
+
+
+def test_range_of_a_month_rolls_into_the_next_year(clinic):
+    assert clinic.timestamp_range("2024-12") == (ts(2024, 12, 1), ts(2025, 1, 1))
+    assert clinic.timestamp_range("12/2024") == (ts(2024, 12, 1), ts(2025, 1, 1))
+    assert clinic.timestamp_range("2024/11") == (ts(2024, 11, 1), ts(2024, 12, 1))
+    assert clinic.timestamp_range("2024") == (ts(2024, 1, 1), ts(2025, 1, 1))
+    assert clinic.timestamp_range("31/12/2024") == (ts(2024, 12, 31), ts(2025, 1, 1))
+    assert clinic.timestamp_range("2024-12-31 23:59") == (ts(2024, 12, 31, 23, 59), ts(2025, 1, 1))
+
+
+def test_date_filters_cover_the_whole_period(clinic):
+    pid = add_patient(clinic, "Alice")
+    for date in ("2024-11-30 23:59", "2024-12-01", "31/12/2024 23:59", "2025-01-01"):
+        clinic.repo.save_visit(pid, date, "Flu", "Rest", "Dr A", 100)
+
+    def dates(value):
+        query = clinic.TableQuery("test", clinic.VISIT_TABLE_COLUMNS, id_expr="v.id")
+        query.filters = {"date": value}
+        return sorted(v.date for v in clinic.repo.list_visits(pid, query))
+
+    assert dates("2024-12") == ["2024-12-01 00:00", "2024-12-31 23:59"]
+    assert dates(">2024-12") == ["2025-01-01 00:00"]
+    assert dates("<12/2024") == ["2024-11-30 23:59"]
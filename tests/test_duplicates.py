@@ -0,0 +1,50 @@
+from conftest import add_patient
+
+
+def name_keys(clinic):
+    conn = clinic.db_connect()
+    try:
+        return set(conn.execute("SELECT name_key, patient_id FROM patient_name_keys"))
+    finally:
+        conn.close()
+
+
+def test_name_keys_follow_deletes_and_merges(clinic):
+    keep = add_patient(clinic, "Mohamed Ali", "01001234567")
+    dup = add_patient(clinic, "Mohammed Aly", "01001234567")
+    other = add_patient(clinic, "Zainab Qureshi", "01119876543")
+    clinic.repo.merge_patients(keep, [dup])
+    clinic.repo.delete_patients([other])
+    assert name_keys(clinic) == {(k, keep) for k in clinic.name_keys("Mohamed Ali")}
+
+
+def test_similar_names_and_phones_are_found(clinic):
+    pid = add_patient(clinic, "Mohamed Ali Hassan", "0100 123 4567")
+    add_patient(clinic, "Sara Nabil", "0122 000 1111")
+    by_name = clinic.repo.find_duplicates("Mohamed Aly Hassan", "")
+    assert [r.id for r in by_name] == [pid] and "similar name" in by_name[0].reason
+    by_phone = clinic.repo.find_duplicates("Someone Else", "+20 100 123 4567")
+    assert by_phone[0].id == pid and by_phone[0].score == 1.0
+    assert clinic.repo.find_duplicates("Mohamed Ali Hassan", "", exclude_id=pid) == []
+
+
+def test_candidate_cap_keeps_the_best_scores(clinic, monkeypatch):
+    conn = clinic.db_connect()
+    with conn:
+        for i in range(30):
+            cur = conn.execute("INSERT INTO patients (name) VALUES (?)", (f"Ahmed Mahmoud Abdelrahman {i:02d}",))
+            clinic.index_patient_keys(conn, cur.lastrowid, f"Ahmed Mahmoud Abdelrahman {i:02d}", "")
+    conn.close()
+    exact = add_patient(clinic, "Ahmed Mahmoud Abdelrahman Youssef")
+    monkeypatch.setattr(clinic, "DUPLICATE_MAX_CANDIDATES", 5)
+    found = clinic.repo.find_duplicates("Ahmed Mahmoud Abdelrahman Youssef", "", limit=1)
+    assert [r.id for r in found] == [exact]
+
+
+def test_shorter_or_longer_registration_is_found(clinic):
+    full = add_patient(clinic, "Mohamed Ali Hassan Ibrahim")
+    short = add_patient(clinic, "Mona Said")
+    add_patient(clinic, "Ali Mohamed Hassan")
+    found = clinic.repo.find_duplicates("Mohammed Ali", "")
+    assert [r.id for r in found] == [full] and found[0].reason == "same leading names"
+    assert [r.id for r in clinic.repo.find_duplicates("Mona Saeed Kamal", "")] == [short]
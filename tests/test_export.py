@@ -0,0 +1,23 @@
+import gzip
+import json
+
+import clinic_export
+from conftest import add_patient
+
+
+def test_gzip_to_stdout_is_compressed(clinic, capsysbinary):
+    add_patient(clinic, "Alice")
+    add_patient(clinic, "Bob")
+    assert clinic_export.export_table("patients", "-", fmt="jsonl", compress=True, db_path=clinic.DB_PATH) == 2
+    rows = [json.loads(line) for line in gzip.decompress(capsysbinary.readouterr().out).splitlines()]
+    assert [r["name"] for r in rows] == ["Alice", "Bob"]
+
+
+def test_plain_stdout_and_gzip_file(clinic, capsys, tmp_path):
+    add_patient(clinic, "Alice")
+    clinic_export.export_table("patients", "-", columns=["id", "name"], db_path=clinic.DB_PATH)
+    assert capsys.readouterr().out.splitlines()[1].endswith(",Alice")
+    path = str(tmp_path / "patients.csv.gz")
+    assert clinic_export.export_table("patients", path, columns=["name"], db_path=clinic.DB_PATH) == 1
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert f.read().splitlines() == ["name", "Alice"]
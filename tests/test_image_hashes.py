@@ -0,0 +1,19 @@
+import random
+
+
+def test_hamming_index_matches_a_linear_scan(clinic):
+    rnd = random.Random(5)
+    base = [rnd.getrandbits(64) for _ in range(200)]
+    hashes = base + [h ^ (1 << rnd.randrange(64)) ^ (1 << rnd.randrange(64)) for h in base[:50]]
+    index = clinic.HammingIndex(clinic.NEAR_DUPLICATE_BITS)
+    for key, h in enumerate(hashes):
+        index.add(h, key)
+    for probe in hashes[:60] + [rnd.getrandbits(64) for _ in range(20)]:
+        expected = sorted((clinic.hamming(probe, h), k) for k, h in enumerate(hashes)
+                          if clinic.hamming(probe, h) <= clinic.NEAR_DUPLICATE_BITS)
+        assert sorted(index.search(probe)) == expected
+
+
+def test_distinct_images_keeps_the_first_of_each_group(clinic):
+    hashes = {1: (0, 0), 2: (0b111, 0b1), 3: (1 << 63 | (1 << 40) - 1, 5)}
+    assert clinic.distinct_images([1, 2, 3], hashes) == [1, 3]
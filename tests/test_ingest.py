@@ -0,0 +1,41 @@
+import io
+
+from PIL import Image
+
+
+def image_bytes(img, fmt, **params):
+    out = io.BytesIO()
+    img.save(out, fmt, **params)
+    return out.getvalue()
+
+
+def test_bmp_scan_becomes_lossless_png(clinic):
+    img = Image.new("RGB", (300, 200))
+    img.frombytes(bytes((x * y + x + 70 * c) % 256 for y in range(200) for x in range(300) for c in range(3)))
+    name, data = clinic.normalize_image(image_bytes(img, "BMP"), "xray.bmp")
+    assert name == "xray.png"
+    out = Image.open(io.BytesIO(data))
+    assert out.format == "PNG" and out.convert("RGB").tobytes() == img.tobytes()
+
+
+def test_gray_screenshot_is_stored_as_8_bit(clinic):
+    img = Image.new("RGB", (400, 400), (90, 90, 90))
+    name, data = clinic.normalize_image(image_bytes(img, "BMP"), "scan.bmp")
+    assert Image.open(io.BytesIO(data)).mode == "L"
+
+
+def test_photo_is_rotated_capped_and_reencoded(clinic):
+    img = Image.new("RGB", (3000, 2000), "red")
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotate 90 degrees on display
+    name, data = clinic.normalize_image(image_bytes(img, "JPEG", exif=exif), "portrait.jpeg", "photo")
+    out = Image.open(io.BytesIO(data))
+    assert name == "portrait.jpg" and out.format == "JPEG"
+    assert out.height == clinic.PHOTO_MAX_DIM and out.width in (682, 683)  # portrait after the EXIF turn
+    assert out.getexif().get(0x0112, 1) == 1
+
+
+def test_small_png_and_non_images_are_left_alone(clinic):
+    png = image_bytes(Image.new("RGB", (20, 20), "blue"), "PNG")
+    assert clinic.normalize_image(png, "small.png") == ("small.png", png)
+    assert clinic.normalize_image(b"not an image", "notes.png") == ("notes.png", b"not an image")
@@ -0,0 +1,78 @@
+import sqlite3
+
+
+def auto_vacuum(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_new_database_starts_incremental(clinic):
+    assert auto_vacuum(clinic.DB_PATH) == 2
+    assert not clinic.MAINTENANCE.vacuum_pending()
+
+
+def test_conversion_vacuum_waits_for_idle_maintenance(clinic, tmp_path, monkeypatch):
+    db = str(tmp_path / "old.db")
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE legacy (a)")  # auto_vacuum is fixed once a table exists
+    conn.close()
+    monkeypatch.setattr(clinic, "DB_PATH", db)
+    scheduler = clinic.MaintenanceScheduler(db)
+    clinic.initialize_database()
+    assert auto_vacuum(db) == 0 and scheduler.vacuum_pending()
+    done = scheduler.step()
+    assert done["vacuumed"] and auto_vacuum(db) == 2 and not scheduler.vacuum_pending()
+    assert not scheduler.step()["vacuumed"]
+
+
+class FakeRoot:
+    def __init__(self):
+        self.bindings = []
+
+    def bind_all(self, sequence, func, add=None):
+        self.bindings.append(sequence)
+
+    def after(self, ms, func):
+        return "job"
+
+    def after_cancel(self, job):
+        pass
+
+
+def test_restarting_does_not_stack_input_bindings(clinic):
+    root = FakeRoot()
+    scheduler = clinic.MaintenanceScheduler()
+    for _ in range(3):  # logout / login on the same Tk root
+        scheduler.start(root)
+        scheduler.stop()
+    assert sorted(root.bindings) == ["<Any-ButtonPress>", "<Any-KeyPress>"]
+
+
+class NoDbstat(sqlite3.Connection):
+    def execute(self, sql, *args):
+        if "dbstat" in sql:
+            raise sqlite3.OperationalError("no such table: dbstat")
+        return super().execute(sql, *args)
+
+
+def test_database_stats_without_dbstat(clinic, monkeypatch):
+    full = clinic.database_stats()
+    assert full["has_dbstat"] and any(o["name"] == "patients" for o in full["objects"])
+    connect = sqlite3.connect
+    monkeypatch.setattr(sqlite3, "connect", lambda *a, **kw: connect(*a, factory=NoDbstat, **kw))
+    totals = clinic.database_stats()
+    assert not totals["has_dbstat"] and totals["objects"] == []
+    assert totals["page_count"] == full["page_count"]
+
+
+def test_memory_map_only_on_read_only_workstations(clinic, monkeypatch):
+    conn = clinic.readonly_connect()
+    assert conn.execute("PRAGMA mmap_size").fetchone()[0] == 0
+    conn.close()
+    monkeypatch.setattr(clinic, "READ_ONLY", True)
+    conn = clinic.readonly_connect()
+    assert conn.execute("PRAGMA mmap_size").fetchone()[0] > 0
+    conn.close()
@@ -0,0 +1,29 @@
+def test_fresh_database_is_at_the_latest_version(clinic):
+    conn = clinic.db_connect()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(clinic.MIGRATIONS)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    conn.close()
+
+
+def test_legacy_database_is_upgraded_in_place(clinic, tmp_path, monkeypatch):
+    db = str(tmp_path / "legacy.db")
+    monkeypatch.setattr(clinic, "DB_PATH", db)
+    monkeypatch.setattr(clinic, "run_migrations", lambda conn: None)
+    clinic.initialize_database()  # the original four tables only
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("INSERT INTO patients (name, phone, last_visit) VALUES ('Alice', '0100 123', '2019-05-04')")
+        conn.execute("INSERT INTO visits (patient_id, date, diagnosis, price) VALUES (1, '2019-05-04', 'Flu', 10)")
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+    conn.close()
+
+    monkeypatch.undo()
+    monkeypatch.setattr(clinic, "DB_PATH", db)
+    clinic.initialize_database()
+    conn = clinic.db_connect()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(clinic.MIGRATIONS)
+    date_ts, uid = conn.execute("SELECT date_ts, uid FROM visits").fetchone()
+    assert date_ts == clinic.parse_timestamp("2019-05-04") and uid
+    assert conn.execute("SELECT last_visit_ts FROM patients").fetchone()[0] == date_ts
+    conn.close()
+    clinic.initialize_database()  # idempotent on an up-to-date database
@@ -0,0 +1,21 @@
+def test_passwords_are_stored_hashed(clinic):
+    clinic.repo.add_user("nurse", "s3cret", "User")
+    conn = clinic.db_connect()
+    stored = dict(conn.execute("SELECT username, password FROM users"))
+    conn.close()
+    assert all(clinic.is_password_hash(p) for p in stored.values())
+    assert clinic.repo.authenticate("nurse", "s3cret").username == "nurse"
+    assert clinic.repo.authenticate("nurse", stored["nurse"]) is None
+    assert clinic.repo.authenticate("abdo", "202300488") is not None
+
+
+def test_migration_hashes_existing_passwords(clinic):
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("INSERT INTO users (username, password, role) VALUES ('legacy', 'plain', 'User')")
+    clinic._migrate_hash_passwords(conn)
+    conn.commit()
+    stored = conn.execute("SELECT password FROM users WHERE username='legacy'").fetchone()[0]
+    conn.close()
+    assert clinic.is_password_hash(stored)
+    assert clinic.repo.authenticate("legacy", "plain") is not None
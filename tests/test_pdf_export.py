@@ -0,0 +1,77 @@
+import io
+import random
+
+from PIL import Image
+
+from conftest import add_patient
+
+
+def jpeg(seed, size=900):
+    rnd = random.Random(seed)
+    img = Image.frombytes("RGB", (size, size), rnd.randbytes(size * size * 3))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=95)
+    return out.getvalue()
+
+
+def export(clinic, tmp_path, pid, **kw):
+    path = clinic.save_patient_record_pdf(clinic.repo, pid, path=str(tmp_path / "record.pdf"), **kw)
+    with open(path, "rb") as f:
+        data = f.read()
+    return data, clinic.pdf_text(data)
+
+
+def test_record_lists_visits_in_the_period_with_a_summary(clinic, tmp_path):
+    pid = add_patient(clinic, "Alice Smith", address="12 Nile St", files=[("notes.txt", b"seen")])
+    clinic.repo.save_visit(pid, "2023-12-31 18:00", "Cold", "Tea", "Dr A", 40)
+    clinic.repo.save_visit(pid, "2024-03-01 10:00", "Flu", "Rest", "Dr A", 100)
+    clinic.repo.save_visit(pid, "2024-03-20 10:00", "Cough", "Syrup", "Dr B", 50.5)
+    start, end = clinic.timestamp_range("2024-03")
+    _, text = export(clinic, tmp_path, pid, start_ts=start, end_ts=end)
+    for expected in ("Alice Smith", "12 Nile St", "Flu", "Cough", "Syrup", "$150.50",
+                     "2024-03-01 to 2024-03-31", "notes.txt"):
+        assert expected in text
+    assert "Cold" not in text
+    _, text = export(clinic, tmp_path, pid, summary=False)
+    assert "Cold" in text and "Total billed" not in text
+
+
+def test_long_history_repeats_the_headings_on_every_page(clinic, tmp_path):
+    pid = add_patient(clinic, "Alice")
+    for i in range(150):
+        clinic.repo.save_visit(pid, f"2024-01-01 {i // 60:02d}:{i % 60:02d}", f"Diagnosis {i}", "Rest", "Dr A", i)
+    clinic.repo.save_visit(pid, "2024-02-01", "A" * 300, "Rest", "Dr A", 1)  # cut to one line, not wrapped
+    data, text = export(clinic, tmp_path, pid, summary=False)
+    pages = data.count(b"/Type /Page\n")
+    assert pages >= 3
+    assert text.count("Prescription") == pages
+    assert all(f"Diagnosis {i}" in text for i in range(150)) and "A" * 300 not in text
+
+
+def test_images_print_as_one_thumbnail_each(clinic, tmp_path):
+    photo = jpeg(1)
+    pid = add_patient(clinic, "Alice", files=[("scan.jpg", photo), ("scan copy.jpg", photo), ("xray.jpg", jpeg(2))])
+    data, text = export(clinic, tmp_path, pid)
+    assert "scan.jpg" in text and "scan copy.jpg" in text and "xray.jpg" in text
+    assert data.count(b"/Subtype /Image") == 2
+    assert len(data) < len(photo) / 4
+    data, _ = export(clinic, tmp_path, pid, thumbnails=False)
+    assert b"/Subtype /Image" not in data
+
+
+def test_template_is_built_once_per_logo(clinic, tmp_path, monkeypatch):
+    logo = tmp_path / "logo.png"
+    Image.new("RGB", (400, 200), "navy").save(logo)
+    monkeypatch.setattr(clinic, "LOGO_PATH", str(logo))
+    clinic.pdf_template.cache_clear()
+    first = clinic.current_pdf_template()
+    assert clinic.current_pdf_template() is first and first.logo
+    assert Image.open(io.BytesIO(first.logo)).size == (160, 80)
+
+
+def test_unprintable_text_and_missing_patients(clinic, tmp_path):
+    pid = add_patient(clinic, "Ahmed أحمد")
+    clinic.repo.save_visit(pid, "2024-03-01", "Grippe – fièvre", "Rest", "Dr A", 100)
+    _, text = export(clinic, tmp_path, pid)
+    assert "Ahmed ????" in text and "Grippe ? fièvre" in text
+    assert clinic.save_patient_record_pdf(clinic.repo, pid + 1, path=str(tmp_path / "none.pdf")) is None
@@ -0,0 +1,104 @@
+import threading
+
+from conftest import add_patient
+
+
+class FakeTree:
+    def __init__(self, pids):
+        self.rows = [f"I{pid}" for pid in pids]
+        self.values = {f"I{pid}": (pid, f"Patient {pid}") for pid in pids}
+        self.selected = ()
+        self.handlers = {}
+        self.jobs = {}
+        self.next_job = 0
+        self.cancelled = []
+
+    def bind(self, sequence, fn, add=None):
+        self.handlers.setdefault(sequence, []).append(fn)
+
+    def fire(self, sequence):
+        for fn in self.handlers.get(sequence, []):
+            fn(None)
+
+    def after(self, ms, fn):
+        self.next_job += 1
+        self.jobs[self.next_job] = fn
+        return self.next_job
+
+    def after_cancel(self, job):
+        self.cancelled.append(job)
+        self.jobs.pop(job, None)
+
+    def run_jobs(self):
+        jobs, self.jobs = self.jobs, {}
+        for fn in jobs.values():
+            fn()
+
+    def select(self, pid):
+        self.selected = (f"I{pid}",)
+        self.fire("<<TreeviewSelect>>")
+
+    def selection(self):
+        return self.selected
+
+    def get_children(self):
+        return self.rows
+
+    def index(self, item):
+        return self.rows.index(item)
+
+    def item(self, item, option):
+        return self.values[item]
+
+
+def drain(clinic):
+    clinic.prefetch_pool().submit(lambda: None).result(timeout=10)
+
+
+def test_selection_warms_the_row_and_its_neighbours(clinic, monkeypatch):
+    pids = [add_patient(clinic, f"P{i}", f"0{i}") for i in range(10)]
+    warmed = []
+    details = clinic.repo.patient_details
+    monkeypatch.setattr(clinic.repo, "patient_details", lambda pid: warmed.append(pid) or details(pid))
+    tree = FakeTree(pids)
+    prefetcher = clinic.PatientPrefetcher(tree, neighbours=2)
+    for pid in pids[3:6]:  # arrowing down: only the settled selection is worked on
+        tree.select(pid)
+    assert tree.cancelled == [1, 2]
+    tree.run_jobs()
+    drain(clinic)
+    assert warmed == [pids[5], pids[6], pids[4], pids[7], pids[3]]
+    assert prefetcher.prefetched == 5
+    tree.select(pids[0])
+    tree.run_jobs()
+    drain(clinic)
+    assert warmed[5:] == [pids[0], pids[1], pids[2]]
+
+
+def test_views_share_one_prefetch_thread(clinic):
+    pids = [add_patient(clinic, f"P{i}", f"0{i}") for i in range(3)]
+    trees = [FakeTree(pids) for _ in range(6)]
+    for tree in trees:  # a view per login, each with its own prefetcher
+        clinic.PatientPrefetcher(tree)
+        tree.select(pids[1])
+        tree.run_jobs()
+    drain(clinic)
+    assert len([t for t in threading.enumerate() if t.name.startswith("prefetch")]) == 1
+
+
+def test_destroyed_view_stops_prefetching(clinic, monkeypatch):
+    pids = [add_patient(clinic, f"P{i}", f"0{i}") for i in range(5)]
+    tree = FakeTree(pids)
+    prefetcher = clinic.PatientPrefetcher(tree)
+    tree.select(pids[2])
+    tree.fire("<Destroy>")
+    assert tree.cancelled == [1] and tree.jobs == {}
+
+    release = threading.Event()
+    clinic.prefetch_pool().submit(release.wait, 10)  # hold the worker while the next batch queues
+    tree.select(pids[2])
+    tree.run_jobs()
+    tree.fire("<Destroy>")
+    release.set()
+    drain(clinic)
+    assert prefetcher.prefetched == 0
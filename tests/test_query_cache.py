@@ -0,0 +1,49 @@
+from conftest import add_patient
+
+
+def test_cached_rows_are_not_shared_with_callers(clinic):
+    add_patient(clinic, "Alice")
+    first = clinic.repo.patient_names()
+    first.append("garbage")
+    first.sort(key=str, reverse=True)
+    second = clinic.repo.patient_names()
+    assert [p.name for p in second] == ["Alice"]
+    assert second is not clinic.repo.patient_names()
+    assert clinic.repo.cache.hits >= 2
+
+
+def test_write_invalidates_its_tables(clinic):
+    add_patient(clinic, "Alice")
+    assert clinic.repo.count_patients() == 1
+    add_patient(clinic, "Bob")
+    assert clinic.repo.count_patients() == 2
+
+
+def test_put_after_concurrent_invalidate_is_dropped(clinic):
+    cache = clinic.QueryCache()
+    epoch = cache.epoch
+    cache.invalidate("patients")  # a writer commits while the reader is still fetching
+    cache.put("k", ("stale",), ("patients",), epoch)
+    assert cache.get("k") is None
+    cache.put("k", ("fresh",), ("patients",), cache.epoch)
+    assert cache.get("k") == ("fresh",)
+
+
+def test_external_commit_drops_everything(clinic):
+    add_patient(clinic, "Alice")
+    assert clinic.repo.count_patients() == 1
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("INSERT INTO patients (name) VALUES ('From another PC')")
+    conn.close()
+    assert clinic.repo.count_patients() == 2
+    assert clinic.repo.cache.external_changes == 1
+
+
+def test_entries_are_bounded_by_size(clinic):
+    cache = clinic.QueryCache(max_bytes=2000)
+    for i in range(50):
+        cache.put(i, tuple(range(20)), ("t",))
+    assert cache.size <= 2000
+    assert cache.evictions > 0
+    assert cache.get(49) is not None and cache.get(0) is None
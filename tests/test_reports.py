@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from conftest import add_patient
+
+
+def patient_fields(**changes):
+    fields = {"name": "Alice", "age": 40, "gender": "Female", "phone": "0100", "address": "", "occupation": "",
+              "diagnosis": "", "prescription": "", "doctor": "Dr A"}
+    fields.update(changes)
+    return fields
+
+
+def test_periods_roll_over_the_year(clinic):
+    december = clinic.parse_report_period("2024-12")
+    assert (december.start_ts, december.end_ts) == clinic.timestamp_range("2024-12")
+    q4 = clinic.parse_report_period("2024-q4")
+    assert q4.key == "2024-Q4" and q4.end_ts == clinic.timestamp_range("2025")[0]
+    for text in ("2024-13", "2024-Q5", "March"):
+        with pytest.raises(ValueError):
+            clinic.parse_report_period(text)
+
+
+def test_unchanged_period_is_served_from_the_cache(clinic):
+    pid = add_patient(clinic, "Alice")
+    clinic.repo.save_visit(pid, "2024-03-01", "Flu", "Rest", "Dr A", 100)
+    period = clinic.parse_report_period("2024-03")
+    path, data, cached = clinic.generate_report(period)
+    assert not cached and (data.visits, data.revenue, data.ages) == (1, 100, [("35-49", 1)])
+    assert clinic.generate_report(period)[:3:2] == (path, True)
+    clinic.repo.update_patient(pid, patient_fields(phone="0999"))  # not shown in the report
+    assert clinic.generate_report(period)[2]
+
+    clinic.repo.update_patient(pid, patient_fields(age=70))
+    new_path, data, cached = clinic.generate_report(period)
+    assert not cached and new_path != path and data.ages == [("65+", 1)]
+    assert not os.path.exists(path)  # superseded
+    clinic.repo.save_visit(pid, "2024-04-01", "Flu", "Rest", "Dr A", 100)  # another period
+    assert clinic.generate_report(period)[2]
+
+
+def test_edits_to_hot_visits_change_the_report(clinic):
+    pid = add_patient(clinic, "Alice")
+    vid = clinic.repo.save_visit(pid, "2024-03-01", "Flu", "Rest", "Dr A", 100)
+    period = clinic.parse_report_period("2024-Q1")
+    clinic.generate_report(period)
+    clinic.repo.save_visit(pid, "2024-03-01", "Flu", "Rest", "Dr A", 999, visit_id=vid)
+    _, data, cached = clinic.generate_report(period)
+    assert not cached and data.revenue == 999
+    clinic.repo.delete_visit(vid)
+    _, data, cached = clinic.generate_report(period)
+    assert not cached and data.visits == 0
+
+
+def test_edits_to_archived_visits_change_the_report(clinic):
+    pid = add_patient(clinic, "Alice")
+    vid = clinic.repo.save_visit(pid, "2015-03-01", "Flu", "Rest", "Dr A", 100)
+    assert clinic.archive_old_records()["visits"] == 1
+    period = clinic.parse_report_period("2015-03")
+    _, data, cached = clinic.generate_report(period)
+    assert not cached and data.revenue == 100
+    assert clinic.generate_report(period)[2]
+
+    clinic.repo.save_visit(pid, "2015-03-01", "Flu", "Rest", "Dr A", 999, visit_id=vid)
+    _, data, cached = clinic.generate_report(period)
+    assert not cached and data.revenue == 999
+    clinic.repo.reassign_doctor("visits", [vid], "Dr B")
+    _, data, cached = clinic.generate_report(period)
+    assert not cached and data.doctors == [("Dr B", 1, 999)]
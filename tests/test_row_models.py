@@ -0,0 +1,46 @@
+import tracemalloc
+
+from conftest import add_patient
+
+
+def test_rows_are_named_tuples_with_blank_nulls(clinic):
+    pid = add_patient(clinic, "Alice", occupation=None)
+    row = clinic.repo.list_patients()[0]
+    assert isinstance(row, clinic.PatientListRow) and isinstance(row, tuple)
+    assert row._fields == ("id", "name", "age", "gender", "phone", "occupation", "doctor", "last_visit")
+    assert row.id == row[0] == pid and row.name == "Alice" and row.occupation == ""
+    assert clinic.repo.get_patient(pid).name == "Alice"
+
+
+def test_repeated_values_share_one_string(clinic):
+    for i in range(3):
+        pid = add_patient(clinic, f"P{i}", doctor="Dr Hassan", gender="Female")
+        clinic.repo.save_visit(pid, "2024-03-01", "Flu", "Rest", "Dr Hassan", 100)
+    rows = clinic.repo.list_patients()
+    assert rows[0].doctor is rows[1].doctor is rows[2].doctor
+    assert rows[0].gender is rows[2].gender
+    assert rows[0].name is not rows[1].name
+    visits = clinic.repo.list_visits()
+    assert visits[0].diagnosis is visits[1].diagnosis and visits[0].price is visits[2].price
+
+
+def test_loaded_rows_take_less_memory_than_lists(clinic, monkeypatch):
+    monkeypatch.setattr(clinic.repo, "cache", None)
+    conn = clinic.db_connect()
+    with conn:
+        conn.executemany("INSERT INTO patients (name, age, gender, phone, occupation, doctor, last_visit) "
+                         "VALUES (?, 40, 'Female', ?, 'Teacher', 'Dr A', '2024-01-02 10:30')",
+                         [(f"Patient {i}", f"0100{i:07d}") for i in range(2000)])
+
+    def retained(load):
+        tracemalloc.start()
+        rows = load()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        assert len(rows) == 2000
+        return size
+
+    legacy = retained(lambda: [list(r) for r in conn.execute(
+        "SELECT id, name, age, gender, phone, occupation, doctor, last_visit FROM patients")])
+    conn.close()
+    assert retained(clinic.repo.list_patients) < legacy * 0.75
@@ -0,0 +1,67 @@
+import json
+import os
+import time
+
+from conftest import add_patient
+
+
+def drain(clinic, scanner, folder, rounds=50):
+    """Poll the way ScannerService.run() does until the drop folder is empty and nothing is in flight."""
+    pool = clinic.ingest_pool()
+    for _ in range(rounds):
+        scanner.poll(folder, pool)
+        pending = [e for e in os.scandir(folder) if e.is_file()]
+        if not pending and not scanner._futures and not scanner._batch:
+            return
+        time.sleep(0.02)
+    raise AssertionError(f"scanner did not settle: {[e.name for e in pending]}")
+
+
+def drop(folder, name, data=b"scan text"):
+    with open(os.path.join(folder, name), "wb") as f:
+        f.write(data)
+
+
+def scanner_in(clinic, tmp_path):
+    folder = str(tmp_path / "scans")
+    for sub in ("",) + clinic.SCAN_FOLDERS:
+        os.makedirs(os.path.join(folder, sub), exist_ok=True)
+    return clinic.ScannerService(folder), folder
+
+
+def test_only_an_explicit_prefix_names_the_patient(clinic, tmp_path):
+    pid = add_patient(clinic, "Alice")
+    scanner, folder = scanner_in(clinic, tmp_path)
+    drop(folder, f"P{pid}_chest.txt")
+    drop(folder, f"{pid}_2024-report.txt", b"other")
+    drop(folder, f"{pid}.txt", b"third")
+    drain(clinic, scanner, folder)
+    assert [f.file_name for f in clinic.repo.patient_files(pid)] == [f"P{pid}_chest.txt"]
+    assert sorted(os.listdir(os.path.join(folder, "unmatched"))) == sorted([f"{pid}_2024-report.txt", f"{pid}.txt"])
+
+
+def test_late_sidecar_brings_the_file_back(clinic, tmp_path):
+    pid = add_patient(clinic, "Alice")
+    scanner, folder = scanner_in(clinic, tmp_path)
+    drop(folder, "xray_0042.txt")
+    drain(clinic, scanner, folder)
+    assert os.listdir(os.path.join(folder, "unmatched")) == ["xray_0042.txt"]
+
+    drop(folder, "xray_0042.txt.json", json.dumps({"patient_id": pid}).encode())
+    drain(clinic, scanner, folder)
+    assert [f.file_name for f in clinic.repo.patient_files(pid)] == ["xray_0042.txt"]
+    assert os.listdir(os.path.join(folder, "unmatched")) == []
+    assert sorted(os.listdir(os.path.join(folder, "processed"))) == ["xray_0042.txt", "xray_0042.txt.json"]
+    assert scanner.counts["unmatched"] == 0 and scanner.counts["ingested"] == 1
+
+
+def test_scans_run_on_the_ingest_threads(clinic, tmp_path, monkeypatch):
+    pid = add_patient(clinic, "Alice")
+    scanner, folder = scanner_in(clinic, tmp_path)
+    seen = []
+    process_scan = clinic.process_scan
+    monkeypatch.setattr(clinic, "process_scan", lambda path: seen.append(clinic.threading.current_thread().name)
+                        or process_scan(path))
+    drop(folder, f"P{pid}_a.txt")
+    drain(clinic, scanner, folder)
+    assert seen and all(name.startswith("ingest") for name in seen)
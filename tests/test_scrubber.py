@@ -0,0 +1,58 @@
+import os
+
+from conftest import add_patient
+
+
+def scrub(clinic):
+    scrubber = clinic.IntegrityScrubber(pause_sec=0)
+    scrubber.paced = False
+    scrubber.scrub_pass(restart=True)
+    return scrubber
+
+
+def test_clean_database_has_no_findings(clinic):
+    add_patient(clinic, "Alice")
+    scrub(clinic)
+    assert clinic.repo.integrity_findings() == []
+
+
+def test_orphaned_visit_is_reattached_to_a_recovered_patient(clinic):
+    conn = clinic.db_connect()
+    conn.execute("PRAGMA foreign_keys = OFF")
+    with conn:
+        conn.execute("INSERT INTO visits (patient_id, date, diagnosis) VALUES (42, '2024-01-01', 'Flu')")
+    conn.close()
+    scrubber = scrub(clinic)
+    assert [(f.kind, f.tbl) for f in clinic.repo.integrity_findings()] == [("orphan", "visits")]
+    scrubber.fix_all()
+    assert clinic.repo.integrity_findings() == []
+    assert clinic.repo.get_patient(42).name == "Recovered patient #42"
+
+
+def test_undecodable_photo_is_quarantined(clinic):
+    pid = add_patient(clinic, "Alice")
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("UPDATE patients SET image=? WHERE id=?", (b"\xff\xd8 broken", pid))
+    conn.close()
+    scrubber = scrub(clinic)
+    finding, = clinic.repo.integrity_findings()
+    assert finding.kind == "photo"
+    assert "Removed the photo" in scrubber.fix(finding.id)
+    assert clinic.repo.get_patient(pid).image is None
+    assert len(os.listdir(clinic.QUARANTINE_DIR)) == 1
+
+
+def test_corrupt_attachment_is_restored_from_a_backup(clinic):
+    pid = add_patient(clinic, "Alice", files=[("notes.txt", b"Blood pressure 120/80\n" * 500)])
+    clinic.BACKUPS.snapshot(force=True)
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("UPDATE patient_files SET file_data = substr(file_data, 1, 40)")
+    conn.close()
+    scrubber = scrub(clinic)
+    finding, = clinic.repo.integrity_findings()
+    assert finding.kind == "corrupt"
+    assert scrubber.fix(finding.id).startswith("Restored notes.txt")
+    fid = clinic.repo.list_attachments(pid)[0].id
+    assert b"".join(clinic.repo.iter_attachment(fid)) == b"Blood pressure 120/80\n" * 500
@@ -0,0 +1,198 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from conftest import add_patient
+
+
+def photo_bytes(color="red"):
+    out = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(out, "PNG")
+    return out.getvalue()
+
+
+@pytest.fixture
+def nodes(clinic, tmp_path, monkeypatch):
+    """Two workstations: the fixture's database ("a") and a second one ("b"), sharing one sync folder."""
+    paths = {"a": clinic.DB_PATH, "b": str(tmp_path / "b" / "clinic.db")}
+    os.makedirs(os.path.dirname(paths["b"]))
+
+    def use(name):
+        monkeypatch.setattr(clinic, "DB_PATH", paths[name])
+        clinic.repo.cache.clear()
+        return clinic
+
+    use("b")
+    clinic.initialize_database()
+    use("a")
+    use.shared = str(tmp_path / "shared")
+    use.sync = lambda name, key="secret": use(name) and clinic.SyncEngine(use.shared, key).sync_once()
+    return use
+
+
+def shared_files(nodes):
+    for folder, _, names in os.walk(nodes.shared):
+        for name in names:
+            yield os.path.join(folder, name)
+
+
+def test_changes_reach_the_peer_and_are_not_echoed(nodes):
+    clinic = nodes("a")
+    pid = clinic.repo.add_patient({"name": "Alice", "age": 40, "gender": "Female", "phone": "0100", "address": "",
+                                   "occupation": "", "diagnosis": "", "prescription": "", "doctor": "Dr A"},
+                                  image=photo_bytes())
+    clinic.repo.add_user("nurse", "s3cret", "User")
+    assert nodes.sync("a")["published"] > 0
+    assert nodes.sync("b")["applied"] > 0
+
+    clinic = nodes("b")
+    alice = [p for p in clinic.repo.patient_names() if p.name == "Alice"]
+    assert len(alice) == 1
+    conn = clinic.db_connect()
+    image = conn.execute("SELECT image FROM patients WHERE name='Alice'").fetchone()[0]
+    conn.close()
+    assert bytes(image) == photo_bytes()
+    assert clinic.repo.authenticate("nurse", "s3cret") is not None
+
+    # What b applied is not published back; b's own first publish carried only its own rows.
+    assert nodes.sync("b")["published"] == 0
+    nodes.sync("a")
+    assert nodes.sync("a")["published"] == 0
+    assert pid == [p.id for p in nodes("a").repo.patient_names() if p.name == "Alice"][0]
+
+
+def test_shared_folder_holds_no_plaintext(nodes):
+    clinic = nodes("a")
+    clinic.repo.add_patient({"name": "Zenobia Quarantino", "age": 40, "gender": "Female", "phone": "0100",
+                             "address": "", "occupation": "", "diagnosis": "", "prescription": "", "doctor": "Dr A"},
+                            image=photo_bytes("blue"))
+    add_patient(clinic, "Bob", files=[("notes.txt", b"Zenobia has a rare allergy")])
+    clinic.repo.add_user("nurse", "s3cret", "User")
+    nodes.sync("a")
+    files = list(shared_files(nodes))
+    assert any("photo-" in f for f in files) and any(f.endswith(".blob") for f in files)
+    for path in files:
+        with open(path, "rb") as f:
+            data = f.read()
+        if os.path.basename(path) == clinic.SYNC_SALT_FILE:
+            assert len(data) == 16
+            continue
+        assert data.startswith(clinic.SYNC_FILE_MAGIC)
+        for secret in (b"Zenobia", b"s3cret", b"202300488", b"\x89PNG"):
+            assert secret not in data, (path, secret)
+
+    with pytest.raises(ValueError):
+        nodes.sync("b", key="wrong")
+    nodes.sync("b")
+    assert nodes("b").repo.count_patients() == 2
+
+
+def test_publishing_needs_a_passphrase(nodes):
+    with pytest.raises(ValueError):
+        nodes.sync("a", key=None)
+
+
+def test_sealed_files_use_a_fresh_nonce_and_the_folder_salt(clinic, tmp_path):
+    salt = clinic.sync_folder_salt(str(tmp_path))
+    assert clinic.sync_folder_salt(str(tmp_path)) == salt
+    other = tmp_path / "other"
+    other.mkdir()
+    assert clinic.sync_folder_salt(str(other)) != salt
+    key = clinic.derive_sync_key("secret", salt)
+    one, two = clinic.sync_seal(b"same text", key), clinic.sync_seal(b"same text", key)
+    assert one != two and clinic.sync_open(one, key) == clinic.sync_open(two, key) == b"same text"
+    altered = one[:-1] + bytes([one[-1] ^ 1])
+    for bad_key, sealed in ((key, altered), (clinic.derive_sync_key("secret", os.urandom(16)), one)):
+        with pytest.raises(ValueError):
+            clinic.sync_open(sealed, bad_key)
+
+
+def test_passphrase_is_never_stored(nodes):
+    clinic = nodes("a")
+    clinic.repo.set_setting("sync.key", "left by an older version")
+    conn = clinic.db_connect()
+    clinic._migrate_sync_aead(conn)
+    conn.commit()
+    conn.close()
+    nodes.sync("a")
+    assert clinic.repo.get_setting("sync.key") is None
+    assert clinic.SyncEngine(nodes.shared).key() is None
+
+
+def test_applied_delete_leaves_a_tombstone_not_a_change(nodes):
+    clinic = nodes("a")
+    pid = add_patient(clinic, "Alice")
+    nodes.sync("a")
+    nodes.sync("b")
+    nodes("a").repo.delete_patients([pid])
+    nodes.sync("a")
+    nodes.sync("b")
+
+    clinic = nodes("b")
+    assert clinic.repo.count_patients() == 0
+    conn = clinic.db_connect()
+    assert conn.execute("SELECT COUNT(*) FROM change_log WHERE op='D'").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM sync_tombstones WHERE tbl='patients'").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM patient_name_keys").fetchone()[0] == 0
+    conn.close()
+
+
+def test_synced_bookings_reach_the_appointment_index(nodes):
+    clinic = nodes("a")
+    pid = add_patient(clinic, "Alice")
+    start = 1_900_000_000
+    clinic.repo.book_appointment(pid, "Dr A", start, 30)
+    nodes("b")
+    assert clinic.APPOINTMENTS.conflicts("Dr A", start, start + 60) == []
+    nodes.sync("a")
+    nodes.sync("b")
+    assert len(clinic.APPOINTMENTS.conflicts("Dr A", start, start + 60)) == 1
+
+
+def test_synced_file_survives_recompression_and_scrubbing(nodes):
+    text = b"Blood pressure 120/80\n" * 500
+    clinic = nodes("a")
+    add_patient(clinic, "Alice", files=[("notes.txt", text)])
+    nodes.sync("a")
+
+    clinic = nodes("b")
+    engine = clinic.SyncEngine(nodes.shared, "secret")
+    engine._unlock(nodes.shared)
+    conn = clinic.db_connect()
+    engine.pull(conn, engine._state(conn, "sync.node_id"), nodes.shared)
+    # The row has arrived without its bytes; the recompressor runs before the blob is fetched.
+    clinic.AttachmentRecompressor(pause=0).run()
+    assert conn.execute("SELECT codec, file_data FROM patient_files").fetchone() == (None, None)
+    assert engine.fetch_blobs(conn, nodes.shared) == 1
+    assert conn.execute("SELECT codec, orig_size FROM patient_files").fetchone() == ("zlib", len(text))
+    conn.close()
+
+    scrubber = clinic.IntegrityScrubber(pause_sec=0)
+    scrubber.paced = False
+    scrubber.scrub_pass(restart=True)
+    assert clinic.repo.integrity_findings() == []
+    fid = clinic.repo.list_attachments(clinic.repo.patient_names()[0].id)[0].id
+    assert b"".join(clinic.repo.iter_attachment(fid)) == text
+
+
+def test_deleting_a_corrupt_local_copy_is_not_synced(nodes):
+    clinic = nodes("a")
+    add_patient(clinic, "Alice", files=[("notes.txt", b"Blood pressure 120/80\n" * 500)])
+    nodes.sync("a")
+    nodes.sync("b")
+
+    clinic = nodes("b")
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("UPDATE patient_files SET file_data = substr(file_data, 1, 40)")
+    conn.close()
+    scrubber = clinic.IntegrityScrubber(pause_sec=0)
+    scrubber.paced = False
+    scrubber.scrub_pass(restart=True)
+    finding, = clinic.repo.integrity_findings()
+    assert scrubber.fix(finding.id).startswith("Deleted notes.txt")
+    nodes.sync("b")
+    nodes.sync("a")
+    assert len(nodes("a").repo.list_attachments(nodes("a").repo.patient_names()[0].id)) == 1
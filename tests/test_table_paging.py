@@ -0,0 +1,109 @@
+import os
+import random
+
+from conftest import add_patient
+
+
+def walk(clinic, query, **kw):
+    """Every page of list_patients, following Next until it runs out, then back with Prev."""
+    pages = [clinic.repo.list_patients(query, **kw)[:query.page_size]]
+    while query.next_page():
+        pages.append(clinic.repo.list_patients(query, **kw)[:query.page_size])
+    back = []
+    while query.prev_page():
+        back.append(clinic.repo.list_patients(query, **kw)[:query.page_size])
+    assert back == pages[-2::-1]
+    return pages
+
+
+def seed(clinic, n=53):
+    rnd = random.Random(3)
+    conn = clinic.db_connect()
+    with conn:
+        conn.executemany("INSERT INTO patients (name, age, phone, doctor) VALUES (?, ?, ?, ?)",
+                         [(rnd.choice(["alice", "Bob", "carol"]), rnd.choice([30, 40, None]),
+                           rnd.choice(["0100", "0200", None]), "Dr A") for _ in range(n)])
+    conn.close()
+
+
+def test_keyset_pages_match_a_full_sort(clinic):
+    seed(clinic)
+    for column, desc in (("name", False), ("name", True), ("age", False), ("age", True), ("phone", False),
+                         ("phone", True), ("id", True)):
+        query = clinic.TableQuery("test", clinic.PATIENT_TABLE_COLUMNS, page_size=7)
+        query.sort, query.desc = column, desc
+        pages = walk(clinic, query)
+        assert all(len(p) == 7 for p in pages[:-1]) and len(pages) == 8
+        expected = clinic.repo.list_patients()
+        # IFNULL(x, '') in the rows: '' is NULL, which sorts first.
+        key = {"name": lambda r: (r.name.lower(), r.id), "age": lambda r: (r.age != "", r.age or 0, r.id),
+               "phone": lambda r: (r.phone, r.id), "id": lambda r: r.id}[column]
+        assert [r.id for p in pages for r in p] == [r.id for r in sorted(expected, key=key, reverse=desc)]
+
+
+def test_paging_combines_with_filters_and_resets(clinic):
+    seed(clinic)
+    query = clinic.TableQuery("test", clinic.PATIENT_TABLE_COLUMNS, page_size=5)
+    query.set_filter("name", "b")
+    rows = [r for p in walk(clinic, query) for r in p]
+    assert rows and {r.name for r in rows} == {"Bob"}
+    query.next_page()
+    query.toggle_sort("age")
+    assert query.page == 0 and query.start is None
+
+
+def test_deleted_boundary_row_does_not_break_the_next_page(clinic):
+    ids = [add_patient(clinic, f"P{i:02d}") for i in range(10)]
+    query = clinic.TableQuery("test", clinic.PATIENT_TABLE_COLUMNS, page_size=4)
+    query.sort, query.desc = "name", False
+    clinic.repo.list_patients(query)
+    clinic.repo.delete_patients([ids[3]])  # the last row of page one
+    query.next_page()
+    assert [r.name for r in clinic.repo.list_patients(query)] == ["P04", "P05", "P06", "P07", "P08"]
+
+
+def test_attachment_pages(clinic):
+    pid = add_patient(clinic, files=[(f"f{i}.txt", b"x" * i) for i in range(7)])
+    conn = clinic.db_connect()
+    with conn:
+        conn.execute("UPDATE patient_files SET upload_ts = CASE WHEN id % 3 = 0 THEN NULL ELSE 1000 + id % 2 END")
+    conn.close()
+    clinic.repo.cache.clear()
+    everything = clinic.repo.attachment_rows(pid)
+    seen, after = [], None
+    while True:
+        page = clinic.repo.list_attachments(pid, after, page_size=3)
+        if not page:
+            break
+        seen += page
+        after = (page[-1].sort_ts, page[-1].id)
+    assert [r.id for r in seen] == [r.id for r in everything] and len(seen) == 7
+
+
+def test_visit_pages_sort_by_the_joined_patient_name(clinic):
+    for name in ("Zed", "Amy", "Max"):
+        pid = add_patient(clinic, name)
+        for day in (1, 2):
+            clinic.repo.save_visit(pid, f"2024-01-0{day}", "Check-up", "", "Dr A", 10)
+    query = clinic.TableQuery("test", clinic.VISIT_TABLE_COLUMNS, id_expr="v.id", page_size=4)
+    query.sort, query.desc = "patient", False
+    first = clinic.repo.list_visits(query=query)
+    assert query.next_page()
+    second = clinic.repo.list_visits(query=query)
+    assert [r.patient for r in first[:4] + second] == ["Amy", "Amy", "Max", "Max", "Zed", "Zed"]
+
+
+def test_opened_attachments_go_to_a_private_session_folder(clinic, monkeypatch):
+    monkeypatch.setattr(clinic, "ATTACHMENT_OPEN_DIR", None)
+    folder = clinic.attachment_open_dir()
+    assert clinic.attachment_open_dir() == folder
+    assert os.path.basename(folder) != "clinic_attachments"
+    if os.name == "posix":
+        assert os.stat(folder).st_mode & 0o077 == 0
+    pid = add_patient(clinic, "Alice", files=[("notes.txt", b"private")])
+    f = clinic.repo.list_attachments(pid)[0]
+    clinic.repo.export_attachment(f.id, os.path.join(folder, f"{f.id}_notes.txt"))
+    clinic.remove_attachment_open_dir()
+    assert not os.path.exists(folder)
+    assert clinic.attachment_open_dir() != folder
+    clinic.remove_attachment_open_dir()
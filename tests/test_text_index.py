@@ -0,0 +1,65 @@
+import io
+import zipfile
+import zlib
+
+from fpdf import FPDF
+
+from conftest import add_patient
+
+
+def pdf_bytes(text):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Helvetica", size=12)
+    pdf.cell(0, 10, text)
+    return bytes(pdf.output())
+
+
+def docx_bytes(xml):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("word/document.xml", xml)
+    return out.getvalue()
+
+
+def test_pdf_and_docx_text(clinic):
+    assert "Hemoglobin 13.5" in clinic.extract_text("lab.pdf", pdf_bytes("Hemoglobin 13.5 g/dL"))
+    xml = '<w:document><w:body><w:p><w:r><w:t>Chest clear</w:t></w:r></w:p></w:body></w:document>'
+    assert clinic.extract_text("letter.docx", docx_bytes(xml)).strip() == "Chest clear"
+
+
+def test_pdf_cells_that_look_like_numbers_or_names(clinic):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Helvetica", size=12)
+    for text in ("Hemoglobin", "13.5", "-2", "/ref", "[high]"):
+        pdf.cell(30, 10, text)
+    text = clinic.extract_text("lab.pdf", bytes(pdf.output()))
+    assert text.split() == ["Hemoglobin", "13.5", "-2", "/ref", "[high]"]
+
+
+def test_decompression_is_capped(clinic):
+    bomb = zlib.compress(b" " * (64 * 1024 * 1024), 9)
+    pdf = (b"%%PDF-1.4\n1 0 obj\n<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(bomb)
+           + bomb + b"\nendstream\nendobj\n%EOF\n")
+    objects = clinic._pdf_objects(pdf)
+    assert len(objects[1][1]) <= clinic.TEXT_INDEX_MAX_INFLATED
+    assert clinic.docx_text(docx_bytes(" " * (64 * 1024 * 1024))) is None
+
+
+def test_indexer_resumes_past_its_watermark(clinic, monkeypatch):
+    indexer = clinic.AttachmentTextIndexer()
+    first = add_patient(clinic, "Alice", files=[("a.txt", b"amoxicillin allergy"), ("b.txt", b"penicillin")])
+    assert indexer.run_all() == 2
+    mark = int(clinic.repo.get_setting("text_index.watermark.main"))
+    assert mark == max(f.id for f in clinic.repo.list_attachments(first))
+
+    read = []
+    extract = clinic.extract_text
+    monkeypatch.setattr(clinic, "extract_text", lambda name, data: read.append(name) or extract(name, data))
+    second = add_patient(clinic, "Bob", phone="0200", files=[("c.txt", b"amoxicillin course")])
+    assert indexer.run_all() == 1
+    assert read == ["c.txt"]
+    assert int(clinic.repo.get_setting("text_index.watermark.main")) > mark
+    matches, _ = clinic.repo.search_attachments("amoxicillin")
+    assert {m.patient_id for m in matches} == {first, second}
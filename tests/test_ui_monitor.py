@@ -0,0 +1,48 @@
+import time
+
+import clinic_app
+
+
+class FakeRoot:
+    def __init__(self):
+        self.jobs = []
+
+    def after(self, ms, fn):
+        self.jobs.append(fn)
+        return len(self.jobs)
+
+    def after_cancel(self, job):
+        pass
+
+
+def test_stall_goes_to_the_trace_not_stdout(capsys):
+    monitor = clinic_app.UiLatencyMonitor(threshold_ms=50)
+    monitor.start(FakeRoot())
+    with monitor.track("PatientsView.refresh"):
+        monitor._expected = time.perf_counter() - 0.2
+        monitor._tick()
+    monitor.stop()
+    assert capsys.readouterr().out == ""
+    assert [s["handlers"] for s in monitor.stalls] == [["PatientsView.refresh"]]
+    assert any(e["name"] == "event-loop stall" for e in monitor.events)
+
+
+def test_stop_ends_the_sampler_thread():
+    monitor = clinic_app.UiLatencyMonitor(profile=True, sample_ms=5)
+    monitor.start(FakeRoot())
+    sampler = monitor._sampler
+    assert sampler.is_alive()
+    monitor.stop()
+    assert not sampler.is_alive()
+    monitor.start(FakeRoot())  # a re-login starts a fresh one
+    assert monitor._sampler.is_alive()
+    monitor.stop()
+
+
+def test_handler_decorator_records_a_trace_event():
+    @clinic_app.ui_handler
+    def handler():
+        return 7
+
+    assert handler() == 7
+    assert clinic_app.UI_MONITOR.events[-1]["name"].endswith("handler")